@@ -2,6 +2,9 @@ import os
 import sys
 import time
 import glob
+import shutil
+import tempfile
+import subprocess
 import settings
 
 import pysam
@@ -13,18 +16,24 @@ import rnaseqlib
 import rnaseqlib.utils as utils
 import rnaseqlib.rpkm
 import rnaseqlib.rpkm.rpkm_utils as rpkm_utils
+import rnaseqlib.rpkm.feature_counts as feature_counts
 import rnaseqlib.mapping
 import rnaseqlib.mapping.mapper_wrappers as mapper_wrappers
 import rnaseqlib.mapping.bedtools_utils as bedtools_utils
 import rnaseqlib.ribo
 import rnaseqlib.ribo.ribo_utils as ribo_utils
 import rnaseqlib.QualityControl as qc
+import rnaseqlib.step_graph as step_graph
+import rnaseqlib.perf_manifest as perf_manifest
 import rnaseqlib.RNABase as rna_base
 import rnaseqlib.clip
 import rnaseqlib.clip.clip_utils as clip_utils
 import rnaseqlib.fastq_utils as fastq_utils
 import rnaseqlib.bam
 import rnaseqlib.bam.bam_utils as bam_utils
+import rnaseqlib.bam.bam_postprocess as bam_postprocess
+import rnaseqlib.bam.bam_sort as bam_sort
+import rnaseqlib.bam.rmdups as rmdups_utils
 import rnaseqlib.motif
 import rnaseqlib.motif.homer_utils as homer_utils
 import rnaseqlib.motif.meme_utils as meme_utils
@@ -35,6 +44,12 @@ from rnaseqlib.paths import *
 
 import cluster_utils.cluster as cluster
 
+# Analysis stages that use all processors themselves (forking
+# counting processes or running a step graph of their own), and
+# so run alone rather than alongside other stages
+EXCLUSIVE_STAGES = ["output_rpkms",
+                    "output_events_mapping"]
+
 class Sample:
     """ 
     A sample to run on. For paired-end, represents a
@@ -67,6 +82,9 @@ class Sample:
         self.rmdups_bam_filename = None
         # Unique BAM after duplicate-subtraction filename
         self.rmdups_unique_bam_filename = None
+        # Read counts recorded while post-processing BAMs
+        self.read_counts = None
+        self.read_counts_filename = None
         # Sample's RPKM directory  
         self.rpkm_dir = None
         # Sample's events directory
@@ -190,6 +208,8 @@ class Pipeline:
         self.rpkm_dir = None
         # QC objects for each sample in pipeline
         self.qc_objects = {}
+        # Performance manifest of the sample being run on
+        self.perf_manifest = None
         # Load basic settings (to be processed later to get
         # full settings)
         self.load_basic_settings()
@@ -208,7 +228,8 @@ class Pipeline:
                               "mapping",
                               "qc",
                               "analysis",
-                              "logs"]
+                              "logs",
+                              "steps"]
         # Initialize output directories
         self.init_outdirs()
         self.load_cluster()
@@ -241,9 +262,11 @@ class Pipeline:
         self.rna_base = rna_base.RNABase(self.genome,
                                          None,
                                          from_dir=self.init_dir)
-        # Load genes information: tables only, without parsing
-        # into gene objects
-        self.rna_base.load_gene_tables(tables_only=True)
+        # Load genes information from the gene annotation snapshots
+        # (built here the first time, so that per-sample processes
+        # started afterwards find them). Gene tables themselves are
+        # only loaded when needed.
+        self.rna_base.load_gene_annotations()
         
 
     def init_qc(self):
@@ -321,6 +344,7 @@ class Pipeline:
           - mapping: mapped data files
           - qc: quality control output
           - analysis: analysis output
+          - steps: completion records of pipeline steps
         """
         self.logger.info("Initializing the pipeline output directories.")
         utils.make_dir(self.output_dir) 
@@ -444,7 +468,9 @@ class Pipeline:
                             self.output_dir,
                             self.logger,
                             cluster_queue=self.settings_info["mapping"]["cluster_queue"],
-                            cluster_memory=self.settings_info["mapping"]["cluster_memory"])
+                            cluster_memory=self.settings_info["mapping"]["cluster_memory"],
+                            local_max_cores=self.settings_info["mapping"]["local_max_cores"],
+                            local_max_memory=self.settings_info["mapping"]["local_max_memory"])
         
 
     def load_sequence_files(self):
@@ -545,8 +571,9 @@ class Pipeline:
             # poly As
             self.logger.info("Trimming polyAs..")
             trimmed_filename = \
-                ribo_utils.trim_polyA_ends(sample.rawdata.seq_filename,
-                                           self.pipeline_outdirs["rawdata"])
+                self.measure_step("trim_polyA_ends",
+                                  lambda: ribo_utils.trim_polyA_ends(sample.rawdata.seq_filename,
+                                                                     self.pipeline_outdirs["rawdata"]))
             # Adjust the trimmed file to be the "reads" sequence file for this
             # sample
             sample.rawdata.reads_filename = trimmed_filename
@@ -555,16 +582,18 @@ class Pipeline:
             clip_utils.check_clip_utils(self.logger)
             # Preprocess CLIP-Seq reads by trimming adaptors
             trimmed_filename = \
-                clip_utils.trim_clip_adaptors(sample.rawdata.seq_filename,
-                                              self.adaptors_filename,
-                                              self.pipeline_outdirs["rawdata"],
-                                              self.logger)
+                self.measure_step("trim_clip_adaptors",
+                                  lambda: clip_utils.trim_clip_adaptors(sample.rawdata.seq_filename,
+                                                                        self.adaptors_filename,
+                                                                        self.pipeline_outdirs["rawdata"],
+                                                                        self.logger))
             sample.rawdata.reads_filename = trimmed_filename
             # Create collapsed versions of sequence files
             sample.rawdata.collapsed_seq_filename = \
-                clip_utils.collapse_clip_reads(sample,
-                                               self.pipeline_outdirs["rawdata"],
-                                               self.logger)
+                self.measure_step("collapse_clip_reads",
+                                  lambda: clip_utils.collapse_clip_reads(sample,
+                                                                         self.pipeline_outdirs["rawdata"],
+                                                                         self.logger))
             self.logger.info("Collapsed reads filename: %s" \
                              %(sample.rawdata.collapsed_seq_filename))
             # Use this to map the reads
@@ -584,13 +613,71 @@ class Pipeline:
             if sample.label == label:
                 return sample
         return None
+
+
+    def get_step_graph(self):
+        """
+        Return an empty step graph whose completion records are
+        kept in the pipeline's steps directory.
+        """
+        return step_graph.StepGraph(self.pipeline_outdirs["steps"],
+                                    self.logger,
+                                    num_workers=self.settings_info["mapping"]["num_processors"],
+                                    manifest=self.perf_manifest)
+
+
+    def run_step(self, name, func,
+                 inputs=[],
+                 outputs=[],
+                 params={}):
+        """
+        Run a step unless its outputs are up to date with
+        its inputs and parameters. Returns True if it was run.
+        """
+        step = step_graph.Step(name, func,
+                               inputs=inputs,
+                               outputs=outputs,
+                               params=params)
+        return self.get_step_graph().run_step(step)
+
+
+    def measure_step(self, step_name, func, level="step"):
+        """
+        Call func, recording its timing and resource usage in
+        the performance manifest of the current sample (if any).
+        """
+        if self.perf_manifest is None:
+            return func()
+        return self.perf_manifest.measure(step_name, func, level=level)
+
+
+    def get_perf_manifest_filename(self, sample):
+        """
+        Return the filename of a sample's performance manifest.
+        """
+        return os.path.join(self.pipeline_outdirs["qc"],
+                            sample.label,
+                            "%s.perf.txt" %(sample.label))
+
+
+    def get_reads_filenames(self, sample):
+        """
+        Return the reads filenames to be mapped for a sample.
+        """
+        if sample.paired:
+            return [rawdata.reads_filename for rawdata in sample.rawdata]
+        return [sample.rawdata.reads_filename]
             
             
     def run_on_samples(self):
-        samples_job_ids = []
+        """
+        Submit a job for each sample, as a single job array
+        when running on a cluster. Returns the job IDs.
+        """
+        sample_cmds = []
+        task_labels = []
         for sample in self.samples:
             self.logger.info("Processing sample %s" %(sample))
-            job_name = "pipeline_run_%s" %(sample.label)
             sample_cmd = \
                 "%s --run-on-sample %s --settings %s --output-dir %s" \
                 %(PIPELINE_RUN_SCRIPT,
@@ -598,9 +685,14 @@ class Pipeline:
                   self.settings_filename,
                   self.output_dir)
             self.logger.info("Executing: %s" %(sample_cmd))
-            job_id = self.my_cluster.launch_job(sample_cmd, job_name)
-            self.logger.info("Job launched with ID %s" %(job_id))
-            samples_job_ids.append(job_id)
+            sample_cmds.append(sample_cmd)
+            task_labels.append([sample.label])
+        samples_job_ids = \
+            self.my_cluster.launch_job_array(sample_cmds, "pipeline_run",
+                                             task_labels=task_labels,
+                                             ppn=self.settings_info["mapping"]["num_processors"])
+        self.logger.info("Jobs launched with IDs %s" \
+                         %(", ".join(map(str, samples_job_ids))))
         return samples_job_ids
             
         
@@ -638,18 +730,34 @@ class Pipeline:
                 self.logger.info("Cannot find sample %s! Exiting.." \
                                  %(label))
                 sys.exit(1)
+            # Record timing and resource usage of each step
+            manifest_filename = self.get_perf_manifest_filename(sample)
+            utils.make_dir(os.path.dirname(manifest_filename))
+            self.perf_manifest = \
+                perf_manifest.PerfManifest(manifest_filename,
+                                           sample.label,
+                                           sample_type=sample.sample_type)
             # Pre-process the data if needed
             self.logger.info("Preprocessing reads")
-            sample = self.preprocess_reads(sample)
+            sample = self.measure_step("preprocess_reads",
+                                       lambda: self.preprocess_reads(sample),
+                                       level="stage")
             # Map the data
             self.logger.info("Mapping reads")
-            sample = self.map_reads(sample)
+            sample = self.measure_step("map_reads",
+                                       lambda: self.map_reads(sample),
+                                       level="stage")
             # Perform QC
             self.logger.info("Running QC")
-            sample = self.run_qc(sample)
+            sample = self.measure_step("run_qc",
+                                       lambda: self.run_qc(sample),
+                                       level="stage")
             # Run gene expression analysis
             self.logger.info("Running analysis")
-            sample = self.run_analysis(sample)
+            sample = self.measure_step("run_analysis",
+                                       lambda: self.run_analysis(sample),
+                                       level="stage")
+            self.logger.info("Performance manifest: %s" %(manifest_filename))
         except:
             self.logger.exception("Failed while running on sample %s" \
                                   %(label))
@@ -669,6 +777,14 @@ class Pipeline:
         job_name = "%s_%s" %(sample.label, mapper)
         self.logger.info("Mapping sample: %s" %(sample))
         self.logger.info("  - Mapper: %s" %(mapper))
+        # Create a directory for processed BAMs
+        sample.processed_bam_dir = \
+            os.path.join(self.pipeline_outdirs["mapping"],
+                         sample.label,
+                         "processed_bams")
+        utils.make_dir(sample.processed_bam_dir)
+        # Whether mapper output was post-processed as it streamed
+        streamed = False
         if mapper == "bowtie":
             bowtie_path = self.settings_info["mapping"]["bowtie_path"]
             index_filename = self.settings_info["mapping"]["bowtie_index"]
@@ -676,19 +792,39 @@ class Pipeline:
                 %(os.path.join(self.pipeline_outdirs["mapping"],
                                sample.label))
             bowtie_options = self.settings_info["mapping"]["bowtie_options"]
-            # Number of mismatches to use in mapping
-            # Optional bowtie arguments
-            mapping_cmd, bowtie_output_filename = \
-                  mapper_wrappers.get_bowtie_mapping_cmd(bowtie_path,
-                                                         sample.reads_filename,
-                                                         index_filename,
-                                                         output_filename,
-                                                         bowtie_options=bowtie_options)
-            # Record the bowtie output filename for this sample
-            sample.bowtie_filename = bowtie_output_filename
-            sample.bam_filename = sample.bowtie_filename
-            self.my_cluster.launch_and_wait(mapping_cmd, job_name,
-                                            unless_exists=output_filename)
+            stream_mapping = self.settings_info["mapping"]["stream_mapping"]
+            if stream_mapping and (not bam_sort.can_sort_stream()):
+                self.logger.warning("Streaming mapping needs samtools 1.0+ " \
+                                    "(found: %s), mapping without it." \
+                                    %(bam_sort.get_samtools_version(),))
+                stream_mapping = False
+            if stream_mapping:
+                sample = self.stream_bowtie_mapping(sample,
+                                                    bowtie_path,
+                                                    index_filename,
+                                                    bowtie_options)
+                streamed = True
+            else:
+                # Number of mismatches to use in mapping
+                # Optional bowtie arguments
+                # Map to a partial file that is moved into place
+                # only if mapping succeeds
+                mapping_cmd, bowtie_output_filename = \
+                      mapper_wrappers.get_bowtie_mapping_cmd(bowtie_path,
+                                                             sample.rawdata.reads_filename,
+                                                             index_filename,
+                                                             output_filename,
+                                                             bowtie_options=bowtie_options,
+                                                             write_filename=step_graph.get_partial_filename("%s.bam" %(output_filename)))
+                # Record the bowtie output filename for this sample
+                sample.bowtie_filename = bowtie_output_filename
+                sample.bam_filename = sample.bowtie_filename
+                self.run_step("%s.map_reads" %(sample.label),
+                              lambda: self.my_cluster.launch_and_wait(mapping_cmd,
+                                                                      job_name),
+                              inputs=self.get_reads_filenames(sample),
+                              outputs=[bowtie_output_filename],
+                              params={"mapping_cmd": mapping_cmd})
         elif mapper == "tophat":
             tophat_path = self.settings_info["mapping"]["tophat_path"]
             sample_mapping_outdir = \
@@ -702,9 +838,12 @@ class Pipeline:
                                                        sample_mapping_outdir,
                                                        self.settings_info)
             self.logger.info("Executing: %s" %(tophat_cmd))
-            # Check that Tophat file does not exist
-            self.my_cluster.launch_and_wait(tophat_cmd, job_name,
-                                            unless_exists=tophat_outfilename)
+            self.run_step("%s.map_reads" %(sample.label),
+                          lambda: self.my_cluster.launch_and_wait(tophat_cmd,
+                                                                  job_name),
+                          inputs=self.get_reads_filenames(sample),
+                          outputs=[tophat_outfilename],
+                          params={"mapping_cmd": tophat_cmd})
             sample.bam_filename = tophat_outfilename
         else:
             self.logger.info("Error: unsupported mapper %s" %(mapper))
@@ -712,27 +851,9 @@ class Pipeline:
         ##
         ## Post processing of BAM reads
         ##
-        # Index the main BAM file
-        self.index_bam(sample.bam_filename)
-        # Create a directory for processed BAMs
-        sample.processed_bam_dir = \
-            os.path.join(self.pipeline_outdirs["mapping"],
-                         sample.label,
-                         "processed_bams")
-        utils.make_dir(sample.processed_bam_dir)
-        # Get the uniquely mapping reads
-        sample.unique_bam_filename = self.get_unique_reads(sample)
-        # Get the ribo-subtracted mapping reads
-        sample.ribosub_bam_filename = self.get_ribosub_bam_reads(sample)
-        # Sort and index the ribo-subtracted mapped reads BAM
-        sample.bam_filename = \
-            self.sort_and_index_bam(sample.bam_filename)
-        # Sort and index the unique BAM reads
-        sample.unique_bam_filename = \
-            self.sort_and_index_bam(sample.unique_bam_filename)
-        # Sort and index the ribosubtracted BAM reads
-        sample.ribosub_bam_filename = \
-            self.sort_and_index_bam(sample.ribosub_bam_filename)
+        if not streamed:
+            # Get the unique and ribo-subtracted mapping reads
+            sample = self.postprocess_bam(sample)
         ##
         ## Remove duplicates optionally for CLIP
         ##
@@ -740,33 +861,129 @@ class Pipeline:
         return sample
 
 
-    def rmdups_bam(self, bam_filename, output_dir):
+    def stream_bowtie_mapping(self, sample, bowtie_path,
+                              index_filename,
+                              bowtie_options):
+        """
+        Map reads with Bowtie and post-process its SAM output as
+        it is produced. The main, unique and rRNA-subtracted BAMs
+        are written sorted (through samtools sort) and then indexed,
+        so no intermediate BAMs are written, unless debugging is
+        on, in which case the unsorted mapper BAM is kept too.
+
+        The mapper runs locally, within the sample's job.
         """
-        Remove duplicates using samtools rmdups
-        from given BAM filename.  Assumes reads are
-        single-end.
+        self.logger.info("Mapping %s with streaming post-processing" \
+                         %(sample.label))
+        stream_cmd = \
+            mapper_wrappers.get_bowtie_stream_cmd(bowtie_path,
+                                                  sample.rawdata.reads_filename,
+                                                  index_filename,
+                                                  bowtie_options=bowtie_options)
+        debug_bam_filename = None
+        if self.settings_info["settings"]["debug"]:
+            debug_bam_filename = \
+                os.path.join(self.pipeline_outdirs["mapping"],
+                             "%s.bam" %(sample.label))
+        # Pipe through which the mapper's SAM output is read
+        pipe_dir = tempfile.mkdtemp(prefix="mapping_pipe.")
+        pipe_filename = os.path.join(pipe_dir, "%s.sam" %(sample.label))
+        # Main, unique and ribosub BAMs are sorted at the same time
+        sort_threads, sort_memory = self.get_sort_params(num_sorts=3)
+        postprocessor = \
+            bam_postprocess.BamPostprocessor(pipe_filename,
+                                             sample.processed_bam_dir,
+                                             self.logger,
+                                             read_count_mode=self.settings_info["settings"]["read_count_mode"],
+                                             read_count_memory=self.settings_info["settings"]["read_count_memory"],
+                                             sorted_input=False,
+                                             output_basename=sample.label,
+                                             sort_outputs=True,
+                                             sort_threads=sort_threads,
+                                             sort_memory=sort_memory,
+                                             output_main=True,
+                                             debug_bam_filename=debug_bam_filename)
+        output_filenames = postprocessor.output_filenames
+        def map_and_postprocess():
+            os.mkfifo(pipe_filename)
+            mapper_proc = None
+            try:
+                self.logger.info("Executing: %s" %(stream_cmd))
+                # Run the mapper in its own process group, so that
+                # it can be stopped if post-processing fails
+                mapper_proc = \
+                    subprocess.Popen("set -o pipefail; %s > %s" \
+                                     %(stream_cmd, pipe_filename),
+                                     shell=True,
+                                     executable="/bin/bash",
+                                     preexec_fn=os.setsid)
+                postprocessor.run()
+                if mapper_proc.wait() != 0:
+                    raise Exception, "Mapping failed: %s" %(stream_cmd)
+            finally:
+                if mapper_proc is not None:
+                    bam_sort.kill_process_group(mapper_proc)
+                shutil.rmtree(pipe_dir, ignore_errors=True)
+        step_outputs = output_filenames.values() + \
+                       [postprocessor.counts_filename]
+        if postprocessor.write_index:
+            step_outputs.extend(["%s.bai" %(output_filename) \
+                                 for output_filename in output_filenames.values()])
+        if debug_bam_filename is not None:
+            step_outputs.append(debug_bam_filename)
+        try:
+            self.run_step("%s.map_reads" %(sample.label),
+                          map_and_postprocess,
+                          inputs=self.get_reads_filenames(sample),
+                          outputs=step_outputs,
+                          params={"mapping_cmd": stream_cmd,
+                                  "chr_ribo": postprocessor.chr_ribo,
+                                  "read_count_mode": postprocessor.read_count_mode})
+        finally:
+            shutil.rmtree(pipe_dir, ignore_errors=True)
+        sample.bowtie_filename = output_filenames["main"]
+        sample.bam_filename = output_filenames["main"]
+        sample.unique_bam_filename = output_filenames["unique"]
+        sample.ribosub_bam_filename = output_filenames["ribosub"]
+        sample.read_counts_filename = postprocessor.counts_filename
+        sample.read_counts = \
+            bam_postprocess.load_read_counts(sample.read_counts_filename)
+        if not postprocessor.write_index:
+            for output_filename in output_filenames.values():
+                self.index_bam(output_filename)
+        return sample
+
+
+    def rmdups_bam(self, bam_filename, output_dir):
         """
-        input_basename = os.path.basename(bam_filename)
-        output_basename = input_basename.replace(".bam", "")
-        self.logger.info("Removing .sorted. from %s" %(input_basename))
-        output_basename = output_basename.replace(".sorted.", "")
+        Remove duplicates from given coordinate-sorted BAM
+        filename. Assumes reads are single-end. The
+        duplicate-removed BAM is sorted and its duplicate
+        counts are recorded next to it.
+        """
+        output_basename = os.path.basename(bam_filename)
+        if output_basename.endswith(".bam"):
+            output_basename = output_basename[0:-4]
+        if output_basename.endswith(".sorted"):
+            output_basename = output_basename[0:-7]
+        rmdups_bam_filename = \
+            os.path.join(output_dir,
+                         "%s.rmdups.sorted.bam" %(output_basename))
+        dup_counts_filename = \
+            rmdups_utils.get_dup_counts_filename(rmdups_bam_filename)
+        umi_regex = self.settings_info["mapping"]["umi_regex"]
         self.logger.info("Removing duplicates from BAM..")
-        rmdups_bam_filename = os.path.join(output_dir,
-                                           "%s.rmdups.bam" %(output_basename))
-        if os.path.isfile(rmdups_bam_filename):
-            self.logger.info("%s exists, skipping duplication removal." \
-                             %(rmdups_bam_filename))
-            return rmdups_bam_filename
         self.logger.info("  Input: %s" %(bam_filename))
         self.logger.info("  Output: %s" %(rmdups_bam_filename))
-        rmdup_cmd = "samtools rmdup -s %s %s" %(bam_filename,
-                                                rmdups_bam_filename)
-        self.logger.info("  Executing: %s" %(rmdup_cmd))
-        t1 = time.time()
-        os.system(rmdup_cmd)
-        t2 = time.time()
-        self.logger.info("Duplicates removal completed in %.2f mins" \
-                         %((t2 - t1)/60.))
+        self.run_step("rmdups_bam.%s" %(output_basename),
+                      lambda: rmdups_utils.rmdups_bam(bam_filename,
+                                                      rmdups_bam_filename,
+                                                      self.logger,
+                                                      umi_regex=umi_regex,
+                                                      counts_filename=dup_counts_filename),
+                      inputs=[bam_filename],
+                      outputs=[rmdups_bam_filename, dup_counts_filename],
+                      params={"umi_regex": umi_regex})
         return rmdups_bam_filename
 
 
@@ -778,6 +995,10 @@ class Pipeline:
             return
         self.logger.info("Postprocessing CLIP-Seq BAMs for %s" \
                          %(sample.label))
+        if sample.rmdups_bam_filename is not None:
+            self.logger.info("  Duplicates already removed during BAM " \
+                             "post-processing.")
+            return
         self.logger.info("  Removing duplicates..")
         # Get the non-duplicate version of BAM file
         sample.rmdups_bam_filename = \
@@ -787,13 +1008,9 @@ class Pipeline:
         sample.rmdups_unique_bam_filename = \
             self.rmdups_bam(sample.unique_bam_filename,
                             sample.processed_bam_dir)
-        self.logger.info("  Sorting and indexing duplicate-removed BAMs..")
-        # Sort and index the non-duplicate BAM
-        sample.rmdups_bam_filename = \
-            self.sort_and_index_bam(sample.rmdups_bam_filename)
-        # Sort and index the non-duplicate unique BAM
-        sample.rmdups_unique_bam_filename = \
-            self.sort_and_index_bam(sample.rmdups_unique_bam_filename)
+        # Duplicate-removed BAMs are already sorted; only index them
+        self.index_bam(sample.rmdups_bam_filename)
+        self.index_bam(sample.rmdups_unique_bam_filename)
         self.logger.info("Postprocessing of CLIP-Seq BAMs completed.")
         
         
@@ -801,103 +1018,107 @@ class Pipeline:
         """
         Index a BAM filename if it's not already indexed.
         """
-        index_cmd = "samtools index %s" %(bam_filename)            
         index_filename = "%s.bai" %(bam_filename)
+        index_cmd = ["samtools", "index", bam_filename,
+                     step_graph.get_partial_filename(index_filename)]
         self.logger.info("Indexing %s" %(bam_filename))
-        if not os.path.isfile(index_filename):
-            os.system(index_cmd)
+        self.run_step("index_bam.%s" %(os.path.basename(bam_filename)),
+                      lambda: subprocess.check_call(index_cmd),
+                      inputs=[bam_filename],
+                      outputs=[index_filename])
 
 
-    def sort_and_index_bam(self, bam_filename):
+    def get_sort_params(self, num_sorts=1):
         """
-        Sort and index the BAM for the sample.
+        Return the number of threads and memory per thread for
+        each of 'num_sorts' BAM sorts run at the same time, so that
+        together they use the sample's processors.
 
-        Return the filename of the sorted, index filename.
+        Memory per thread is the 'sort_memory' setting if given,
+        or otherwise a share of 'cluster_memory' (if given).
         """
-        self.logger.info("Sort and indexing BAM: %s" \
-                         %(bam_filename))
+        num_processors = self.settings_info["mapping"]["num_processors"]
+        threads = max(1, num_processors / num_sorts)
+        memory_per_thread = self.settings_info["mapping"]["sort_memory"]
+        cluster_memory = self.my_cluster.get_job_memory()
+        if (memory_per_thread is None) and (cluster_memory is not None):
+            # Leave a quarter of the job's memory for other uses
+            memory_per_thread = \
+                "%dM" %(max(100, (3 * cluster_memory / 4) / \
+                            (threads * num_sorts)))
+        return threads, memory_per_thread
+
+
+    def get_sorted_bam_filename(self, bam_filename):
         bam_basename = os.path.basename(bam_filename).split(".bam")[0]
-        sorted_bam_filename = os.path.join(os.path.dirname(bam_filename),
-                                           "%s.sorted" %(bam_basename))
-        self.logger.info("Sorting %s as %s" %(bam_filename,
-                                              sorted_bam_filename))
-        sort_cmd = "samtools sort %s %s" %(bam_filename,
-                                           sorted_bam_filename)
-        job_name = "sorted_bam_%s" %(bam_basename)
-        expected_bam_filename = "%s.bam" %(sorted_bam_filename)
-        if not os.path.isfile(expected_bam_filename):
-            os.system(sort_cmd)
-        # Index the sorted BAM
-        self.index_bam(expected_bam_filename)
-        return expected_bam_filename
+        return os.path.join(os.path.dirname(bam_filename),
+                            "%s.sorted.bam" %(bam_basename))
 
 
-    def get_ribosub_bam_reads(self, sample, chr_ribo="chrRibo"):
-        """
-        Subtract the rRNA-mapping reads away from the BAM file
-        and create a new BAM file.
+    def sort_and_index_bam(self, bam_filename,
+                           num_sorts=1):
         """
-        self.logger.info("Getting rRNA-subtracted BAM file for %s" \
-                         %(sample.label))
-        mapped_reads = pysam.Samfile(sample.bam_filename, "rb")
-        if not sample.bam_filename.endswith(".bam"):
-            self.logger.critical("BAM %s file does not end in .bam" \
-                                 %(sample.bam_filename))
-        bam_basename = os.path.basename(sample.bam_filename)
-        ribosub_bam_filename = \
-            os.path.join(sample.processed_bam_dir,
-                         "%s.ribosub.bam" %(bam_basename[0:-4]))
-        self.logger.info("Getting rRNA-subtracted reads for %s" \
-                         %(sample.label))
-        self.logger.info("  - Output file: %s" %(ribosub_bam_filename))
-        if not os.path.isfile(ribosub_bam_filename):
-            # Get the ribosomal rRNA mapping reads
-            ribo_read_ids = {}
-            ribo_reads = []
-            try:
-                ribo_reads = mapped_reads.fetch(reference=chr_ribo,
-                                                start=None,
-                                                end=None,
-                                                multiple_iterators=True)
-            except:
-                self.logger.warning("Could not fetch %s from %s" \
-                                    %(chr_ribo,
-                                      sample.bam_filename))
-            for ribo_read in ribo_reads:
-                ribo_read_ids[ribo_read.qname] = True
-            num_ribo_reads = len(ribo_read_ids)
-            if num_ribo_reads == 0:
-                self.logger.warning("Could not find any rRNA mapping reads " \
-                                    "in %s" %(sample.bam_filename))
-            else:
-                self.logger.info("Subtracting %d rRNA reads from %s" \
-                                 %(num_ribo_reads,
-                                   sample.bam_filename))
-                self.logger.info("  - Subtracted BAM: %s" \
-                                 %(ribosub_bam_filename))
-            ribosub_bam = pysam.Samfile(ribosub_bam_filename, "wb",
-                                        # Use original file's headers
-                                        template=mapped_reads)
-            for read in mapped_reads:
-                # If the read has any mapping to rRNA, then
-                # skip it
-                if read.qname in ribo_read_ids:
-                    continue
-                ribosub_bam.write(read)
-            ribosub_bam.close()
-        else:
-            self.logger.info("Found %s. Skipping.." \
-                             %(ribosub_bam_filename))
-        mapped_reads.close()
-        return ribosub_bam_filename
-        
+        Sort and index the BAM for the sample. The index is
+        written by the sorter if it can.
 
-    def get_unique_reads(self, sample):
-        """
-        Get only the uniquely mapping reads from the reads BAM
-        file and put them in a new file.
+        - num_sorts: number of sorts run at the same time (used
+          to divide processors between them)
+
+        Return the filename of the sorted, index filename.
         """
-        self.logger.info("Getting unique reads for %s" %(sample.label))
+        self.logger.info("Sort and indexing BAM: %s" \
+                         %(bam_filename))
+        bam_basename = os.path.basename(bam_filename).split(".bam")[0]
+        sorted_bam_filename = self.get_sorted_bam_filename(bam_filename)
+        self.logger.info("Sorting %s as %s" %(bam_filename,
+                                              sorted_bam_filename))
+        threads, memory_per_thread = self.get_sort_params(num_sorts=num_sorts)
+        write_index = bam_sort.can_write_index()
+        step_outputs = [sorted_bam_filename]
+        if write_index:
+            step_outputs.append("%s.bai" %(sorted_bam_filename))
+        self.run_step("sort_bam.%s" %(bam_basename),
+                      lambda: bam_sort.sort_bam(bam_filename,
+                                                sorted_bam_filename,
+                                                threads=threads,
+                                                memory_per_thread=memory_per_thread,
+                                                write_index=write_index),
+                      inputs=[bam_filename],
+                      outputs=step_outputs,
+                      params={"write_index": write_index})
+        if not write_index:
+            # Index the sorted BAM
+            self.index_bam(sorted_bam_filename)
+        return sorted_bam_filename
+
+
+    def sort_and_index_bams(self, sample, bam_filenames):
+        """
+        Sort and index independent BAMs at the same time. Returns
+        the sorted BAM filenames.
+        """
+        sort_graph = self.get_step_graph()
+        for bam_filename in bam_filenames:
+            sort_graph.add_step(
+                step_graph.Step("%s.sort_and_index.%s" \
+                                %(sample.label,
+                                  os.path.basename(bam_filename)),
+                                lambda bam_filename=bam_filename: \
+                                self.sort_and_index_bam(bam_filename,
+                                                        num_sorts=len(bam_filenames))))
+        sort_graph.run()
+        return [self.get_sorted_bam_filename(bam_filename) \
+                for bam_filename in bam_filenames]
+
+
+    def postprocess_bam(self, sample):
+        """
+        Create the unique and rRNA-subtracted BAM files (and
+        the duplicate-removed BAM files for CLIP-Seq) from the
+        mapped reads in a single pass. The read counts needed
+        for QC are recorded along the way.
+        """
+        self.logger.info("Post-processing BAM for %s" %(sample.label))
         if not os.path.isfile(sample.bam_filename):
             bam_error = "Error: Cannot find BAM file %s\n" \
                         "Did your mapping step work? Check the Tophat/Bowtie " \
@@ -905,39 +1126,52 @@ class Pipeline:
                         %(sample.bam_filename)
             self.logger.critical(bam_error)
             sys.exit(1)
-        mapped_reads = pysam.Samfile(sample.bam_filename, "rb")
-        if not sample.bam_filename.endswith(".bam"):
-            self.logger.critical("BAM %s file does not end in .bam" \
-                                 %(sample.bam_filename))
-        bam_basename = os.path.basename(sample.bam_filename)
-        unique_bam_filename = \
-            os.path.join(sample.processed_bam_dir,
-                         "%s.unique.bam" %(bam_basename[0:-4]))
-        self.logger.info("Getting unique reads for %s" \
-                         %(sample.label))
-        self.logger.info("  - Output file: %s" \
-                         %(unique_bam_filename))
-        if not os.path.isfile(unique_bam_filename):
-            # Get unique reads if file for them does not already
-            # exist
-            unique_reads = pysam.Samfile(unique_bam_filename, "wb",
-                                         # Use original file's headers
-                                         template=mapped_reads)
-            num_unique = 0
-            for read in mapped_reads:
-                # Keep only reads with 'NH' tag equal to 1
-                if ("NH", 1) in read.tags:
-                    unique_reads.write(read)
-                    num_unique += 1
-            if num_unique == 0:
-                self.logger.warning("No unique reads found in %s" \
-                                    %(sample.bam_filename))
-            unique_reads.close()
+        rmdups = (sample.sample_type == "clipseq")
+        postprocessor = \
+            bam_postprocess.BamPostprocessor(sample.bam_filename,
+                                             sample.processed_bam_dir,
+                                             self.logger,
+                                             rmdups=rmdups,
+                                             read_count_mode=self.settings_info["settings"]["read_count_mode"],
+                                             read_count_memory=self.settings_info["settings"]["read_count_memory"],
+                                             umi_regex=self.settings_info["mapping"]["umi_regex"])
+        if postprocessor.sorted_input:
+            # Index the main BAM file, needed to fetch rRNA reads
+            self.index_bam(sample.bam_filename)
+        output_filenames = postprocessor.output_filenames
+        self.run_step("%s.postprocess_bam" %(sample.label),
+                      postprocessor.run,
+                      inputs=[sample.bam_filename],
+                      outputs=output_filenames.values() + \
+                              postprocessor.dup_counts_filenames.values() + \
+                              [postprocessor.counts_filename],
+                      params={"rmdups": rmdups,
+                              "umi_regex": postprocessor.umi_regex,
+                              "chr_ribo": postprocessor.chr_ribo,
+                              "read_count_mode": postprocessor.read_count_mode})
+        sample.read_counts_filename = postprocessor.counts_filename
+        sample.read_counts = \
+            bam_postprocess.load_read_counts(sample.read_counts_filename)
+        if postprocessor.sorted_input:
+            # Outputs are already sorted; only index them
+            for output_filename in output_filenames.values():
+                self.index_bam(output_filename)
+            sample.unique_bam_filename = output_filenames["unique"]
+            sample.ribosub_bam_filename = output_filenames["ribosub"]
+            if "rmdups" in output_filenames:
+                sample.rmdups_bam_filename = output_filenames["rmdups"]
+                sample.rmdups_unique_bam_filename = \
+                    output_filenames["rmdups_unique"]
         else:
-            self.logger.info("Found %s. Skipping.." \
-                             %(unique_bam_filename))
-        mapped_reads.close()
-        return unique_bam_filename
+            # Sort and index the main BAM file, the unique BAM reads
+            # and the ribosubtracted BAM reads
+            sample.bam_filename, sample.unique_bam_filename, \
+                sample.ribosub_bam_filename = \
+                self.sort_and_index_bams(sample,
+                                         [sample.bam_filename,
+                                          output_filenames["unique"],
+                                          output_filenames["ribosub"]])
+        return sample
     
 
     def run_qc(self, sample):
@@ -976,6 +1210,37 @@ class Pipeline:
                                           "qc_stats.txt")
         self.logger.info("Outputting QC to: %s" %(qc_output_filename))
         qc_stats.to_csv(qc_output_filename)
+        self.compile_perf_output()
+
+
+    def compile_perf_output(self):
+        """
+        Merge the performance manifests of all samples into a
+        table of all steps and a per-sample summary of stages.
+        """
+        manifest_filenames = [self.get_perf_manifest_filename(sample) \
+                              for sample in self.samples]
+        perf_df = perf_manifest.load_manifests(manifest_filenames)
+        if perf_df is None:
+            self.logger.info("No performance manifests to compile.")
+            return
+        perf_output_filename = os.path.join(self.pipeline_outdirs["qc"],
+                                            "perf_stats.txt")
+        self.logger.info("Outputting performance stats to: %s" \
+                         %(perf_output_filename))
+        perf_df.to_csv(perf_output_filename,
+                       sep="\t",
+                       na_rep=self.na_val,
+                       float_format="%.3f",
+                       index=False)
+        summary_output_filename = \
+            os.path.join(self.pipeline_outdirs["qc"], "perf_summary.txt")
+        summary_df = perf_manifest.summarize_manifests(perf_df)
+        summary_df.to_csv(summary_output_filename,
+                          sep="\t",
+                          na_rep=self.na_val,
+                          float_format="%.3f",
+                          index=False)
 
 
     def compile_analysis_output(self):
@@ -990,26 +1255,54 @@ class Pipeline:
     def compile_rpkms_output(self):
         """
         Compile and output RPKMs for all samples.
+
+        Tables are built from the count store of each table when
+        it has all samples, and otherwise from the samples' RPKM
+        files. Tables built from the count store also get RPKMs
+        normalized across samples ('norm_rpkm_<label>' columns)
+        if an 'rpkm_norm_method' is set.
         """
-        # Load RPKMs for all samples
-        self.load_rpkms()
+        sample_labels = [sample.label for sample in self.samples]
+        norm_method = self.settings_info["settings"]["rpkm_norm_method"]
+        stored_rpkm_tables = {}
+        for table_name in self.rna_base.rpkm_table_names:
+            table_count_store = rpkm_utils.get_count_store(self.rpkm_dir,
+                                                           table_name)
+            if all([table_count_store.has_sample(sample_label) \
+                    for sample_label in sample_labels]):
+                stored_rpkm_tables[table_name] = \
+                    table_count_store.get_rpkm_table(sample_labels)
+                if norm_method is not None:
+                    # Normalize to the library sizes the RPKMs used
+                    rpkm_utils.add_normalized_rpkms(stored_rpkm_tables[table_name],
+                                                    sample_labels,
+                                                    table_count_store.get_num_mapped(sample_labels),
+                                                    method=norm_method)
+        if len(stored_rpkm_tables) < len(self.rna_base.tables_to_const_exons):
+            # Load RPKMs for all samples
+            self.load_rpkms()
+        self.rpkm_tables.update(stored_rpkm_tables)
         # Output RPKM tables
         # Order in which table columns should be serialized:
-        # Gene ID first, followed by gene symbol, the counts for each sample,
-        # followed by the exons used in the calculation and the
-        # gene description
-        fieldnames = ["gene_id", "gene_symbol"]
-        fieldnames.extend(["rpkm_%s" %(sample.label) \
-                           for sample in self.samples])
-        fieldnames.extend(["counts_%s" %(sample.label) \
-                           for sample in self.samples])
-        fieldnames.extend(["gene_desc", "exons"])
+        # Gene ID first, followed by gene symbol, the RPKMs (and
+        # normalized RPKMs, if any), TPMs (if all samples have them)
+        # and counts for each sample, followed by the gene
+        # description and the exons used in the calculation
         for table_name, rpkm_table in self.rpkm_tables.iteritems():
             if rpkm_table is None: continue
+            fieldnames = ["gene_id", "gene_symbol"]
+            for column_prefix in ["rpkm", "norm_rpkm", "tpm", "counts"]:
+                sample_fieldnames = ["%s_%s" %(column_prefix, sample.label) \
+                                     for sample in self.samples]
+                if (column_prefix in ["norm_rpkm", "tpm"]) and \
+                   (not set(sample_fieldnames).issubset(rpkm_table.columns)):
+                    continue
+                fieldnames.extend(sample_fieldnames)
+            fieldnames.extend(["gene_desc", "exons"])
             rpkm_table_filename = os.path.join(self.rpkm_dir,
                                                "%s.rpkm.txt" %(table_name))
             rpkm_table.to_csv(rpkm_table_filename,
-                              cols=fieldnames,
+                              columns=fieldnames,
                               na_rep=self.na_val,
                               sep="\t",
                               index=False)
@@ -1022,11 +1315,39 @@ class Pipeline:
         self.logger.info("Outputting RPKMs for sample: %s" \
                          %(sample.label))
         sample_rpkm_outdir = os.path.join(self.rpkm_dir, sample.label)
-        rpkm_tables = rpkm_utils.output_rpkm(sample,
-                                             sample_rpkm_outdir,
-                                             self.settings_info,
-                                             self.rna_base,
-                                             self.logger)
+        table_names = sorted(self.rna_base.tables_to_const_exons.keys())
+        const_exons_gffs = \
+            [self.rna_base.tables_to_const_exons[table_name].gff_filename \
+             for table_name in table_names]
+        rpkm_filenames = ["%s.rpkm" %(os.path.join(sample_rpkm_outdir,
+                                                   table_name)) \
+                          for table_name in table_names]
+        # The sample's column in the count store of each table
+        count_filenames = \
+            [rpkm_utils.get_count_store(self.rpkm_dir,
+                                        table_name).get_sample_filename(sample.label) \
+             for table_name in table_names]
+        # The sample's exon and junction counts of each gene table
+        for gene_table_name in rpkm_utils.get_feature_gene_tables(self.rna_base):
+            gene_table_store = rpkm_utils.get_count_store(self.rpkm_dir,
+                                                          gene_table_name)
+            count_filenames.extend(
+                [gene_table_store.get_sample_features_filename(sample.label,
+                                                               kind) \
+                 for kind in feature_counts.FEATURE_KINDS])
+        self.run_step("%s.output_rpkms" %(sample.label),
+                      lambda: rpkm_utils.output_rpkm(sample,
+                                                     sample_rpkm_outdir,
+                                                     self.settings_info,
+                                                     self.rna_base,
+                                                     self.logger,
+                                                     count_store_dir=self.rpkm_dir),
+                      inputs=[sample.ribosub_bam_filename] + const_exons_gffs,
+                      outputs=rpkm_filenames + count_filenames,
+                      params={"readlen": self.settings_info["mapping"]["readlen"],
+                              "paired": self.settings_info["mapping"]["paired"],
+                              "stranded": self.settings_info["mapping"]["stranded"],
+                              "count_tile_size": self.settings_info["settings"]["count_tile_size"]})
         return sample
 
     
@@ -1053,32 +1374,42 @@ class Pipeline:
             utils.get_gff_filenames_in_dir(self.gff_events_dir)
         gff_labels = [os.path.basename(utils.trim_gff_ext(f)) \
                       for f in gff_filenames]
-        # Run tagBam against all events, outputting a BAM for each
+        # Run tagBam and coverageBed against all events, outputting
+        # a BAM and a BED for each. These are independent steps and
+        # are run in parallel.
+        events_graph = self.get_step_graph()
         for gff_fname, gff_label in zip(gff_filenames, gff_labels):
             bam_events_fname = \
                 os.path.join(sample_events_bam_outdir,
                              "%s.bam" %(gff_label))
-            if os.path.isfile(bam_events_fname):
-                self.logger.info("Found %s, skipping.." %(bam_events_fname))
-            else:
-                # Map BAM reads to events GFF
-                bedtools_utils.multi_tagBam(sample.unique_bam_filename,
-                                            [gff_fname],
-                                            [gff_label],
-                                            bam_events_fname,
-                                            self.logger)
+            # Map BAM reads to events GFF
+            events_graph.add_step(
+                step_graph.Step("%s.tagBam.%s" %(sample.label, gff_label),
+                                lambda gff_fname=gff_fname,
+                                       gff_label=gff_label,
+                                       bam_events_fname=bam_events_fname: \
+                                bedtools_utils.multi_tagBam(sample.unique_bam_filename,
+                                                            [gff_fname],
+                                                            [gff_label],
+                                                            bam_events_fname,
+                                                            self.logger),
+                                inputs=[sample.unique_bam_filename, gff_fname],
+                                outputs=[bam_events_fname]))
             # Run coverageBed against all events
             coverage_events_fname = \
                 os.path.join(sample_events_bed_outdir,
                              "%s.bed" %(gff_label))
-            if os.path.isfile(coverage_events_fname):
-                self.logger.info("Found %s, skipping.." \
-                                 %(coverage_events_fname))
-            else:
-                bedtools_utils.coverageBed(sample.unique_bam_filename,
-                                           gff_fname,
-                                           coverage_events_fname,
-                                           self.logger)
+            events_graph.add_step(
+                step_graph.Step("%s.coverageBed.%s" %(sample.label, gff_label),
+                                lambda gff_fname=gff_fname,
+                                       coverage_events_fname=coverage_events_fname: \
+                                bedtools_utils.coverageBed(sample.unique_bam_filename,
+                                                           gff_fname,
+                                                           coverage_events_fname,
+                                                           self.logger),
+                                inputs=[sample.unique_bam_filename, gff_fname],
+                                outputs=[coverage_events_fname]))
+        events_graph.run()
         self.logger.info("Events mapping completed.")
 
 
@@ -1102,12 +1433,14 @@ class Pipeline:
             bed_fname = \
                 os.path.join(sample_bed_dir, "%s.bed" %(bam_basename))
             sample.reads_bed_fnames[bam_label] = bed_fname
-            if os.path.isfile(bed_fname):
-                self.logger.info("Found %s, skipping.." %(bed_fname))
-                continue
-            bam_utils.bam_to_bed(bam_fname, bed_fname,
-                                 extend_read_to_len=extend_read_to_len,
-                                 skip_junctions=skip_junctions)
+            self.run_step("%s.bam_to_bed.%s" %(sample.label, bam_label),
+                          lambda: bam_utils.bam_to_bed(bam_fname, bed_fname,
+                                                       extend_read_to_len=extend_read_to_len,
+                                                       skip_junctions=skip_junctions),
+                          inputs=[bam_fname],
+                          outputs=[bed_fname],
+                          params={"extend_read_to_len": extend_read_to_len,
+                                  "skip_junctions": skip_junctions})
         self.logger.info("Done outputting reads as BED.")
 
 
@@ -1155,12 +1488,16 @@ class Pipeline:
                                      "since GFF %s not found." \
                                      %(self.genes_gff_fname))
                 sys.exit(1)
-            clusters_fname = \
-                clip_utils.output_clip_clusters(self.logger,
-                                                bed_fname_to_use,
-                                                sample.clusters_fnames[bam_label],
-                                                self.genes_gff_fname,
-                                                cluster_dist=cluster_dist)
+            clusters_fname = sample.clusters_fnames[bam_label]
+            self.run_step("%s.clusters.%s" %(sample.label, bam_label),
+                          lambda: clip_utils.output_clip_clusters(self.logger,
+                                                                  bed_fname_to_use,
+                                                                  clusters_fname,
+                                                                  self.genes_gff_fname,
+                                                                  cluster_dist=cluster_dist),
+                          inputs=[bed_fname_to_use, self.genes_gff_fname],
+                          outputs=[clusters_fname],
+                          params={"cluster_dist": cluster_dist})
             # Filter the clusters
             sample.filtered_clusters_fnames[bam_label] = \
                 clip_utils.filter_clusters(self.logger,
@@ -1223,14 +1560,15 @@ class Pipeline:
             os.path.join(sample_seqs_dir, "%s.fa" %(bam_basename))
         sample.bam_seqs_fname = bam_seqs_fname
         self.logger.info("Outputting BAM FASTA sequences..")
-        if not os.path.isfile(bam_seqs_fname):
-            self.logger.info("  - Output file: %s" %(bam_seqs_fname))
-            bam_utils.bam_to_fastx(self.logger,
-                                   sample.ribosub_bam_filename,
-                                   bam_seqs_fname,
-                                   make_unique_recs=make_unique_recs)
-        else:
-            self.logger.info("Found %s, skipping.." %(bam_seqs_fname))
+        self.logger.info("  - Output file: %s" %(bam_seqs_fname))
+        self.run_step("%s.bam_to_fastx" %(sample.label),
+                      lambda: bam_utils.bam_to_fastx(self.logger,
+                                                     sample.ribosub_bam_filename,
+                                                     bam_seqs_fname,
+                                                     make_unique_recs=make_unique_recs),
+                      inputs=[sample.ribosub_bam_filename],
+                      outputs=[bam_seqs_fname],
+                      params={"make_unique_recs": make_unique_recs})
         # Output the FASTA sequences for the sample's CLIP clusters
         # First for all clusters
         self.output_clip_clusters_seqs(sample, "all")
@@ -1373,18 +1711,18 @@ class Pipeline:
         bams_to_convert = [sample.ribosub_bam_filename,
                            sample.unique_bam_filename]
         for bam_fname in bams_to_convert:
-            bam_basename = \
-                os.path.basename(sample.ribosub_bam_filename)
+            bam_basename = os.path.basename(bam_fname)
             bam_basename = bam_basename.rsplit(".bam", 1)[0]
             bigWig_fname = os.path.join(tracks_outdir,
                                         "%s.bigWig" %(bam_basename))
-            if os.path.isfile(bigWig_fname):
-                self.logger.info("Found %s, skipping.." %(bigWig_fname))
-                continue
             # Convert BAM file to bigWig file
-            bam_utils.bam_to_bigWig_file(bam_fname,
-                                         bigWig_fname,
-                                         self.rna_base.genome)
+            self.run_step("%s.bigWig.%s" %(sample.label, bam_basename),
+                          lambda: bam_utils.bam_to_bigWig_file(bam_fname,
+                                                               bigWig_fname,
+                                                               self.rna_base.genome),
+                          inputs=[bam_fname],
+                          outputs=[bigWig_fname],
+                          params={"genome": self.rna_base.genome})
             self.logger.info("  - Output file: %s" %(bigWig_fname))
         self.logger.info("Done outputting bigWigs.")
 
@@ -1394,29 +1732,49 @@ class Pipeline:
         Run analysis on a sample.
         """
         self.logger.info("Running analysis on %s" %(sample.label))
-        # Compute RPKMs
-        self.output_rpkms(sample)
+        # Analysis stages: (name, function, names of stages it
+        # depends on). Independent stages run in parallel, except
+        # those in EXCLUSIVE_STAGES.
+        analysis_stages = [("output_rpkms", self.output_rpkms, [])]
         ##
         ## Ribo-Seq specific analysis steps
         ##
         if sample.sample_type == "riboseq":
-            self.output_bigWigs(sample)
+            analysis_stages.append(("output_bigWigs", self.output_bigWigs, []))
         ##
         ## CLIP-Seq specific analysis steps
         ##
         if sample.sample_type == "clipseq":
-            # Output a bigWig file for the sample
-            self.output_bigWigs(sample)
-            # Run events analysis: only for CLIP-Seq datasets
-            self.output_events_mapping(sample)
-            # Convert BAM reads to BED
-            self.output_reads_as_bed(sample)
-            # Find CLIP clusters
-            self.output_clusters(sample)
-            # Output CLIP sequences
-            self.output_clip_sequences(sample)
-            # Output motifs for sample
-            self.output_motifs(sample)
+            analysis_stages.extend([
+                # Output a bigWig file for the sample
+                ("output_bigWigs", self.output_bigWigs, []),
+                # Run events analysis: only for CLIP-Seq datasets
+                ("output_events_mapping", self.output_events_mapping, []),
+                # Convert BAM reads to BED
+                ("output_reads_as_bed", self.output_reads_as_bed, []),
+                # Find CLIP clusters
+                ("output_clusters", self.output_clusters,
+                 ["output_reads_as_bed"]),
+                # Output CLIP sequences
+                ("output_clip_sequences", self.output_clip_sequences,
+                 ["output_clusters"]),
+                # Output motifs for sample
+                ("output_motifs", self.output_motifs,
+                 ["output_clip_sequences"])])
+        analysis_graph = self.get_step_graph()
+        for stage_name, stage_func, stage_deps in analysis_stages:
+            # Stages declare no outputs of their own, so they always
+            # run; the steps within them are skipped if up to date.
+            # Stage names are prefixed so that they differ from
+            # the names of steps within them.
+            analysis_graph.add_step(
+                step_graph.Step("%s.stage.%s" %(sample.label, stage_name),
+                                lambda stage_func=stage_func: \
+                                stage_func(sample),
+                                deps=["%s.stage.%s" %(sample.label, dep) \
+                                      for dep in stage_deps],
+                                exclusive=(stage_name in EXCLUSIVE_STAGES)))
+        analysis_graph.run()
         return sample
 
 
@@ -7,8 +7,13 @@ import csv
 
 import rnaseqlib
 import rnaseqlib.fastx_utils as fastx_utils
+import rnaseqlib.bam.bam_postprocess as bam_postprocess
+import rnaseqlib.bam.read_counters as read_counters
+import rnaseqlib.bam.rmdups as rmdups_utils
 import rnaseqlib.mapping.bedtools_utils as bedtools_utils
+import rnaseqlib.mapping.interval_index as interval_index
 import rnaseqlib.utils as utils
+import rnaseqlib.tables as tables
 
 import numpy
 from numpy import log, log2, exp, power
@@ -29,6 +34,10 @@ class QualityControl:
         self.pipeline = pipeline
         self.sample = sample
         self.settings_info = pipeline.settings_info
+        # Parameters for counting distinct read IDs
+        self.read_count_params = \
+            {"mode": self.settings_info["settings"]["read_count_mode"],
+             "max_memory": self.settings_info["settings"]["read_count_memory"]}
         # Define logger
         self.logger = utils.get_logger("QualityControl.%s" %(sample.label),
                                        self.pipeline.pipeline_outdirs["logs"])
@@ -53,13 +62,18 @@ class QualityControl:
                                 "3p_to_cds",
                                 "5p_to_cds",
                                 "3p_to_5p",
-                                "exon_intron_ratio"]
+                                "exon_intron_ratio",
+                                "percent_dups",
+                                "percent_unique_dups"]
         self.qc_header = ["num_reads", 
                           "num_mapped",
                           "num_ribosub_mapped",
                           "num_unique_mapped"] + \
                           self.qc_stats_header + \
                           self.regions_header
+        # Duplicate counts recorded when removing duplicates
+        # (CLIP-Seq only)
+        self.dup_counts = {}
         # QC results
         self.na_val = "NA"
         self.qc_results = defaultdict(lambda: self.na_val)
@@ -75,8 +89,10 @@ class QualityControl:
         self.qc_filename = os.path.join(self.sample_outdir,
                                         "%s.qc.txt" %(self.sample.label))
         self.qc_loaded = False
-        # use ensGene gene table for QC computations
-        self.gene_table = self.pipeline.rna_base.gene_tables["ensGene"]
+        # use the ensGene gene table's region files for QC
+        # computations (without loading the table itself)
+        self.table_dirs = \
+            tables.get_table_dirs(self.pipeline.rna_base.ucsc_tables_dir)
         # Load QC information if file corresponding to sample
         # already exists
         self.load_qc_from_file()
@@ -110,25 +126,18 @@ class QualityControl:
         self.logger.info("Getting number of reads.")
         if self.sample.paired:
             self.logger.info("Getting number of paired-end reads.")
-            # Paired-end
-            mate_reads = []
-            for mate_rawdata in self.sample.rawdata:
-                num_reads = 0
-                fastx_entries = \
-                    fastx_utils.get_fastx_entries(mate_rawdata.reads_filename)
-                for entry in fastx_entries:
-                    num_reads += 1
-                mate_reads.append(num_reads)
+            # Paired-end: count the mates concurrently
+            mate_filenames = [mate_rawdata.reads_filename \
+                              for mate_rawdata in self.sample.rawdata]
+            mate_reads = \
+                fastx_utils.get_num_fastx_records_parallel(mate_filenames)
             pair_num_reads = ",".join(map(str, mate_reads))
             return pair_num_reads
         else:
             self.logger.info("Getting number of single-end reads.")
-            num_reads = 0
             # Single-end
-            fastx_entries = \
-                fastx_utils.get_fastx_entries(self.sample.rawdata.reads_filename)
-            for entry in fastx_entries:
-                num_reads += 1
+            num_reads = \
+                fastx_utils.get_num_fastx_records(self.sample.rawdata.reads_filename)
             return num_reads
 
             
@@ -138,14 +147,16 @@ class QualityControl:
         reads that have alignments in the BAM file.
         """
         self.logger.info("Getting number of mapped reads.")        
-        num_mapped = count_nondup_reads(self.sample.bam_filename)
+        num_mapped = count_nondup_reads(self.sample.bam_filename,
+                                        **self.read_count_params)
         return num_mapped
 
 
     def get_num_unique_mapped(self):
         self.logger.info("Getting number of unique reads.")
         num_unique_mapped = \
-            count_nondup_reads(self.sample.unique_bam_filename)
+            count_nondup_reads(self.sample.unique_bam_filename,
+                               **self.read_count_params)
         return num_unique_mapped
 
 
@@ -156,7 +167,8 @@ class QualityControl:
         """
         self.logger.info("Getting number of ribosub mapped reads.")        
         num_ribosub_mapped = \
-            count_nondup_reads(self.sample.ribosub_bam_filename)
+            count_nondup_reads(self.sample.ribosub_bam_filename,
+                               **self.read_count_params)
         return num_ribosub_mapped
     
 
@@ -223,7 +235,8 @@ class QualityControl:
                                        multiple_iterators=True)
             # Count reads (fetch returns an iterator)
             # Do not count duplicates
-            num_ribo = count_nondup_reads(ribo_reads)
+            num_ribo = count_nondup_reads(ribo_reads,
+                                          **self.read_count_params)
             self.logger.info("Number ribo reads: %d" %(num_ribo))
         except:
             self.logger.warning("Could not fetch %s reads" %(chr_ribo))
@@ -239,7 +252,7 @@ class QualityControl:
         Return number of reads mapping to exons.
         """
         self.logger.info("Getting number of exonic reads..")
-        merged_exons_filename = os.path.join(self.gene_table.exons_dir,
+        merged_exons_filename = os.path.join(self.table_dirs["exons"],
                                              "ensGene.merged_exons.bed")
         output_basename = "region.merged_exons.bed"
         merged_exons_map_fname = os.path.join(self.regions_outdir,
@@ -263,7 +276,7 @@ class QualityControl:
         Return number of reads mapping to introns.
         """
         self.logger.info("Getting number of intronic reads..")
-        introns_filename = os.path.join(self.gene_table.introns_dir,
+        introns_filename = os.path.join(self.table_dirs["introns"],
                                         "ensGene.introns.bed")
         self.logger.info("Reading: %s" %(introns_filename))
         output_basename = "region.introns.bed"
@@ -289,38 +302,7 @@ class QualityControl:
         Get region filenames to map reads to for QC and their
         labels.
         """
-        # Merged exons 
-        merged_exons_filename = os.path.join(self.gene_table.exons_dir,
-                                             "ensGene.merged_exons.bed")
-        # Introns 
-        introns_filename = os.path.join(self.gene_table.introns_dir,
-                                        "ensGene.introns.bed")
-        # CDS-only merged exons
-        merged_cds_only_exons_filename \
-            = os.path.join(self.gene_table.exons_dir,
-                           "ensGene.cds_only.merged_exons.bed")
-        # 3' UTRs
-        three_prime_utrs_fname = os.path.join(self.gene_table.utrs_dir,
-                                              "ensGene.3p_utrs.bed")
-        # 5' UTRs
-        five_prime_utrs_fname = os.path.join(self.gene_table.utrs_dir,
-                                             "ensGene.5p_utrs.bed")
-        # tRNAs
-        tRNAs_fname = os.path.join(self.gene_table.tRNAs_dir,
-                                   "tRNAs.bed")
-        region_files = [[merged_exons_filename,
-                         "merged_exons"],
-                        [introns_filename,
-                         "introns"],
-                        [merged_cds_only_exons_filename,
-                         "cds_only.merged_exons"],
-                        [three_prime_utrs_fname,
-                         "3p_utrs"],
-                        [five_prime_utrs_fname,
-                         "5p_utrs"],
-                        [tRNAs_fname,
-                         "tRNAs"]]
-        return [r[0] for r in region_files], [r[1] for r in region_files]
+        return self.pipeline.rna_base.get_qc_region_files()
 
 
     def compute_region_lens(self):
@@ -330,17 +312,17 @@ class QualityControl:
         """
         self.logger.info("Computing lengths of all regions..")
         # Mapping from region types (e.g. 3' UTR, cds) to
-        # coordinates to lengths
-        self.qc_region_lens = defaultdict(lambda: defaultdict(int))
+        # the lengths of their regions (in the order of the
+        # regions' BED file)
+        self.qc_region_lens = {}
         # Mapping from region types to sum of lengths
         self.total_qc_region_lens = defaultdict(int)
-        region_files, region_labels = self.get_region_files()
-        for region_filename, region_label in zip(region_files,
-                                                 region_labels):
-            curr_len_dict, total_len = \
-                bedtools_utils.get_bed_lens(region_filename)
-            self.qc_region_lens[region_label] = curr_len_dict
-            self.total_qc_region_lens[region_label] = total_len
+        region_labels, interval_indexes, total_lens = \
+            self.pipeline.rna_base.get_qc_regions()
+        for region_label, region_index in zip(region_labels,
+                                              interval_indexes):
+            self.qc_region_lens[region_label] = region_index.get_lens() + 1
+            self.total_qc_region_lens[region_label] = total_lens[region_label]
         self.logger.info("Finished computing region lengths.")
         return self.qc_region_lens
 
@@ -363,118 +345,87 @@ class QualityControl:
                 self.logger.critical("Cannot find regions filename for %s" \
                                      %(fname))
                 sys.exit(1)
-        self.qc_regions_bam = \
-            os.path.join(self.regions_outdir, "qc_regions.bam")
-        if not os.path.isfile(self.qc_regions_bam):
-            num_regions = len(region_filenames)
-            self.logger.info("Mapping reads to %d region types." \
-                             %(num_regions))
-            # Compute which reads map to each region
-            region_results = \
-                bedtools_utils.multi_tagBam(self.sample.unique_bam_filename,
-                                            region_filenames,
-                                            region_labels,
-                                            self.qc_regions_bam,
-                                            self.logger)
-            if region_results is None:
-                self.logger.critical("Mapping of reads to QC regions failed.")
-                sys.exit(1)
-        else:
-            self.logger.info("QC regions BAM %s found, skipping.." \
-                             %(self.qc_regions_bam))
+        num_regions = len(region_filenames)
+        self.logger.info("Mapping reads to %d region types." \
+                         %(num_regions))
+        t1 = time.time()
+        # Assign the unique reads to the regions' interval
+        # indexes (loaded from the RNABase snapshot)
+        region_labels, interval_indexes, total_lens = \
+            self.pipeline.rna_base.get_qc_regions()
         region_counts = \
-            self.count_reads_in_qc_regions(self.qc_regions_bam)
+            interval_index.count_reads_in_regions(self.sample.unique_bam_filename,
+                                                  region_labels,
+                                                  interval_indexes,
+                                                  num_processes=self.settings_info["mapping"]["num_processors"],
+                                                  tile_size=self.settings_info["settings"]["count_tile_size"])
+        t2 = time.time()
+        self.logger.info("Assigning reads to regions took %.2f minutes." \
+                         %((t2 - t1)/60.))
+        self.count_reads_in_qc_regions(region_counts)
         self.logger.info("Done counting reads in QC regions.")
 
 
-    def count_reads_in_qc_regions(self, qc_regions_bam):
+    def count_reads_in_qc_regions(self, region_counts):
         """
-        Count reads mapping to various QC regions in the
-        BAM produced by tagBam.
+        Count reads mapping to various QC regions, given
+        the reads assigned to each region type (a RegionCounts
+        object).
         """
-        if not os.path.isfile(qc_regions_bam):
-            self.logger.critical("Cannot found reads, BAM file %s not found." \
-                                 %(qc_regions_bam))
-            return
-        # Count reads in exons
-        bam_file = pysam.Samfile(qc_regions_bam, "rb")
-        self.logger.info("Counting reads in: %s" %(qc_regions_bam))
-        region_counts = defaultdict(int)
-        ##
-        ## Map transcripts to region types and hits
+        # Mapping from region type to array of read counts for
+        # each interval of that type
+        self.region_interval_counts = region_counts.interval_counts
+        qc_region_counts = defaultdict(int)
+        ## Rules for counting regions
         ##
-        self.region_counts_by_transcript = \
-            defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
-        for bam_read in bam_file:
-            # Read aligns to region of interest
-            regions_field = None
-            try:
-                regions_field = bam_read.opt("YB")
-            except KeyError:
-                continue
-            region_coordinates, regions_detected = \
-                bedtools_utils.parse_tagBam_region(regions_field)
-            for region_info in region_coordinates:
-                curr_region, region_type, transcripts = \
-                    region_info
-                for curr_transcript in transcripts:
-                    transcript_info = \
-                        self.region_counts_by_transcript[curr_transcript]
-                    transcript_info[region_type][curr_region] += 1
-            ## Rules for counting regions
-            ##
-            # Count junction reads but do not use them
-            # in counting regions
-            # (3 signals "N" in cigar string)
-            # First check if it's a junction
-            if (len(bam_read.cigar) > 1) and \
-               (3 in [c[0] for c in bam_read.cigar]):
-                # It's a junction read
-                region_counts["num_junctions"] += 1
-            # Then check if it's a tRNA
+        # Count junction reads but do not use them
+        # in counting regions
+        qc_region_counts["num_junctions"] = region_counts.num_junctions
+        for regions_detected, num_reads in region_counts.iter_masks():
+            # First check if it's a tRNA
             if "tRNAs" in regions_detected:
                 # It's a tRNA
-                region_counts["num_tRNAs"] += 1
+                qc_region_counts["num_tRNAs"] += num_reads
                 continue
             # Check if it's in a CDS region
             if "cds_only.merged_exons" in regions_detected:
-                region_counts["num_cds"] += 1
+                qc_region_counts["num_cds"] += num_reads
                 continue
             # Check if it's in a 3' UTR
             if "3p_utrs" in regions_detected:
-                region_counts["num_3p_utr"] += 1
+                qc_region_counts["num_3p_utr"] += num_reads
                 continue
             # Check if it's in a 5' UTR
             if "5p_utrs" in regions_detected:
-                region_counts["num_5p_utr"] += 1
+                qc_region_counts["num_5p_utr"] += num_reads
                 continue
             # Check if it's in a generic exonic region
             # which is non-CDS, non-UTR
             if "merged_exons" in regions_detected:
-                region_counts["num_other_exons"] += 1
+                qc_region_counts["num_other_exons"] += num_reads
             elif ("introns" in regions_detected) and \
                  (len(regions_detected) == 1):
                 # It maps to an intron and only an intron, count it
                 # as intronic read
-                region_counts["num_introns"] += 1
-        self.qc_results["num_cds"] = region_counts["num_cds"]
-        self.qc_results["num_introns"] = region_counts["num_introns"]
-        self.qc_results["num_3p_utr"] = region_counts["num_3p_utr"]
-        self.qc_results["num_5p_utr"] = region_counts["num_5p_utr"]
+                qc_region_counts["num_introns"] += num_reads
+        self.qc_results["num_cds"] = qc_region_counts["num_cds"]
+        self.qc_results["num_introns"] = qc_region_counts["num_introns"]
+        self.qc_results["num_3p_utr"] = qc_region_counts["num_3p_utr"]
+        self.qc_results["num_5p_utr"] = qc_region_counts["num_5p_utr"]
         self.logger.info("num 3p utr: %d" %(self.qc_results["num_3p_utr"]))
         self.logger.info("num 5p utr: %d" %(self.qc_results["num_5p_utr"]))
-        self.qc_results["num_tRNAs"] = region_counts["num_tRNAs"]
-        self.qc_results["num_junctions"] = region_counts["num_junctions"]
+        self.qc_results["num_tRNAs"] = qc_region_counts["num_tRNAs"]
+        self.qc_results["num_junctions"] = qc_region_counts["num_junctions"]
         # Number of exonic reads is defined as
         # sum of reads that fall in:
         #  - CDS exons
         #  - 3'/5' UTRs
         #  - Other misc. exons
         self.qc_results["num_exons"] = \
-            region_counts["num_cds"] + \
-            region_counts["num_other_exons"] + \
-            region_counts["num_3p_utr"] + \
-            region_counts["num_5p_utr"]
+            qc_region_counts["num_cds"] + \
+            qc_region_counts["num_other_exons"] + \
+            qc_region_counts["num_3p_utr"] + \
+            qc_region_counts["num_5p_utr"]
         # Collect sum of all the QC regions
         self.qc_results["qc_regions_total"] = \
             self.qc_results["num_exons"] + self.qc_results["num_introns"]
@@ -483,14 +434,58 @@ class QualityControl:
     def compute_basic_qc(self):
         """
         Compute basic QC stats like number of reads mapped.
+
+        Uses the read counts recorded when the BAM files were
+        post-processed if these are available.
         """
         self.qc_results["num_reads"] = self.get_num_reads()
+        self.load_dup_counts()
+        read_counts = self.sample.read_counts
+        if read_counts is None:
+            read_counts = \
+                bam_postprocess.load_read_counts(self.sample.read_counts_filename)
+        if read_counts is not None:
+            self.logger.info("Using read counts from BAM post-processing.")
+            for count_field in bam_postprocess.READ_COUNTS_HEADER:
+                self.qc_results[count_field] = read_counts[count_field]
+            return
         self.qc_results["num_mapped"] = self.get_num_mapped()
         self.qc_results["num_ribosub_mapped"] = self.get_num_ribosub_mapped()        
         self.qc_results["num_unique_mapped"] = self.get_num_unique_mapped()
         self.qc_results["num_ribo"] = self.get_num_ribo()
 
 
+    def load_dup_counts(self):
+        """
+        Load the duplicate counts recorded when duplicates were
+        removed from the sample's BAMs, if any.
+        """
+        rmdups_bams = [("dups", self.sample.rmdups_bam_filename),
+                       ("unique_dups", self.sample.rmdups_unique_bam_filename)]
+        for dup_label, rmdups_bam_filename in rmdups_bams:
+            if rmdups_bam_filename is None:
+                continue
+            dup_counts = \
+                rmdups_utils.load_dup_counts(rmdups_utils.get_dup_counts_filename(rmdups_bam_filename))
+            if dup_counts is not None:
+                self.dup_counts[dup_label] = dup_counts
+
+
+    def get_percent_dups(self, dup_label="dups"):
+        """
+        Get percent of alignments removed as duplicates.
+        """
+        if dup_label not in self.dup_counts:
+            return self.na_val
+        dup_counts = self.dup_counts[dup_label]
+        if dup_counts["num_alignments"] == 0:
+            return 0
+        percent_dups = \
+            dup_counts["num_duplicates"] / float(dup_counts["num_alignments"])
+        percent_dups *= float(100)
+        return percent_dups
+
+
     def get_percent_mapped(self):
         """
         Get percent of reads that were mapped.
@@ -672,25 +667,6 @@ class QualityControl:
         """
         Get 3' UTR to 5' UTR ratio: Computed at the transcript level.
         """
-        for transcript in self.region_counts_by_transcript:
-            transcript_info = \
-                self.region_counts_by_transcript[transcript]
-            # Skip transcripts that don't have 3p / 5p UTR reads
-            if (len(transcript_info["3p_utr"]) == 0) or \
-               (len(transcript_info["5p_utr"]) == 0):
-                continue
-            # Take sum of 3p UTR reads and their length
-            sum_reads_3p = 0
-            sum_lens_3p = 0
-            for region in transcript_info["3p_utr"]:
-                chrom, start, end, strand = utils.parse_coords(region)
-                num_reads = transcript_info["3p_utr"][region]
-                curr_len = end - start + 1
-                sum_reads_3p += num_reads
-                sum_lens_3p += curr_len
-            # Take sum of 5p UTR reads and their lengths
-            sum_reads_3p = [transcript_info["3p_utr"][r] \
-                            for r in transcript_info["3p_utr"]]
         return 0
         # ratio_3p_to_5p = 0
         # if (self.qc_results["num_3p_utr"] == self.na_val) or \
@@ -730,7 +706,10 @@ class QualityControl:
                               ("3p_to_cds", self.get_3p_to_cds),
                               ("5p_to_cds", self.get_5p_to_cds),
                               ("3p_to_5p", self.get_3p_to_5p),
-                              ("exon_intron_ratio", self.get_exon_intron_ratio)]
+                              ("exon_intron_ratio", self.get_exon_intron_ratio),
+                              ("percent_dups", self.get_percent_dups),
+                              ("percent_unique_dups",
+                               lambda: self.get_percent_dups("unique_dups"))]
         for stat_name, stat_func in self.qc_stat_funcs:
             self.qc_results[stat_name] = stat_func()
         
@@ -748,11 +727,14 @@ class QualityControl:
                 %(self.sample.label)
         else:
             # Basic QC stats
-            self.compute_basic_qc()
+            self.pipeline.measure_step("run_qc.compute_basic_qc",
+                                       self.compute_basic_qc)
             # Number of reads in various regions
-            self.compute_regions()
+            self.pipeline.measure_step("run_qc.compute_regions",
+                                       self.compute_regions)
             # Compute statistics from these results
-            self.compute_qc_stats()
+            self.pipeline.measure_step("run_qc.compute_qc_stats",
+                                       self.compute_qc_stats)
         # Set that QC results were loaded
         self.qc_loaded = True
         return self.qc_results
@@ -771,7 +753,7 @@ class QualityControl:
         qc_df = pandas.DataFrame([self.qc_results])
         # Write QC information as csv
         qc_df.to_csv(self.qc_filename,
-                     cols=self.qc_header,
+                     columns=self.qc_header,
                      na_rep=self.na_val,
                      float_format="%.3f",
                      sep="\t",
@@ -874,28 +856,28 @@ class QCStats:
                              na_rep=self.na_val,
                              float_format="%.3f",
                              index=False,
-                             cols=output_header)
+                             columns=output_header)
 
 ##
 ## Misc. QC functions
 ##
-def count_nondup_reads(bam_in):
+def count_nondup_reads(bam_in, mode="auto",
+                       max_memory=read_counters.DEFAULT_READ_COUNT_MEMORY):
     """
     Return number of BAM reads that appear in the file, excluding
     duplicates (i.e. only count unique read ids/QNAMEs.)
 
     Takes a filename or a stream.
+
+    - mode: read counting mode ('auto', 'hash' or 'exact')
+    - max_memory: memory cap (in MB) for hashed counting
     """
-    bam_reads = bam_in
     if isinstance(bam_in, basestring):
         # We're passed a filename
         if not os.path.isfile(bam_in):
             print "WARNING: Could not find BAM file %s" %(bam_in)
             return 0
-        else:
-            bam_reads = pysam.Samfile(bam_in, "rb")
-    bam_reads_ids = {}
-    for read in bam_reads:
-        bam_reads_ids[read.qname] = True
-    num_reads = len(bam_reads_ids.keys())
+    num_reads = read_counters.count_read_ids(bam_in,
+                                             mode=mode,
+                                             max_memory=max_memory)
     return num_reads
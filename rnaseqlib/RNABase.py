@@ -12,6 +12,9 @@ import rnaseqlib
 import rnaseqlib.init as init
 import rnaseqlib.utils as utils
 import rnaseqlib.tables as tables
+import rnaseqlib.array_snapshot as array_snapshot
+import rnaseqlib.mapping.interval_index as interval_index
+import rnaseqlib.genes.gene_annotation as gene_annotation
 from rnaseqlib.init import download_seqs
 
 
@@ -40,8 +43,13 @@ class RNABase:
 #                                 "refSeq"]
         # Gene tables indexed by table name
         self.gene_tables = {}
+        # Gene annotation snapshots indexed by table name
+        self.gene_annotations = {}
         # Mapping from tables to const exons information
         self.tables_to_const_exons = {}
+        # QC regions: labels, interval indexes and total lengths
+        # (see get_qc_regions)
+        self.qc_regions = None
         self.output_dir = None
         if from_dir is None:
             self.output_dir = os.path.join(output_dir,
@@ -94,14 +102,96 @@ class RNABase:
         return table
 
 
+    def has_gene_table(self, table_name):
+        """
+        Return True if the UCSC table of a gene table is present.
+        """
+        return os.path.isfile(os.path.join(self.ucsc_tables_dir,
+                                           "%s.txt" %(table_name)))
+
+
+    def get_gene_table(self, table_name):
+        """
+        Return a gene table (tables only, without parsing
+        into gene objects), loading it the first time.
+        """
+        if table_name not in self.gene_tables:
+            self.gene_tables[table_name] = \
+                tables.GeneTable(self.ucsc_tables_dir,
+                                 table_name,
+                                 tables_only=True)
+        return self.gene_tables[table_name]
+
+
+    def get_snapshot_dir(self, name):
+        """
+        Return the directory of a snapshot of the RNABase
+        (see array_snapshot).
+        """
+        return os.path.join(self.ucsc_tables_dir,
+                            "snapshots",
+                            name)
+
+
+    def get_gene_annotation_dir(self, table_name):
+        return self.get_snapshot_dir("%s.annotation" %(table_name))
+
+
+    def get_gene_annotation(self, table_name):
+        """
+        Return the gene annotation (gene symbols, descriptions
+        and exons) of a gene table.
+
+        Annotation is read from a memory-mapped snapshot, which
+        is built from the gene table the first time, or when the
+        UCSC tables it comes from change. This avoids parsing
+        the gene tables in every process that only needs
+        to look up genes.
+        """
+        if table_name in self.gene_annotations:
+            return self.gene_annotations[table_name]
+        snapshot_dir = self.get_gene_annotation_dir(table_name)
+        source_stamp = gene_annotation.get_source_stamp(self.ucsc_tables_dir,
+                                                        table_name)
+        if not gene_annotation.is_snapshot_current(snapshot_dir,
+                                                   source_stamp):
+            print "Building gene annotation snapshot for %s" %(table_name)
+            print "  - Output dir: %s" %(snapshot_dir)
+            gene_table = self.get_gene_table(table_name)
+            gene_ids, fields_to_values = \
+                gene_table.get_gene_annotation_values()
+            utils.make_dir(os.path.dirname(snapshot_dir))
+            gene_annotation.write_gene_annotation(snapshot_dir,
+                                                  gene_ids,
+                                                  fields_to_values,
+                                                  source_stamp)
+        self.gene_annotations[table_name] = \
+            gene_annotation.GeneAnnotation(snapshot_dir)
+        return self.gene_annotations[table_name]
+
+
+    def load_gene_annotations(self):
+        """
+        Load gene annotation for all gene tables that
+        are present, building snapshots as needed.
+        """
+        for table_name in self.gene_table_names:
+            if self.has_gene_table(table_name):
+                self.get_gene_annotation(table_name)
+
+
     def load_const_exons_info(self):
         """
         Load constitutive exons information for all tables.
         """
         const_exons_dir = self.get_const_exons_dir()
         for table_name in self.rpkm_table_names:
-            const_exons = tables.ConstExons(table_name,
-                                            from_dir=const_exons_dir)
+            snapshot_dir = self.get_snapshot_dir("%s.const_exons" %(table_name))
+            utils.make_dir(os.path.dirname(snapshot_dir))
+            const_exons = \
+                tables.ConstExons(table_name,
+                                  from_dir=const_exons_dir,
+                                  snapshot=array_snapshot.ArraySnapshot(snapshot_dir))
             if const_exons.found:
                 self.tables_to_const_exons[table_name] = const_exons
 
@@ -110,7 +200,98 @@ class RNABase:
         """
         Load all information needed to compute QC.
         """
-        pass
+        region_filenames, region_labels = self.get_qc_region_files()
+        if not all([os.path.isfile(fname) for fname in region_filenames]):
+            print "WARNING: Cannot find all QC region files, not " \
+                  "loading QC regions."
+            return
+        self.get_qc_regions()
+
+
+    def get_qc_region_files(self):
+        """
+        Get region filenames to map reads to for QC and their
+        labels.
+        """
+        table_dirs = tables.get_table_dirs(self.ucsc_tables_dir)
+        region_files = \
+            [# Merged exons
+             [os.path.join(table_dirs["exons"], "ensGene.merged_exons.bed"),
+              "merged_exons"],
+             # Introns
+             [os.path.join(table_dirs["introns"], "ensGene.introns.bed"),
+              "introns"],
+             # CDS-only merged exons
+             [os.path.join(table_dirs["exons"],
+                           "ensGene.cds_only.merged_exons.bed"),
+              "cds_only.merged_exons"],
+             # 3' UTRs
+             [os.path.join(table_dirs["utrs"], "ensGene.3p_utrs.bed"),
+              "3p_utrs"],
+             # 5' UTRs
+             [os.path.join(table_dirs["utrs"], "ensGene.5p_utrs.bed"),
+              "5p_utrs"],
+             # tRNAs
+             [os.path.join(table_dirs["tRNAs"], "tRNAs.bed"),
+              "tRNAs"]]
+        return [r[0] for r in region_files], [r[1] for r in region_files]
+
+
+    def get_qc_regions(self):
+        """
+        Return the QC regions: their labels, an interval index
+        of each set of regions and a mapping from labels to the
+        total length of the regions (as 1-based, inclusive
+        intervals).
+
+        The regions are read from a memory-mapped snapshot, which
+        is built from the region BED files the first time, or
+        when they change.
+        """
+        if self.qc_regions is not None:
+            return self.qc_regions
+        region_filenames, region_labels = self.get_qc_region_files()
+        snapshot_dir = self.get_snapshot_dir("qc_regions")
+        snapshot = array_snapshot.ArraySnapshot(snapshot_dir)
+        stamp = array_snapshot.get_files_stamp(region_filenames)
+        if not snapshot.is_current(stamp):
+            print "Building QC regions snapshot"
+            print "  - Output dir: %s" %(snapshot_dir)
+            interval_indexes = \
+                [interval_index.load_bed_index(region_filename,
+                                               label=region_label) \
+                 for region_filename, region_label in zip(region_filenames,
+                                                          region_labels)]
+            total_lens = \
+                dict([(region_label, int((index.get_lens() + 1).sum())) \
+                      for region_label, index in zip(region_labels,
+                                                     interval_indexes)])
+            utils.make_dir(os.path.dirname(snapshot_dir))
+            interval_index.write_indexes_snapshot(snapshot,
+                                                  region_labels,
+                                                  interval_indexes,
+                                                  stamp,
+                                                  meta={"total_lens": total_lens})
+        labels, interval_indexes = \
+            interval_index.load_indexes_snapshot(snapshot)
+        total_lens = dict([(str(label), total_len) \
+                           for label, total_len \
+                           in snapshot.load_meta()["total_lens"].iteritems()])
+        self.qc_regions = (labels, interval_indexes, total_lens)
+        return self.qc_regions
+
+
+    def compile_snapshots(self):
+        """
+        Compile the gene tables, constitutive exons and QC regions
+        (merged exons, introns, UTRs, tRNAs and their lengths)
+        into snapshots, so that pipeline runs load them without
+        parsing the tables.
+        """
+        print "Compiling snapshots.."
+        self.load_const_exons_info()
+        self.load_gene_annotations()
+        self.load_qc_info()
         
 
     def download_seqs(self):
@@ -214,3 +395,5 @@ class RNABase:
         self.download_seqs()
         self.download_tables()
         self.build_indices()
+        self.ucsc_tables_dir = os.path.join(self.output_dir, "ucsc")
+        self.compile_snapshots()
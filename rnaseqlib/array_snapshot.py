@@ -0,0 +1,230 @@
+##
+## Versioned snapshots of numpy arrays, memory-mapped
+## when loaded
+##
+import os
+import sys
+import time
+import glob
+import json
+import shutil
+import threading
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+
+# Version of the snapshot layout. Snapshots of other versions
+# are out of date and get rebuilt.
+SNAPSHOT_VERSION = 1
+
+
+def get_files_stamp(filenames):
+    """
+    Return a string identifying the versions of a list of files
+    (their sizes and modification times), to tell whether
+    arrays computed from them are out of date.
+    """
+    stamp = []
+    for fname in filenames:
+        if not os.path.isfile(fname):
+            stamp.append("%s\tNA" %(os.path.basename(fname)))
+            continue
+        file_stat = os.stat(fname)
+        stamp.append("%s\t%d\t%d" %(os.path.basename(fname),
+                                    file_stat.st_size,
+                                    int(file_stat.st_mtime)))
+    return "\n".join(stamp)
+
+
+def pack_strings(values):
+    """
+    Pack strings into a single byte array and the offsets
+    of each string in it.
+    """
+    values = [str(value) for value in values]
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(value) for value in values])
+    data = np.frombuffer("".join(values), dtype=np.uint8)
+    return data, offsets
+
+
+def unpack_strings(data, offsets):
+    """
+    Return the list of strings packed by pack_strings.
+    """
+    data = data.tostring()
+    return [data[start:end] \
+            for start, end in zip(offsets[:-1].tolist(),
+                                  offsets[1:].tolist())]
+
+
+class ArraySnapshot:
+    """
+    Directory of numpy arrays (one .npy file each) and a small
+    metadata file recording the snapshot version, a stamp of
+    the files the arrays were computed from (see get_files_stamp)
+    and any other metadata (JSON-serializable).
+
+    Lists of strings are kept packed (see pack_strings), as
+    '<name>.data' and '<name>.offsets' arrays.
+
+    Each write goes to a new version directory next to the
+    snapshot ('<snapshot_dir>.v.<id>'), and 'snapshot_dir' is a
+    symbolic link to the current version. Loading resolves the
+    link once, so a loader keeps reading from the same version
+    even if the snapshot is rewritten meanwhile.
+
+    - snapshot_dir: directory of the snapshot
+    """
+    def __init__(self, snapshot_dir):
+        self.snapshot_dir = snapshot_dir
+        self.meta = None
+        # Version directory the snapshot is loaded from
+        self.version_dir = None
+
+
+    def get_version_dir(self):
+        """
+        Return the directory of the version the snapshot is
+        loaded from (the current version when first called).
+        """
+        if self.version_dir is None:
+            self.version_dir = os.path.realpath(self.snapshot_dir)
+        return self.version_dir
+
+
+    def get_version_time(self, version_dir):
+        """
+        Return the time (in microseconds) a version directory was
+        written at, or None if it is not a version directory.
+        """
+        version_prefix = "%s.v." %(os.path.basename(self.snapshot_dir))
+        version_basename = os.path.basename(version_dir)
+        if not version_basename.startswith(version_prefix):
+            return None
+        try:
+            return int(version_basename[len(version_prefix):].split(".")[0])
+        except ValueError:
+            return None
+
+
+    def get_meta_filename(self):
+        return os.path.join(self.get_version_dir(), "snapshot.json")
+
+
+    def get_array_filename(self, name):
+        return os.path.join(self.get_version_dir(), "%s.npy" %(name))
+
+
+    def load_meta(self):
+        """
+        Load the snapshot metadata. Returns None if there
+        is no snapshot.
+        """
+        if self.meta is None:
+            meta_filename = self.get_meta_filename()
+            if not os.path.isfile(meta_filename):
+                # Look up the current version again next time
+                self.version_dir = None
+                return None
+            with open(meta_filename) as meta_file:
+                self.meta = json.load(meta_file)
+        return self.meta
+
+
+    def is_current(self, stamp):
+        """
+        Return True if the snapshot exists and was built, with the
+        current layout, from the files identified by the stamp.
+        """
+        meta = self.load_meta()
+        return (meta is not None) and \
+               (meta["version"] == SNAPSHOT_VERSION) and \
+               (meta["stamp"] == stamp)
+
+
+    def write(self, arrays, stamp,
+              strings={},
+              meta={}):
+        """
+        Write the snapshot.
+
+        - arrays: mapping from names to numpy arrays
+        - stamp: stamp of the files the arrays were computed from
+        - strings: mapping from names to lists of strings
+        - meta: other metadata
+
+        The snapshot is written to a new version directory, and
+        the link to the current version is then replaced by a link
+        to it (atomically, by renaming), so that processes loading
+        the snapshot never see a partial or missing snapshot.
+        Versions older than the previous one are removed.
+        """
+        version_id = "%d.%d.%d" %(int(time.time() * 1e6), os.getpid(),
+                                   threading.current_thread().ident)
+        tmp_dir = "%s.tmp.%s" %(self.snapshot_dir, version_id)
+        utils.make_dir(tmp_dir)
+        for name, array in arrays.iteritems():
+            np.save(os.path.join(tmp_dir, "%s.npy" %(name)), array)
+        for name, values in strings.iteritems():
+            data, offsets = pack_strings(values)
+            np.save(os.path.join(tmp_dir, "%s.data.npy" %(name)), data)
+            np.save(os.path.join(tmp_dir, "%s.offsets.npy" %(name)), offsets)
+        snapshot_meta = dict(meta)
+        snapshot_meta["version"] = SNAPSHOT_VERSION
+        snapshot_meta["stamp"] = stamp
+        with open(os.path.join(tmp_dir, "snapshot.json"), "w") as meta_file:
+            json.dump(snapshot_meta, meta_file, sort_keys=True, indent=1)
+        version_dir = "%s.v.%s" %(self.snapshot_dir, version_id)
+        os.rename(tmp_dir, version_dir)
+        previous_dir = None
+        if os.path.islink(self.snapshot_dir):
+            previous_dir = os.path.realpath(self.snapshot_dir)
+        elif os.path.isdir(self.snapshot_dir):
+            # Snapshot written before versions were kept: move it
+            # aside (as the oldest version) so the link can take
+            # its place
+            previous_dir = "%s.v.0.%s" %(self.snapshot_dir, version_id)
+            os.rename(self.snapshot_dir, previous_dir)
+        # Link relative to the snapshot's directory, so the
+        # snapshots can be moved together
+        tmp_link = "%s.link.%s" %(self.snapshot_dir, version_id)
+        os.symlink(os.path.basename(version_dir), tmp_link)
+        os.rename(tmp_link, self.snapshot_dir)
+        # Remove versions older than the previous one, which is kept
+        # for processes still loading it. Newer versions may be
+        # being written by other processes.
+        if previous_dir is not None:
+            previous_time = self.get_version_time(previous_dir)
+            for old_dir in glob.glob("%s.v.*" %(self.snapshot_dir)):
+                old_time = self.get_version_time(old_dir)
+                if (old_time is not None) and (previous_time is not None) and \
+                   (old_time < previous_time):
+                    shutil.rmtree(old_dir, ignore_errors=True)
+        self.meta = None
+        self.version_dir = None
+        return self.snapshot_dir
+
+
+    def load_array(self, name):
+        """
+        Memory-map an array of the snapshot.
+        """
+        return np.load(self.get_array_filename(name), mmap_mode="r")
+
+
+    def load_string_arrays(self, name):
+        """
+        Memory-map the (data, offsets) arrays of a list of strings.
+        """
+        return (self.load_array("%s.data" %(name)),
+                self.load_array("%s.offsets" %(name)))
+
+
+    def load_strings(self, name):
+        """
+        Load a list of strings of the snapshot.
+        """
+        return unpack_strings(*self.load_string_arrays(name))
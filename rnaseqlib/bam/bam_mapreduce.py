@@ -0,0 +1,200 @@
+##
+## Region-parallel counting of reads in indexed BAM files
+##
+import os
+import sys
+import time
+import traceback
+import multiprocessing
+
+import pysam
+
+
+def is_bam_indexed(bam_filename):
+    """
+    Return True if a BAM file has an index next to it.
+    """
+    return os.path.isfile("%s.bai" %(bam_filename)) or \
+           os.path.isfile("%s.bai" %(os.path.splitext(bam_filename)[0]))
+
+
+def get_bam_regions(bam_filename, tile_size=None):
+    """
+    Split the reference sequences of a BAM file into regions,
+    using the lengths in the BAM header. Returns a list of
+    (chrom, start, end) tuples, largest first.
+
+    - tile_size: if given, split chromosomes into tiles of at
+      most this many bases. Otherwise there is one region per
+      chromosome.
+    """
+    bamfile = pysam.Samfile(bam_filename, "rb")
+    chrom_lens = zip(bamfile.references, bamfile.lengths)
+    bamfile.close()
+    regions = []
+    for chrom, chrom_len in chrom_lens:
+        if tile_size is None:
+            regions.append((chrom, 0, chrom_len))
+            continue
+        for start in range(0, chrom_len, tile_size):
+            regions.append((chrom, start, min(start + tile_size, chrom_len)))
+    # Start with the largest regions so that workers finish together
+    regions.sort(key=lambda region: region[2] - region[1], reverse=True)
+    return regions
+
+
+def count_region_reads(bamfile, counter, chrom, start, end):
+    """
+    Add the mapped reads of a BAM region to a counter. Only reads
+    starting in the region are added, so that reads spanning
+    the border of two regions are counted once.
+    """
+    for read in bamfile.fetch(chrom, start, end):
+        if read.is_unmapped or (read.pos < start):
+            continue
+        counter.add_read(chrom, read)
+    counter.flush()
+
+
+def count_regions_worker(bam_filename, new_counter,
+                         region_queue, result_queue):
+    """
+    Count reads of the regions in the queue until there are
+    no regions left, and put the counter's partial counts in
+    the result queue.
+    """
+    try:
+        counter = new_counter()
+        bamfile = pysam.Samfile(bam_filename, "rb")
+        while True:
+            region = region_queue.get()
+            if region is None:
+                break
+            count_region_reads(bamfile, counter, *region)
+        bamfile.close()
+        result_queue.put((True, counter.get_partial()))
+    except:
+        result_queue.put((False, traceback.format_exc()))
+
+
+class MultiCounter:
+    """
+    Count the same reads with several counters (so that they
+    share a single pass over the BAM file).
+    """
+    def __init__(self, counters):
+        self.counters = counters
+
+
+    def new_counter(self):
+        return MultiCounter([counter.new_counter() \
+                             for counter in self.counters])
+
+
+    def add_read(self, chrom, read):
+        for counter in self.counters:
+            counter.add_read(chrom, read)
+
+
+    def flush(self):
+        for counter in self.counters:
+            counter.flush()
+
+
+    def get_partial(self):
+        return [counter.get_partial() for counter in self.counters]
+
+
+    def add_partial(self, partials):
+        for counter, partial in zip(self.counters, partials):
+            counter.add_partial(partial)
+
+
+    def count_bam(self, bam_filename,
+                  num_processes=1,
+                  tile_size=None):
+        """
+        Count all mapped reads in a BAM file with each counter.
+        """
+        counter = map_reduce_bam(bam_filename,
+                                 self.new_counter,
+                                 num_processes=num_processes,
+                                 tile_size=tile_size)
+        self.add_partial(counter.get_partial())
+        return self.counters
+
+
+def map_reduce_bam(bam_filename, new_counter,
+                   num_processes=1,
+                   tile_size=None):
+    """
+    Count the mapped reads of a BAM file with a counter, splitting
+    the work across processes by region.
+
+    Counters must have these methods:
+
+    - add_read(chrom, read): count a read
+    - flush(): count any reads that are still buffered
+    - get_partial(): return the counts so far (sent between
+      processes, so should hold arrays rather than the counter's
+      lookup structures)
+    - add_partial(partial): add counts returned by get_partial()
+
+    Takes as input:
+
+    - bam_filename: BAM file (indexed, for more than one process)
+    - new_counter: function that returns a new, empty counter
+    - num_processes: number of processes to count in
+    - tile_size: if given, split chromosomes into tiles of this
+      many bases. Otherwise each chromosome is one region.
+
+    Each worker process counts its regions in a counter of its own;
+    the counters are merged in a counter of the calling process,
+    which is returned. Unindexed BAM files (or a single process)
+    are read front to back in the calling process.
+    """
+    counter = new_counter()
+    if (num_processes <= 1) or (not is_bam_indexed(bam_filename)):
+        bamfile = pysam.Samfile(bam_filename, "rb")
+        chrom_names = bamfile.references
+        for read in bamfile:
+            if read.is_unmapped:
+                continue
+            counter.add_read(chrom_names[read.tid], read)
+        counter.flush()
+        bamfile.close()
+        return counter
+    regions = get_bam_regions(bam_filename, tile_size=tile_size)
+    num_processes = min(num_processes, len(regions))
+    region_queue = multiprocessing.Queue()
+    result_queue = multiprocessing.Queue()
+    for region in regions:
+        region_queue.put(region)
+    # One end marker per worker
+    for n in range(num_processes):
+        region_queue.put(None)
+    workers = [multiprocessing.Process(target=count_regions_worker,
+                                       args=(bam_filename,
+                                             new_counter,
+                                             region_queue,
+                                             result_queue)) \
+               for n in range(num_processes)]
+    for worker in workers:
+        worker.start()
+    errors = []
+    try:
+        # Merge partial counts as workers finish, before joining
+        # them, so that workers are not blocked on a full queue
+        for n in range(num_processes):
+            succeeded, result = result_queue.get()
+            if not succeeded:
+                errors.append(result)
+                continue
+            counter.add_partial(result)
+    finally:
+        for worker in workers:
+            worker.join()
+    if len(errors) > 0:
+        raise Exception, "Counting reads in %s failed:\n%s" \
+              %(bam_filename, errors[0])
+    return counter
@@ -0,0 +1,379 @@
+##
+## Single-pass post-processing of mapped BAM files
+##
+import os
+import sys
+import time
+import csv
+
+import pysam
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+import rnaseqlib.bam.read_counters as read_counters
+import rnaseqlib.bam.bam_sort as bam_sort
+import rnaseqlib.bam.rmdups as rmdups_utils
+
+
+# Order of fields in the read counts file
+READ_COUNTS_HEADER = ["num_mapped",
+                      "num_unique_mapped",
+                      "num_ribosub_mapped",
+                      "num_ribo"]
+
+
+def get_bam_sort_order(bam_filename):
+    """
+    Return the sort order (SO field of @HD header line) of
+    a BAM file, or None if it is not recorded.
+    """
+    bamfile = pysam.Samfile(bam_filename, "rb")
+    header = bamfile.header
+    if hasattr(header, "to_dict"):
+        header = header.to_dict()
+    bamfile.close()
+    return header.get("HD", {}).get("SO", None)
+
+
+def load_read_counts(counts_filename):
+    """
+    Load read counts file produced by BamPostprocessor.
+
+    Returns a dictionary mapping count name to value or None
+    if the file is not available.
+    """
+    if (counts_filename is None) or \
+       (not os.path.isfile(counts_filename)):
+        return None
+    counts_in = csv.DictReader(open(counts_filename, "r"),
+                               delimiter="\t")
+    read_counts = {}
+    for field, value in counts_in.next().iteritems():
+        read_counts[field] = int(value)
+    return read_counts
+
+
+def output_read_counts(read_counts, counts_filename):
+    """
+    Write read counts to file.
+    """
+    counts_out = open(counts_filename, "w")
+    counts_out.write("%s\n" %("\t".join(READ_COUNTS_HEADER)))
+    counts_out.write("%s\n" %("\t".join([str(read_counts[field]) \
+                                        for field in READ_COUNTS_HEADER])))
+    counts_out.close()
+
+
+class BamPostprocessor:
+    """
+    Post-process a mapper's BAM file in a single pass.
+
+    Writes the unique, rRNA-subtracted and (optionally) duplicate
+    removed BAM files together and collects the number of
+    distinct read IDs that are mapped, uniquely mapped,
+    rRNA-subtracted and rRNA mapping along the way, so that
+    QC does not have to rescan any of the BAMs.
+
+    If the input BAM is coordinate-sorted, the outputs are
+    coordinate-sorted too. Otherwise, the alignments of each
+    read are expected to be grouped together (as in Bowtie
+    output) and the outputs have to be sorted afterwards, unless
+    they are sorted as they are written ('sort_outputs').
+
+    The input can also be a SAM stream (e.g. a named pipe fed by
+    the mapper), in which case 'sorted_input' and 'output_basename'
+    must be given since the header cannot be read twice.
+
+    - sort_outputs: sort outputs of grouped input as they are written
+    - sort_threads, sort_memory: threads and memory per thread
+      used for sorting each output. Sorted outputs are indexed
+      by the sorter if it can ('write_index').
+    - output_main: also write all input reads to a sorted main BAM
+      (only with 'sort_outputs')
+    - debug_bam_filename: if given, also write all input reads
+      unsorted to this BAM
+    - umi_regex: regular expression matching random barcodes in
+      read names, used when removing duplicates
+    """
+    def __init__(self, bam_filename, output_dir, logger,
+                 rmdups=False,
+                 chr_ribo="chrRibo",
+                 read_count_mode="auto",
+                 read_count_memory=read_counters.DEFAULT_READ_COUNT_MEMORY,
+                 sorted_input=None,
+                 output_basename=None,
+                 sort_outputs=False,
+                 sort_threads=1,
+                 sort_memory=None,
+                 output_main=False,
+                 debug_bam_filename=None,
+                 umi_regex=None):
+        self.bam_filename = bam_filename
+        self.output_dir = output_dir
+        self.logger = logger
+        self.rmdups = rmdups
+        self.chr_ribo = chr_ribo
+        self.read_count_mode = read_count_mode
+        self.read_count_memory = read_count_memory
+        self.sort_threads = sort_threads
+        self.sort_memory = sort_memory
+        self.debug_bam_filename = debug_bam_filename
+        self.umi_regex = umi_regex
+        # Read SAM input as text
+        self.input_mode = "rb"
+        if not self.bam_filename.endswith(".bam"):
+            self.input_mode = "r"
+        if output_basename is None:
+            if not self.bam_filename.endswith(".bam"):
+                self.logger.critical("BAM %s file does not end in .bam" \
+                                     %(self.bam_filename))
+            output_basename = os.path.basename(self.bam_filename)[0:-4]
+        self.bam_basename = output_basename
+        if sorted_input is None:
+            sorted_input = \
+                (get_bam_sort_order(self.bam_filename) == "coordinate")
+        self.sorted_input = sorted_input
+        self.sort_outputs = sort_outputs and (not self.sorted_input)
+        self.write_index = self.sort_outputs and bam_sort.can_write_index()
+        # Sorted input yields sorted outputs
+        ext = "bam"
+        if self.sorted_input or self.sort_outputs:
+            ext = "sorted.bam"
+        self.output_filenames = {}
+        if output_main and self.sort_outputs:
+            self.output_filenames["main"] = \
+                self.get_output_filename(ext)
+        self.output_filenames["unique"] = \
+            self.get_output_filename("unique.%s" %(ext))
+        self.output_filenames["ribosub"] = \
+            self.get_output_filename("ribosub.%s" %(ext))
+        if self.rmdups and self.sorted_input:
+            # Duplicates can only be removed on the fly when the
+            # input is coordinate-sorted
+            self.output_filenames["rmdups"] = \
+                self.get_output_filename("rmdups.sorted.bam")
+            self.output_filenames["rmdups_unique"] = \
+                self.get_output_filename("unique.rmdups.sorted.bam")
+        # Duplicate counts of each duplicate-removed output
+        self.dup_counts_filenames = {}
+        for output_label in ["rmdups", "rmdups_unique"]:
+            if output_label in self.output_filenames:
+                self.dup_counts_filenames[output_label] = \
+                    rmdups_utils.get_dup_counts_filename(self.output_filenames[output_label])
+        self.counts_filename = \
+            self.get_output_filename("read_counts.txt")
+        self.read_counts = None
+        # Output BAMs being written, by label
+        self.outputs = {}
+
+
+    def get_output_filename(self, suffix):
+        return os.path.join(self.output_dir,
+                            "%s.%s" %(self.bam_basename, suffix))
+
+
+    def outputs_sorted(self):
+        """
+        Return True if the outputs are coordinate-sorted.
+        """
+        return self.sorted_input or self.sort_outputs
+
+
+    def open_output(self, output_fname, template):
+        """
+        Open an output BAM, sorting it as it's written if asked.
+        """
+        if self.sort_outputs:
+            return bam_sort.SortedBamWriter(output_fname, template,
+                                            threads=self.sort_threads,
+                                            memory_per_thread=self.sort_memory,
+                                            write_index=self.write_index)
+        return pysam.Samfile(output_fname, "wb", template=template)
+
+
+    def abort_outputs(self):
+        """
+        Stop the sorters of outputs that are being sorted as they
+        are written (e.g. when post-processing failed).
+        """
+        for output_bam in self.outputs.values():
+            if hasattr(output_bam, "abort"):
+                output_bam.abort()
+
+
+    def is_done(self):
+        """
+        Return True if all outputs already exist.
+        """
+        for fname in self.output_filenames.values() + \
+                     self.dup_counts_filenames.values() + \
+                     [self.counts_filename]:
+            if not os.path.isfile(fname):
+                return False
+        return True
+
+
+    def get_ribo_read_ids(self, bamfile):
+        """
+        Get the IDs of reads mapping to the rRNA chromosome using
+        the BAM index.
+        """
+        ribo_read_ids = set()
+        try:
+            ribo_reads = bamfile.fetch(reference=self.chr_ribo,
+                                       start=None,
+                                       end=None,
+                                       multiple_iterators=True)
+            for ribo_read in ribo_reads:
+                ribo_read_ids.add(ribo_read.qname)
+        except:
+            self.logger.warning("Could not fetch %s from %s" \
+                                %(self.chr_ribo,
+                                  self.bam_filename))
+        return ribo_read_ids
+
+
+    def run(self):
+        """
+        Run the post-processing pass. Returns a dictionary of
+        read counts.
+        """
+        if self.is_done():
+            self.logger.info("Found post-processed BAMs for %s. Skipping.." \
+                             %(self.bam_filename))
+            self.read_counts = load_read_counts(self.counts_filename)
+            return self.read_counts
+        self.outputs = {}
+        try:
+            return self.write_outputs()
+        except:
+            exc_info = sys.exc_info()
+            self.abort_outputs()
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+
+    def write_outputs(self):
+        """
+        Read the input BAM and write the post-processed BAMs and
+        the read counts. Returns a dictionary of read counts.
+        """
+        self.logger.info("Post-processing BAM: %s" %(self.bam_filename))
+        for output_label, output_fname in self.output_filenames.iteritems():
+            self.logger.info("  - Output %s: %s" %(output_label,
+                                                   output_fname))
+        t1 = time.time()
+        bamfile = pysam.Samfile(self.bam_filename, self.input_mode)
+        # Use original file's headers for all outputs
+        outputs = self.outputs
+        for output_label, output_fname in self.output_filenames.iteritems():
+            outputs[output_label] = self.open_output(output_fname, bamfile)
+        debug_bam = None
+        if self.debug_bam_filename is not None:
+            self.logger.info("  - Debug output: %s" %(self.debug_bam_filename))
+            debug_bam = pysam.Samfile(self.debug_bam_filename, "wb",
+                                      template=bamfile)
+        if self.sorted_input:
+            ribo_read_ids = self.get_ribo_read_ids(bamfile)
+            read_groups = ([read] for read in bamfile)
+        else:
+            ribo_read_ids = set()
+            read_groups = self.group_reads_by_id(bamfile)
+        ribo_tid = None
+        if self.chr_ribo in bamfile.references:
+            ribo_tid = bamfile.references.index(self.chr_ribo)
+        # Counters of distinct read IDs. Reads come grouped by
+        # name unless the input is coordinate-sorted.
+        counters = {}
+        for count_field in READ_COUNTS_HEADER:
+            counters[count_field] = \
+                read_counters.get_read_id_counter(mode=self.read_count_mode,
+                                                  max_memory=self.read_count_memory,
+                                                  grouped=(not self.sorted_input))
+        # Duplicate removal for each duplicate-removed output
+        dedups = {}
+        for output_label in self.dup_counts_filenames:
+            dedups[output_label] = \
+                rmdups_utils.StreamingDeduplicator(umi_regex=self.umi_regex)
+        for reads in read_groups:
+            is_ribo = (reads[0].qname in ribo_read_ids)
+            if not self.sorted_input:
+                # Grouped input: the read is rRNA if any of its
+                # alignments are to the rRNA chromosome
+                is_ribo = \
+                    any([(r.tid == ribo_tid) for r in reads \
+                         if not r.is_unmapped])
+                if is_ribo:
+                    counters["num_ribo"].add(reads[0].qname)
+            for read in reads:
+                if debug_bam is not None:
+                    debug_bam.write(read)
+                if "main" in outputs:
+                    outputs["main"].write(read)
+                if read.is_unmapped:
+                    continue
+                counters["num_mapped"].add(read.qname)
+                # Keep only reads with 'NH' tag equal to 1
+                is_unique = ("NH", 1) in read.tags
+                if is_unique:
+                    counters["num_unique_mapped"].add(read.qname)
+                    outputs["unique"].write(read)
+                if not is_ribo:
+                    counters["num_ribosub_mapped"].add(read.qname)
+                    outputs["ribosub"].write(read)
+                if "rmdups" not in outputs:
+                    continue
+                for kept_read in dedups["rmdups"].add(read):
+                    outputs["rmdups"].write(kept_read)
+                if is_unique:
+                    for kept_read in dedups["rmdups_unique"].add(read):
+                        outputs["rmdups_unique"].write(kept_read)
+        for output_label, dedup in dedups.iteritems():
+            for kept_read in dedup.flush():
+                outputs[output_label].write(kept_read)
+            rmdups_utils.output_dup_counts(dedup.get_counts(),
+                                           self.dup_counts_filenames[output_label])
+        if self.sort_outputs:
+            # Close all outputs before waiting on the sorters, so
+            # that they finish in parallel
+            for output_bam in outputs.values():
+                output_bam.close(wait=False)
+            for output_bam in outputs.values():
+                output_bam.wait()
+        else:
+            for output_bam in outputs.values():
+                output_bam.close()
+        if debug_bam is not None:
+            debug_bam.close()
+        bamfile.close()
+        if self.sorted_input:
+            for ribo_read_id in ribo_read_ids:
+                counters["num_ribo"].add(ribo_read_id)
+        self.read_counts = {}
+        for count_field, counter in counters.iteritems():
+            self.read_counts[count_field] = counter.count()
+        if self.read_counts["num_unique_mapped"] == 0:
+            self.logger.warning("No unique reads found in %s" \
+                                %(self.bam_filename))
+        if self.read_counts["num_ribo"] == 0:
+            self.logger.warning("Could not find any rRNA mapping reads " \
+                                "in %s" %(self.bam_filename))
+        output_read_counts(self.read_counts, self.counts_filename)
+        t2 = time.time()
+        self.logger.info("Post-processing took %.2f mins" \
+                         %((t2 - t1)/60.))
+        return self.read_counts
+
+
+    def group_reads_by_id(self, bamfile):
+        """
+        Yield lists of consecutive alignments that share a read ID.
+        """
+        curr_group = []
+        for read in bamfile:
+            if (len(curr_group) > 0) and \
+               (read.qname != curr_group[0].qname):
+                yield curr_group
+                curr_group = []
+            curr_group.append(read)
+        if len(curr_group) > 0:
+            yield curr_group
@@ -0,0 +1,273 @@
+##
+## Coordinate-sorting of BAM files with samtools
+##
+import os
+import re
+import sys
+import time
+import errno
+import shutil
+import signal
+import tempfile
+import subprocess
+
+import pysam
+
+# Cached samtools version
+_samtools_version = []
+
+
+def parse_version(version_str):
+    """
+    Parse a version string like '1.10' or '0.1.19-44428cd' into
+    a tuple of integers.
+    """
+    version_match = re.match(r"(\d+(\.\d+)*)", version_str)
+    if version_match is None:
+        return None
+    return tuple(map(int, version_match.group(1).split(".")))
+
+
+def get_samtools_version():
+    """
+    Return the version of samtools on the path as a tuple of
+    integers (e.g. (1, 10)), or None if it cannot be determined.
+    """
+    if len(_samtools_version) > 0:
+        return _samtools_version[0]
+    version = None
+    proc = subprocess.Popen("samtools --version", shell=True,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    output = proc.communicate()
+    if (proc.returncode == 0) and output[0].startswith("samtools"):
+        version = parse_version(output[0].split()[1])
+    else:
+        # Older versions only print their version in the usage
+        proc = subprocess.Popen("samtools", shell=True,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        output = proc.communicate()
+        version_match = re.search(r"Version:\s*(\S+)",
+                                  output[0] + output[1])
+        if version_match is not None:
+            version = parse_version(version_match.group(1))
+    _samtools_version.append(version)
+    return version
+
+
+def can_write_index():
+    """
+    Return True if samtools sort can write the BAM index
+    itself (samtools 1.10+).
+    """
+    version = get_samtools_version()
+    return (version is not None) and (version >= (1, 10))
+
+
+def can_sort_stream():
+    """
+    Return True if samtools sort can sort reads as they are
+    written to it (samtools 1.0+, see SortedBamWriter).
+    """
+    version = get_samtools_version()
+    return (version is not None) and (version >= (1, 0))
+
+
+def get_sort_cmd(input_filename, output_filename,
+                 threads=1,
+                 memory_per_thread=None,
+                 tmp_prefix=None,
+                 write_index=False):
+    """
+    Return a samtools (1.x) command to coordinate-sort a BAM file.
+
+    - threads: number of sorting and compression threads
+    - memory_per_thread: maximum memory per thread (e.g. '768M')
+    - tmp_prefix: prefix of temporary files
+    - write_index: also write a .bai index (samtools 1.10+)
+    """
+    sort_cmd = "samtools sort -@ %d" %(threads)
+    if memory_per_thread is not None:
+        sort_cmd += " -m %s" %(memory_per_thread)
+    if tmp_prefix is not None:
+        sort_cmd += " -T %s" %(tmp_prefix)
+    if write_index:
+        sort_cmd += " --write-index -o %s##idx##%s.bai %s" \
+                    %(output_filename, output_filename, input_filename)
+    else:
+        sort_cmd += " -o %s %s" %(output_filename, input_filename)
+    return sort_cmd
+
+
+def get_legacy_sort_cmd(input_filename, output_filename,
+                        threads=1,
+                        memory_per_thread=None):
+    """
+    Return a samtools (0.1.x) command to coordinate-sort a BAM file.
+    """
+    sort_cmd = "samtools sort"
+    version = get_samtools_version()
+    if (version is not None) and (version >= (0, 1, 19)):
+        sort_cmd += " -@ %d" %(threads)
+        if memory_per_thread is not None:
+            sort_cmd += " -m %s" %(memory_per_thread)
+    # Output is given as a prefix
+    output_prefix = output_filename.rsplit(".bam", 1)[0]
+    sort_cmd += " %s %s" %(input_filename, output_prefix)
+    return sort_cmd
+
+
+def sort_bam(bam_filename, sorted_bam_filename,
+             threads=1,
+             memory_per_thread=None,
+             write_index=True):
+    """
+    Coordinate-sort a BAM file with the installed samtools.
+
+    If 'write_index' is set and samtools can write the index while
+    sorting, the .bai index is written too. Returns True if the
+    index was written.
+    """
+    version = get_samtools_version()
+    index_written = write_index and can_write_index()
+    if (version is not None) and (version < (1, 0)):
+        sort_cmd = get_legacy_sort_cmd(bam_filename, sorted_bam_filename,
+                                       threads=threads,
+                                       memory_per_thread=memory_per_thread)
+    else:
+        sort_cmd = get_sort_cmd(bam_filename, sorted_bam_filename,
+                                threads=threads,
+                                memory_per_thread=memory_per_thread,
+                                tmp_prefix="%s.tmp" %(sorted_bam_filename),
+                                write_index=index_written)
+    print "  - Executing: %s" %(sort_cmd)
+    if os.system(sort_cmd) != 0:
+        raise Exception, "Sorting failed: %s" %(sort_cmd)
+    return index_written
+
+
+def kill_process_group(proc):
+    """
+    Kill a process started in its own process group (with
+    os.setsid) along with its children, and wait for it.
+    """
+    if proc.poll() is None:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    proc.wait()
+
+
+class SortedBamWriter:
+    """
+    Write reads to a BAM file that is coordinate-sorted as it is
+    written, by a samtools sort subprocess.
+
+    Reads are passed to the sorter as uncompressed BAM through a
+    named pipe in a local temporary directory, so that nothing but
+    the final sorted BAM is written to the output directory.
+    Supports the write() and close() methods of pysam BAM files.
+
+    - write_index: also write a .bai index (samtools 1.10+)
+    """
+    def __init__(self, output_filename, template,
+                 threads=1,
+                 memory_per_thread=None,
+                 write_index=False):
+        if not can_sort_stream():
+            raise Exception, "Sorting BAMs as they are written needs " \
+                             "samtools 1.0+ (found: %s)" \
+                             %(get_samtools_version(),)
+        if write_index and (not can_write_index()):
+            raise Exception, "Writing the BAM index while sorting needs " \
+                             "samtools 1.10+ (found: %s)" \
+                             %(get_samtools_version(),)
+        self.output_filename = output_filename
+        self.pipe_dir = tempfile.mkdtemp(prefix="sort_pipe.")
+        self.pipe_filename = os.path.join(self.pipe_dir, "reads.bam")
+        os.mkfifo(self.pipe_filename)
+        self.sort_cmd = \
+            get_sort_cmd(self.pipe_filename, output_filename,
+                         threads=threads,
+                         memory_per_thread=memory_per_thread,
+                         tmp_prefix="%s.tmp" %(output_filename),
+                         write_index=write_index)
+        # Run the sorter in its own process group, so that it can
+        # be stopped along with its shell
+        self.sort_proc = subprocess.Popen(self.sort_cmd, shell=True,
+                                          preexec_fn=os.setsid)
+        self.bamfile = None
+        try:
+            self.bamfile = self.open_pipe(template)
+        except:
+            self.abort()
+            raise
+
+
+    def open_pipe(self, template, poll_interval=0.1):
+        """
+        Open the pipe to the sorter for writing. Opening a pipe
+        blocks until it is opened for reading, so wait for the
+        sorter to open it without blocking, and fail if the
+        sorter exits first.
+        """
+        while True:
+            try:
+                pipe_fd = os.open(self.pipe_filename,
+                                  os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except OSError, e:
+                if e.errno != errno.ENXIO:
+                    raise
+            if self.sort_proc.poll() is not None:
+                raise Exception, "Sorter exited (exit code %d) before " \
+                                 "reading its input: %s" \
+                                 %(self.sort_proc.returncode, self.sort_cmd)
+            time.sleep(poll_interval)
+        try:
+            # The sorter is reading, so this does not block
+            return pysam.Samfile(self.pipe_filename, "wbu",
+                                 template=template)
+        finally:
+            os.close(pipe_fd)
+
+
+    def write(self, read):
+        return self.bamfile.write(read)
+
+
+    def close(self, wait=True):
+        """
+        Finish writing and (optionally) wait for the sorter to
+        write the sorted BAM.
+        """
+        self.bamfile.close()
+        if wait:
+            self.wait()
+
+
+    def wait(self):
+        """
+        Wait for the sorter to write the sorted BAM.
+        """
+        returncode = self.sort_proc.wait()
+        shutil.rmtree(self.pipe_dir, ignore_errors=True)
+        if returncode != 0:
+            raise Exception, "Sorting failed (exit code %d): %s" \
+                             %(returncode, self.sort_cmd)
+
+
+    def abort(self):
+        """
+        Stop the sorter without waiting for a sorted BAM
+        (e.g. when writing the reads failed).
+        """
+        kill_process_group(self.sort_proc)
+        if self.bamfile is not None:
+            try:
+                self.bamfile.close()
+            except:
+                pass
+        shutil.rmtree(self.pipe_dir, ignore_errors=True)
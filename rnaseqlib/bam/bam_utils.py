@@ -48,6 +48,58 @@ def parse_tagBam_opt_field(opt_field,
     return regions
 
 
+# CIGAR operations that consume the reference and
+# are aligned (M, =, X)
+CIGAR_ALIGNED_OPS = (0, 7, 8)
+# CIGAR operations that consume the reference without
+# being aligned (D, N)
+CIGAR_SKIP_OPS = (2, 3)
+
+
+def get_read_blocks(read):
+    """
+    Return the aligned blocks of a read as a list of 0-based,
+    end-exclusive (start, end) reference coordinates.
+    Blocks are split at deletions and skipped regions (e.g.
+    introns of junction reads).
+    """
+    blocks = []
+    curr_pos = read.pos
+    for cigar_op, cigar_len in read.cigar:
+        if cigar_op in CIGAR_ALIGNED_OPS:
+            blocks.append((curr_pos, curr_pos + cigar_len))
+            curr_pos += cigar_len
+        elif cigar_op in CIGAR_SKIP_OPS:
+            curr_pos += cigar_len
+    return blocks
+
+
+def get_read_junctions(read):
+    """
+    Return the junctions a read spans (its 'N' CIGAR operations)
+    as a list of 0-based, end-exclusive (start, end) reference
+    coordinates of the skipped introns.
+    """
+    junctions = []
+    curr_pos = read.pos
+    for cigar_op, cigar_len in read.cigar:
+        if cigar_op == 3:
+            junctions.append((curr_pos, curr_pos + cigar_len))
+        if (cigar_op in CIGAR_ALIGNED_OPS) or (cigar_op in CIGAR_SKIP_OPS):
+            curr_pos += cigar_len
+    return junctions
+
+
+def is_junction_read(read):
+    """
+    Return True if the read spans a junction ('N' in CIGAR).
+    """
+    for cigar_op, cigar_len in read.cigar:
+        if cigar_op == 3:
+            return True
+    return False
+
+
 ##
 ## Utilities for converting bam to UCSC formats like
 ## bigWig
@@ -0,0 +1,158 @@
+##
+## Streaming pairing of mates from coordinate-sorted BAMs
+##
+import os
+import sys
+import heapq
+
+# Default maximum number of reads waiting for their mates
+DEFAULT_MAX_PENDING = 1000000
+
+
+def get_fragment_strand(read, first_read_antisense):
+    """
+    Return the strand ('+' or '-') of the transcript a read's
+    fragment came from, given the library's strand convention:
+
+    - first_read_antisense: True if the first read of a fragment
+      maps to the opposite strand of the transcript (as in
+      'fr-firststrand' libraries), False if it maps to the same
+      strand ('fr-secondstrand')
+    """
+    on_minus = read.is_reverse
+    # The second mate maps to the opposite strand of the first
+    if read.is_paired and read.is_read2:
+        on_minus = not on_minus
+    if first_read_antisense:
+        on_minus = not on_minus
+    return "-" if on_minus else "+"
+
+
+def parse_strand_convention(stranded):
+    """
+    Parse the 'stranded' setting (Tophat's library types, e.g.
+    'fr-firststrand' or 'fr-first'). Returns whether the first
+    read is antisense to the transcript, or None if the library
+    is not strand-specific.
+
+    Unknown conventions are treated as not strand-specific, with
+    a warning.
+    """
+    if stranded is None:
+        return None
+    stranded = stranded.strip().strip("\"'").lower()
+    if stranded in ("fr-unstranded", "none", "false", ""):
+        return None
+    if stranded in ("fr-first", "fr-firststrand"):
+        return True
+    if stranded in ("fr-second", "fr-secondstrand"):
+        return False
+    print "WARNING: Unknown strand convention %s, counting reads " \
+          "on both strands." %(stranded)
+    return None
+
+
+class MateBuffer:
+    """
+    Group coordinate-sorted alignments into fragments, pairing
+    mates by read name in a single pass (without sorting the
+    BAM by name).
+
+    A read whose mate maps further along the same chromosome is
+    held until the mate arrives. Since the input is sorted, the
+    mate cannot arrive once the input moves past its position:
+    the read is then released on its own (e.g. if the mate was
+    filtered out). Reads that are unpaired, whose mate is
+    unmapped or on another chromosome are released right away.
+
+    - max_pending: maximum number of reads waiting for their mates.
+      Past this, the read whose mate is due first is released on
+      its own, and its mate will form a fragment of its own too.
+    """
+    def __init__(self, max_pending=DEFAULT_MAX_PENDING):
+        self.max_pending = max_pending
+        self.num_pairs = 0
+        self.num_unpaired = 0
+        self.num_early_releases = 0
+        self.num_waiting = 0
+        self.reset()
+
+
+    def reset(self):
+        self.curr_tid = None
+        # (name, position, mate position) -> (read, waiting number)
+        self.pending = {}
+        # Heap of pending reads by mate position
+        self.pending_by_mate_pos = []
+
+
+    def release_pending(self, mate_pos, waiting_num, key):
+        """
+        Release a pending read on its own, if it is still waiting.
+        """
+        pending_read = self.pending.get(key)
+        if (pending_read is None) or (pending_read[1] != waiting_num):
+            return []
+        del self.pending[key]
+        self.num_unpaired += 1
+        return [[pending_read[0]]]
+
+
+    def add(self, read):
+        """
+        Add the next read of the input. Returns a list of complete
+        fragments, each a list of one or two reads.
+        """
+        fragments = []
+        if read.tid != self.curr_tid:
+            fragments = self.flush()
+            self.curr_tid = read.tid
+        # Reads whose mates were due before this read
+        while (len(self.pending_by_mate_pos) > 0) and \
+              (self.pending_by_mate_pos[0][0] < read.pos):
+            fragments.extend(
+                self.release_pending(*heapq.heappop(self.pending_by_mate_pos)))
+        if (not read.is_paired) or read.mate_is_unmapped or \
+           (read.rnext != read.tid):
+            self.num_unpaired += 1
+            fragments.append([read])
+            return fragments
+        mate = self.pending.pop((read.qname, read.pnext, read.pos), None)
+        if mate is not None:
+            self.num_pairs += 1
+            fragments.append([mate[0], read])
+            return fragments
+        if read.pnext < read.pos:
+            # Mate came before this read but was not buffered
+            self.num_unpaired += 1
+            fragments.append([read])
+            return fragments
+        key = (read.qname, read.pos, read.pnext)
+        if key in self.pending:
+            # Same name and positions as a pending read (e.g. a
+            # duplicated alignment): release the earlier read
+            self.num_unpaired += 1
+            fragments.append([self.pending[key][0]])
+        self.num_waiting += 1
+        self.pending[key] = (read, self.num_waiting)
+        heapq.heappush(self.pending_by_mate_pos,
+                       (read.pnext, self.num_waiting, key))
+        while len(self.pending) > self.max_pending:
+            released = \
+                self.release_pending(*heapq.heappop(self.pending_by_mate_pos))
+            self.num_early_releases += len(released)
+            fragments.extend(released)
+        return fragments
+
+
+    def flush(self):
+        """
+        Release all pending reads on their own (at the end of
+        a chromosome or of the input).
+        """
+        fragments = []
+        while len(self.pending_by_mate_pos) > 0:
+            fragments.extend(
+                self.release_pending(*heapq.heappop(self.pending_by_mate_pos)))
+        self.reset()
+        return fragments
@@ -0,0 +1,183 @@
+##
+## Memory-compact counting of distinct read IDs (QNAMEs)
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+import pysam
+
+
+# Supported read counting modes:
+#  - hash: store 64-bit hashes of read IDs in numpy arrays
+#  - exact: count runs of identical read IDs; requires reads
+#    to be grouped by name (e.g. name-sorted BAMs), otherwise
+#    read IDs are hashed
+#  - auto: exact if the BAM is known to be grouped by name,
+#    hash otherwise
+READ_COUNT_MODES = ["auto", "hash", "exact"]
+# Default memory cap (in MB) for hashed read counting
+DEFAULT_READ_COUNT_MEMORY = 2048
+# Number of partitions to spill hashes to when the memory
+# cap is exceeded
+NUM_SPILL_PARTITIONS = 64
+
+
+class GroupedReadIdCounter:
+    """
+    Exact count of distinct read IDs for reads grouped by
+    name: counts runs of identical IDs, using constant memory.
+    """
+    def __init__(self):
+        self.num_ids = 0
+        self.last_id = None
+
+
+    def add(self, read_id):
+        if read_id != self.last_id:
+            self.num_ids += 1
+            self.last_id = read_id
+
+
+    def count(self):
+        return self.num_ids
+
+
+class HashedReadIdCounter:
+    """
+    Count distinct read IDs by storing 64-bit hashes of them.
+
+    Hashes are buffered and periodically merged into a sorted
+    numpy array of unique hashes, so that about 8 bytes are used
+    per distinct read. If the array grows past the memory cap,
+    hashes are spilled to disk in partitions (by their top bits)
+    that are each counted separately at the end.
+
+    With 64-bit hashes the expected number of collisions is
+    well below one read for a billion reads.
+    """
+    def __init__(self, max_memory=DEFAULT_READ_COUNT_MEMORY,
+                 buffer_size=2**20):
+        # Memory cap in MB. Merging needs about three times the
+        # space of the stored hashes.
+        self.max_memory = max_memory
+        self.max_hashes = max(buffer_size,
+                              int(max_memory * (2**20) / (3 * 8)))
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.hashes = np.array([], dtype=np.int64)
+        # Directory of spilled hash partitions
+        self.spill_dir = None
+
+
+    def add(self, read_id):
+        self.buffer.append(hash(read_id))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+
+    def flush(self):
+        """
+        Merge buffered hashes into the sorted hashes array.
+        """
+        if len(self.buffer) == 0:
+            return
+        new_hashes = np.array(self.buffer, dtype=np.int64)
+        self.buffer = []
+        if self.spill_dir is not None:
+            self.spill(new_hashes)
+            return
+        self.hashes = np.union1d(self.hashes, new_hashes)
+        if len(self.hashes) > self.max_hashes:
+            self.spill_dir = tempfile.mkdtemp(prefix="read_ids.")
+            self.spill(self.hashes)
+            self.hashes = np.array([], dtype=np.int64)
+
+
+    def spill(self, hashes):
+        """
+        Append hashes to the partition files on disk.
+        """
+        partitions = (hashes >> 58) & (NUM_SPILL_PARTITIONS - 1)
+        for partition in np.unique(partitions):
+            partition_fname = os.path.join(self.spill_dir,
+                                           "%d.bin" %(partition))
+            with open(partition_fname, "ab") as partition_file:
+                np.unique(hashes[partitions == partition]).tofile(partition_file)
+
+
+    def count(self):
+        self.flush()
+        if self.spill_dir is None:
+            return len(self.hashes)
+        num_ids = 0
+        for partition_fname in os.listdir(self.spill_dir):
+            partition_hashes = \
+                np.fromfile(os.path.join(self.spill_dir, partition_fname),
+                            dtype=np.int64)
+            num_ids += len(np.unique(partition_hashes))
+        shutil.rmtree(self.spill_dir)
+        self.spill_dir = None
+        return num_ids
+
+
+def is_grouped_by_name(bam_filename):
+    """
+    Return True if the BAM header says its reads are sorted
+    or grouped by read name.
+    """
+    bamfile = pysam.Samfile(bam_filename, "rb")
+    header = bamfile.header
+    if hasattr(header, "to_dict"):
+        header = header.to_dict()
+    bamfile.close()
+    hd_fields = header.get("HD", {})
+    return (hd_fields.get("SO", None) == "queryname") or \
+           (hd_fields.get("GO", None) == "query")
+
+
+def get_read_id_counter(mode="hash",
+                        max_memory=DEFAULT_READ_COUNT_MEMORY,
+                        grouped=False):
+    """
+    Return a read ID counter for the given mode.
+
+    - mode: read counting mode (see READ_COUNT_MODES)
+    - max_memory: memory cap in MB for hashed counting
+    - grouped: whether reads are known to be grouped by name
+    """
+    if mode not in READ_COUNT_MODES:
+        raise Exception, "Unknown read counting mode %s." %(mode)
+    if (mode == "exact") and (not grouped):
+        # Counting runs of identical IDs would count a read again
+        # for each of its mates or alignments that are not adjacent
+        print "WARNING: exact read counting needs reads grouped by " \
+              "name; counting hashed read IDs instead."
+        mode = "hash"
+    if (mode in ["exact", "auto"]) and grouped:
+        return GroupedReadIdCounter()
+    return HashedReadIdCounter(max_memory=max_memory)
+
+
+def count_read_ids(bam_in, mode="auto",
+                   max_memory=DEFAULT_READ_COUNT_MEMORY):
+    """
+    Count distinct read IDs in a BAM file or stream of reads.
+    In 'auto' mode, BAM files whose header marks them as grouped
+    by name are counted exactly.
+    """
+    grouped = False
+    bam_reads = bam_in
+    if isinstance(bam_in, basestring):
+        grouped = is_grouped_by_name(bam_in)
+        bam_reads = pysam.Samfile(bam_in, "rb")
+    counter = get_read_id_counter(mode=mode,
+                                  max_memory=max_memory,
+                                  grouped=grouped)
+    for read in bam_reads:
+        counter.add(read.qname)
+    return counter.count()
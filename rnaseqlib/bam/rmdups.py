@@ -0,0 +1,261 @@
+##
+## Streaming removal of PCR duplicates from coordinate-sorted BAMs
+##
+import os
+import re
+import csv
+import heapq
+
+import pysam
+
+# Order of fields in a duplicate counts file
+DUP_COUNTS_HEADER = ["num_alignments",
+                     "num_duplicates"]
+
+# Default maximum number of pending duplicate groups
+DEFAULT_MAX_WINDOW = 500000
+
+
+def get_read_five_prime(read):
+    """
+    Return the (0-based) position of the 5' end of a read:
+    its leftmost position on the forward strand and its last
+    aligned position on the reverse strand.
+    """
+    if read.is_reverse:
+        return read.aend - 1
+    return read.pos
+
+
+def get_dup_counts_filename(rmdups_bam_filename):
+    """
+    Return the name of the duplicate counts file kept next to
+    a duplicate-removed BAM.
+    """
+    basename = rmdups_bam_filename
+    if basename.endswith(".bam"):
+        basename = basename[0:-4]
+    if basename.endswith(".sorted"):
+        basename = basename[0:-7]
+    return "%s.dup_counts.txt" %(basename)
+
+
+def load_dup_counts(counts_filename):
+    """
+    Load duplicate counts file. Returns a dictionary mapping
+    count name to value or None if the file is not available.
+    """
+    if (counts_filename is None) or \
+       (not os.path.isfile(counts_filename)):
+        return None
+    counts_in = csv.DictReader(open(counts_filename, "r"),
+                               delimiter="\t")
+    dup_counts = {}
+    for field, value in counts_in.next().iteritems():
+        dup_counts[field] = int(value)
+    return dup_counts
+
+
+def output_dup_counts(dup_counts, counts_filename):
+    """
+    Write duplicate counts to file.
+    """
+    counts_out = open(counts_filename, "w")
+    counts_out.write("%s\n" %("\t".join(DUP_COUNTS_HEADER)))
+    counts_out.write("%s\n" %("\t".join([str(dup_counts[field]) \
+                                        for field in DUP_COUNTS_HEADER])))
+    counts_out.close()
+
+
+class StreamingDeduplicator:
+    """
+    Remove PCR duplicates from coordinate-sorted single-end
+    reads in a single streaming pass.
+
+    Reads are duplicates if they map to the same chromosome and
+    strand with the same 5' end (the crosslink-proximal end for
+    CLIP) and, if 'umi_regex' is given, carry the same random
+    barcode in their read name. Of each set of duplicates, the
+    read with the highest mapping quality is kept (the first one
+    seen on ties).
+
+    Since the input is sorted by leftmost position, a set of
+    duplicates is complete as soon as the input moves past its
+    5' end, so only reads whose 5' end lies ahead of the input
+    are buffered. Kept reads are released in coordinate order,
+    so the output is sorted too.
+
+    - umi_regex: regular expression matching the random barcode
+      in read names (its first group is used, if it has one)
+    - max_window: maximum number of pending duplicate sets. Past
+      this, the set with the leftmost 5' end is released early,
+      which can leave duplicates of very long (spliced) reverse
+      strand reads in the output.
+    """
+    def __init__(self, umi_regex=None,
+                 max_window=DEFAULT_MAX_WINDOW):
+        self.umi_regex = None
+        if umi_regex is not None:
+            self.umi_regex = re.compile(umi_regex)
+        self.max_window = max_window
+        self.num_alignments = 0
+        self.num_duplicates = 0
+        self.num_early_releases = 0
+        self.num_groups = 0
+        self.reset()
+
+
+    def reset(self):
+        """
+        Clear the buffers (at the start of each chromosome).
+        """
+        self.curr_tid = None
+        self.curr_pos = None
+        # Duplicate key -> [kept read, leftmost position, group number]
+        self.groups = {}
+        # Heaps of pending groups by 5' end and by leftmost position
+        self.groups_by_five_prime = []
+        self.groups_by_start = []
+        # Heap of kept reads of complete groups by position
+        self.released = []
+
+
+    def get_umi(self, read):
+        if self.umi_regex is None:
+            return None
+        umi_match = self.umi_regex.search(read.qname)
+        if umi_match is None:
+            return None
+        if umi_match.lastindex is None:
+            return umi_match.group(0)
+        return umi_match.group(1)
+
+
+    def release_group(self, key):
+        kept_read, start, group_num = self.groups.pop(key)
+        heapq.heappush(self.released, (kept_read.pos, group_num, kept_read))
+
+
+    def get_released_reads(self):
+        """
+        Return the kept reads that no pending group can precede,
+        in coordinate order.
+        """
+        # Drop entries of groups that were already released
+        while (len(self.groups_by_start) > 0):
+            start, group_num, key = self.groups_by_start[0]
+            group = self.groups.get(key)
+            if (group is not None) and (group[2] == group_num):
+                break
+            heapq.heappop(self.groups_by_start)
+        min_start = None
+        if len(self.groups_by_start) > 0:
+            min_start = self.groups_by_start[0][0]
+        released_reads = []
+        while (len(self.released) > 0) and \
+              ((min_start is None) or (self.released[0][0] <= min_start)):
+            released_reads.append(heapq.heappop(self.released)[2])
+        return released_reads
+
+
+    def add(self, read):
+        """
+        Add the next read of the input. Returns a list of kept
+        reads that can be written out.
+        """
+        released_reads = []
+        if read.is_unmapped:
+            # Unmapped reads have no position: pass them through
+            released_reads = self.flush()
+            released_reads.append(read)
+            return released_reads
+        if read.tid != self.curr_tid:
+            released_reads = self.flush()
+            self.curr_tid = read.tid
+        elif read.pos < self.curr_pos:
+            raise Exception, "Cannot remove duplicates: input is not " \
+                             "coordinate-sorted (read %s)." %(read.qname)
+        self.curr_pos = read.pos
+        # Groups whose 5' end the input has moved past are complete
+        while (len(self.groups_by_five_prime) > 0) and \
+              (self.groups_by_five_prime[0][0] < read.pos):
+            self.release_group(heapq.heappop(self.groups_by_five_prime)[1])
+        self.num_alignments += 1
+        five_prime = get_read_five_prime(read)
+        key = (five_prime, read.is_reverse, self.get_umi(read))
+        group = self.groups.get(key)
+        if group is not None:
+            self.num_duplicates += 1
+            if read.mapq > group[0].mapq:
+                group[0] = read
+        else:
+            self.num_groups += 1
+            self.groups[key] = [read, read.pos, self.num_groups]
+            heapq.heappush(self.groups_by_five_prime, (five_prime, key))
+            heapq.heappush(self.groups_by_start,
+                           (read.pos, self.num_groups, key))
+            if len(self.groups) > self.max_window:
+                self.num_early_releases += 1
+                self.release_group(heapq.heappop(self.groups_by_five_prime)[1])
+        released_reads.extend(self.get_released_reads())
+        return released_reads
+
+
+    def flush(self):
+        """
+        Release all buffered reads (at the end of a chromosome or
+        of the input). Returns the kept reads in coordinate order.
+        """
+        while len(self.groups_by_five_prime) > 0:
+            self.release_group(heapq.heappop(self.groups_by_five_prime)[1])
+        released_reads = [heapq.heappop(self.released)[2] \
+                          for n in range(len(self.released))]
+        self.reset()
+        return released_reads
+
+
+    def get_counts(self):
+        """
+        Return the number of alignments seen and the number of
+        duplicates removed.
+        """
+        return {"num_alignments": self.num_alignments,
+                "num_duplicates": self.num_duplicates}
+
+
+def rmdups_bam(bam_filename, output_filename, logger,
+               umi_regex=None,
+               max_window=DEFAULT_MAX_WINDOW,
+               counts_filename=None):
+    """
+    Remove duplicates from a coordinate-sorted BAM file. The
+    output BAM is coordinate-sorted.
+
+    - counts_filename: if given, write the duplicate counts
+      to this file
+
+    Returns a dictionary of duplicate counts.
+    """
+    logger.info("Removing duplicates from %s" %(bam_filename))
+    bamfile = pysam.Samfile(bam_filename, "rb")
+    output_bam = pysam.Samfile(output_filename, "wb", template=bamfile)
+    dedup = StreamingDeduplicator(umi_regex=umi_regex,
+                                  max_window=max_window)
+    for read in bamfile:
+        for kept_read in dedup.add(read):
+            output_bam.write(kept_read)
+    for kept_read in dedup.flush():
+        output_bam.write(kept_read)
+    output_bam.close()
+    bamfile.close()
+    dup_counts = dedup.get_counts()
+    logger.info("  - Removed %d duplicates of %d alignments" \
+                %(dup_counts["num_duplicates"],
+                  dup_counts["num_alignments"]))
+    if dedup.num_early_releases > 0:
+        logger.warning("  - Duplicate window was exceeded %d times; " \
+                       "some duplicates may remain." \
+                       %(dedup.num_early_releases))
+    if counts_filename is not None:
+        output_dup_counts(dup_counts, counts_filename)
+    return dup_counts
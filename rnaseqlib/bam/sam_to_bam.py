@@ -5,8 +5,19 @@
 import os
 import time
 
+import rnaseqlib
+import rnaseqlib.bam.bam_sort as bam_sort
+
 def sam_to_bam(sam_filename, output_dir,
-               header_ref=None):
+               header_ref=None,
+               threads=1,
+               memory_per_thread=None):
+    """
+    Convert SAM to a sorted, indexed BAM file.
+
+    - threads: number of threads used for sorting
+    - memory_per_thread: memory per sorting thread (e.g. '768M')
+    """
     # Convert to BAM
     print "Converting SAM to BAM..."
     if not os.path.isdir(output_dir):
@@ -24,18 +35,17 @@ def sam_to_bam(sam_filename, output_dir,
 
     # Sort
     print "Sorting BAM file..."
-    sorted_filename = "%s.sorted" %(bam_filename.split(".bam")[0])
-    cmd = "samtools sort %s %s" %(bam_filename,
-                                  sorted_filename)
-    print "  - Executing: %s" %(cmd)
-    os.system(cmd)
+    final_filename = "%s.sorted.bam" %(bam_filename.split(".bam")[0])
+    index_written = bam_sort.sort_bam(bam_filename, final_filename,
+                                      threads=threads,
+                                      memory_per_thread=memory_per_thread)
 
-    # Index
-    final_filename = "%s.bam" %(sorted_filename)
-    print "Indexing BAM..."
-    cmd = "samtools index %s" %(final_filename)
-    print "  - Executing: %s" %(cmd)
-    os.system(cmd)
+    # Index (unless written by the sorter)
+    if not index_written:
+        print "Indexing BAM..."
+        cmd = "samtools index %s" %(final_filename)
+        print "  - Executing: %s" %(cmd)
+        os.system(cmd)
 
     t2 = time.time()
     print "Conversion took %.2f minutes." %((t2 - t1)/60.)
@@ -48,6 +58,10 @@ def main():
                       "with headers. Takes SAM filename and output directory.")
     parser.add_option("--ref", dest="ref", nargs=1, default=None,
                       help="References file to use to get chromosome lengths.")
+    parser.add_option("--threads", dest="threads", nargs=1, type="int", default=1,
+                      help="Number of threads to use for sorting.")
+    parser.add_option("--sort-memory", dest="sort_memory", nargs=1, default=None,
+                      help="Memory per sorting thread (e.g. 768M).")
     (options, args) = parser.parse_args()
 
     if options.convert != None:
@@ -60,7 +74,9 @@ def main():
         sam_filename = os.path.abspath(os.path.expanduser(options.convert[0]))
         output_dir = os.path.abspath(os.path.expanduser(options.convert[1]))
 
-        sam_to_bam(sam_filename, output_dir, header_ref=ref)
+        sam_to_bam(sam_filename, output_dir, header_ref=ref,
+                   threads=options.threads,
+                   memory_per_thread=options.sort_memory)
         
     else:
         print "Need --convert to convert SAM to BAM."
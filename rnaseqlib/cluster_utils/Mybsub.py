@@ -1,28 +1,60 @@
 import rnaseqlib
 import rnaseqlib.utils as utils
+import rnaseqlib.cluster_utils.job_poller as job_poller
 
 import os, os.path, subprocess, sys, time, getpass
 from optparse import OptionParser
 
 
-def waitUntilDone(jobID, sleep=60):
+# Job states that mean a job is no longer running
+FINISHED_STATES = ["DONE", "EXIT", "ZOMBI"]
+
+
+def getActiveJobs(jobIDs):
+    """
+    Return the set of job IDs that are still pending or running,
+    querying all of them with a single bjobs call.
+
+    Returns None if bjobs failed.
+    """
+    ids_by_str = dict([(str(jobID), jobID) for jobID in jobIDs])
+    proc = subprocess.Popen("bjobs %s" %(" ".join(ids_by_str.keys())),
+                            shell=True,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    output = proc.communicate()
+    active = set()
+    num_found = 0
+    for line in output[0].splitlines():
+        fields = line.split()
+        if (len(fields) < 3) or (fields[0] not in ids_by_str):
+            continue
+        num_found += 1
+        status = fields[2]
+        if status not in FINISHED_STATES:
+            active.add(ids_by_str[fields[0]])
+        elif status == "EXIT":
+            print "WARNING: Job %s exited with an error." %(fields[0])
+    # Jobs that bjobs does not know about are finished
+    if (proc.returncode != 0) and (num_found == 0) and \
+       ("not found" not in output[1]):
+        return None
+    return active
+
+
+def waitUntilAllDone(jobIDs, logger=None):
+    """
+    Waits until none of the job IDs are pending or running.
+    """
+    job_poller.wait_until_done(jobIDs, getActiveJobs,
+                               logger=logger)
+
+
+def waitUntilDone(jobID):
     """
-    Waits until a job ID is no longer found in the bjobs output.
+    Waits until a job ID is no longer pending or running.
     """
-    while True:
-        output = subprocess.Popen("bjobs %i"%jobID,
-                                  shell=True,
-                                  stdout=subprocess.PIPE,
-                                  stderr=subprocess.PIPE).communicate()
-        if len(output[0]) > 0:
-            status = output[0].split()[10]
-            if status == "DONE":
-                break
-        else:
-            # No jobs available
-            break
-        time.sleep(sleep)
-    time.sleep(sleep)
+    waitUntilAllDone([jobID])
 
     
 def launchJob(cmd, job_name,
@@ -32,7 +64,8 @@ def launchJob(cmd, job_name,
               test=False,
               ppn="4",
               queue_type=None,
-              memory=None):
+              memory=None,
+              num_tasks=None):
     """
     Submits a job on the cluster which will run command 'cmd',
     with options 'scriptOptions'
@@ -41,6 +74,8 @@ def launchJob(cmd, job_name,
     verbose: output the job script
     test: don't actually submit the job script
           (usually used in conjunction with verbose)
+    num_tasks: submit a job array of tasks 1..num_tasks; each
+          task gets its index in $LSB_JOBINDEX
 
     Returns a job ID if the job was submitted properly
     """
@@ -70,6 +105,11 @@ def launchJob(cmd, job_name,
     scriptOptions["outf"] = \
         os.path.abspath(os.path.join(script_outdir,
                                      outscriptName+".out"))
+    if num_tasks is not None:
+        scriptOptions["jobname"] = "%s[1-%d]" %(scriptOptions["jobname"],
+                                                num_tasks)
+        # One output file per task
+        scriptOptions["outf"] = "%s.%%I" %(scriptOptions["outf"])
     # exclude rusage
     ##BSUB -R "rusage[mem=800]"
     
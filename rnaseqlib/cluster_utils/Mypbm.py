@@ -1,24 +1,60 @@
 import rnaseqlib
 import rnaseqlib.utils as utils
+import rnaseqlib.cluster_utils.job_poller as job_poller
 
 import os, subprocess, sys, time, getpass
 from optparse import OptionParser
 
-def waitUntilDone(jobID,
-                  sleep=60):
+# Job states that mean a job is no longer running
+FINISHED_STATES = ["C"]
+
+
+def getActiveJobs(jobIDs):
+    """
+    Return the set of job IDs that are still queued or running,
+    querying all of them with a single qstat call.
+
+    Returns None if qstat failed.
+    """
+    ids_by_str = dict([(str(jobID), jobID) for jobID in jobIDs])
+    proc = subprocess.Popen("qstat %s" %(" ".join(ids_by_str.keys())),
+                            shell=True,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    output = proc.communicate()
+    active = set()
+    num_found = 0
+    for line in output[0].splitlines():
+        fields = line.split()
+        if len(fields) < 5:
+            continue
+        # Job IDs are listed with the server name
+        listed_id = fields[0].split(".")[0]
+        if listed_id not in ids_by_str:
+            continue
+        num_found += 1
+        if fields[4] not in FINISHED_STATES:
+            active.add(ids_by_str[listed_id])
+    # Jobs that qstat does not know about are finished
+    if (proc.returncode != 0) and (num_found == 0) and \
+       ("Unknown Job" not in output[1]):
+        return None
+    return active
+
+
+def waitUntilAllDone(jobIDs, logger=None):
+    """
+    Waits until none of the job IDs are found in the qstat output.
+    """
+    job_poller.wait_until_done(jobIDs, getActiveJobs,
+                               logger=logger)
+
+
+def waitUntilDone(jobID):
     """
     Waits until a job ID is no longer found in the qstat output
     """
-    while True:
-        output = \
-            subprocess.Popen("qstat %i" %(jobID),
-                             shell=True,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE).communicate()
-        if "Unknown Job" in output[1]:
-            break
-        time.sleep(sleep)
-    time.sleep(sleep)
+    waitUntilAllDone([jobID])
 
         
 def launchJob(cmd, job_name, scriptOptions,
@@ -26,7 +62,8 @@ def launchJob(cmd, job_name, scriptOptions,
               test=False,
               fast=False,
               queue_type="quick",
-              ppn="4"):
+              ppn="4",
+              num_tasks=None):
     """
     Submits a job on the cluster which will run command 'cmd',
     with options 'scriptOptions'
@@ -36,6 +73,8 @@ def launchJob(cmd, job_name, scriptOptions,
     test: don't actually submit the job script
           (usually used in conjunction with verbose)
     fast: submit only to the fast nodes on coyote
+    num_tasks: submit a job array of tasks 1..num_tasks; each
+          task gets its index in $PBS_ARRAYID
 
     Returns a job ID if the job was submitted properly
     """
@@ -64,6 +103,10 @@ def launchJob(cmd, job_name, scriptOptions,
             "Can only choose specific nodes if you're " \
             "not restricting jobs to the fast nodes."
         scriptOptions["nodes"] = "1:E5450"
+
+    scriptOptions["array_option"] = ""
+    if num_tasks is not None:
+        scriptOptions["array_option"] = "#PBS -t 1-%d" %(num_tasks)
     
     outtext = """#!/bin/bash
 
@@ -77,6 +120,7 @@ def launchJob(cmd, job_name, scriptOptions,
     #PBS -q %(queue)s
 
     #PBS -S /bin/bash
+    %(array_option)s
 
     echo $HOSTNAME
 
@@ -106,7 +150,9 @@ def launchJob(cmd, job_name, scriptOptions,
             output = qsub.communicate()
 
             if output[0].strip().endswith(".coyote.mit.edu"):
-                jobID = int(output[0].split(".")[0])
+                jobID = output[0].split(".")[0]
+                if num_tasks is None:
+                    jobID = int(jobID)
 
                 if verbose:
                     print "Process launched with job ID:", jobID
@@ -1,17 +1,43 @@
 import os, os.path, subprocess, sys, time, getpass
 from optparse import OptionParser
 
-def waitUntilDone(jobID, sleep=1):
-    """ Waits until a job ID is no longer found in the qstat output """
-    while True:
-        output = subprocess.Popen("qstat -j %i"%jobID, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
+import rnaseqlib.cluster_utils.job_poller as job_poller
+
+def getActiveJobs(jobIDs):
+    """
+    Return the set of job IDs that are still queued or running,
+    listing all of the user's jobs with a single qstat call.
 
-        if "Following jobs do not exist:" in output[1]:
-            break
-        time.sleep(sleep)
+    Returns None if qstat failed.
+    """
+    ids_by_str = dict([(str(jobID), jobID) for jobID in jobIDs])
+    proc = subprocess.Popen("qstat -u %s" %(getpass.getuser()),
+                            shell=True,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    output = proc.communicate()
+    if proc.returncode != 0:
+        return None
+    active = set()
+    for line in output[0].splitlines():
+        fields = line.split()
+        if (len(fields) > 0) and (fields[0] in ids_by_str):
+            active.add(ids_by_str[fields[0]])
+    return active
+
+
+def waitUntilAllDone(jobIDs, logger=None):
+    """ Waits until none of the job IDs are found in the qstat output """
+    job_poller.wait_until_done(jobIDs, getActiveJobs,
+                               logger=logger)
+
+
+def waitUntilDone(jobID):
+    """ Waits until a job ID is no longer found in the qstat output """
+    waitUntilAllDone([jobID])
         
 def launchJob(cmd, scriptOptions, verbose=True, test=False, fast=True,
-              queue_type="quick", scratchDir="/tmp"):
+              queue_type="quick", scratchDir="/tmp", num_tasks=None):
     """
     Submits a job on the cluster which will run command 'cmd', with options 'scriptOptions'
 
@@ -19,6 +45,7 @@ def launchJob(cmd, scriptOptions, verbose=True, test=False, fast=True,
     verbose: output the job script
     test: don't actually submit the job script (usually used in conjunction with verbose)
     fast: submit only to the fast nodes on coyote
+    num_tasks: submit a job array of tasks 1..num_tasks; each task gets its index in $SGE_TASK_ID
 
     Returns a job ID if the job was submitted properly
     """
@@ -51,6 +78,9 @@ def launchJob(cmd, scriptOptions, verbose=True, test=False, fast=True,
         assert scriptOptions["nodes"] == "1", "Can only choose specific nodes if you're not restricting jobs to the fast nodes."
         scriptOptions["nodes"] = "1:E5450"
 
+    scriptOptions["array_option"] = ""
+    if num_tasks is not None:
+        scriptOptions["array_option"] = "#$ -t 1-%d" %(num_tasks)
     
     outtext = """#!/bin/bash
 
@@ -61,6 +91,7 @@ def launchJob(cmd, scriptOptions, verbose=True, test=False, fast=True,
 #$ -j y
 #$ -cwd
 #$ -o %(outdir)s
+%(array_option)s
 
 echo $HOSTNAME
 echo Working directory is %(workingdir)s
@@ -92,7 +123,8 @@ echo "===== %(command)s finished =====" """ % scriptOptions
             output = qsub.communicate()
 
             if output[0].startswith("Your job "):
-                jobID = int(output[0].split(" ")[2])
+                # Job arrays are reported as "<id>.<first>-<last>:<step>"
+                jobID = int(output[0].split(" ")[2].split(".")[0])
 
                 if verbose:
                     print "Process launched with job ID:", jobID
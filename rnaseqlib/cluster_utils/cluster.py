@@ -5,9 +5,31 @@ import os
 import subprocess
 import sys
 import time
+import threading
 
 import rnaseqlib
 from rnaseqlib.cluster_utils import Mybsub, Mypbm, Mysge
+import rnaseqlib.cluster_utils.local_executor as local_executor
+import rnaseqlib.utils as utils
+
+# Environment variable holding the task number (1-based) of
+# a job array task, by cluster type
+ARRAY_TASK_ID_VARS = {"bsub": "LSB_JOBINDEX",
+                      "qsub": "PBS_ARRAYID",
+                      "sge": "SGE_TASK_ID"}
+
+# Shell script that runs the command listed for a task in a job
+# array index file. Arguments are the index filename and the
+# task number.
+ARRAY_TASK_SCRIPT = """#!/bin/sh
+TASK_CMD=`awk -F '\\t' -v task_num="$2" '$1 == task_num { print $NF }' "$1"`
+if [ -z "$TASK_CMD" ]; then
+  echo "No task $2 in $1"
+  exit 1
+fi
+echo "Task $2: $TASK_CMD"
+eval "$TASK_CMD"
+"""
 
 class Cluster:
     """
@@ -17,9 +39,11 @@ class Cluster:
                  cluster_type,
                  output_dir,
                  logger,
-                 supported_types=["bsub", "qsub", "none"],
+                 supported_types=["bsub", "qsub", "sge", "none"],
                  cluster_queue=None,
-                 cluster_memory=None):
+                 cluster_memory=None,
+                 local_max_cores=None,
+                 local_max_memory=None):
         self.logger = logger
         self.cluster_type = cluster_type.lower()
         self.cluster_queue = cluster_queue
@@ -35,26 +59,121 @@ class Cluster:
             print "Error: unsupported cluster type %s" \
                 %(self.cluster_type)
             sys.exit(1)
+        # Executor for running jobs on the local machine
+        self.local_executor = None
+        if self.cluster_type == "none":
+            self.local_executor = \
+                local_executor.LocalExecutor(self.logger,
+                                             max_cores=local_max_cores,
+                                             max_memory=local_max_memory)
+            self.logger.info("Running jobs locally with at most %s cores " \
+                             "and %s MB of memory." \
+                             %(self.local_executor.max_cores,
+                               self.local_executor.max_memory))
+
+
+    def get_job_memory(self):
+        """
+        Return memory per job in MB, if given.
+        """
+        if self.cluster_memory is None:
+            return None
+        try:
+            return int(self.cluster_memory)
+        except ValueError:
+            self.logger.warning("Cannot parse cluster memory %s" \
+                                %(self.cluster_memory))
+            return None
             
 
     def launch_and_wait(self, cmd, job_name,
                         unless_exists=None,
-                        extra_sleep=20,
-                        ppn=1):
+                        extra_sleep=0,
+                        ppn=1,
+                        check=True):
         """
-        Launch job and wait until it's done.
+        Launch job and wait until it's done. Returns the exit
+        status of the job, or None if it was skipped.
+
+        - extra_sleep: optional time (in seconds) to sleep after
+          the job is done
+        - check: raise an error if the job was not submitted or
+          exited with a non-zero status (the status of a pipeline
+          is non-zero if any of its commands failed)
         """
+        if (unless_exists is not None) and \
+            os.path.isfile(unless_exists):
+            print "launch_and_wait: SKIPPING %s since %s exists." \
+                %(cmd, unless_exists)
+            return None
+        status_filename = None
+        if check:
+            cmd, status_filename = self.get_status_cmd(cmd, job_name)
         job_id = self.launch_job(cmd, job_name,
-                                 unless_exists=unless_exists,
                                  ppn=ppn)
         if job_id is None:
             # Job submission failed
+            if check:
+                raise Exception, "Job %s not submitted." %(job_name)
             return None
         else:
             # Job is submitted (assigned an ID) so now
             # wait for it to finish
             self.wait_on_job(job_id)
-        time.sleep(extra_sleep)
+        if extra_sleep > 0:
+            time.sleep(extra_sleep)
+        if status_filename is None:
+            return 0
+        exit_status = self.read_exit_status(status_filename)
+        if exit_status != 0:
+            raise Exception, "Job %s failed (exit status %s): %s" \
+                             %(job_name, exit_status, cmd)
+        return exit_status
+
+
+    def get_status_cmd(self, cmd, job_name):
+        """
+        Wrap a command in a script that records its exit status,
+        so that it can be read back once the job is done. The
+        script is run by bash with 'pipefail' set.
+
+        Returns the command to run and the exit status filename.
+        """
+        scripts_dir = os.path.join(self.output_dir, "cluster_scripts")
+        utils.make_dir(scripts_dir)
+        self._curjobid += 1
+        script_basename = \
+            os.path.abspath(os.path.join(scripts_dir,
+                                         "%s.%d.%d.%d" \
+                                         %(job_name,
+                                           os.getpid(),
+                                           threading.current_thread().ident,
+                                           self._curjobid)))
+        script_filename = "%s.sh" %(script_basename)
+        status_filename = "%s.status" %(script_basename)
+        if os.path.isfile(status_filename):
+            os.remove(status_filename)
+        with open(script_filename, "w") as script_file:
+            script_file.write("#!/bin/bash\n")
+            script_file.write("set -o pipefail\n")
+            script_file.write("%s\n" %(cmd))
+            script_file.write("echo $? > %s\n" %(status_filename))
+        return "bash %s" %(script_filename), status_filename
+
+
+    def read_exit_status(self, status_filename):
+        """
+        Return the exit status recorded by a job, or None if the
+        job did not record one (e.g. it was killed).
+        """
+        if not os.path.isfile(status_filename):
+            return None
+        with open(status_filename) as status_file:
+            status = status_file.read().strip()
+        try:
+            return int(status)
+        except ValueError:
+            return None
     
 
     def launch_job(self, cmd, job_name,
@@ -90,15 +209,121 @@ class Cluster:
                                      self.output_dir,
                                      queue_type="long",
                                      ppn=ppn)
+        elif self.cluster_type == "sge":
+            # Use SGE qsub for submission
+            job_id = Mysge.launchJob(cmd,
+                                     self.get_sge_options(job_name),
+                                     verbose=False,
+                                     fast=False)
         elif self.cluster_type == "none":
-            # Use local machine (multi-cores)
-            p = subprocess.Popen(cmd, shell=True)
-            self.jobs[self._curjobid] = p
-            job_id = self._curjobid
-            self._curjobid += 1
+            # Use local machine (multi-cores), queueing the job
+            # until there are enough cores and memory for it
+            job_id = self.local_executor.submit(cmd, job_name,
+                                                ppn=ppn,
+                                                memory=self.get_job_memory())
         if job_id is None:
             print "WARNING: Job %s not submitted." %(job_name)
         return job_id
+
+
+    def get_sge_options(self, job_name):
+        scripts_dir = os.path.join(self.output_dir, "cluster_scripts")
+        utils.make_dir(scripts_dir)
+        return {"jobname": job_name,
+                "outdir": scripts_dir}
+
+
+    def write_task_index(self, cmds, job_name, task_labels=None):
+        """
+        Write the index file of a job array: one line per task,
+        with the task number (1-based), optional label fields
+        (e.g. sample and event type) and the command to run,
+        separated by tabs.
+
+        Returns the index filename.
+        """
+        scripts_dir = os.path.join(self.output_dir, "cluster_scripts")
+        utils.make_dir(scripts_dir)
+        index_filename = \
+            os.path.abspath(os.path.join(scripts_dir,
+                                         "%s.%d.tasks.txt" %(job_name,
+                                                             os.getpid())))
+        with open(index_filename, "w") as index_file:
+            for task_num, cmd in enumerate(cmds):
+                if ("\t" in cmd) or ("\n" in cmd):
+                    raise Exception, "Cannot run command with tabs or " \
+                                     "newlines in job array: %s" %(cmd)
+                fields = [str(task_num + 1)]
+                if task_labels is not None:
+                    fields.extend(task_labels[task_num])
+                fields.append(cmd)
+                index_file.write("%s\n" %("\t".join(fields)))
+        return index_filename
+
+
+    def launch_job_array(self, cmds, job_name,
+                         task_labels=None,
+                         ppn=1):
+        """
+        Launch a list of commands as a single job array and
+        return a list of job IDs to wait on.
+
+        Each task of the array looks up its command by task
+        number in an index file written to the cluster scripts
+        directory.
+
+        - task_labels: optional list of label fields for each task
+          (e.g. [sample_label, event_type]), recorded in the index
+        
+        When running locally, each command is queued as its own job.
+        """
+        if len(cmds) == 0:
+            return []
+        if self.cluster_type == "none":
+            job_ids = []
+            for task_num, cmd in enumerate(cmds):
+                task_name = "%s_%d" %(job_name, task_num + 1)
+                if task_labels is not None:
+                    task_name = "%s_%s" %(job_name,
+                                          "_".join(task_labels[task_num]))
+                job_ids.append(self.launch_job(cmd, task_name, ppn=ppn))
+            return job_ids
+        num_tasks = len(cmds)
+        index_filename = self.write_task_index(cmds, job_name,
+                                               task_labels=task_labels)
+        task_script_filename = "%s.sh" %(index_filename.rsplit(".", 1)[0])
+        with open(task_script_filename, "w") as task_script:
+            task_script.write(ARRAY_TASK_SCRIPT)
+        task_cmd = "sh %s %s $%s" %(task_script_filename,
+                                    index_filename,
+                                    ARRAY_TASK_ID_VARS[self.cluster_type])
+        self.logger.info("Submitting job array %s of %d tasks (index: %s)" \
+                         %(job_name, num_tasks, index_filename))
+        job_id = None
+        if self.cluster_type == "bsub":
+            job_id = Mybsub.launchJob(task_cmd, job_name,
+                                      {},
+                                      self.output_dir,
+                                      queue_type=self.cluster_queue,
+                                      memory=self.cluster_memory,
+                                      ppn=ppn,
+                                      num_tasks=num_tasks)
+        elif self.cluster_type == "qsub":
+            job_id = Mypbm.launchJob(task_cmd, job_name,
+                                     {"outdir": self.output_dir},
+                                     queue_type="long",
+                                     ppn=ppn,
+                                     num_tasks=num_tasks)
+        elif self.cluster_type == "sge":
+            job_id = Mysge.launchJob(task_cmd,
+                                     self.get_sge_options(job_name),
+                                     verbose=False,
+                                     fast=False,
+                                     num_tasks=num_tasks)
+        if job_id is None:
+            print "WARNING: Job array %s not submitted." %(job_name)
+            return []
+        return [job_id]
         
 
     def wait_on_job(self, job_id):
@@ -106,18 +331,22 @@ class Cluster:
             print "Waiting on %s.. (started wait @ %s)" \
                 %(job_id,
                   time.strftime("%x, %X"))
-            Mybsub.waitUntilDone(job_id)
+            Mybsub.waitUntilAllDone([job_id], logger=self.logger)
             print "  - Completed at %s" %(time.strftime("%x, %X"))
             return True
         elif self.cluster_type == "qsub":
             print "Waiting on %s.. (started wait @ %s)" \
                 %(job_id,
                   time.strftime("%x, %X"))
-            Mypbm.waitUntilDone(job_id)
+            Mypbm.waitUntilAllDone([job_id], logger=self.logger)
             print "  - Completed at %s" %(time.strftime("%x, %X"))
             return True
+        elif self.cluster_type == "sge":
+            Mysge.waitUntilAllDone([job_id], logger=self.logger)
+            return True
         elif self.cluster_type == "none":
-            self.jobs[job_id].wait()
+            self.local_executor.wait(job_id)
+            return True
         else:
             raise Exception, "Not implemented yet."
         
@@ -126,9 +355,26 @@ class Cluster:
         num_jobs = len(job_ids)
         print "Starting to wait on a collection of %d jobs" \
             %(num_jobs)
-        jobs_completed = {}
-        for job_id in job_ids:
-            if job_id in jobs_completed: continue
-            if self.wait_on_job(job_id):
-                jobs_completed[job_id] = True
+        if self.cluster_type == "none":
+            # Wake up on whichever job finishes first
+            pending_job_ids = [job_id for job_id in job_ids \
+                               if job_id is not None]
+            while len(pending_job_ids) > 0:
+                job_id = self.local_executor.wait_any(pending_job_ids)
+                pending_job_ids.remove(job_id)
+                self.logger.info("%d jobs remaining." \
+                                 %(len(pending_job_ids)))
+            print "All jobs completed."
+            return
+        # Poll the status of all outstanding jobs at once
+        pending_job_ids = [job_id for job_id in job_ids \
+                           if job_id is not None]
+        if self.cluster_type == "bsub":
+            Mybsub.waitUntilAllDone(pending_job_ids, logger=self.logger)
+        elif self.cluster_type == "qsub":
+            Mypbm.waitUntilAllDone(pending_job_ids, logger=self.logger)
+        elif self.cluster_type == "sge":
+            Mysge.waitUntilAllDone(pending_job_ids, logger=self.logger)
+        else:
+            raise Exception, "Not implemented yet."
         print "All jobs completed."
@@ -0,0 +1,50 @@
+##
+## Batched polling of cluster job status
+##
+import os
+import sys
+import time
+
+
+def wait_until_done(job_ids, get_active_jobs,
+                    min_sleep=10,
+                    max_sleep=120,
+                    backoff=1.5,
+                    logger=None):
+    """
+    Wait until none of the given jobs are active on the cluster.
+
+    - job_ids: IDs of jobs to wait on
+    - get_active_jobs: function that takes a list of job IDs, queries
+      the scheduler once for all of them and returns the set of IDs
+      still pending or running (or None if the query failed)
+    - min_sleep, max_sleep: bounds (in seconds) on time between polls
+    - backoff: factor by which the time between polls grows while
+      no job finishes. It is reset whenever a job finishes.
+    """
+    pending_job_ids = set(job_ids)
+    # Start so that the first poll is followed by 'min_sleep'
+    sleep = min_sleep / float(backoff)
+    while len(pending_job_ids) > 0:
+        active_job_ids = get_active_jobs(list(pending_job_ids))
+        if active_job_ids is None:
+            # Scheduler query failed; try again later
+            if logger is not None:
+                logger.warning("Could not query status of %d jobs." \
+                               %(len(pending_job_ids)))
+            finished_job_ids = set()
+        else:
+            finished_job_ids = pending_job_ids - set(active_job_ids)
+        if len(finished_job_ids) > 0:
+            pending_job_ids -= finished_job_ids
+            if logger is not None:
+                logger.info("%d jobs finished (%s), %d remaining." \
+                            %(len(finished_job_ids),
+                              ", ".join(map(str, finished_job_ids)),
+                              len(pending_job_ids)))
+            sleep = min_sleep
+        else:
+            sleep = max(min(sleep * backoff, max_sleep), min_sleep)
+        if len(pending_job_ids) == 0:
+            break
+        time.sleep(sleep)
@@ -0,0 +1,180 @@
+##
+## Bounded executor for running jobs on the local machine
+##
+import os
+import sys
+import time
+import subprocess
+import threading
+import multiprocessing
+
+from collections import deque
+
+
+def get_total_memory():
+    """
+    Return total physical memory of the machine in MB, or None
+    if it cannot be determined.
+    """
+    try:
+        page_size = os.sysconf("SC_PAGE_SIZE")
+        num_pages = os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+    return (page_size * num_pages) / (1024 * 1024)
+
+
+class LocalJob:
+    """
+    A job run on the local machine.
+    """
+    def __init__(self, job_id, cmd, job_name, ppn, memory):
+        self.job_id = job_id
+        self.cmd = cmd
+        self.job_name = job_name
+        self.ppn = ppn
+        self.memory = memory
+        self.proc = None
+        self.submit_time = time.time()
+        self.start_time = None
+        self.end_time = None
+        self.returncode = None
+
+
+    def is_done(self):
+        return self.end_time is not None
+
+
+class LocalExecutor:
+    """
+    Run jobs on the local machine with bounded concurrency.
+
+    Jobs are queued and started in submission order as long as
+    the cores (ppn) and memory (in MB) declared by the running
+    jobs stay within the budget. A job that exceeds the budget
+    on its own is still run, but only when nothing else is.
+    """
+    def __init__(self, logger,
+                 max_cores=None,
+                 max_memory=None):
+        self.logger = logger
+        if max_cores is None:
+            max_cores = multiprocessing.cpu_count()
+        if max_memory is None:
+            max_memory = get_total_memory()
+        self.max_cores = max_cores
+        self.max_memory = max_memory
+        self.used_cores = 0
+        self.used_memory = 0
+        self.queue = deque()
+        self.jobs = {}
+        self.num_running = 0
+        self._curjobid = 0
+        # Condition signalled whenever a job finishes
+        self.job_done = threading.Condition()
+
+
+    def submit(self, cmd, job_name, ppn=1, memory=None):
+        """
+        Queue a job for running and return its ID.
+
+        - ppn: number of cores used by the job
+        - memory: memory (in MB) used by the job
+        """
+        with self.job_done:
+            job_id = self._curjobid
+            self._curjobid += 1
+            job = LocalJob(job_id, cmd, job_name, int(ppn), memory)
+            self.jobs[job_id] = job
+            self.queue.append(job)
+            self.logger.info("Queued job %s (%d) [queue depth: %d, " \
+                             "running: %d]" %(job_name, job_id,
+                                              len(self.queue),
+                                              self.num_running))
+            self.start_jobs()
+        return job_id
+
+
+    def job_fits(self, job):
+        """
+        Return True if the job fits in the remaining budget.
+        """
+        if self.num_running == 0:
+            return True
+        if (self.used_cores + job.ppn) > self.max_cores:
+            return False
+        if (job.memory is not None) and (self.max_memory is not None) and \
+           (self.used_memory + job.memory) > self.max_memory:
+            return False
+        return True
+
+
+    def start_jobs(self):
+        """
+        Start queued jobs while they fit in the budget. Must be
+        called with the job condition held.
+        """
+        while (len(self.queue) > 0) and self.job_fits(self.queue[0]):
+            job = self.queue.popleft()
+            job.start_time = time.time()
+            job.proc = subprocess.Popen(job.cmd, shell=True)
+            self.num_running += 1
+            self.used_cores += job.ppn
+            if job.memory is not None:
+                self.used_memory += job.memory
+            self.logger.info("Started job %s (%d) after %.2f mins in " \
+                             "queue [queue depth: %d, running: %d]" \
+                             %(job.job_name, job.job_id,
+                               (job.start_time - job.submit_time)/60.,
+                               len(self.queue),
+                               self.num_running))
+            waiter = threading.Thread(target=self.wait_on_proc,
+                                      args=(job,))
+            waiter.daemon = True
+            waiter.start()
+
+
+    def wait_on_proc(self, job):
+        """
+        Wait for a job's process to exit and release its budget.
+        """
+        returncode = job.proc.wait()
+        with self.job_done:
+            job.returncode = returncode
+            job.end_time = time.time()
+            self.num_running -= 1
+            self.used_cores -= job.ppn
+            if job.memory is not None:
+                self.used_memory -= job.memory
+            self.logger.info("Job %s (%d) finished with exit code %d " \
+                             "in %.2f mins [queue depth: %d, running: %d]" \
+                             %(job.job_name, job.job_id,
+                               returncode,
+                               (job.end_time - job.start_time)/60.,
+                               len(self.queue),
+                               self.num_running))
+            self.start_jobs()
+            self.job_done.notify_all()
+
+
+    def wait_any(self, job_ids):
+        """
+        Wait until any of the given jobs finishes and return
+        its ID.
+        """
+        with self.job_done:
+            while True:
+                for job_id in job_ids:
+                    if self.jobs[job_id].is_done():
+                        return job_id
+                # Wake up periodically so that the wait can be
+                # interrupted
+                self.job_done.wait(5)
+
+
+    def wait(self, job_id):
+        """
+        Wait until a job finishes. Returns its exit code.
+        """
+        self.wait_any([job_id])
+        return self.jobs[job_id].returncode
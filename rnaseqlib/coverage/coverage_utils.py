@@ -181,9 +181,138 @@ def coverage_dist_from_uniform(obs_reads_per_base):
     return sqrt_jsd_dist
 
 
+# Coverage statistics computed for each exon
+COVERAGE_STATS = ["mean",
+                  "std",
+                  "max",
+                  "min",
+                  "kurtosis",
+                  "cv",
+                  "sqrt_jsd"]
+
+
+def get_blocks_coverage(region_starts, region_ends,
+                        block_regions, block_starts, block_ends):
+    """
+    Compute the per-base coverage of regions by aligned blocks of
+    reads, from a difference array of block starts and ends.
+    Coordinates are 0-based and end-exclusive; blocks must lie
+    within their regions.
+
+    Args:
+    - region_starts, region_ends: coordinates of the regions
+    - block_regions: region ID of each block
+    - block_starts, block_ends: coordinates of the blocks
+
+    Returns the coverage of all regions concatenated in one
+    array and the offsets of each region in it (the coverage of
+    region i is coverage[offsets[i]:offsets[i+1]]).
+    """
+    offsets = np.concatenate(([0], np.cumsum(region_ends - region_starts)))
+    coverage_diffs = np.zeros(offsets[-1] + 1, dtype=np.int64)
+    diff_offsets = offsets[block_regions] - region_starts[block_regions]
+    np.add.at(coverage_diffs, diff_offsets + block_starts, 1)
+    np.add.at(coverage_diffs, diff_offsets + block_ends, -1)
+    return np.cumsum(coverage_diffs[0:-1]), offsets
+
+
+def add_coverage_diffs(coverage_diffs, num_diffs, diff_starts, diff_ends):
+    """
+    Add aligned blocks to a difference array of the coverage of
+    regions (as in get_blocks_coverage), given as the positions of
+    the blocks' starts and ends in the array. The array is grown
+    (at least doubled) if it holds fewer than 'num_diffs' values.
+
+    Returns the difference array.
+    """
+    if num_diffs > len(coverage_diffs):
+        grown_diffs = np.zeros(max(num_diffs, 2 * len(coverage_diffs)),
+                               dtype=np.int64)
+        grown_diffs[0:len(coverage_diffs)] = coverage_diffs
+        coverage_diffs = grown_diffs
+    np.add.at(coverage_diffs, np.array(diff_starts, dtype=np.int64), 1)
+    np.add.at(coverage_diffs, np.array(diff_ends, dtype=np.int64), -1)
+    return coverage_diffs
+
+
+def get_batch_coverage_stats(coverage, offsets,
+                             max_bases=10000000):
+    """
+    Compute coverage statistics (see COVERAGE_STATS) of many
+    regions at once.
+
+    Args:
+    - coverage: coverage of all regions concatenated in one array
+    - offsets: offsets of the regions in 'coverage' (one more
+      than the number of regions)
+
+    Kwargs:
+    - max_bases: maximum number of bases processed at once (to
+      bound memory use)
+
+    Returns a dictionary mapping statistic name to an array of
+    values for each region.
+    """
+    num_regions = len(offsets) - 1
+    stats = {}
+    for stat_name in COVERAGE_STATS:
+        stats[stat_name] = np.zeros(num_regions, dtype=float)
+    first = 0
+    while first < num_regions:
+        # Take regions up to max_bases (at least one)
+        last = np.searchsorted(offsets, offsets[first] + max_bases,
+                               side="right") - 1
+        last = min(max(last, first + 1), num_regions)
+        chunk_offsets = offsets[first:last + 1] - offsets[first]
+        chunk_coverage = \
+            coverage[offsets[first]:offsets[last]].astype(float)
+        chunk_stats = get_chunk_coverage_stats(chunk_coverage, chunk_offsets)
+        for stat_name in COVERAGE_STATS:
+            stats[stat_name][first:last] = chunk_stats[stat_name]
+        first = last
+    return stats
+
+
+def get_chunk_coverage_stats(coverage, offsets):
+    """
+    Compute coverage statistics of regions, as returned by
+    get_batch_coverage_stats, in a single vectorized pass.
+    """
+    starts = offsets[0:-1]
+    lens = np.diff(offsets)
+    totals = np.add.reduceat(coverage, starts)
+    means = totals / lens
+    centered = coverage - np.repeat(means, lens)
+    m2 = np.add.reduceat(centered**2, starts) / lens
+    m4 = np.add.reduceat(centered**4, starts) / lens
+    stds = np.sqrt(m2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Pearson kurtosis (0 for constant coverage, as in scipy)
+        kurtosis = np.where(m2 == 0, 0, m4 / m2**2)
+        cvs = stds / means
+        # Square root of the Jensen-Shannon divergence between the
+        # observed and a uniform distribution of reads per base
+        obs_dist = coverage / np.repeat(totals, lens)
+        uniform_dist = np.repeat(1. / lens, lens)
+        mixture = obs_dist + uniform_dist
+        d1 = obs_dist * np.log2(2 * obs_dist / mixture)
+        d2 = uniform_dist * np.log2(2 * uniform_dist / mixture)
+    d1[np.isnan(d1)] = 0
+    d2[np.isnan(d2)] = 0
+    sqrt_jsds = np.sqrt(0.5 * np.add.reduceat(d1 + d2, starts))
+    return {"mean": means,
+            "std": stds,
+            "max": np.maximum.reduceat(coverage, starts),
+            "min": np.minimum.reduceat(coverage, starts),
+            "kurtosis": kurtosis,
+            "cv": cvs,
+            "sqrt_jsd": sqrt_jsds}
+
+
 def get_exons_coverage_from_tagBam(bam_fname,
                                    interval_label="gff",
-                                   gff_coords=True):
+                                   gff_coords=True,
+                                   chunk_size=200000):
     """
     Count exons coverage from BAM file produced by tagBam.
     Returns mapping from an exon to its coverage statistics.
@@ -199,71 +328,77 @@ def get_exons_coverage_from_tagBam(bam_fname,
     from BED format (0-based) to GFF based by adding 1 to the start
     coordinate. Note that tagBam produces intervals in BED format
     always.
+    - chunk_size: number of aligned blocks to add to the coverage
+    at once (to bound memory use)
     """
-    # Mapping from exons to start positions counts, i.e.
-    #  exon1 -> genomic start_pos1 -> # at genomic start position 1
-    #        -> genomic start_pos4 -> # at genomic start position 4
-    #  exon2 -> ...
-    exons_to_start_pos_counts = {}
+    # Exons seen so far, their (0-based, end-exclusive)
+    # coordinates and the offsets of their coverage in one
+    # difference array of all exons (see get_blocks_coverage)
+    exons_to_ids = {}
+    exon_names = []
+    exon_starts = []
+    exon_ends = []
+    exon_offsets = [0]
+    coverage_diffs = np.zeros(0, dtype=np.int64)
+    # Positions of the aligned blocks of the current chunk of
+    # reads in the difference array
+    diff_starts = []
+    diff_ends = []
     bam_file = pysam.Samfile(bam_fname, "rb")
-    num_unmatched = 0
     for bam_read in bam_file:
         gff_aligned_regions = bam_read.opt("YB")
         # Get GFF regions that read aligns to
         parsed_regions = \
           bam_utils.parse_tagBam_opt_field(gff_aligned_regions,
+                                           interval_label=interval_label,
                                            gff_coords=gff_coords)
-        # Get read start position
-        read_start_pos = bam_read.pos + 1
+        if len(parsed_regions) == 0:
+            continue
+        read_blocks = bam_utils.get_read_blocks(bam_read)
         for region in parsed_regions:
-            # If we've seen this exon region before, use its dictionary
-            if region in exons_to_start_pos_counts:
-                curr_region_starts = exons_to_start_pos_counts[region]
-            else:
-                curr_region_starts = init_region_start_pos(region)
-                exons_to_start_pos_counts[region] = curr_region_starts
-            # Add +1 to each read position that the read overlaps
-            # Have a simple read position counter that starts with
-            # read start and counts the bases covered by a Match
-            # according to the cigar string
-            read_counter = read_start_pos
-            read_matched_to_interval = False
-            for cigar_type, cigar_len in bam_read.cigar:
-                # Skip the non-matches (denoted as 0 in pysam)
-                # but increment the read_counter
-                if cigar_type != 0:
-                    read_counter += cigar_len
-                    continue
-                # It's a match, so record the bases covered
-                for match_pos in range(read_counter,
-                                       read_counter + cigar_len + 1):
-                    # This match portion of read does not land in region
-                    if match_pos not in curr_region_starts:
-                        # Advance counter
-                        read_counter += 1
-                        continue
-                    curr_region_starts[match_pos] += 1
-                    # Record that the read was matched to this interval
-                    read_matched_to_interval = True
-            if not read_matched_to_interval:
-                num_unmatched += 1
+            exon_id = exons_to_ids.get(region)
+            if exon_id is None:
+                chrom, start, end, strand = utils.parse_dash_coords(region)
+                # Check that start < end
+                assert (start <= end), \
+                  "Start (%d) must be less than end (%d): %s" \
+                  %(start, end, region)
+                exon_id = len(exon_names)
+                exons_to_ids[region] = exon_id
+                exon_names.append(region)
+                exon_starts.append(start - 1)
+                exon_ends.append(end)
+                exon_offsets.append(exon_offsets[-1] + end - (start - 1))
+            # Record the part of each aligned block in the exon
+            diff_offset = exon_offsets[exon_id] - exon_starts[exon_id]
+            for block_start, block_end in read_blocks:
+                block_start = max(block_start, exon_starts[exon_id])
+                block_end = min(block_end, exon_ends[exon_id])
+                if block_start < block_end:
+                    diff_starts.append(diff_offset + block_start)
+                    diff_ends.append(diff_offset + block_end)
+        if len(diff_starts) >= chunk_size:
+            coverage_diffs = add_coverage_diffs(coverage_diffs,
+                                                exon_offsets[-1] + 1,
+                                                diff_starts, diff_ends)
+            diff_starts = []
+            diff_ends = []
+    bam_file.close()
+    exon_stats_dict = {}
+    if len(exon_names) == 0:
+        return exon_stats_dict
+    coverage_diffs = add_coverage_diffs(coverage_diffs,
+                                        exon_offsets[-1] + 1,
+                                        diff_starts, diff_ends)
+    offsets = np.array(exon_offsets, dtype=np.int64)
+    coverage = np.cumsum(coverage_diffs[0:offsets[-1]])
     # Calculate statistics and return as dictionary
     # indexed by exons
-    exon_stats_dict = {}
-    for exon in exons_to_start_pos_counts:
-        exon_info = exons_to_start_pos_counts[exon]
-        exon_counts = exon_info.values()
-        # Calculate sqrt JSD-based coverage metric
-        sqrt_jsd_val = coverage_dist_from_uniform(exon_counts)
-        entry = {"exon": exon,
-                 "mean": np.mean(exon_counts),
-                 "std": np.std(exon_counts),
-                 "max": np.max(exon_counts),
-                 "min": np.min(exon_counts),
-                 "kurtosis": scipy.stats.kurtosis(exon_counts,
-                                                  fisher=False),
-                 "cv": stats_utils.coeff_var(exon_counts),
-                 "sqrt_jsd": sqrt_jsd_val}
+    exon_stats = get_batch_coverage_stats(coverage, offsets)
+    for exon_id, exon in enumerate(exon_names):
+        entry = {"exon": exon}
+        for stat_name in COVERAGE_STATS:
+            entry[stat_name] = exon_stats[stat_name][exon_id]
         exon_stats_dict[exon] = entry
     return exon_stats_dict
 
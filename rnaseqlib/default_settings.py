@@ -103,9 +103,32 @@ def set_default_settings(settings_info):
         settings_info["mapping"]["cluster_queue"] = None
     if "cluster_memory" not in settings_info["mapping"]:
         settings_info["mapping"]["cluster_memory"] = None
+    # Cores and memory (in MB) available for running jobs
+    # locally. By default, use all cores and memory.
+    if "local_max_cores" not in settings_info["mapping"]:
+        settings_info["mapping"]["local_max_cores"] = None
+    if "local_max_memory" not in settings_info["mapping"]:
+        settings_info["mapping"]["local_max_memory"] = None
+    # Number of cores used by each sample's jobs
+    if "num_processors" not in settings_info["mapping"]:
+        settings_info["mapping"]["num_processors"] = 4
+    # Memory per thread for sorting BAMs (e.g. 768M)
+    if "sort_memory" not in settings_info["mapping"]:
+        settings_info["mapping"]["sort_memory"] = None
     if "paired" not in settings_info["mapping"]:
         # Not paired-end by default, only if no setting was given
         settings_info["mapping"]["paired"] = False
+    # Strand convention of the library (not strand-specific by default)
+    if "stranded" not in settings_info["mapping"]:
+        settings_info["mapping"]["stranded"] = None
+    # Post-process mapper output as it is produced, without
+    # writing intermediate BAMs (Bowtie only)
+    if "stream_mapping" not in settings_info["mapping"]:
+        settings_info["mapping"]["stream_mapping"] = False
+    # Regular expression matching random barcodes in read names,
+    # used when removing duplicates
+    if "umi_regex" not in settings_info["mapping"]:
+        settings_info["mapping"]["umi_regex"] = None
     if data_type == "rnaseq":
         settings_info = set_default_rnaseq_settings(settings_info)
     elif data_type == "riboseq":
@@ -123,4 +146,21 @@ def set_default_settings(settings_info):
         # By default, set it so that MISO events are not
         # prefiltered
         settings_info["settings"]["prefilter_miso"] = False
+    # Mode and memory cap (in MB) for counting distinct read IDs
+    if "read_count_mode" not in settings_info["settings"]:
+        settings_info["settings"]["read_count_mode"] = "auto"
+    if "read_count_memory" not in settings_info["settings"]:
+        settings_info["settings"]["read_count_memory"] = 2048
+    # Method to normalize RPKMs across samples with: 'lowess' or
+    # one of rpkm.normalization.NORM_FACTOR_METHODS (e.g. 'tmm').
+    # Not normalized by default.
+    if "rpkm_norm_method" not in settings_info["settings"]:
+        settings_info["settings"]["rpkm_norm_method"] = None
+    # Size of the regions indexed BAMs are split into when counting
+    # reads in parallel (by default, one region per chromosome)
+    if "count_tile_size" not in settings_info["settings"]:
+        settings_info["settings"]["count_tile_size"] = None
+    # Keep intermediate files for debugging
+    if "debug" not in settings_info["settings"]:
+        settings_info["settings"]["debug"] = False
     return settings_info
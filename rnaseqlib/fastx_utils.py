@@ -4,6 +4,8 @@
 import os
 import sys
 import time
+import subprocess
+import multiprocessing
 
 import rnaseqlib
 import rnaseqlib.utils as utils
@@ -115,6 +117,132 @@ def get_fastx_entries(fastx_filename,
     return entries
 
 
+##
+## Fast counting of FASTQ/FASTA records
+##
+def open_fastx_stream(fastx_filename):
+    """
+    Open a FASTQ/FASTA file as a raw byte stream. Gzipped files
+    are decompressed in a separate 'gzip' process when available,
+    so that decompression runs alongside counting.
+
+    Returns the stream and the decompressing process (or None).
+    """
+    if not fastx_filename.endswith(".gz"):
+        return open(fastx_filename, "rb"), None
+    gzip_path = utils.which("gzip")
+    if gzip_path is None:
+        return gzip.open(fastx_filename, "rb"), None
+    gzip_proc = subprocess.Popen([gzip_path, "-dc", fastx_filename],
+                                 stdout=subprocess.PIPE)
+    return gzip_proc.stdout, gzip_proc
+
+
+def count_fastx_records(fastx_filename,
+                        block_size=2**22):
+    """
+    Count the records of a FASTQ/FASTA file by reading it in
+    raw byte blocks: newlines are counted for FASTQ files (four
+    lines per record) and record headers ('>' at the start of a
+    line) for FASTA files.
+    """
+    fastx_type = get_fastx_type(fastx_filename)
+    fastx_stream, gzip_proc = open_fastx_stream(fastx_filename)
+    num_records = 0
+    num_lines = 0
+    # Last byte of the previous block
+    prev_byte = "\n"
+    while True:
+        block = fastx_stream.read(block_size)
+        if not block:
+            break
+        if fastx_type == "fasta":
+            num_records += block.count("\n>")
+            if (prev_byte == "\n") and (block[0] == ">"):
+                num_records += 1
+        else:
+            num_lines += block.count("\n")
+        prev_byte = block[-1]
+    fastx_stream.close()
+    if gzip_proc is not None:
+        if gzip_proc.wait() != 0:
+            raise Exception, "Failed to decompress %s" %(fastx_filename)
+    if fastx_type == "fastq":
+        # Count last line if it does not end in newline
+        if prev_byte != "\n":
+            num_lines += 1
+        num_records = num_lines / 4
+    return num_records
+
+
+def get_num_reads_filename(fastx_filename):
+    """
+    Return the filename of the sidecar file caching the number
+    of records of a FASTQ/FASTA file.
+    """
+    return "%s.num_reads" %(fastx_filename)
+
+
+def load_num_reads(fastx_filename):
+    """
+    Load cached number of records of a FASTQ/FASTA file. Returns
+    None if there is no cached count or it is out of date.
+    """
+    num_reads_fname = get_num_reads_filename(fastx_filename)
+    if not os.path.isfile(num_reads_fname):
+        return None
+    with open(num_reads_fname) as num_reads_in:
+        fields = num_reads_in.read().strip().split("\t")
+    if len(fields) != 3:
+        return None
+    num_reads, file_size, file_mtime = fields
+    fastx_stat = os.stat(fastx_filename)
+    if (int(file_size) != fastx_stat.st_size) or \
+       (file_mtime != repr(fastx_stat.st_mtime)):
+        return None
+    return int(num_reads)
+
+
+def get_num_fastx_records(fastx_filename):
+    """
+    Get number of records in a FASTQ/FASTA file. The count is
+    cached in a sidecar file next to the input, along with the
+    input's size and modification time.
+    """
+    num_reads = load_num_reads(fastx_filename)
+    if num_reads is not None:
+        return num_reads
+    num_reads = count_fastx_records(fastx_filename)
+    fastx_stat = os.stat(fastx_filename)
+    num_reads_fname = get_num_reads_filename(fastx_filename)
+    try:
+        with open(num_reads_fname, "w") as num_reads_out:
+            num_reads_out.write("%d\t%d\t%s\n" %(num_reads,
+                                                  fastx_stat.st_size,
+                                                  repr(fastx_stat.st_mtime)))
+    except IOError:
+        # Input directory might not be writable
+        print "WARNING: Could not cache number of reads in %s" \
+            %(num_reads_fname)
+    return num_reads
+
+
+def get_num_fastx_records_parallel(fastx_filenames):
+    """
+    Get number of records in each of a list of FASTQ/FASTA
+    files, counting the files concurrently.
+    """
+    if len(fastx_filenames) == 1:
+        return [get_num_fastx_records(fastx_filenames[0])]
+    pool = multiprocessing.Pool(processes=len(fastx_filenames))
+    try:
+        nums_reads = pool.map(get_num_fastx_records, fastx_filenames)
+    finally:
+        pool.close()
+        pool.join()
+    return nums_reads
+
+
 def fastx_collapse_fastq(fastq_filename, output_dir, logger):
     """
     FASTX collapse FASTQ. Return 
@@ -1,9 +1,13 @@
 ##
 ## Gene Model
 ##
+## Gene models are kept as flat arrays (see GeneArrays); Gene,
+## Transcript and Part objects are views of them.
+##
 import os
 import sys
 import time
+import itertools
 
 
 import numpy
@@ -19,40 +23,400 @@ import misopy.gff_utils as gff_utils
 import operator
 from collections import namedtuple
 
+# CDS shorter than this (in nucleotides) are skipped
+MIN_CDS_LEN = 10
+
+
+def get_group_indices(offsets, groups):
+    """
+    Return the indices of the members of a list of groups, where
+    the members of the n-th group are at offsets[n]:offsets[n + 1],
+    and the position in the list of the group of each member.
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    group_starts = offsets[groups]
+    group_lens = offsets[groups + 1] - group_starts
+    positions = np.repeat(np.arange(len(groups)), group_lens)
+    # Index of each member relative to the first member of its group
+    member_nums = np.arange(group_lens.sum()) - \
+                  (np.cumsum(group_lens) - group_lens)[positions]
+    return group_starts[positions] + member_nums, positions
+
+
+def get_first_occurrences(starts, ends):
+    """
+    Return the indices of the first occurrence of each distinct
+    (start, end) pair, in order.
+    """
+    keys = (starts.astype(np.int64) << 32) | ends.astype(np.int64)
+    unique_keys, first_indices = np.unique(keys, return_index=True)
+    return np.sort(first_indices)
+
+
+def get_cds_coords(exon_starts, exon_ends, trans_offsets,
+                   cds_starts, cds_ends,
+                   min_cds_len=MIN_CDS_LEN):
+    """
+    Compute the parts of transcripts that are in their CDS. Exons
+    that overlap the CDS start/end are trimmed to start/end at the
+    CDS start/end, respectively. If the CDS is entirely contained
+    within an exon, the CDS itself is the only part.
+
+    Transcripts whose CDS is shorter than 'min_cds_len'
+    nucleotides have no CDS parts.
+
+    Returns the CDS part starts and ends, and the offsets of each
+    transcript's CDS parts in them (laid out like the exons).
+    """
+    num_trans = len(trans_offsets) - 1
+    exon_trans = np.repeat(np.arange(num_trans), np.diff(trans_offsets))
+    exon_cds_starts = cds_starts[exon_trans]
+    exon_cds_ends = cds_ends[exon_trans]
+    # Skip exons that end before the CDS or start after the CDS
+    in_cds = (exon_ends > exon_cds_starts) & \
+             (exon_starts < exon_cds_ends) & \
+             (cds_ends - cds_starts + 1 >= min_cds_len)[exon_trans]
+    contains_cds = in_cds & \
+                   (exon_starts <= exon_cds_starts) & \
+                   (exon_ends >= exon_cds_ends)
+    if contains_cds.any():
+        # Keep only the first exon containing the CDS
+        containing = np.flatnonzero(contains_cds)
+        containing_trans = exon_trans[containing]
+        is_first = np.ones(len(containing), dtype=bool)
+        is_first[1:] = (containing_trans[1:] != containing_trans[:-1])
+        in_cds[np.in1d(exon_trans, containing_trans)] = False
+        in_cds[containing[is_first]] = True
+    kept = np.flatnonzero(in_cds)
+    offsets = np.zeros(num_trans + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(exon_trans[kept],
+                                        minlength=num_trans))
+    return (np.maximum(exon_starts[kept], exon_cds_starts[kept]),
+            np.minimum(exon_ends[kept], exon_cds_ends[kept]),
+            offsets)
+
+
+class GeneArrays:
+    """
+    Gene models of a set of genes, as flat arrays:
+
+    - exon_starts, exon_ends: exon coordinates of all transcripts
+      (1-based start, GFF convention)
+    - trans_offsets: the exons of the n-th transcript are at
+      trans_offsets[n]:trans_offsets[n + 1]
+    - cds_starts, cds_ends: CDS coordinates of each transcript
+    - gene_offsets: the transcripts of the n-th gene are at
+      gene_offsets[n]:gene_offsets[n + 1]
+    - trans_labels, chroms, strands: ID, chromosome and strand
+      of each transcript
+    - gene_labels, gene_symbols: ID and symbol of each gene
+
+    Gene, Transcript and Part objects are made from the arrays
+    only when asked for (see get_gene).
+    """
+    def __init__(self, exon_starts, exon_ends, trans_offsets,
+                 cds_starts, cds_ends, gene_offsets,
+                 trans_labels, chroms, strands, gene_labels,
+                 gene_symbols=None):
+        self.exon_starts = np.asarray(exon_starts, dtype=np.int32)
+        self.exon_ends = np.asarray(exon_ends, dtype=np.int32)
+        self.trans_offsets = np.asarray(trans_offsets, dtype=np.int64)
+        self.cds_starts = np.asarray(cds_starts, dtype=np.int32)
+        self.cds_ends = np.asarray(cds_ends, dtype=np.int32)
+        self.gene_offsets = np.asarray(gene_offsets, dtype=np.int64)
+        self.trans_labels = trans_labels
+        self.chroms = chroms
+        self.strands = strands
+        self.gene_labels = gene_labels
+        if gene_symbols is None:
+            gene_symbols = len(gene_labels) * [None]
+        self.gene_symbols = gene_symbols
+        # CDS parts of the transcripts (see get_cds_arrays)
+        self.cds_arrays = None
+
+
+    def get_num_genes(self):
+        return len(self.gene_offsets) - 1
+
+
+    def get_gene_trans(self, gene_num):
+        """
+        Return the transcripts of a gene.
+        """
+        return np.arange(self.gene_offsets[gene_num],
+                         self.gene_offsets[gene_num + 1])
+
+
+    def get_cds_arrays(self):
+        """
+        Return the CDS parts of all transcripts (see get_cds_coords),
+        computed when first asked for.
+        """
+        if self.cds_arrays is None:
+            self.cds_arrays = get_cds_coords(self.exon_starts,
+                                             self.exon_ends,
+                                             self.trans_offsets,
+                                             self.cds_starts,
+                                             self.cds_ends)
+        return self.cds_arrays
+
+
+    def get_coords(self, trans_nums,
+                   cds_only=False,
+                   min_cds_len=MIN_CDS_LEN):
+        """
+        Return the starts and ends of the parts (CDS parts if
+        'cds_only') of a list of transcripts, and the position in
+        the list of the transcript of each part.
+        """
+        trans_nums = np.asarray(trans_nums, dtype=np.int64)
+        if not cds_only:
+            starts, ends, offsets = \
+                self.exon_starts, self.exon_ends, self.trans_offsets
+        elif min_cds_len == MIN_CDS_LEN:
+            starts, ends, offsets = self.get_cds_arrays()
+        else:
+            exon_starts, exon_ends, exon_positions = \
+                self.get_coords(trans_nums)
+            exon_offsets = np.zeros(len(trans_nums) + 1, dtype=np.int64)
+            exon_offsets[1:] = \
+                np.cumsum(np.bincount(exon_positions,
+                                      minlength=len(trans_nums)))
+            starts, ends, offsets = \
+                get_cds_coords(exon_starts, exon_ends, exon_offsets,
+                               self.cds_starts[trans_nums],
+                               self.cds_ends[trans_nums],
+                               min_cds_len=min_cds_len)
+            trans_nums = np.arange(len(trans_nums))
+        indices, positions = get_group_indices(offsets, trans_nums)
+        return starts[indices], ends[indices], positions
+
+
+    def get_cds_trans(self, trans_nums):
+        """
+        Return the transcripts (of a list) that have CDS parts.
+        """
+        trans_nums = np.asarray(trans_nums, dtype=np.int64)
+        cds_offsets = self.get_cds_arrays()[2]
+        return trans_nums[cds_offsets[trans_nums + 1] > \
+                          cds_offsets[trans_nums]]
+
+
+    def get_parts_coords(self, gene_num, cds_only=False):
+        """
+        Return the distinct parts (by start and end) of all of a
+        gene's transcripts, in order of first appearance, as their
+        starts, ends and the transcript they first appear in.
+        """
+        trans_nums = self.get_gene_trans(gene_num)
+        starts, ends, positions = self.get_coords(trans_nums,
+                                                  cds_only=cds_only)
+        first = get_first_occurrences(starts, ends)
+        return starts[first], ends[first], trans_nums[positions[first]]
+
+
+    def get_const_coords(self, gene_num, trans_nums,
+                         cds_only=False,
+                         base_diff=6,
+                         min_exon_space=40):
+        """
+        Get (approximately) constitutive parts of a gene in a set
+        of its transcripts: the parts that occur in the highest
+        fraction of the transcripts. A part occurs in a transcript
+        if one of the transcript's parts is within 'base_diff'
+        nucleotides of it at both ends.
+
+        If the constitutive parts add up to less than 'min_exon_space'
+        nucleotides, the next most constitutive part is added.
+
+        Returns the starts, ends, transcripts and fraction of
+        transcripts of the constitutive parts.
+        """
+        starts, ends, part_trans = self.get_parts_coords(gene_num,
+                                                         cds_only=cds_only)
+        if len(starts) == 0:
+            return starts, ends, part_trans, np.zeros(0)
+        trans_nums = np.asarray(trans_nums, dtype=np.int64)
+        trans_starts, trans_ends, trans_positions = \
+            self.get_coords(trans_nums, cds_only=cds_only)
+        # Transcript parts matching each part, and the fraction
+        # of transcripts that have a matching part
+        part_nums, match_nums = \
+            np.nonzero((np.abs(starts[:, np.newaxis] - trans_starts) \
+                        <= base_diff) & \
+                       (np.abs(ends[:, np.newaxis] - trans_ends) \
+                        <= base_diff))
+        in_trans = np.zeros((len(starts), len(trans_nums)), dtype=bool)
+        in_trans[part_nums, trans_positions[match_nums]] = True
+        fracs = in_trans.sum(axis=1) / float(len(trans_nums))
+        # Sort parts by how constitutive they are (ties are kept
+        # in order of first appearance)
+        sorted_parts = np.argsort(-fracs, kind="mergesort")
+        max_frac = fracs[sorted_parts[0]]
+        const_parts = list(sorted_parts[fracs[sorted_parts] == max_frac])
+        sum_lens = np.sum(ends[const_parts] - starts[const_parts] + 1)
+        if sum_lens < min_exon_space:
+            print "NOTE: sum of constitutive exon lengths for %s is only %d" \
+                  %(self.gene_labels[gene_num], sum_lens)
+            # Try to get next exon in list if there are any
+            if len(sorted_parts) >= 2:
+                print "Fetching next exon which appears in %.2f fraction " \
+                      "of transcripts" %(fracs[sorted_parts[1]])
+                const_parts.append(sorted_parts[1])
+        const_parts = np.array(const_parts, dtype=np.int64)
+        return (starts[const_parts], ends[const_parts],
+                part_trans[const_parts], fracs[const_parts])
+
+
+    def make_parts(self, starts, ends, trans_nums, cds_only=False):
+        """
+        Make Part objects of a transcript's parts, with the
+        transcript as their parent.
+        """
+        parts = []
+        for start, end, trans_num in itertools.izip(starts.tolist(),
+                                                    ends.tolist(),
+                                                    trans_nums.tolist()):
+            chrom = self.chroms[trans_num]
+            strand = self.strands[trans_num]
+            label = None
+            if cds_only:
+                label = "cds.%s:%s-%s:%s" %(chrom, str(start), str(end),
+                                            strand)
+            parts.append(Part(start, end, chrom, strand,
+                              label=label,
+                              parent=self.trans_labels[trans_num]))
+        return parts
+
+
+    def get_parts(self, trans_nums,
+                  cds_only=False,
+                  min_cds_len=MIN_CDS_LEN):
+        """
+        Return the parts (CDS parts if 'cds_only') of a list of
+        transcripts as Part objects.
+        """
+        trans_nums = np.asarray(trans_nums, dtype=np.int64)
+        starts, ends, positions = self.get_coords(trans_nums,
+                                                  cds_only=cds_only,
+                                                  min_cds_len=min_cds_len)
+        return self.make_parts(starts, ends, trans_nums[positions],
+                               cds_only=cds_only)
+
+
+    def get_transcript(self, trans_num, parent=None):
+        """
+        Return a transcript as a Transcript object.
+        """
+        return Transcript(None,
+                          self.chroms[trans_num],
+                          self.strands[trans_num],
+                          label=self.trans_labels[trans_num],
+                          cds_start=int(self.cds_starts[trans_num]),
+                          cds_end=int(self.cds_ends[trans_num]),
+                          parent=parent,
+                          gene_arrays=self,
+                          trans_num=trans_num)
+
+
+    def get_gene(self, gene_num):
+        """
+        Return a gene as a Gene object. Genes take the chromosome
+        and strand of their last transcript.
+        """
+        last_trans = self.gene_offsets[gene_num + 1] - 1
+        return Gene(None,
+                    self.chroms[last_trans],
+                    self.strands[last_trans],
+                    label=self.gene_labels[gene_num],
+                    gene_symbol=self.gene_symbols[gene_num],
+                    gene_arrays=self,
+                    gene_num=gene_num)
+
+
+def get_gene_arrays_from_parts(trans_parts, cds_coords,
+                               trans_labels, chroms, strands,
+                               gene_label=None,
+                               gene_symbol=None):
+    """
+    Make the GeneArrays of a single gene from the Part objects of
+    each of its transcripts.
+
+    - cds_coords: (CDS start, CDS end) of each transcript. Transcripts
+      without CDS coordinates have no CDS parts.
+    """
+    exon_starts = [part.start for parts in trans_parts for part in parts]
+    exon_ends = [part.end for parts in trans_parts for part in parts]
+    trans_offsets = np.zeros(len(trans_parts) + 1, dtype=np.int64)
+    trans_offsets[1:] = np.cumsum([len(parts) for parts in trans_parts])
+    cds_coords = [(1, 0) if None in coords else coords \
+                  for coords in cds_coords]
+    return GeneArrays(exon_starts, exon_ends, trans_offsets,
+                      [coords[0] for coords in cds_coords],
+                      [coords[1] for coords in cds_coords],
+                      [0, len(trans_parts)],
+                      trans_labels, chroms, strands,
+                      [gene_label],
+                      gene_symbols=[gene_symbol])
+
+
 class Gene:
     """
     Representation of a gene model.
 
     By convention, all coordinates will be a 1-based start (GFF convention.)
+
+    A gene is a view of a gene of a GeneArrays (see GeneArrays.get_gene);
+    its transcripts and parts are made from the arrays when first used.
     """
-    __slots__ = ['transcripts', 'chrom', 'strand', 'label', 'gene_symbol',
-                 'parts', 'const_exons', 'has_cds']
     def __init__(self, transcripts, chrom, strand,
                  label=None,
-                 gene_symbol=None):
-        self.transcripts = transcripts
+                 gene_symbol=None,
+                 gene_arrays=None,
+                 gene_num=0):
+        if gene_arrays is None:
+            # Gene made from Transcript objects
+            gene_arrays = \
+                get_gene_arrays_from_parts([t.parts for t in transcripts],
+                                           [t.cds_coords for t in transcripts],
+                                           [t.label for t in transcripts],
+                                           [t.chrom for t in transcripts],
+                                           [t.strand for t in transcripts],
+                                           gene_label=label,
+                                           gene_symbol=gene_symbol)
+            gene_num = 0
+            self.transcripts = transcripts
+        self.gene_arrays = gene_arrays
+        self.gene_num = gene_num
+        self.trans_nums = gene_arrays.get_gene_trans(gene_num)
         self.chrom = chrom
         self.strand = strand
         self.label = label
         self.gene_symbol = gene_symbol
         self.const_exons = []
-        self.has_cds = False
-        # Determine if the gene has at least one
-        # CDS containing transcript
-        for t in transcripts:
-            if t.cds_coords is not None:
-                self.has_cds = True
-                break
+        # Every transcript has CDS coordinates (an empty CDS if
+        # non-coding), so the gene has a CDS if it has transcripts
+        self.has_cds = (len(self.trans_nums) > 0)
         if not self.has_cds:
             print "has no cds: %s" %(self.label)
-        # Get all parts from all transcripts
-        self.parts = []
-        for trans in self.transcripts:
-            self.parts.extend(trans.parts)
-        # Get all CDS parts from all transcripts
-        self.cds_parts = []
-        for trans in self.transcripts:
-            self.cds_parts.extend(trans.cds_parts)
+
+
+    def __getattr__(self, attr):
+        # Transcripts and all parts/CDS parts of the transcripts
+        # are made from the arrays when first used
+        if attr == "transcripts":
+            value = [self.gene_arrays.get_transcript(trans_num,
+                                                     parent=self.label) \
+                     for trans_num in self.trans_nums]
+        elif attr == "parts":
+            value = self.gene_arrays.get_parts(self.trans_nums)
+        elif attr == "cds_parts":
+            value = self.gene_arrays.get_parts(self.trans_nums,
+                                               cds_only=True)
+        else:
+            raise AttributeError, attr
+        self.__dict__[attr] = value
+        return value
 
             
     def get_inclusive_trans_coords(self):
@@ -61,9 +425,12 @@ class Gene:
         i.e. the lowest start coordinate across all transcripts and
         the highest end coordinate across all transcripts.
         """
-        trans_starts = [transcript.start for transcript in self.transcripts]
-        trans_ends = [transcript.end for transcript in self.transcripts]
-        inclusive_coords = [min(trans_starts), max(trans_ends)]
+        trans_offsets = self.gene_arrays.trans_offsets
+        trans_starts = \
+            self.gene_arrays.exon_starts[trans_offsets[self.trans_nums]]
+        trans_ends = \
+            self.gene_arrays.exon_ends[trans_offsets[self.trans_nums + 1] - 1]
+        inclusive_coords = [int(trans_starts.min()), int(trans_ends.max())]
         return inclusive_coords
         
 
@@ -82,21 +449,11 @@ class Gene:
         """
         Get all parts from all transcripts.
         """
-        seen_parts = {}
-        parts = []
-        for trans in self.transcripts:
-            if cds_only:
-                trans_parts = trans.get_cds_parts()
-            else:
-                trans_parts = trans.parts
-            for exon in trans_parts:
-                # Skip parts that we've collected
-                # already
-                if (exon.start, exon.end) in seen_parts:
-                    continue
-                parts.append(exon)
-                seen_parts[(exon.start, exon.end)] = True
-        return parts
+        starts, ends, trans_nums = \
+            self.gene_arrays.get_parts_coords(self.gene_num,
+                                              cds_only=cds_only)
+        return self.gene_arrays.make_parts(starts, ends, trans_nums,
+                                           cds_only=cds_only)
         
         
     def compute_const_exons(self,
@@ -119,33 +476,29 @@ class Gene:
           when no truly constitutive exons are available.
         """
         self.const_exons = []
-        transcripts = []
         if cds_only:
             # If asked for CDS-only but there's no CDS,
             # then quit
             if not self.has_cds:
                 return self.const_exons
-            transcripts = self.get_cds_transcripts()
+            trans_nums = self.gene_arrays.get_cds_trans(self.trans_nums)
         else:
-            transcripts = self.transcripts
-        num_trans = len(transcripts)
+            trans_nums = self.trans_nums
+        num_trans = len(trans_nums)
         # If we have only one transcript then all
         # exons are constitutive
         frac_str = "NA"
         if num_trans == 1:
-            if cds_only:
-                self.const_exons = transcripts[0].get_cds_parts()
-            else:
-                self.const_exons = transcripts[0].parts
+            self.const_exons = self.gene_arrays.get_parts(trans_nums,
+                                                          cds_only=cds_only)
             frac_str = ",".join(len(self.const_exons) * ["1"])
             return self.const_exons, frac_str
         # If there's one or more fully constitutive exons, use these only
         self.const_exons, frac_str = \
-            self.get_const_exons_from_transcripts(transcripts,
-                                                  frac_const,
-                                                  cds_only,
-                                                  base_diff,
-                                                  min_exon_space=min_exon_space)
+            self.get_const_exons_from_trans_nums(trans_nums,
+                                                 cds_only,
+                                                 base_diff,
+                                                 min_exon_space=min_exon_space)
         return self.const_exons, frac_str
 
     
@@ -169,54 +522,35 @@ class Gene:
         base_diff: base difference allowed when considering an exon
         to be 'included' in transcript
         """
-        num_trans = len(transcripts)
-        # Iterate through each exon and determine what fraction
-        # of the transcripts it appears in.
-        exons = self.get_parts(cds_only=cds_only)
-        # Fraction of transcripts that each exon occurs in
-        exons_fracs = []
+        trans_positions = dict((id(trans), n) \
+                               for n, trans in enumerate(self.transcripts))
+        trans_nums = self.trans_nums[[trans_positions[id(trans)] \
+                                      for trans in transcripts]]
+        return self.get_const_exons_from_trans_nums(trans_nums,
+                                                    cds_only,
+                                                    base_diff,
+                                                    min_exon_space=min_exon_space)
+
+
+    def get_const_exons_from_trans_nums(self, trans_nums,
+                                        cds_only,
+                                        base_diff,
+                                        min_exon_space=40):
+        """
+        Get constitutive exons in a set of the gene's transcripts,
+        given by their numbers in the gene arrays (see
+        GeneArrays.get_const_coords).
+        """
+        starts, ends, part_trans, fracs = \
+            self.gene_arrays.get_const_coords(self.gene_num, trans_nums,
+                                              cds_only=cds_only,
+                                              base_diff=base_diff,
+                                              min_exon_space=min_exon_space)
+        const_exons = self.gene_arrays.make_parts(starts, ends, part_trans,
+                                                  cds_only=cds_only)
         frac_str = "NA"
-        if len(exons) == 0:
-            return exons, frac_str
-        for exon in exons:
-            # Calculate if the exon is in or out of each
-            # transcript
-            exon_status = array([trans.has_part(exon,
-                                                base_diff=base_diff,
-                                                cds_only=cds_only) \
-                                 for trans in transcripts])
-            # Compute the fraction of transcripts in which the exon
-            # occurs.
-            in_transcripts_frac = \
-                len(where(exon_status == True)[0]) / float(num_trans)
-            exons_fracs.append(in_transcripts_frac)
-        ## Get the exons that are most approximately constitutive, i.e.
-        ## occur in high fraction of transcripts
-        exons_dict = \
-            dict([(exon, frac) for exon, frac in zip(exons, exons_fracs)])
-        # Sort exons by how constitutive they are
-        sorted_exons = \
-            sorted(exons_dict.iteritems(), key=operator.itemgetter(1),
-                   reverse=True)
-        # Get maximally constitutive exons first
-        max_frac = max(exons_fracs)
-        const_exons = \
-            [e[0] for e in sorted_exons if e[1] == max_frac]
-        # Fraction of transcripts chosen exons appear in 
-        fracs = len(const_exons) * [max_frac]
-        # Compute sum of lengths of exons
-        sum_lens = np.sum([exon.len for exon in const_exons])
-        if sum_lens < min_exon_space:
-            print "NOTE: sum of constitutive exon lengths for %s is only %d" \
-                  %(self.label, sum_lens)
-            # Try to get next exon in list if there are any
-            if len(sorted_exons) >= 2:
-                next_exon, next_exon_frac = sorted_exons[1]
-                print "Fetching next exon which appears in %.2f fraction " \
-                      "of transcripts" %(next_exon_frac)
-                const_exons.append(next_exon)
-                fracs.append(next_exon_frac)
-                sum_lens += next_exon.len
+        if len(const_exons) == 0:
+            return const_exons, frac_str
         # Return constitutive exons and a string describing the fraction of
         # transcripts they appear in
         frac_str = ",".join(["%.2f" %(f) for f in fracs])
@@ -332,33 +666,57 @@ class Gene:
 class Transcript:
     """
     Transcript of a gene.
+
+    A transcript is a view of a transcript of a GeneArrays (see
+    GeneArrays.get_transcript); its parts are made from the arrays
+    when first used.
     """
-    __slots__ = ['parts', 'chrom', 'strand', 'label',
-                 'cds_start', 'cds_end', 'cds_coords',
-                 'cds_parts', 'parent']
     def __init__(self, parts, chrom, strand,
                  label=None,
                  cds_start=None,
                  cds_end=None,
-                 parent=None):
+                 parent=None,
+                 gene_arrays=None,
+                 trans_num=0):
+        if gene_arrays is None:
+            # Transcript made from Part objects
+            gene_arrays = get_gene_arrays_from_parts([parts],
+                                                     [(cds_start, cds_end)],
+                                                     [label],
+                                                     [chrom],
+                                                     [strand])
+            trans_num = 0
+            self.parts = parts
+        self.gene_arrays = gene_arrays
+        self.trans_num = trans_num
         self.gene = None
         self.chrom = chrom
         self.strand = strand
         # Start/end of transcript defined by start/end
         # of first and last exons, respectively
-        self.start = parts[0].start
-        self.end = parts[-1].end
-        self.parts = parts
+        trans_offsets = gene_arrays.trans_offsets
+        self.start = int(gene_arrays.exon_starts[trans_offsets[trans_num]])
+        self.end = int(gene_arrays.exon_ends[trans_offsets[trans_num + 1] - 1])
         self.label = label
         self.cds_start = cds_start
         self.cds_end = cds_end
         self.cds_coords = (self.cds_start,
                            self.cds_end)
         self.parent = parent
-        self.cds_parts = self.get_cds_parts()
-        self.has_cds = False
-        if len(self.cds_parts) > 0:
-            self.has_cds = True
+        self.has_cds = \
+            (len(gene_arrays.get_cds_trans([trans_num])) > 0)
+
+
+    def __getattr__(self, attr):
+        # Parts are made from the arrays when first used
+        if attr == "parts":
+            value = self.gene_arrays.get_parts([self.trans_num])
+        elif attr == "cds_parts":
+            value = self.get_cds_parts()
+        else:
+            raise AttributeError, attr
+        self.__dict__[attr] = value
+        return value
             
         
     def __repr__(self):
@@ -385,30 +743,17 @@ class Transcript:
         - cds_only: whether to use CDS only parts of the
           transcript
         """
-        trans_parts = []
-        if cds_only:
-            trans_parts = self.get_cds_parts()
-        else:
-            trans_parts = self.parts
-        if len(trans_parts) == 0:
-            # If no parts found, assume that the exon
-            # is not present in the transcript
-            return False
-        # Compute the start coord difference and end coord difference
-        # between our exon and each exon in the current transcript
-        start_end_diffs = array([(abs(part.start - curr_exon.start),
-                                  abs(part.end - curr_exon.end)) \
-                                  for curr_exon in trans_parts])
-        # The exon is NOT considered constitutive if there are no exons
-        # in the transcripts whose start/end diff with the current exon
-        # is less than or equal to 'base_diff'
-        status = all(start_end_diffs <= base_diff, axis=1)
-        if all(status == False):
-            return False
-        return True
+        starts, ends, positions = \
+            self.gene_arrays.get_coords([self.trans_num],
+                                        cds_only=cds_only)
+        # The part is in the transcript if one of the transcript's
+        # parts is within 'base_diff' of it at both ends. If no
+        # parts are found, the part is not in the transcript.
+        return bool(np.any((np.abs(part.start - starts) <= base_diff) & \
+                           (np.abs(part.end - ends) <= base_diff)))
 
     
-    def get_cds_parts(self, min_cds_len=10):
+    def get_cds_parts(self, min_cds_len=MIN_CDS_LEN):
         """
         Compute the parts that are in the CDS.  Trim UTR containing
         exons to start/end at the CDS start/end, respectively.
@@ -417,65 +762,14 @@ class Transcript:
         skip it altogether.
         """
         self.cds_parts = []
-        cds_len = self.cds_end - self.cds_start + 1
-        if (self.cds_start is None) or \
-           (cds_len < min_cds_len):
+        cds_len = self.gene_arrays.cds_ends[self.trans_num] - \
+                  self.gene_arrays.cds_starts[self.trans_num] + 1
+        if cds_len < min_cds_len:
             return self.cds_parts
-        # Compute the parts that are in the CDS
-        for part in self.parts:
-            # Skip parts that end before the CDS or
-            # start after the CDS
-            if (part.end <= self.cds_start) or \
-               (part.start >= self.cds_end):
-                continue
-            cds_part = None
-            # Check for special case that CDS is entirely contained
-            # within the exon
-            if (part.start <= self.cds_start) and \
-               (part.end >= self.cds_end):
-                # If so, make the part be the CDS itself
-                cds_part = Part(self.cds_start, self.cds_end,
-                                chrom=part.chrom,
-                                strand=part.strand,
-                                parent=part.parent)
-                cds_part.label = "cds.%s:%s-%s:%s" %(cds_part.chrom,
-                                                     str(cds_part.start),
-                                                     str(cds_part.end),
-                                                     part.strand)
-                self.cds_parts = [cds_part]
-                break
-            elif (part.start <= self.cds_start) and \
-                 (part.end > self.cds_start):
-                # If the part is overlapping the CDS start make it
-                # start at the CDS
-                cds_part = Part(self.cds_start, part.end,
-                                chrom=part.chrom,
-                                strand=part.strand,
-                                parent=part.parent)
-            elif (part.start <= self.cds_end) and \
-                 (part.end > self.cds_end):
-                # If the part is overlapping the CDS end make it
-                # end at the CDS
-                cds_part = Part(part.start, self.cds_end,
-                                chrom=part.chrom,
-                                strand=part.strand,
-                                parent=part.parent)
-            elif (part.start >= self.cds_start) and \
-                 (part.end <= self.cds_end):
-                # If the part is totally contained within CDS,
-                # add it as is
-                cds_part = Part(part.start, part.end,
-                                chrom=part.chrom,
-                                strand=part.strand,
-                                parent=part.parent)
-            # Set label for CDS part to match CDS coordinates
-            cds_part.label = "cds.%s:%s-%s:%s" %(cds_part.chrom,
-                                                 str(cds_part.start),
-                                                 str(cds_part.end),
-                                                 part.strand)
-            if cds_part is not None:
-                self.cds_parts.append(cds_part)
-        self.cds_parts = tuple(self.cds_parts)
+        self.cds_parts = \
+            tuple(self.gene_arrays.get_parts([self.trans_num],
+                                             cds_only=True,
+                                             min_cds_len=min_cds_len))
         return self.cds_parts
         
     
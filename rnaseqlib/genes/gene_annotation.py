@@ -0,0 +1,165 @@
+##
+## Compact, memory-mapped snapshot of gene annotation
+## (gene symbols, descriptions and exons by gene ID)
+##
+import os
+import sys
+import time
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.array_snapshot as array_snapshot
+
+# Fields kept for each gene, as strings
+ANNOTATION_FIELDS = ["symbol",
+                     "desc",
+                     "exons"]
+
+# UCSC tables that gene annotation is built from, by gene table
+SOURCE_TABLES = {"ensGene": ["ensGene.txt",
+                             "ensemblToGeneName.txt",
+                             "knownToEnsembl.txt",
+                             "kgXref.txt"]}
+
+
+def get_source_stamp(table_dir, source):
+    """
+    Return a stamp of the UCSC tables a gene table is built
+    from, to tell whether a snapshot is out of date.
+    """
+    return array_snapshot.get_files_stamp(
+        [os.path.join(table_dir, table_basename) \
+         for table_basename in SOURCE_TABLES.get(source,
+                                                 ["%s.txt" %(source)])])
+
+
+def is_snapshot_current(snapshot_dir, source_stamp):
+    """
+    Return True if a snapshot exists and was built, with the current
+    layout, from the UCSC tables identified by the stamp.
+    """
+    return array_snapshot.ArraySnapshot(snapshot_dir).is_current(source_stamp)
+
+
+def write_gene_annotation(snapshot_dir, gene_ids, fields_to_values,
+                          source_stamp):
+    """
+    Write a gene annotation snapshot.
+
+    - snapshot_dir: directory of the snapshot
+    - gene_ids: list of gene IDs
+    - fields_to_values: mapping from each of ANNOTATION_FIELDS to
+      a list of values (strings), in the order of gene_ids
+    - source_stamp: stamp of the UCSC tables (see get_source_stamp)
+    """
+    gene_ids = np.array([str(gene_id) for gene_id in gene_ids], dtype=str)
+    # Genes are kept sorted by ID so they can be looked up by
+    # binary search
+    order = np.argsort(gene_ids, kind="mergesort")
+    strings = {}
+    for field in ANNOTATION_FIELDS:
+        values = fields_to_values[field]
+        strings[field] = [values[n] for n in order]
+    snapshot = array_snapshot.ArraySnapshot(snapshot_dir)
+    return snapshot.write({"gene_ids": gene_ids[order]},
+                          source_stamp,
+                          strings=strings)
+
+
+class GeneLookup:
+    """
+    Mapping from gene IDs to a field of the gene annotation,
+    with a default value for unknown genes (like the
+    genes_to_names and genes_to_desc maps of GeneTable).
+    """
+    def __init__(self, annotation, field):
+        self.annotation = annotation
+        self.field = field
+
+
+    def __getitem__(self, gene_id):
+        return self.annotation.get_values(self.field, [gene_id])[0]
+
+
+    def __contains__(self, gene_id):
+        return self.annotation.get_gene_indices([gene_id])[0] >= 0
+
+
+class GeneAnnotation:
+    """
+    Gene annotation snapshot. Arrays are memory-mapped when the
+    snapshot is first used, so loading is fast and the pages are
+    shared between processes.
+
+    - snapshot_dir: directory of the snapshot
+    - na_val: value of unknown genes
+    """
+    def __init__(self, snapshot_dir, na_val="NA"):
+        self.snapshot_dir = snapshot_dir
+        self.na_val = na_val
+        self.gene_ids = None
+        self.fields_to_arrays = None
+        # Mapping from genes to gene names/symbols
+        self.genes_to_names = GeneLookup(self, "symbol")
+        # Mapping from genes to descriptions
+        self.genes_to_desc = GeneLookup(self, "desc")
+        # Mapping from genes to their exons
+        self.genes_to_exons = GeneLookup(self, "exons")
+
+
+    def load(self):
+        """
+        Memory-map the snapshot arrays, if not already done.
+        """
+        if self.gene_ids is not None:
+            return
+        snapshot = array_snapshot.ArraySnapshot(self.snapshot_dir)
+        if snapshot.load_meta() is None:
+            raise Exception, "Cannot find gene annotation snapshot %s" \
+                  %(self.snapshot_dir)
+        self.gene_ids = snapshot.load_array("gene_ids")
+        self.fields_to_arrays = {}
+        for field in ANNOTATION_FIELDS:
+            self.fields_to_arrays[field] = snapshot.load_string_arrays(field)
+
+
+    def get_gene_indices(self, gene_ids):
+        """
+        Return the index of each gene in the snapshot, or -1
+        for genes that are not in it.
+        """
+        self.load()
+        gene_ids = np.array([str(gene_id) for gene_id in gene_ids], dtype=str)
+        indices = -np.ones(len(gene_ids), dtype=np.int64)
+        if (len(gene_ids) == 0) or (len(self.gene_ids) == 0):
+            return indices
+        positions = np.searchsorted(self.gene_ids, gene_ids)
+        positions = np.minimum(positions, len(self.gene_ids) - 1)
+        found = (self.gene_ids[positions] == gene_ids)
+        indices[found] = positions[found]
+        return indices
+
+
+    def get_values(self, field, gene_ids):
+        """
+        Return the values of a field (one of ANNOTATION_FIELDS)
+        for a list of gene IDs.
+        """
+        indices = self.get_gene_indices(gene_ids)
+        data, offsets = self.fields_to_arrays[field]
+        values = []
+        for index in indices:
+            if index < 0:
+                values.append(self.na_val)
+                continue
+            values.append(data[offsets[index]:offsets[index + 1]].tostring())
+        return values
+
+
+    def get_symbols(self, gene_ids):
+        return self.get_values("symbol", gene_ids)
+
+
+    def get_descs(self, gene_ids):
+        return self.get_values("desc", gene_ids)
@@ -56,9 +56,9 @@ def extract_lens_from_gff(gff_fname, output_dir):
         entries.append(entry)
     entries_df = pandas.DataFrame(entries)
     entries_df.to_csv(output_fname,
-                      cols=["event_name", "mRNA_labels",
-                            "mRNA_lens", "exon_lens",
-                            "genomic_lens"],
+                      columns=["event_name", "mRNA_labels",
+                               "mRNA_lens", "exon_lens",
+                               "genomic_lens"],
                       sep="\t",
                       index=False)
 
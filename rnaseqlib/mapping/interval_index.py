@@ -0,0 +1,474 @@
+##
+## Sorted-array index of genomic intervals, used to assign
+## reads to regions without going through bedtools
+##
+import os
+import sys
+import time
+
+import numpy as np
+
+import pysam
+
+import rnaseqlib
+import rnaseqlib.bam.bam_utils as bam_utils
+import rnaseqlib.bam.bam_mapreduce as bam_mapreduce
+
+
+class IntervalIndex:
+    """
+    Index of genomic intervals stored as sorted numpy arrays.
+
+    Intervals are 0-based and end-exclusive (as in BED). They are
+    sorted by chromosome and start and each interval is given an
+    integer ID, which is its position in the original input.
+    """
+    def __init__(self, label=None):
+        self.label = label
+        self.num_intervals = 0
+        # Interval starts, ends and IDs sorted by chromosome
+        # and start coordinate
+        self.starts = np.array([], dtype=np.int64)
+        self.ends = np.array([], dtype=np.int64)
+        self.ids = np.array([], dtype=np.int64)
+        # Running maximum of ends and the ID of the interval
+        # that attains it (within each chromosome)
+        self.max_ends = np.array([], dtype=np.int64)
+        self.max_end_ids = np.array([], dtype=np.int64)
+        # Mapping from chromosome to its (first, last + 1) positions
+        # in the sorted arrays
+        self.chrom_bounds = {}
+        # Optional interval names and strands, indexed by ID
+        self.names = None
+        self.strands = None
+
+
+    def add_intervals(self, chroms, starts, ends,
+                      names=None,
+                      strands=None):
+        """
+        Build the index from lists of chromosomes, starts
+        and ends.
+        """
+        self.num_intervals = len(starts)
+        chroms = np.asarray(chroms)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        if names is not None:
+            self.names = np.asarray(names)
+        if strands is not None:
+            self.strands = np.asarray(strands)
+        # Sort by chromosome, then by start
+        order = np.lexsort((starts, chroms))
+        self.starts = starts[order]
+        self.ends = ends[order]
+        self.ids = np.arange(self.num_intervals, dtype=np.int64)[order]
+        self.max_ends = np.empty(self.num_intervals, dtype=np.int64)
+        self.max_end_ids = np.empty(self.num_intervals, dtype=np.int64)
+        self.chrom_bounds = {}
+        sorted_chroms = chroms[order]
+        chrom_breaks = \
+            np.flatnonzero(sorted_chroms[1:] != sorted_chroms[:-1]) + 1
+        chrom_starts = np.concatenate(([0], chrom_breaks))
+        chrom_ends = np.concatenate((chrom_breaks, [self.num_intervals]))
+        for first, last in zip(chrom_starts, chrom_ends):
+            if first == last:
+                continue
+            self.chrom_bounds[sorted_chroms[first]] = (first, last)
+            chrom_ends_arr = self.ends[first:last]
+            chrom_max_ends = np.maximum.accumulate(chrom_ends_arr)
+            self.max_ends[first:last] = chrom_max_ends
+            # Position of the interval attaining the running maximum
+            positions = np.arange(last - first)
+            positions[chrom_ends_arr < chrom_max_ends] = 0
+            positions = np.maximum.accumulate(positions)
+            self.max_end_ids[first:last] = self.ids[first:last][positions]
+
+
+    def get_arrays(self):
+        """
+        Return the index as a mapping from names to arrays, and
+        the mapping from chromosomes to their positions in the
+        sorted arrays (e.g. to save the index in a snapshot).
+        """
+        arrays = {"starts": self.starts,
+                  "ends": self.ends,
+                  "ids": self.ids,
+                  "max_ends": self.max_ends,
+                  "max_end_ids": self.max_end_ids}
+        if self.names is not None:
+            arrays["names"] = self.names
+        if self.strands is not None:
+            arrays["strands"] = self.strands
+        return arrays, self.chrom_bounds
+
+
+    def set_arrays(self, arrays, chrom_bounds):
+        """
+        Set the index from arrays returned by get_arrays.
+        """
+        self.starts = arrays["starts"]
+        self.ends = arrays["ends"]
+        self.ids = arrays["ids"]
+        self.max_ends = arrays["max_ends"]
+        self.max_end_ids = arrays["max_end_ids"]
+        self.names = arrays.get("names")
+        self.strands = arrays.get("strands")
+        self.num_intervals = len(self.starts)
+        self.chrom_bounds = dict([(str(chrom), tuple(bounds)) \
+                                  for chrom, bounds in chrom_bounds.iteritems()])
+
+
+    def get_lens(self):
+        """
+        Return interval lengths, indexed by interval ID.
+        """
+        lens = np.empty(self.num_intervals, dtype=np.int64)
+        lens[self.ids] = self.ends - self.starts
+        return lens
+
+
+    def find_containing(self, chrom, starts, ends):
+        """
+        Find intervals that contain each of the given (start, end)
+        queries on a chromosome.
+
+        Returns an array with the ID of a containing interval for
+        each query, or -1 if no interval contains it. When several
+        intervals contain a query, the one reaching furthest
+        is returned.
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        hits = -np.ones(len(starts), dtype=np.int64)
+        if chrom not in self.chrom_bounds:
+            return hits
+        first, last = self.chrom_bounds[chrom]
+        # Last interval starting at or before each query start
+        positions = \
+            np.searchsorted(self.starts[first:last], starts, side="right") - 1
+        has_prev = (positions >= 0)
+        positions = positions[has_prev] + first
+        contained = (self.max_ends[positions] >= ends[has_prev])
+        hit_ids = -np.ones(len(positions), dtype=np.int64)
+        hit_ids[contained] = self.max_end_ids[positions[contained]]
+        hits[has_prev] = hit_ids
+        return hits
+
+
+    def find_all_containing(self, chrom, starts, ends):
+        """
+        Find all intervals that contain each of the given
+        (start, end) queries on a chromosome.
+
+        Returns two arrays of the same length, with one entry
+        per (query, containing interval) pair: the query numbers
+        (in increasing order) and the interval IDs.
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        query_hits = []
+        id_hits = []
+        if chrom in self.chrom_bounds:
+            first, last = self.chrom_bounds[chrom]
+            # Last interval starting at or before each query start
+            positions = \
+                np.searchsorted(self.starts[first:last], starts,
+                                side="right") - 1 + first
+            queries = np.flatnonzero(positions >= first)
+            positions = positions[queries]
+            # Walk back through intervals starting before each query
+            # for as long as one of them can still reach its end
+            while len(queries) > 0:
+                query_ends = ends[queries]
+                reaching = (self.max_ends[positions] >= query_ends)
+                queries = queries[reaching]
+                positions = positions[reaching]
+                query_ends = query_ends[reaching]
+                contained = (self.ends[positions] >= query_ends)
+                query_hits.append(queries[contained])
+                id_hits.append(self.ids[positions[contained]])
+                positions = positions - 1
+                has_prev = (positions >= first)
+                queries = queries[has_prev]
+                positions = positions[has_prev]
+        if len(query_hits) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        query_hits = np.concatenate(query_hits)
+        id_hits = np.concatenate(id_hits)
+        order = np.argsort(query_hits, kind="mergesort")
+        return query_hits[order], id_hits[order]
+
+
+def load_bed_index(bed_filename, label=None):
+    """
+    Load a BED file into an IntervalIndex. Interval IDs are
+    the line numbers of the intervals in the BED file.
+    """
+    chroms = []
+    starts = []
+    ends = []
+    names = []
+    with open(bed_filename) as bed_file:
+        for line in bed_file:
+            if line.startswith("#") or line.startswith("track"):
+                continue
+            fields = line.strip().split("\t")
+            if len(fields) < 3:
+                continue
+            start, end = int(fields[1]), int(fields[2])
+            if start > end:
+                start, end = end, start
+            chroms.append(fields[0])
+            starts.append(start)
+            ends.append(end)
+            if len(fields) > 3:
+                names.append(fields[3])
+            else:
+                names.append("")
+    interval_index = IntervalIndex(label=label)
+    interval_index.add_intervals(chroms, starts, ends, names=names)
+    return interval_index
+
+
+def write_indexes_snapshot(snapshot, labels, interval_indexes, stamp,
+                           meta={}):
+    """
+    Write labeled interval indexes to an ArraySnapshot.
+    """
+    arrays = {}
+    array_names = {}
+    indexes_chrom_bounds = {}
+    for label, index in zip(labels, interval_indexes):
+        index_arrays, chrom_bounds = index.get_arrays()
+        for name, array in index_arrays.iteritems():
+            arrays["%s.%s" %(label, name)] = array
+        array_names[label] = sorted(index_arrays.keys())
+        indexes_chrom_bounds[label] = \
+            dict([(chrom, [int(first), int(last)]) \
+                  for chrom, (first, last) in chrom_bounds.iteritems()])
+    snapshot_meta = dict(meta)
+    snapshot_meta["labels"] = labels
+    snapshot_meta["array_names"] = array_names
+    snapshot_meta["chrom_bounds"] = indexes_chrom_bounds
+    snapshot.write(arrays, stamp, meta=snapshot_meta)
+
+
+def load_indexes_snapshot(snapshot):
+    """
+    Load labeled interval indexes from an ArraySnapshot written
+    by write_indexes_snapshot. Arrays are memory-mapped.
+
+    Returns the labels and the interval indexes.
+    """
+    meta = snapshot.load_meta()
+    labels = [str(label) for label in meta["labels"]]
+    interval_indexes = []
+    for label in labels:
+        arrays = dict([(name, snapshot.load_array("%s.%s" %(label, name))) \
+                       for name in meta["array_names"][label]])
+        index = IntervalIndex(label=label)
+        index.set_arrays(arrays, meta["chrom_bounds"][label])
+        interval_indexes.append(index)
+    return labels, interval_indexes
+
+
+class RegionCounts:
+    """
+    Counts of reads assigned to sets of regions.
+
+    - labels: labels of the region sets
+    - mask_counts: number of reads for each combination of
+      region sets hit, indexed by bitmask (bit i set if
+      the read fell in the i-th region set)
+    - interval_counts: mapping from label to an array of
+      read counts for each interval in that region set
+    - num_reads: number of mapped reads considered
+    - num_junctions: number of junction reads
+    """
+    def __init__(self, labels, interval_indexes):
+        self.labels = labels
+        self.mask_counts = np.zeros(2**len(labels), dtype=np.int64)
+        self.interval_counts = {}
+        for label, interval_index in zip(labels, interval_indexes):
+            self.interval_counts[label] = \
+                np.zeros(interval_index.num_intervals, dtype=np.int64)
+        self.num_reads = 0
+        self.num_junctions = 0
+
+
+    def get_mask(self, labels):
+        """
+        Get bitmask for a set of labels.
+        """
+        mask = 0
+        for label in labels:
+            mask |= (1 << self.labels.index(label))
+        return mask
+
+
+    def iter_masks(self):
+        """
+        Iterate over (set of labels hit, number of reads) pairs
+        for combinations of regions that have reads.
+        """
+        for mask in np.flatnonzero(self.mask_counts):
+            labels_hit = set([label for n, label in enumerate(self.labels) \
+                              if mask & (1 << n)])
+            yield labels_hit, self.mask_counts[mask]
+
+
+class RegionCounter:
+    """
+    Assign reads from a BAM file to sets of regions.
+
+    A read falls in a region set if all of its aligned blocks are
+    contained in intervals of that set. Reads are processed in
+    chunks so that interval lookups are vectorized.
+    """
+    def __init__(self, labels, interval_indexes,
+                 chunk_size=200000):
+        self.labels = labels
+        self.interval_indexes = interval_indexes
+        self.chunk_size = chunk_size
+        self.region_counts = RegionCounts(labels, interval_indexes)
+        self.init_chunk()
+
+
+    def init_chunk(self):
+        self.chunk_chrom = None
+        self.block_starts = []
+        self.block_ends = []
+        # Offset of each read's first block in the chunk
+        self.read_offsets = []
+
+
+    def add_read(self, chrom, read):
+        """
+        Add a read to be counted.
+        """
+        if (chrom != self.chunk_chrom) or \
+           (len(self.read_offsets) >= self.chunk_size):
+            self.flush()
+            self.chunk_chrom = chrom
+        blocks = bam_utils.get_read_blocks(read)
+        if len(blocks) == 0:
+            return
+        self.region_counts.num_reads += 1
+        if len(blocks) > 1 and bam_utils.is_junction_read(read):
+            self.region_counts.num_junctions += 1
+        self.read_offsets.append(len(self.block_starts))
+        for block_start, block_end in blocks:
+            self.block_starts.append(block_start)
+            self.block_ends.append(block_end)
+
+
+    def flush(self):
+        """
+        Assign the reads in the current chunk to regions.
+        """
+        num_reads = len(self.read_offsets)
+        if num_reads == 0:
+            self.init_chunk()
+            return
+        read_offsets = np.array(self.read_offsets, dtype=np.int64)
+        num_blocks = len(self.block_starts)
+        # Read number of each block
+        block_reads = \
+            np.repeat(np.arange(num_reads),
+                      np.diff(np.append(read_offsets, num_blocks)))
+        masks = np.zeros(num_reads, dtype=np.int64)
+        for n, interval_index in enumerate(self.interval_indexes):
+            hits = interval_index.find_containing(self.chunk_chrom,
+                                                  self.block_starts,
+                                                  self.block_ends)
+            contained = (hits >= 0)
+            # Reads whose blocks are all contained in the regions
+            reads_hit = \
+                np.minimum.reduceat(contained.astype(np.int8),
+                                    read_offsets).astype(bool)
+            masks[reads_hit] |= (1 << n)
+            # Count each read once per interval it falls in
+            block_hit = contained & reads_hit[block_reads]
+            if not block_hit.any():
+                continue
+            read_hits = np.unique(block_reads[block_hit] * \
+                                  interval_index.num_intervals + \
+                                  hits[block_hit])
+            interval_ids = read_hits % interval_index.num_intervals
+            np.add.at(self.region_counts.interval_counts[self.labels[n]],
+                      interval_ids, 1)
+        self.region_counts.mask_counts += \
+            np.bincount(masks, minlength=len(self.region_counts.mask_counts))
+        self.init_chunk()
+
+
+    def new_counter(self):
+        """
+        Return an empty counter of the same regions.
+        """
+        return RegionCounter(self.labels, self.interval_indexes,
+                             chunk_size=self.chunk_size)
+
+
+    def get_partial(self):
+        return self.region_counts
+
+
+    def add_partial(self, region_counts):
+        self.region_counts.mask_counts += region_counts.mask_counts
+        for label in self.labels:
+            self.region_counts.interval_counts[label] += \
+                region_counts.interval_counts[label]
+        self.region_counts.num_reads += region_counts.num_reads
+        self.region_counts.num_junctions += region_counts.num_junctions
+
+
+    def count_bam(self, bam_filename,
+                  num_processes=1,
+                  tile_size=None):
+        """
+        Count all mapped reads in a BAM file. Returns a
+        RegionCounts object.
+
+        - num_processes: number of processes to count in, splitting
+          an indexed BAM by chromosome (or by tiles of 'tile_size')
+        """
+        counter = bam_mapreduce.map_reduce_bam(bam_filename,
+                                               self.new_counter,
+                                               num_processes=num_processes,
+                                               tile_size=tile_size)
+        self.add_partial(counter.get_partial())
+        return self.region_counts
+
+
+def count_reads_in_bed_regions(bam_filename, bed_filenames, labels,
+                               num_processes=1,
+                               tile_size=None):
+    """
+    Count reads from BAM file in regions given by BED files,
+    using 'num_processes' processes if the BAM is indexed.
+
+    Returns a RegionCounts object.
+    """
+    interval_indexes = [load_bed_index(bed_filename, label=label) \
+                        for bed_filename, label in zip(bed_filenames,
+                                                       labels)]
+    return count_reads_in_regions(bam_filename, labels, interval_indexes,
+                                  num_processes=num_processes,
+                                  tile_size=tile_size)
+
+
+def count_reads_in_regions(bam_filename, labels, interval_indexes,
+                           num_processes=1,
+                           tile_size=None):
+    """
+    Count reads from BAM file in labeled sets of regions given
+    as interval indexes.
+
+    Returns a RegionCounts object.
+    """
+    region_counter = RegionCounter(labels, interval_indexes)
+    return region_counter.count_bam(bam_filename,
+                                    num_processes=num_processes,
+                                    tile_size=tile_size)
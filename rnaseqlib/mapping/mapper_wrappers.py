@@ -69,27 +69,23 @@ def get_tophat_mapping_cmd(tophat_path,
     return mapper_cmd, tophat_outfilename
 
 
-def get_bowtie_mapping_cmd(bowtie_path,
-                           input_filename,
-                           genome_index_filename,
-                           output_filename,
-                           bowtie_options=""):
+def get_bowtie_stream_cmd(bowtie_path,
+                          input_filename,
+                          genome_index_filename,
+                          bowtie_options=""):
     """
-    Get bowtie args for mapping.
+    Get bowtie args for mapping, writing SAM to stdout.
     """
     input_compressed = False
     if input_filename.endswith(".gz"):
         input_compressed = True
     check_genome_index_path(genome_index_filename)
-    # Make output always gzipped
     if ("--sam" not in bowtie_options):
         # Always output sam
         bowtie_options += " --sam"
-    output_filename = "%s.bam" %(output_filename)
     args = {"bowtie_path": bowtie_path,
             "input_filename": input_filename,
             "genome_index_filename": genome_index_filename,
-            "output_filename": output_filename,
             "bowtie_options": bowtie_options}
     if input_compressed:
         # Assume the input is compressed. Pass it through
@@ -97,13 +93,34 @@ def get_bowtie_mapping_cmd(bowtie_path,
         # The "-c" argument to -gunzip is for printing to stdout
         mapper_cmd = \
             "gunzip -c %(input_filename)s | %(bowtie_path)s %(bowtie_options)s " \
-            "%(genome_index_filename)s - | samtools view -bS - -o %(output_filename)s" % args
+            "%(genome_index_filename)s -" % args
     else:
-        mapper_cmd = "%s %s " %(bowtie_path, bowtie_options)
-        mapper_cmd += " %s %s - | samtools view -Sbh - > %s" \
-            %(genome_index_filename,
-              input_filename,
-              output_filename)
+        mapper_cmd = "%(bowtie_path)s %(bowtie_options)s " \
+                     "%(genome_index_filename)s %(input_filename)s -" % args
+    return mapper_cmd
+
+
+def get_bowtie_mapping_cmd(bowtie_path,
+                           input_filename,
+                           genome_index_filename,
+                           output_filename,
+                           bowtie_options="",
+                           write_filename=None):
+    """
+    Get bowtie args for mapping.
+
+    - write_filename: optional file to write the BAM to instead
+      of the output filename (e.g. a temporary file that is
+      renamed to the output filename once mapping succeeds)
+    """
+    output_filename = "%s.bam" %(output_filename)
+    if write_filename is None:
+        write_filename = output_filename
+    mapper_cmd = get_bowtie_stream_cmd(bowtie_path,
+                                       input_filename,
+                                       genome_index_filename,
+                                       bowtie_options=bowtie_options)
+    mapper_cmd += " | samtools view -Sbh - > %s" %(write_filename)
     return mapper_cmd, output_filename
 
 
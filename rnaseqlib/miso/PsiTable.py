@@ -329,7 +329,7 @@ class PsiTable:
                 curr_df.to_csv(output_filename,
                                sep=self.delimiter,
                                float_format="%.4f",
-                               cols=columns_to_write)
+                               columns=columns_to_write)
             
     
     def get_differential_events(self):
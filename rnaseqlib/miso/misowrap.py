@@ -191,24 +191,18 @@ def get_read_len(sample_label, readlen_val):
 @arg("settings", help="misowrap settings filename.")
 @arg("logs-outdir", help="Directory where to place logs.")
 @arg("--use-cluster", help="Use cluster to submit jobs.")
-@arg("--base-delay", help="Base delay to use (in seconds).")
-@arg("--batch-delay",
-     help="Delay to use between batches of jobs (in seconds).")
-@arg("--delay-every-n-jobs",
-     help="Number of jobs after which a delay is imposed.")
 @arg("--dry-run", help="Dry run: do not submit or execute jobs.")
 @arg("--samples", help="Samples to run on.", nargs='+', type=str)
 def run(settings, logs_outdir,
         use_cluster=True,
-        base_delay=10,
-        # Batch delay (20 mins by default)
-        batch_delay=60*20,
-        delay_every_n_jobs=30,
         dry_run=False,
         event_types=None,
         samples=[]):
     """
     Run MISO on a set of samples.
+
+    When using the cluster, all sample and event type pairs are
+    submitted as a single job array.
     """
     if dry_run:
         print " -- DRY RUN -- "
@@ -236,7 +230,9 @@ def run(settings, logs_outdir,
     event_types_dirs = \
         miso_utils.get_event_types_dirs(misowrap_obj.settings_info)
     miso_settings_filename = misowrap_obj.miso_settings_filename
-    n = 0
+    # MISO commands and their (sample, event type) labels
+    miso_cmds = []
+    task_labels = []
     for bam_input in bam_files:
         bam_filename, sample_label = bam_input
         # If asked to run on certain samples only,
@@ -292,23 +288,20 @@ def run(settings, logs_outdir,
             # Settings
             miso_cmd += " --settings %s" %(miso_settings_filename)
             misowrap_obj.logger.info("Executing: %s" %(miso_cmd))
-            job_name = "%s_%s" %(sample_label, event_type)
             if use_cluster:
-                if not dry_run:
-                    misowrap_obj.my_cluster.launch_job(miso_cmd,
-                                                       job_name,
-                                                       ppn=1)
-                if n == delay_every_n_jobs:
-                    # Larger delay everytime we've submitted n jobs
-                    misowrap_obj.logger.info("Submitted %d jobs, now waiting %.2f mins." \
-                                             %(n, batch_delay / 60.))
-                    time.sleep(batch_delay)
-                    n = 0
-                time.sleep(base_delay)
+                miso_cmds.append(miso_cmd)
+                task_labels.append([sample_label, event_type])
             else:
                 if not dry_run:
                     os.system(miso_cmd)
-            n += 1
+    if use_cluster and (len(miso_cmds) > 0):
+        misowrap_obj.logger.info("Submitting %d MISO jobs as a job array" \
+                                 %(len(miso_cmds)))
+        if not dry_run:
+            misowrap_obj.my_cluster.launch_job_array(miso_cmds,
+                                                     "misowrap_run",
+                                                     task_labels=task_labels,
+                                                     ppn=1)
 
 
 @arg("settings", help="misowrap settings filename.")
@@ -135,7 +135,7 @@ class Kmers:
         kmer_df.to_csv(output_fname,
                        sep="\t",
                        index=False,
-                       cols=column_order)
+                       columns=column_order)
         return kmer_df
             
 
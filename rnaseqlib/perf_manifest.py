@@ -0,0 +1,326 @@
+##
+## Per-step timing and resource usage manifests
+##
+import os
+import sys
+import time
+import resource
+import threading
+
+import pandas
+
+import rnaseqlib
+
+
+# Fields of a performance manifest
+MANIFEST_HEADER = ["sample",
+                   "sample_type",
+                   "step",
+                   "level",
+                   "status",
+                   "concurrent",
+                   "start_time",
+                   "wall_time",
+                   "cpu_time",
+                   "peak_rss_mb",
+                   "read_bytes",
+                   "write_bytes"]
+
+# Resources measured for the whole process, which are not recorded
+# for steps that ran at the same time as other steps
+PROCESS_FIELDS = ["cpu_time",
+                  "peak_rss_mb",
+                  "read_bytes",
+                  "write_bytes"]
+
+# Top-level stages of running the pipeline on a sample, in order
+PIPELINE_STAGES = ["preprocess_reads",
+                   "map_reads",
+                   "run_qc",
+                   "run_analysis"]
+
+
+def get_cpu_time():
+    """
+    Return user and system CPU time (in seconds) used so far by
+    this process and its waited-for children.
+    """
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def get_io_counters():
+    """
+    Return a (read_bytes, write_bytes) pair of bytes read from and
+    written to storage so far by this process and its waited-for
+    children, or None if not available (non-Linux).
+    """
+    io_counters = {}
+    try:
+        with open("/proc/self/io") as io_file:
+            for line in io_file:
+                field, value = line.split(":")
+                io_counters[field] = int(value)
+    except (IOError, ValueError):
+        return None
+    return (io_counters.get("read_bytes", 0),
+            io_counters.get("write_bytes", 0))
+
+
+def get_peak_rss():
+    """
+    Return the peak resident set size (in MB) of this process since
+    it started or since the last call to reset_peak_rss().
+    """
+    try:
+        with open("/proc/self/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, ValueError):
+        pass
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of this process, where the
+    kernel supports it (Linux 4.0+).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except IOError:
+        pass
+
+
+def get_children_peak_rss():
+    """
+    Return the largest peak RSS (in MB) of any waited-for child.
+    """
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.
+
+
+class ResourceTimer:
+    """
+    Measure wall time, CPU time, peak RSS and I/O of a step.
+
+    CPU time and I/O are counted for the whole process, so they
+    only describe a step if no other step ran at the same time
+    (see PerfManifest.measure). Peak RSS is that of the process
+    since the start of the enclosing stage (it is only reset at
+    stage level), or that of the largest external command run
+    during the step if larger.
+    """
+    def __init__(self, reset_peak=False):
+        if reset_peak:
+            reset_peak_rss()
+        self.start_time = time.time()
+        self.start_cpu_time = get_cpu_time()
+        self.start_io = get_io_counters()
+        self.start_children_rss = get_children_peak_rss()
+
+
+    def stop(self):
+        """
+        Return the resources used since the timer started.
+        """
+        usage = {"start_time": self.start_time,
+                 "wall_time": time.time() - self.start_time,
+                 "cpu_time": get_cpu_time() - self.start_cpu_time,
+                 "peak_rss_mb": get_peak_rss(),
+                 "read_bytes": None,
+                 "write_bytes": None}
+        children_rss = get_children_peak_rss()
+        if children_rss > self.start_children_rss:
+            usage["peak_rss_mb"] = max(usage["peak_rss_mb"], children_rss)
+        end_io = get_io_counters()
+        if (self.start_io is not None) and (end_io is not None):
+            usage["read_bytes"] = end_io[0] - self.start_io[0]
+            usage["write_bytes"] = end_io[1] - self.start_io[1]
+        return usage
+
+
+class PerfManifest:
+    """
+    Machine-readable record of the resources used by each step
+    of running the pipeline on a sample (tab-separated, one line
+    per step). Lines are written as steps finish.
+
+    - level: 'stage' for the top-level stages of the pipeline
+      (see PIPELINE_STAGES), 'step' for steps within them
+
+    Steps that ran in parallel threads with other steps are
+    marked 'concurrent', with only their wall time recorded:
+    the other resources are measured for the whole process and
+    would include the other steps' usage. Stages run one at a
+    time, so their resources include all of their steps.
+    """
+    def __init__(self, manifest_filename, sample_label,
+                 sample_type=None):
+        self.manifest_filename = manifest_filename
+        self.sample_label = sample_label
+        self.sample_type = sample_type
+        self.lock = threading.Lock()
+        # Steps being measured, as [thread ID, concurrent] entries
+        self.running_steps = []
+        # Start a new manifest
+        with open(self.manifest_filename, "w") as manifest_file:
+            manifest_file.write("%s\n" %("\t".join(MANIFEST_HEADER)))
+
+
+    def get_step_name(self, step_name):
+        # Drop the sample label that step names are prefixed with
+        prefix = "%s." %(self.sample_label)
+        if step_name.startswith(prefix):
+            return step_name[len(prefix):]
+        return step_name
+
+
+    def record(self, step_name, usage,
+               level="step",
+               status="ok",
+               concurrent=False):
+        """
+        Write a step's resource usage to the manifest.
+        """
+        entry = dict(usage)
+        if concurrent:
+            for field in PROCESS_FIELDS:
+                entry[field] = None
+        entry.update({"sample": self.sample_label,
+                      "sample_type": self.sample_type,
+                      "step": self.get_step_name(step_name),
+                      "level": level,
+                      "status": status,
+                      "concurrent": int(concurrent)})
+        fields = []
+        for field in MANIFEST_HEADER:
+            value = entry.get(field, None)
+            if value is None:
+                fields.append("NA")
+            elif isinstance(value, float):
+                fields.append("%.3f" %(value))
+            else:
+                fields.append(str(value))
+        with self.lock:
+            with open(self.manifest_filename, "a") as manifest_file:
+                manifest_file.write("%s\n" %("\t".join(fields)))
+
+
+    def record_skipped(self, step_name, level="step"):
+        """
+        Record a step that was skipped since it was up to date.
+        """
+        self.record(step_name, {"start_time": time.time(),
+                                "wall_time": 0.,
+                                "cpu_time": 0.},
+                    level=level,
+                    status="skipped")
+
+
+    def start_step(self):
+        """
+        Register a step starting in the current thread. Returns
+        its entry in running_steps. The step and any steps running
+        in other threads are marked concurrent (steps nested in
+        a step of the same thread are not).
+        """
+        thread_id = threading.current_thread().ident
+        step_entry = [thread_id, False]
+        with self.lock:
+            for running_step in self.running_steps:
+                if running_step[0] != thread_id:
+                    running_step[1] = True
+                    step_entry[1] = True
+            self.running_steps.append(step_entry)
+        return step_entry
+
+
+    def stop_step(self, step_entry):
+        """
+        Unregister a step. Returns True if it ran concurrently
+        with steps of other threads.
+        """
+        with self.lock:
+            self.running_steps = [running_step \
+                                  for running_step in self.running_steps \
+                                  if running_step is not step_entry]
+        return step_entry[1]
+
+
+    def measure(self, step_name, func, level="step"):
+        """
+        Call func, recording its resource usage under the given
+        step name. Returns the result of func.
+        """
+        step_entry = None
+        if level == "step":
+            step_entry = self.start_step()
+        timer = ResourceTimer(reset_peak=(level == "stage"))
+        status = "failed"
+        try:
+            result = func()
+            status = "ok"
+            return result
+        finally:
+            usage = timer.stop()
+            concurrent = False
+            if step_entry is not None:
+                concurrent = self.stop_step(step_entry)
+            self.record(step_name, usage,
+                        level=level,
+                        status=status,
+                        concurrent=concurrent)
+
+
+def load_manifests(manifest_filenames):
+    """
+    Load and merge performance manifests into one DataFrame.
+    Missing manifests are skipped.
+    """
+    manifests = []
+    for manifest_filename in manifest_filenames:
+        if not os.path.isfile(manifest_filename):
+            continue
+        manifests.append(pandas.read_table(manifest_filename,
+                                           sep="\t",
+                                           na_values=["NA"]))
+    if len(manifests) == 0:
+        return None
+    return pandas.concat(manifests, ignore_index=True)
+
+
+def summarize_manifests(perf_df):
+    """
+    Summarize merged manifests: one row per sample with the wall
+    time of each pipeline stage and the slowest step within
+    the stages.
+    """
+    summary_header = ["sample", "sample_type"]
+    summary_header.extend(["%s_wall_time" %(stage) \
+                           for stage in PIPELINE_STAGES])
+    summary_header.extend(["slowest_step", "slowest_step_wall_time",
+                           "max_peak_rss_mb", "total_read_bytes",
+                           "total_write_bytes"])
+    summary_entries = []
+    for sample_label, sample_df in perf_df.groupby("sample", sort=False):
+        stages_df = sample_df[sample_df["level"] == "stage"]
+        steps_df = sample_df[sample_df["level"] == "step"]
+        entry = {"sample": sample_label,
+                 "sample_type": sample_df["sample_type"].iloc[0]}
+        for stage in PIPELINE_STAGES:
+            stage_times = stages_df[stages_df["step"] == stage]["wall_time"]
+            if len(stage_times) > 0:
+                entry["%s_wall_time" %(stage)] = stage_times.sum()
+        if len(steps_df) > 0:
+            slowest = steps_df["wall_time"].values.argmax()
+            entry["slowest_step"] = steps_df["step"].iloc[slowest]
+            entry["slowest_step_wall_time"] = \
+                steps_df["wall_time"].iloc[slowest]
+        entry["max_peak_rss_mb"] = sample_df["peak_rss_mb"].max()
+        entry["total_read_bytes"] = stages_df["read_bytes"].sum()
+        entry["total_write_bytes"] = stages_df["write_bytes"].sum()
+        summary_entries.append(entry)
+    return pandas.DataFrame(summary_entries, columns=summary_header)
@@ -0,0 +1,362 @@
+##
+## Columnar store of gene read counts for all samples
+##
+import os
+import sys
+import time
+
+import numpy as np
+import pandas
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+import rnaseqlib.rpkm.normalization as normalization
+
+# Fields of the gene metadata file
+GENES_HEADER = ["gene_id",
+                "gene_symbol",
+                "gene_desc",
+                "exons",
+                "length"]
+
+
+class CountStore:
+    """
+    Store of gene read counts for a gene table (e.g. ensGene),
+    as a genes x samples matrix kept one column per file.
+
+    Gene metadata (IDs, symbols, descriptions, constitutive
+    exons and their total length) is written once, and each
+    sample's counts are added as a column (an .npz file holding
+    the counts, in the order of the gene metadata, and the
+    number of mapped reads to normalize to). Adding a sample
+    does not touch the other samples' columns, so samples can
+    be added from separate jobs.
+
+    Counts of finer features (e.g. exons and splice junctions of
+    the gene table) can be kept in the store too: the features
+    are written once per kind, and each sample's counts are kept
+    sparsely (only the features that have reads).
+
+    Gene metadata and features can be written with a stamp of
+    the files they come from (see array_snapshot.get_files_stamp).
+    They are rewritten when the stamp changes, and each sample's
+    column records the stamp it was counted against, so columns
+    counted against other genes or features are not mixed in.
+
+    - store_dir: directory of the store
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.genes_filename = os.path.join(self.store_dir, "genes.txt")
+        self.samples_dir = os.path.join(self.store_dir, "samples")
+        self.genes_df = None
+
+
+    def get_sample_filename(self, sample_label):
+        return os.path.join(self.samples_dir, "%s.npz" %(sample_label))
+
+
+    def get_stamp_filename(self, name):
+        return os.path.join(self.store_dir, "%s.stamp" %(name))
+
+
+    def load_stamp(self, name):
+        """
+        Return the stamp of the genes ('genes') or features of
+        a kind, or None if they were written without one.
+        """
+        stamp_filename = self.get_stamp_filename(name)
+        if not os.path.isfile(stamp_filename):
+            return None
+        with open(stamp_filename) as stamp_file:
+            return stamp_file.read()
+
+
+    def is_current(self, name, stamp):
+        """
+        Return True if the genes ('genes') or features of a kind
+        are in the store and were written from the files
+        identified by the stamp.
+        """
+        return os.path.isfile(self.get_features_filename(name)) and \
+               (self.load_stamp(name) == stamp)
+
+
+    def get_column_stamp(self, column_filename):
+        """
+        Return the stamp a sample's column was counted against,
+        or None if it has none.
+        """
+        column_data = np.load(column_filename)
+        if "stamp" not in column_data.files:
+            return None
+        return str(column_data["stamp"])
+
+
+    def has_column(self, column_filename, name, stamp):
+        if not os.path.isfile(column_filename):
+            return False
+        if stamp is None:
+            stamp = self.load_stamp(name)
+        return self.get_column_stamp(column_filename) == stamp
+
+
+    def has_sample(self, sample_label, stamp=None):
+        """
+        Return True if the store has a sample's gene counts,
+        counted against genes with the given stamp (by default,
+        the stamp of the genes in the store).
+        """
+        return self.has_column(self.get_sample_filename(sample_label),
+                               "genes",
+                               stamp)
+
+
+    def get_features_filename(self, kind):
+        return os.path.join(self.store_dir, "%s.txt" %(kind))
+
+
+    def get_sample_features_filename(self, sample_label, kind):
+        return os.path.join(self.samples_dir,
+                            "%s.%s.npz" %(sample_label, kind))
+
+
+    def has_sample_features(self, sample_label, kind, stamp=None):
+        """
+        Return True if the store has a sample's counts of features
+        of a kind, counted against features with the given stamp
+        (by default, the stamp of the features in the store).
+        """
+        return self.has_column(self.get_sample_features_filename(sample_label,
+                                                                 kind),
+                               kind,
+                               stamp)
+
+
+    def write_stamp(self, name, stamp):
+        stamp_filename = self.get_stamp_filename(name)
+        if stamp is None:
+            if os.path.isfile(stamp_filename):
+                os.remove(stamp_filename)
+            return
+        tmp_filename = "%s.tmp.%d" %(stamp_filename, os.getpid())
+        with open(tmp_filename, "w") as stamp_file:
+            stamp_file.write(stamp)
+        os.rename(tmp_filename, stamp_filename)
+
+
+    def write_genes(self, gene_ids, gene_symbols, gene_descs,
+                    gene_exons, gene_lens,
+                    stamp=None):
+        """
+        Write gene metadata, unless it is already in the store
+        with the same stamp.
+
+        - stamp: stamp of the files the genes come from
+        """
+        if os.path.isfile(self.genes_filename) and \
+           (stamp is None or self.load_stamp("genes") == stamp):
+            return
+        utils.make_dir(self.samples_dir)
+        genes_df = pandas.DataFrame({"gene_id": gene_ids,
+                                     "gene_symbol": gene_symbols,
+                                     "gene_desc": gene_descs,
+                                     "exons": gene_exons,
+                                     "length": gene_lens})
+        # Write to a temporary file and rename it into place, so
+        # samples written at the same time never see a partial file
+        tmp_filename = "%s.tmp.%d" %(self.genes_filename, os.getpid())
+        genes_df[GENES_HEADER].to_csv(tmp_filename,
+                                      sep="\t",
+                                      index=False)
+        os.rename(tmp_filename, self.genes_filename)
+        self.write_stamp("genes", stamp)
+        self.genes_df = None
+
+
+    def write_features(self, kind, features_df, stamp=None):
+        """
+        Write the features of a kind (a DataFrame with one row
+        per feature), unless they are already in the store with
+        the same stamp.
+
+        - stamp: stamp of the files the features come from
+        """
+        features_filename = self.get_features_filename(kind)
+        if os.path.isfile(features_filename) and \
+           (stamp is None or self.load_stamp(kind) == stamp):
+            return
+        utils.make_dir(self.samples_dir)
+        tmp_filename = "%s.tmp.%d" %(features_filename, os.getpid())
+        features_df.to_csv(tmp_filename,
+                           sep="\t",
+                           index=False)
+        os.rename(tmp_filename, features_filename)
+        self.write_stamp(kind, stamp)
+
+
+    def load_features(self, kind):
+        """
+        Load the features of a kind as a DataFrame.
+        """
+        return pandas.read_csv(self.get_features_filename(kind),
+                               sep="\t",
+                               dtype={"chrom": str,
+                                      "gene_id": str},
+                               keep_default_na=False)
+
+
+    def load_genes(self):
+        """
+        Load gene metadata as a DataFrame.
+        """
+        if self.genes_df is None:
+            self.genes_df = pandas.read_csv(self.genes_filename,
+                                            sep="\t",
+                                            dtype={"gene_id": str,
+                                                   "gene_symbol": str,
+                                                   "gene_desc": str,
+                                                   "exons": str},
+                                            keep_default_na=False)
+        return self.genes_df
+
+
+    def get_column_arrays(self, name):
+        """
+        Return the arrays recording, in a sample's column, the
+        stamp of the genes ('genes') or features it was counted
+        against.
+        """
+        stamp = self.load_stamp(name)
+        if stamp is None:
+            return {}
+        return {"stamp": np.array(stamp)}
+
+
+    def add_sample(self, sample_label, counts, num_mapped):
+        """
+        Add (or replace) a sample's gene counts, counted against
+        the genes in the store.
+        """
+        utils.make_dir(self.samples_dir)
+        sample_filename = self.get_sample_filename(sample_label)
+        tmp_filename = "%s.tmp.%d.npz" %(sample_filename, os.getpid())
+        np.savez(tmp_filename,
+                 counts=np.asarray(counts, dtype=np.int64),
+                 num_mapped=np.array(num_mapped, dtype=np.int64),
+                 **self.get_column_arrays("genes"))
+        os.rename(tmp_filename, sample_filename)
+
+
+    def add_sample_features(self, sample_label, kind, counts):
+        """
+        Add (or replace) a sample's counts of features of a kind,
+        given as an array indexed by feature row of the features
+        in the store.
+        """
+        utils.make_dir(self.samples_dir)
+        counts = np.asarray(counts, dtype=np.int64)
+        feature_rows = np.flatnonzero(counts)
+        sample_filename = self.get_sample_features_filename(sample_label,
+                                                            kind)
+        tmp_filename = "%s.tmp.%d.npz" %(sample_filename, os.getpid())
+        np.savez(tmp_filename,
+                 rows=feature_rows,
+                 counts=counts[feature_rows],
+                 num_features=np.array(len(counts), dtype=np.int64),
+                 **self.get_column_arrays(kind))
+        os.rename(tmp_filename, sample_filename)
+
+
+    def load_feature_matrix(self, kind, sample_labels):
+        """
+        Load samples' counts of features of a kind. Returns a
+        sparse (scipy CSC) features x samples count matrix.
+        """
+        # Only feature matrices need scipy
+        import scipy.sparse
+        rows = []
+        cols = []
+        counts = []
+        num_features = None
+        for sample_num, sample_label in enumerate(sample_labels):
+            sample_filename = self.get_sample_features_filename(sample_label,
+                                                                kind)
+            if not self.has_column(sample_filename, kind, None):
+                raise Exception, "Counts of sample %s were not counted " \
+                                 "against the %s of %s." \
+                                 %(sample_label, kind, self.store_dir)
+            sample_data = np.load(sample_filename)
+            if num_features is None:
+                num_features = int(sample_data["num_features"])
+            elif num_features != int(sample_data["num_features"]):
+                raise Exception, "Counts of sample %s do not match %s " \
+                                 "of %s." %(sample_label, kind, self.store_dir)
+            rows.append(sample_data["rows"])
+            cols.append(np.repeat(sample_num, len(sample_data["rows"])))
+            counts.append(sample_data["counts"])
+        if num_features is None:
+            num_features = len(self.load_features(kind))
+            return scipy.sparse.csc_matrix((num_features, 0), dtype=np.int64)
+        return scipy.sparse.csc_matrix((np.concatenate(counts),
+                                        (np.concatenate(rows),
+                                         np.concatenate(cols))),
+                                       shape=(num_features,
+                                              len(sample_labels)))
+
+
+    def load_samples(self, sample_labels):
+        """
+        Load samples' counts. Returns a genes x samples count
+        matrix and an array of the number of mapped reads of
+        each sample.
+        """
+        num_genes = len(self.load_genes())
+        counts = np.empty((num_genes, len(sample_labels)), dtype=np.int64)
+        num_mapped = np.empty(len(sample_labels), dtype=np.int64)
+        for sample_num, sample_label in enumerate(sample_labels):
+            sample_filename = self.get_sample_filename(sample_label)
+            if not self.has_column(sample_filename, "genes", None):
+                raise Exception, "Counts of sample %s were not counted " \
+                                 "against the genes of %s." \
+                                 %(sample_label, self.store_dir)
+            sample_data = np.load(sample_filename)
+            if len(sample_data["counts"]) != num_genes:
+                raise Exception, "Counts of sample %s do not match genes " \
+                                 "of %s." %(sample_label, self.store_dir)
+            counts[:, sample_num] = sample_data["counts"]
+            num_mapped[sample_num] = sample_data["num_mapped"]
+        return counts, num_mapped
+
+
+    def get_num_mapped(self, sample_labels):
+        """
+        Return the number of mapped reads of each sample, which
+        its RPKMs are normalized to.
+        """
+        return np.array([np.load(self.get_sample_filename(sample_label))["num_mapped"] \
+                         for sample_label in sample_labels],
+                        dtype=np.int64)
+
+
+    def get_rpkm_table(self, sample_labels):
+        """
+        Return a table of RPKMs, TPMs and counts of the given
+        samples, with columns 'rpkm_<label>', 'tpm_<label>' and
+        'counts_<label>' for each sample along with the gene
+        metadata.
+        """
+        genes_df = self.load_genes()
+        counts, num_mapped = self.load_samples(sample_labels)
+        # Reads per kilobase per million mapped reads
+        gene_kb = genes_df["length"].values[:, np.newaxis] / float(1e3)
+        rpkms = (counts / gene_kb) / (num_mapped / float(1e6))
+        tpms = normalization.compute_tpm(counts, gene_kb)
+        rpkm_table = genes_df[["gene_id", "gene_symbol",
+                               "gene_desc", "exons"]].copy()
+        for sample_num, sample_label in enumerate(sample_labels):
+            rpkm_table["rpkm_%s" %(sample_label)] = rpkms[:, sample_num]
+            rpkm_table["tpm_%s" %(sample_label)] = tpms[:, sample_num]
+            rpkm_table["counts_%s" %(sample_label)] = counts[:, sample_num]
+        return rpkm_table
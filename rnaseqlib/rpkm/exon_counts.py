@@ -0,0 +1,378 @@
+##
+## Single-pass counting of reads in constitutive exons
+##
+import os
+import sys
+import time
+
+import numpy as np
+
+import pysam
+
+import rnaseqlib
+import rnaseqlib.bam.bam_utils as bam_utils
+import rnaseqlib.bam.bam_mapreduce as bam_mapreduce
+import rnaseqlib.bam.mate_pairs as mate_pairs
+import rnaseqlib.coverage.coverage_utils as coverage_utils
+import rnaseqlib.mapping.interval_index as interval_index
+
+
+def get_unprefixed_exon(exon):
+    """
+    Return an exon without its 'cds.' prefix, if any.
+    """
+    if exon.startswith("cds."):
+        return exon.split("cds.")[1]
+    return exon
+
+
+def get_stranded_chrom(chrom, strand):
+    """
+    Return the key of a chromosome strand in a stranded index.
+    """
+    return "%s:%s" %(chrom, strand)
+
+
+def get_const_exons_index(const_exons, stranded=False):
+    """
+    Return an interval index of the exons of a ConstExons table.
+    Interval IDs are the exon IDs of the table's gene index.
+
+    - stranded: if True, exons are indexed by chromosome strand
+      (see get_stranded_chrom) rather than by chromosome
+    """
+    exon_chroms = const_exons.exon_chroms
+    if stranded:
+        exon_chroms = [get_stranded_chrom(chrom, strand) \
+                       for chrom, strand in zip(const_exons.exon_chroms,
+                                                const_exons.exon_strands)]
+    exons_index = interval_index.IntervalIndex(label=const_exons.table_name)
+    exons_index.add_intervals(exon_chroms,
+                              const_exons.exon_starts,
+                              const_exons.exon_ends,
+                              strands=const_exons.exon_strands)
+    return exons_index
+
+
+class ExonCounter:
+    """
+    Count reads in exons from a BAM file in a single pass,
+    without writing intermediate files.
+
+    A read is counted in an exon if its alignment lies entirely
+    within the exon (as with 'tagBam -f 1'). Reads are looked up
+    in the exon index in chunks, so lookups are vectorized. If
+    exons overlap, a read is counted in every exon that
+    contains it.
+
+    - with_coverage: also compute the per-base coverage of each
+      exon by the aligned blocks of the reads counted in it
+    - paired: count fragments rather than reads. Mates are paired
+      by name as they are read (see mate_pairs.MateBuffer) and a
+      fragment is counted in the exons of its first mate or, if
+      that mate is in no exon, in the exons of its second mate.
+    - first_read_antisense: for strand-specific libraries, whether
+      the first read of a fragment is antisense to the transcript
+      (see mate_pairs.parse_strand_convention). Fragments are then
+      only counted in exons on their transcript's strand, which
+      requires an index built with 'stranded' set.
+    """
+    def __init__(self, exons_index,
+                 chunk_size=200000,
+                 with_coverage=False,
+                 paired=False,
+                 first_read_antisense=None,
+                 max_pending_mates=mate_pairs.DEFAULT_MAX_PENDING):
+        self.exons_index = exons_index
+        self.chunk_size = chunk_size
+        self.with_coverage = with_coverage
+        self.paired = paired
+        self.first_read_antisense = first_read_antisense
+        self.max_pending_mates = max_pending_mates
+        self.mate_buffer = None
+        if self.paired:
+            self.mate_buffer = mate_pairs.MateBuffer(max_pending=max_pending_mates)
+        self.counts = np.zeros(exons_index.num_intervals, dtype=np.int64)
+        if self.with_coverage:
+            region_lens = exons_index.get_lens()
+            self.region_starts = np.empty(exons_index.num_intervals,
+                                          dtype=np.int64)
+            self.region_starts[exons_index.ids] = exons_index.starts
+            # Coverage of all regions is kept in one array, as
+            # differences between consecutive bases
+            self.coverage_offsets = \
+                np.concatenate(([0], np.cumsum(region_lens)))
+            self.coverage_diffs = \
+                np.zeros(self.coverage_offsets[-1] + 1, dtype=np.int32)
+        self.init_chunk()
+
+
+    def init_chunk(self):
+        self.chunk_chrom = None
+        self.read_starts = []
+        self.read_ends = []
+        # Offset of each fragment's first read and, for strand-
+        # specific libraries, the fragment's strand
+        self.fragment_offsets = []
+        self.fragment_strands = []
+        # Aligned blocks of the reads and the offset of each
+        # read's first block (only kept for coverage)
+        self.block_starts = []
+        self.block_ends = []
+        self.read_offsets = []
+
+
+    def add_read(self, chrom, read):
+        """
+        Add a read to be counted.
+        """
+        if read.aend is None:
+            return
+        if chrom != self.chunk_chrom:
+            self.flush()
+            self.chunk_chrom = chrom
+        if self.mate_buffer is None:
+            self.add_fragment([read])
+            return
+        for fragment in self.mate_buffer.add(read):
+            self.add_fragment(fragment)
+
+
+    def add_fragment(self, reads):
+        """
+        Add the reads of a fragment (on the current chromosome).
+        """
+        if len(self.fragment_offsets) >= self.chunk_size:
+            self.count_chunk()
+        self.fragment_offsets.append(len(self.read_starts))
+        if self.first_read_antisense is not None:
+            self.fragment_strands.append(
+                mate_pairs.get_fragment_strand(reads[0],
+                                               self.first_read_antisense))
+        for read in reads:
+            self.read_starts.append(read.pos)
+            self.read_ends.append(read.aend)
+            if self.with_coverage:
+                self.read_offsets.append(len(self.block_starts))
+                for block_start, block_end in bam_utils.get_read_blocks(read):
+                    self.block_starts.append(block_start)
+                    self.block_ends.append(block_end)
+
+
+    def find_read_exons(self):
+        """
+        Return the exons of the reads in the current chunk, as
+        arrays of read numbers and exon IDs with one entry per
+        (read, containing exon) pair.
+        """
+        if self.first_read_antisense is None:
+            return self.exons_index.find_all_containing(self.chunk_chrom,
+                                                        self.read_starts,
+                                                        self.read_ends)
+        num_reads = len(self.read_starts)
+        fragment_offsets = np.array(self.fragment_offsets, dtype=np.int64)
+        # Reads take the strand of their fragment
+        read_strands = \
+            np.repeat(np.array(self.fragment_strands),
+                      np.diff(np.append(fragment_offsets, num_reads)))
+        read_starts = np.array(self.read_starts, dtype=np.int64)
+        read_ends = np.array(self.read_ends, dtype=np.int64)
+        hit_reads = []
+        hit_exons = []
+        for strand in ["+", "-"]:
+            strand_reads = np.flatnonzero(read_strands == strand)
+            if len(strand_reads) == 0:
+                continue
+            queries, exon_ids = \
+                self.exons_index.find_all_containing(
+                    get_stranded_chrom(self.chunk_chrom, strand),
+                    read_starts[strand_reads],
+                    read_ends[strand_reads])
+            hit_reads.append(strand_reads[queries])
+            hit_exons.append(exon_ids)
+        if len(hit_reads) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        return np.concatenate(hit_reads), np.concatenate(hit_exons)
+
+
+    def flush(self):
+        """
+        Count all buffered reads, including reads still waiting
+        for their mates.
+        """
+        if self.mate_buffer is not None:
+            for fragment in self.mate_buffer.flush():
+                self.add_fragment(fragment)
+        self.count_chunk()
+
+
+    def count_chunk(self):
+        """
+        Count the fragments in the current chunk.
+        """
+        if len(self.read_starts) == 0:
+            self.init_chunk()
+            return
+        chunk_chrom = self.chunk_chrom
+        num_reads = len(self.read_starts)
+        hit_reads, hit_exons = self.find_read_exons()
+        fragment_exons = hit_exons
+        if self.mate_buffer is not None:
+            fragment_offsets = np.array(self.fragment_offsets, dtype=np.int64)
+            # Fragment of each read and whether it is its first read
+            read_fragments = \
+                np.repeat(np.arange(len(fragment_offsets)),
+                          np.diff(np.append(fragment_offsets, num_reads)))
+            is_first = np.zeros(num_reads, dtype=bool)
+            is_first[fragment_offsets] = True
+            first_hit = np.zeros(len(fragment_offsets), dtype=bool)
+            first_hit[read_fragments[hit_reads[is_first[hit_reads]]]] = True
+            # Count the exons of the first mate or, if it is in no
+            # exon, those of the second mate
+            use_hit = is_first[hit_reads] | \
+                      ~first_hit[read_fragments[hit_reads]]
+            fragment_exons = hit_exons[use_hit]
+        self.counts += \
+            np.bincount(fragment_exons,
+                        minlength=self.exons_index.num_intervals)
+        if self.with_coverage and (len(self.block_starts) > 0) and \
+           (len(hit_reads) > 0):
+            num_blocks = len(self.block_starts)
+            read_offsets = np.array(self.read_offsets, dtype=np.int64)
+            read_num_blocks = np.diff(np.append(read_offsets, num_blocks))
+            # Blocks of each (read, exon) pair
+            pair_num_blocks = read_num_blocks[hit_reads]
+            pair_block_offsets = np.cumsum(pair_num_blocks) - pair_num_blocks
+            block_exons = np.repeat(hit_exons, pair_num_blocks)
+            block_indices = \
+                np.repeat(read_offsets[hit_reads], pair_num_blocks) + \
+                np.arange(pair_num_blocks.sum()) - \
+                np.repeat(pair_block_offsets, pair_num_blocks)
+            diff_offsets = self.coverage_offsets[block_exons] - \
+                           self.region_starts[block_exons]
+            np.add.at(self.coverage_diffs,
+                      diff_offsets + \
+                      np.array(self.block_starts, dtype=np.int64)[block_indices],
+                      1)
+            np.add.at(self.coverage_diffs,
+                      diff_offsets + \
+                      np.array(self.block_ends, dtype=np.int64)[block_indices],
+                      -1)
+        self.init_chunk()
+        # Fragments of the next chunk are on the same chromosome
+        self.chunk_chrom = chunk_chrom
+
+
+    def new_counter(self):
+        """
+        Return an empty counter with the same exons and options.
+        """
+        return ExonCounter(self.exons_index,
+                           chunk_size=self.chunk_size,
+                           with_coverage=self.with_coverage,
+                           paired=self.paired,
+                           first_read_antisense=self.first_read_antisense,
+                           max_pending_mates=self.max_pending_mates)
+
+
+    def get_partial(self):
+        coverage_diffs = None
+        if self.with_coverage:
+            coverage_diffs = self.coverage_diffs
+        return self.counts, coverage_diffs
+
+
+    def add_partial(self, partial):
+        counts, coverage_diffs = partial
+        self.counts += counts
+        if self.with_coverage:
+            self.coverage_diffs += coverage_diffs
+
+
+    def count_bam(self, bam_filename,
+                  num_processes=1,
+                  tile_size=None):
+        """
+        Count all mapped reads in a BAM file. Returns an array
+        of read counts indexed by interval ID.
+
+        - num_processes: number of processes to count in, splitting
+          an indexed BAM by chromosome (or by tiles of 'tile_size')
+        """
+        if self.paired:
+            # Mates can fall in different tiles, but not in different
+            # chromosomes (pairs across chromosomes are not paired)
+            tile_size = None
+        counter = bam_mapreduce.map_reduce_bam(bam_filename,
+                                               self.new_counter,
+                                               num_processes=num_processes,
+                                               tile_size=tile_size)
+        self.add_partial(counter.get_partial())
+        return self.counts
+
+
+    def get_coverage_stats(self):
+        """
+        Return coverage statistics of intervals that have reads,
+        as a mapping from interval ID to statistics.
+        """
+        coverage = np.cumsum(self.coverage_diffs[0:-1])
+        stats = coverage_utils.get_batch_coverage_stats(coverage,
+                                                        self.coverage_offsets)
+        region_stats = {}
+        for region_id in np.flatnonzero(self.counts):
+            region_stats[region_id] = \
+                dict([(stat_name, stats[stat_name][region_id]) \
+                      for stat_name in coverage_utils.COVERAGE_STATS])
+        return region_stats
+
+
+def count_reads_in_const_exons(bam_filename, const_exons,
+                               with_coverage=False,
+                               num_processes=1,
+                               tile_size=None,
+                               paired=False,
+                               stranded=None,
+                               other_counters=[]):
+    """
+    Count reads from a BAM file in constitutive exons, using
+    'num_processes' processes if the BAM is indexed.
+
+    - paired: count fragments of paired-end reads once
+    - stranded: strand convention of the library (the 'stranded'
+      setting), or None if it is not strand-specific
+    - other_counters: counters (e.g. a feature_counts.FeatureCounter)
+      that count the same reads in the same pass over the BAM
+
+    Returns an array of read counts indexed by exon ID and, if
+    'with_coverage' is set, a mapping from exons (without 'cds.'
+    prefix) to their coverage statistics.
+    """
+    first_read_antisense = mate_pairs.parse_strand_convention(stranded)
+    exons_index = \
+        get_const_exons_index(const_exons,
+                              stranded=(first_read_antisense is not None))
+    exon_counter = ExonCounter(exons_index,
+                               with_coverage=with_coverage,
+                               paired=paired,
+                               first_read_antisense=first_read_antisense)
+    if paired:
+        # Mates can fall in different tiles, but not in different
+        # chromosomes (pairs across chromosomes are not paired)
+        tile_size = None
+    bam_mapreduce.MultiCounter([exon_counter] + other_counters).count_bam(
+        bam_filename,
+        num_processes=num_processes,
+        tile_size=tile_size)
+    counts = exon_counter.counts
+    if not with_coverage:
+        return counts, None
+    region_stats = exon_counter.get_coverage_stats()
+    exon_stats_dict = {}
+    for exon, region_id in const_exons.get_exons_to_ids().iteritems():
+        if region_id not in region_stats:
+            continue
+        exon_stats = dict(region_stats[region_id])
+        exon_stats["exon"] = get_unprefixed_exon(exon)
+        exon_stats_dict[exon_stats["exon"]] = exon_stats
+    return counts, exon_stats_dict
@@ -0,0 +1,312 @@
+##
+## Counting of reads in annotated exons and splice junctions
+##
+import os
+import sys
+import time
+
+import numpy as np
+
+import rnaseqlib
+import rnaseqlib.bam.bam_utils as bam_utils
+import rnaseqlib.bam.mate_pairs as mate_pairs
+import rnaseqlib.rpkm.exon_counts as exon_counts
+import rnaseqlib.mapping.interval_index as interval_index
+
+# Kinds of features counted, in the order of a counter's partials
+FEATURE_KINDS = ["exons",
+                 "junctions"]
+
+
+def get_junction_keys(starts, ends):
+    """
+    Encode (start, end) junction coordinates as single integers.
+    """
+    return (np.asarray(starts, dtype=np.int64) << 32) | \
+           np.asarray(ends, dtype=np.int64)
+
+
+class JunctionIndex:
+    """
+    Index of junctions (introns) by exact coordinates.
+
+    Junction IDs are the row numbers of the introns given.
+    """
+    def __init__(self, chroms, starts, ends):
+        self.num_junctions = len(starts)
+        chroms = np.asarray(chroms)
+        keys = get_junction_keys(starts, ends)
+        # Mapping from chromosome to its sorted keys and their IDs
+        self.chrom_keys = {}
+        for chrom in np.unique(chroms):
+            chrom_ids = np.flatnonzero(chroms == chrom)
+            order = np.argsort(keys[chrom_ids])
+            self.chrom_keys[chrom] = (keys[chrom_ids][order],
+                                      chrom_ids[order])
+
+
+    def find_junctions(self, chrom, starts, ends):
+        """
+        Return the ID of the junction matching each of the
+        given (start, end) coordinates, or -1 if none does.
+        """
+        hits = -np.ones(len(starts), dtype=np.int64)
+        if (chrom not in self.chrom_keys) or (len(starts) == 0):
+            return hits
+        sorted_keys, sorted_ids = self.chrom_keys[chrom]
+        keys = get_junction_keys(starts, ends)
+        positions = np.searchsorted(sorted_keys, keys)
+        positions = np.minimum(positions, len(sorted_keys) - 1)
+        matched = (sorted_keys[positions] == keys)
+        hits[matched] = sorted_ids[positions[matched]]
+        return hits
+
+
+class FeatureCounter:
+    """
+    Count reads in the exons and splice junctions of a gene
+    table (see GeneTable.get_exon_intron_coords).
+
+    A read is counted once in each exon that contains one of its
+    aligned blocks (including every one of several overlapping
+    exons, e.g. with alternative 5' or 3' splice sites) and once
+    in each annotated junction that its 'N' CIGAR operations
+    span exactly. Junctions that are not
+    annotated are only tallied in 'num_novel_junctions'.
+
+    - paired: count fragments rather than reads. Mates are paired
+      as in exon_counts.ExonCounter, and a fragment is counted once
+      in each exon or junction that either of its mates falls in.
+    - first_read_antisense: for strand-specific libraries, whether
+      the first read of a fragment is antisense to the transcript
+      (see mate_pairs.parse_strand_convention). Fragments are then
+      only counted in features on their transcript's strand, which
+      requires indices built with 'stranded' set.
+    """
+    def __init__(self, exons_index, junction_index,
+                 chunk_size=200000,
+                 paired=False,
+                 first_read_antisense=None,
+                 max_pending_mates=mate_pairs.DEFAULT_MAX_PENDING):
+        self.exons_index = exons_index
+        self.junction_index = junction_index
+        self.chunk_size = chunk_size
+        self.paired = paired
+        self.first_read_antisense = first_read_antisense
+        self.max_pending_mates = max_pending_mates
+        self.mate_buffer = None
+        if self.paired:
+            self.mate_buffer = mate_pairs.MateBuffer(max_pending=max_pending_mates)
+        self.exon_counts = np.zeros(exons_index.num_intervals,
+                                    dtype=np.int64)
+        self.junction_counts = np.zeros(junction_index.num_junctions,
+                                        dtype=np.int64)
+        self.num_novel_junctions = 0
+        self.init_chunk()
+
+
+    def init_chunk(self):
+        self.chunk_chrom = None
+        self.num_fragments = 0
+        # Strand of each fragment (only for strand-specific libraries)
+        self.fragment_strands = []
+        self.block_starts = []
+        self.block_ends = []
+        # Fragment number of each block and junction
+        self.block_fragments = []
+        self.junction_starts = []
+        self.junction_ends = []
+        self.junction_fragments = []
+
+
+    def add_read(self, chrom, read):
+        """
+        Add a read to be counted.
+        """
+        if read.aend is None:
+            return
+        if chrom != self.chunk_chrom:
+            self.flush()
+            self.chunk_chrom = chrom
+        if self.mate_buffer is None:
+            self.add_fragment([read])
+            return
+        for fragment in self.mate_buffer.add(read):
+            self.add_fragment(fragment)
+
+
+    def add_fragment(self, reads):
+        """
+        Add the reads of a fragment (on the current chromosome).
+        """
+        if self.num_fragments >= self.chunk_size:
+            self.count_chunk()
+        if self.first_read_antisense is not None:
+            self.fragment_strands.append(
+                mate_pairs.get_fragment_strand(reads[0],
+                                               self.first_read_antisense))
+        for read in reads:
+            for block_start, block_end in bam_utils.get_read_blocks(read):
+                self.block_starts.append(block_start)
+                self.block_ends.append(block_end)
+                self.block_fragments.append(self.num_fragments)
+            for junction_start, junction_end in \
+                bam_utils.get_read_junctions(read):
+                self.junction_starts.append(junction_start)
+                self.junction_ends.append(junction_end)
+                self.junction_fragments.append(self.num_fragments)
+        self.num_fragments += 1
+
+
+    def get_strand_queries(self, query_fragments):
+        """
+        Return the chromosome keys to look up the current chunk's
+        queries (blocks or junctions) in, as a list of (key, query
+        numbers) pairs.
+        """
+        if self.first_read_antisense is None:
+            return [(self.chunk_chrom, np.arange(len(query_fragments)))]
+        # Queries take the strand of their fragment
+        query_strands = \
+            np.array(self.fragment_strands)[np.array(query_fragments,
+                                                     dtype=np.int64)]
+        return [(exon_counts.get_stranded_chrom(self.chunk_chrom, strand),
+                 np.flatnonzero(query_strands == strand)) \
+                for strand in ["+", "-"]]
+
+
+    def flush(self):
+        """
+        Count all buffered reads, including reads still waiting
+        for their mates.
+        """
+        if self.mate_buffer is not None:
+            for fragment in self.mate_buffer.flush():
+                self.add_fragment(fragment)
+        self.count_chunk()
+
+
+    def count_chunk(self):
+        """
+        Count the fragments in the current chunk.
+        """
+        chunk_chrom = self.chunk_chrom
+        if len(self.block_starts) > 0:
+            block_starts = np.array(self.block_starts, dtype=np.int64)
+            block_ends = np.array(self.block_ends, dtype=np.int64)
+            block_fragments = np.array(self.block_fragments, dtype=np.int64)
+            num_exons = self.exons_index.num_intervals
+            for chrom_key, queries in \
+                self.get_strand_queries(self.block_fragments):
+                if len(queries) == 0:
+                    continue
+                blocks, exon_ids = \
+                    self.exons_index.find_all_containing(chrom_key,
+                                                         block_starts[queries],
+                                                         block_ends[queries])
+                # Count each fragment once per exon its blocks fall in
+                fragment_hits = \
+                    np.unique(block_fragments[queries][blocks] * num_exons + \
+                              exon_ids)
+                self.exon_counts += \
+                    np.bincount(fragment_hits % num_exons,
+                                minlength=num_exons)
+        if len(self.junction_starts) > 0:
+            junction_starts = np.array(self.junction_starts, dtype=np.int64)
+            junction_ends = np.array(self.junction_ends, dtype=np.int64)
+            junction_fragments = np.array(self.junction_fragments,
+                                          dtype=np.int64)
+            num_junctions = self.junction_index.num_junctions
+            for chrom_key, queries in \
+                self.get_strand_queries(self.junction_fragments):
+                if len(queries) == 0:
+                    continue
+                hits = self.junction_index.find_junctions(chrom_key,
+                                                          junction_starts[queries],
+                                                          junction_ends[queries])
+                fragments = junction_fragments[queries]
+                # Count each fragment once per junction its mates span
+                annotated = (hits >= 0)
+                fragment_hits = \
+                    np.unique(fragments[annotated] * num_junctions + \
+                              hits[annotated])
+                self.junction_counts += \
+                    np.bincount(fragment_hits % num_junctions,
+                                minlength=num_junctions)
+                novel = ~annotated
+                if novel.any():
+                    novel_keys = \
+                        get_junction_keys(junction_starts[queries][novel],
+                                          junction_ends[queries][novel])
+                    order = np.lexsort((novel_keys, fragments[novel]))
+                    is_new = \
+                        (np.diff(fragments[novel][order]) != 0) | \
+                        (np.diff(novel_keys[order]) != 0)
+                    self.num_novel_junctions += 1 + int(is_new.sum())
+        self.init_chunk()
+        # Fragments of the next chunk are on the same chromosome
+        self.chunk_chrom = chunk_chrom
+
+
+    def new_counter(self):
+        return FeatureCounter(self.exons_index,
+                              self.junction_index,
+                              chunk_size=self.chunk_size,
+                              paired=self.paired,
+                              first_read_antisense=self.first_read_antisense,
+                              max_pending_mates=self.max_pending_mates)
+
+
+    def get_partial(self):
+        return (self.exon_counts,
+                self.junction_counts,
+                self.num_novel_junctions)
+
+
+    def add_partial(self, partial):
+        exon_counts, junction_counts, num_novel_junctions = partial
+        self.exon_counts += exon_counts
+        self.junction_counts += junction_counts
+        self.num_novel_junctions += num_novel_junctions
+
+
+    def get_counts(self):
+        """
+        Return a mapping from kind of feature to its counts
+        (indexed by feature row).
+        """
+        return {"exons": self.exon_counts,
+                "junctions": self.junction_counts}
+
+
+def get_feature_counter(exons_df, introns_df,
+                        paired=False,
+                        stranded=None):
+    """
+    Return a FeatureCounter for exons and introns given as
+    DataFrames of coordinates.
+
+    - paired: count fragments of paired-end reads once
+    - stranded: strand convention of the library (the 'stranded'
+      setting), or None if it is not strand-specific
+    """
+    first_read_antisense = mate_pairs.parse_strand_convention(stranded)
+    exon_chroms = exons_df["chrom"].values
+    junction_chroms = introns_df["chrom"].values
+    if first_read_antisense is not None:
+        exon_chroms = [exon_counts.get_stranded_chrom(chrom, strand) \
+                       for chrom, strand in zip(exons_df["chrom"],
+                                                exons_df["strand"])]
+        junction_chroms = [exon_counts.get_stranded_chrom(chrom, strand) \
+                           for chrom, strand in zip(introns_df["chrom"],
+                                                    introns_df["strand"])]
+    exons_index = interval_index.IntervalIndex(label="exons")
+    exons_index.add_intervals(exon_chroms,
+                              exons_df["start"].values,
+                              exons_df["end"].values)
+    junction_index = JunctionIndex(junction_chroms,
+                                   introns_df["start"].values,
+                                   introns_df["end"].values)
+    return FeatureCounter(exons_index, junction_index,
+                          paired=paired,
+                          first_read_antisense=first_read_antisense)
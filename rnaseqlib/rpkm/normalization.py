@@ -0,0 +1,323 @@
+##
+## Normalization of gene expression across samples
+##
+## All methods work on a genes x samples matrix at once
+## (no R required).
+##
+import os
+import sys
+import time
+
+import numpy as np
+
+# Normalization methods that rescale library sizes
+NORM_FACTOR_METHODS = ["upper_quartile",
+                       "tmm",
+                       "median_of_ratios"]
+
+
+def compute_tpm(counts, lens):
+    """
+    Transcripts per million: reads per base of each gene,
+    scaled so that each sample sums to a million.
+
+    - counts: read counts of genes (one column per sample)
+    - lens: lengths of genes (broadcast against counts)
+    """
+    reads_per_base = np.asarray(counts, dtype=float) / lens
+    total_per_base = reads_per_base.sum(axis=0)
+    return reads_per_base * (1e6 / np.where(total_per_base > 0,
+                                            total_per_base, 1))
+
+
+def get_lib_sizes(counts, lib_sizes=None):
+    if lib_sizes is None:
+        return counts.sum(axis=0).astype(float)
+    return np.asarray(lib_sizes, dtype=float)
+
+
+def scale_to_unit_geomean(factors):
+    """
+    Rescale factors so that their geometric mean is 1.
+    """
+    return factors / np.exp(np.mean(np.log(factors)))
+
+
+def compute_upper_quartile_factors(counts,
+                                   lib_sizes=None,
+                                   quantile=0.75):
+    """
+    Upper-quartile normalization factors: the upper quartile of
+    each sample's counts (scaled by library size), over genes with
+    reads in some sample.
+
+    - counts: genes x samples count matrix
+    - lib_sizes: library size of each sample (by default, the
+      total counts of each sample)
+    """
+    counts = np.asarray(counts, dtype=float)
+    lib_sizes = get_lib_sizes(counts, lib_sizes)
+    expressed = (counts > 0).any(axis=1)
+    upper_quartiles = np.percentile(counts[expressed] / lib_sizes,
+                                    quantile * 100,
+                                    axis=0)
+    return scale_to_unit_geomean(upper_quartiles)
+
+
+def get_ranks(values):
+    """
+    Return 1-based ranks of the values in each column, with NaNs
+    ranked last.
+    """
+    return np.argsort(np.argsort(values, axis=0, kind="mergesort"),
+                      axis=0, kind="mergesort") + 1
+
+
+def compute_tmm_factors(counts,
+                        lib_sizes=None,
+                        ref_sample=None,
+                        logratio_trim=0.3,
+                        sum_trim=0.05):
+    """
+    Trimmed mean of M-values (TMM) normalization factors, as in
+    edgeR's calcNormFactors.
+
+    Each sample is compared to a reference sample: genes with
+    extreme log-ratios (M) or extreme average abundance (A) are
+    trimmed, and the factor is the precision-weighted mean of
+    the remaining log-ratios.
+
+    - counts: genes x samples count matrix
+    - lib_sizes: library size of each sample (by default, the
+      total counts of each sample)
+    - ref_sample: column of the reference sample. By default, the
+      sample whose upper quartile is closest to the mean upper
+      quartile.
+    - logratio_trim: fraction of M-values trimmed at each end
+    - sum_trim: fraction of A-values trimmed at each end
+    """
+    counts = np.asarray(counts, dtype=float)
+    lib_sizes = get_lib_sizes(counts, lib_sizes)
+    if ref_sample is None:
+        upper_quartiles = np.percentile(counts / lib_sizes, 75, axis=0)
+        ref_sample = \
+            np.argmin(np.abs(upper_quartiles - upper_quartiles.mean()))
+    ref = counts[:, [ref_sample]]
+    ref_lib_size = lib_sizes[ref_sample]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_props = np.log2(counts / lib_sizes)
+        log_ref_props = np.log2(ref / ref_lib_size)
+        # Log-ratios and average log-abundances
+        log_ratios = log_props - log_ref_props
+        abundances = (log_props + log_ref_props) / 2.
+        # Asymptotic variances of the log-ratios
+        variances = (lib_sizes - counts) / lib_sizes / counts + \
+                    (ref_lib_size - ref) / ref_lib_size / ref
+    valid = np.isfinite(log_ratios) & np.isfinite(abundances)
+    log_ratios[~valid] = np.nan
+    abundances[~valid] = np.nan
+    num_valid = valid.sum(axis=0)
+    # Rank bounds of the genes that are kept
+    low_ratio = np.floor(num_valid * logratio_trim) + 1
+    high_ratio = num_valid + 1 - low_ratio
+    low_sum = np.floor(num_valid * sum_trim) + 1
+    high_sum = num_valid + 1 - low_sum
+    ratio_ranks = get_ranks(log_ratios)
+    sum_ranks = get_ranks(abundances)
+    kept = valid & \
+           (ratio_ranks >= low_ratio) & (ratio_ranks <= high_ratio) & \
+           (sum_ranks >= low_sum) & (sum_ranks <= high_sum)
+    weights = np.where(kept, 1. / np.where(kept, variances, 1.), 0.)
+    weighted_sums = np.where(kept, log_ratios, 0.) * weights
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_factors = weighted_sums.sum(axis=0) / weights.sum(axis=0)
+    # Samples identical to the reference, or with nothing left
+    # after trimming, are not rescaled
+    log_factors[~np.isfinite(log_factors)] = 0.
+    max_log_ratios = np.abs(np.where(valid, log_ratios, 0.)).max(axis=0)
+    log_factors[max_log_ratios < 1e-6] = 0.
+    return scale_to_unit_geomean(2**log_factors)
+
+
+def compute_median_of_ratios_factors(counts,
+                                     lib_sizes=None):
+    """
+    Median-of-ratios normalization factors (as DESeq's size
+    factors): the median ratio of each sample's counts to the
+    geometric mean counts across samples, over genes with reads
+    in all samples. Returned relative to library size, so that
+    they can be used like the other normalization factors.
+    """
+    counts = np.asarray(counts, dtype=float)
+    lib_sizes = get_lib_sizes(counts, lib_sizes)
+    expressed = (counts > 0).all(axis=1)
+    if not expressed.any():
+        raise Exception, "Cannot compute median of ratios: no gene " \
+                         "has reads in all samples."
+    log_counts = np.log(counts[expressed])
+    log_geomeans = log_counts.mean(axis=1)[:, np.newaxis]
+    size_factors = np.exp(np.median(log_counts - log_geomeans, axis=0))
+    return scale_to_unit_geomean(size_factors / lib_sizes)
+
+
+def compute_norm_factors(counts,
+                         method="tmm",
+                         lib_sizes=None):
+    """
+    Compute normalization factors for the samples of a genes x
+    samples count matrix. The effective library size of a sample
+    is its library size times its factor, so normalized values
+    are obtained by dividing by the factors.
+
+    - method: one of NORM_FACTOR_METHODS
+    """
+    if method == "upper_quartile":
+        return compute_upper_quartile_factors(counts, lib_sizes=lib_sizes)
+    elif method == "tmm":
+        return compute_tmm_factors(counts, lib_sizes=lib_sizes)
+    elif method == "median_of_ratios":
+        return compute_median_of_ratios_factors(counts, lib_sizes=lib_sizes)
+    raise Exception, "Unknown normalization method %s." %(method)
+
+
+def compute_lowess(x, y,
+                   span=0.75,
+                   num_bins=200,
+                   num_iters=3):
+    """
+    Robust locally-weighted linear regression of y on x.
+
+    Points are grouped into 'num_bins' bins of equal size (by x),
+    the local fits are computed at the bins' centers from their
+    (robustness weighted) sums, and the curve is interpolated
+    between the centers. Each fit uses the nearest 'span' fraction
+    of the points, weighted by a tricube kernel.
+
+    Returns the bin centers and the fitted values at the centers;
+    evaluate the curve with np.interp.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    num_points = len(x)
+    if num_points == 0:
+        return np.array([0.]), np.array([0.])
+    num_bins = min(num_bins, num_points)
+    order = np.argsort(x, kind="mergesort")
+    point_bins = np.empty(num_points, dtype=np.int64)
+    point_bins[order] = (np.arange(num_points) * num_bins) // num_points
+    bin_sizes = np.bincount(point_bins, minlength=num_bins)
+    centers = np.bincount(point_bins, weights=x, minlength=num_bins) / \
+              bin_sizes
+    # Tricube weights of each bin in the fit at each center, with a
+    # bandwidth that reaches the nearest 'span' fraction of bins
+    dists = np.abs(centers[:, np.newaxis] - centers[np.newaxis, :])
+    num_near = min(max(int(np.ceil(span * num_bins)), 2), num_bins)
+    bandwidths = np.partition(dists, num_near - 1, axis=1)[:, num_near - 1]
+    bandwidths[bandwidths <= 0] = 1e-12
+    kernel = np.clip(1 - (dists / bandwidths[:, np.newaxis])**3, 0, 1)**3
+    robustness = np.ones(num_points)
+    for iter_num in range(num_iters + 1):
+        sums = [np.bincount(point_bins, weights=robustness * values,
+                            minlength=num_bins) \
+                for values in [np.ones(num_points), x, y, x * x, x * y]]
+        w, wx, wy, wxx, wxy = [kernel.dot(bin_sums) for bin_sums in sums]
+        w[w <= 0] = np.nan
+        mean_x = wx / w
+        mean_y = wy / w
+        var_x = wxx / w - mean_x**2
+        cov_xy = wxy / w - mean_x * mean_y
+        slopes = np.where(var_x > 1e-12, cov_xy / np.where(var_x > 1e-12,
+                                                           var_x, 1.), 0.)
+        fitted = mean_y + slopes * (centers - mean_x)
+        # Centers with no weight left take the overall fit
+        fitted[~np.isfinite(fitted)] = np.nanmedian(fitted) \
+            if np.isfinite(fitted).any() else np.median(y)
+        if iter_num == num_iters:
+            break
+        # Downweight outliers (bisquare of the residuals)
+        residuals = y - np.interp(x, centers, fitted)
+        residual_scale = np.median(np.abs(residuals))
+        if residual_scale <= 0:
+            break
+        scaled = residuals / (6 * residual_scale)
+        robustness = np.where(np.abs(scaled) < 1, (1 - scaled**2)**2, 0.)
+    return centers, fitted
+
+
+def compute_ma_lowess(values,
+                      span=0.75,
+                      num_bins=200,
+                      num_iters=3):
+    """
+    Normalize samples by lowess on MA-plots against a common
+    reference, the geometric mean across samples.
+
+    For each sample, M (log-ratio to the reference) is fitted as
+    a function of A (average log-value) and the fitted trend is
+    removed from the sample's log-values.
+
+    - values: genes x samples matrix of non-logged expression
+      values (e.g. RPKMs)
+
+    Returns the normalized (non-logged) values. Values that are
+    not positive are returned as they are.
+    """
+    values = np.asarray(values, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_values = np.log2(values)
+    log_values[~np.isfinite(log_values)] = np.nan
+    # Genes without a value in all samples are not in the reference
+    log_ref = log_values.mean(axis=1)
+    normed = values.copy()
+    for sample_num in range(values.shape[1]):
+        sample_logs = log_values[:, sample_num]
+        log_ratios = sample_logs - log_ref
+        abundances = (sample_logs + log_ref) / 2.
+        fit_genes = np.isfinite(log_ratios)
+        centers, fitted = compute_lowess(abundances[fit_genes],
+                                         log_ratios[fit_genes],
+                                         span=span,
+                                         num_bins=num_bins,
+                                         num_iters=num_iters)
+        # Genes outside the reference are corrected at their own value
+        abundances = np.where(np.isfinite(abundances), abundances,
+                              sample_logs)
+        has_value = np.isfinite(sample_logs)
+        normed[has_value, sample_num] = \
+            2**(sample_logs[has_value] - \
+                np.interp(abundances[has_value], centers, fitted))
+    return normed
+
+
+def compute_ma_lowess_pair(x, y,
+                           span=0.75,
+                           num_bins=200,
+                           num_iters=3):
+    """
+    Normalize two samples against each other by lowess on their
+    MA-plot (M = log2(x/y), A = log2(xy)/2). The fitted trend of
+    M is split evenly between the two samples.
+
+    Returns the normalized (non-logged) x and y; values where
+    either input is not positive are NaN.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_x = np.log2(np.asarray(x, dtype=float))
+        log_y = np.log2(np.asarray(y, dtype=float))
+    log_ratios = log_x - log_y
+    abundances = (log_x + log_y) / 2.
+    fit_genes = np.isfinite(log_ratios) & np.isfinite(abundances)
+    centers, fitted = compute_lowess(abundances[fit_genes],
+                                     log_ratios[fit_genes],
+                                     span=span,
+                                     num_bins=num_bins,
+                                     num_iters=num_iters)
+    corrected_x = np.empty(len(log_x)) * np.nan
+    corrected_y = np.empty(len(log_y)) * np.nan
+    corrected_ratios = log_ratios[fit_genes] - \
+                       np.interp(abundances[fit_genes], centers, fitted)
+    corrected_x[fit_genes] = \
+        2**(abundances[fit_genes] + corrected_ratios / 2.)
+    corrected_y[fit_genes] = \
+        2**(abundances[fit_genes] - corrected_ratios / 2.)
+    return corrected_x, corrected_y
@@ -4,6 +4,7 @@
 import os
 import sys
 import time
+import itertools
 
 from collections import defaultdict
 
@@ -11,8 +12,14 @@ import subprocess
 
 import rnaseqlib
 import rnaseqlib.utils as utils
+import rnaseqlib.array_snapshot as array_snapshot
 import rnaseqlib.coverage.coverage_utils as coverage_utils
+import rnaseqlib.rpkm.exon_counts as exon_counts
+import rnaseqlib.rpkm.feature_counts as feature_counts
+import rnaseqlib.rpkm.count_store as count_store
+import rnaseqlib.rpkm.normalization as normalization
 
+import numpy as np
 import pandas
 
 import pysam
@@ -29,37 +36,89 @@ def load_sample_rpkms(sample,
         rpkm_filename = os.path.join(sample.rpkm_dir,
                                      "%s.rpkm" %(table_name))
         if os.path.isfile(rpkm_filename):
-            # Insert the sample name into the header
-            fieldnames = ["gene_id",
-                          "rpkm_%s" %(sample.label),
-                          "counts_%s" %(sample.label),
-                          "exons"]
             # Load each table as a DataFrame
             rpkm_table = pandas.read_csv(rpkm_filename,
-                                         sep="\t",
-                                         names=fieldnames,
-                                         # Skip the current header
-                                         skiprows=1)
+                                         sep="\t")
+            # Insert the sample name into the header (tables
+            # written before TPMs were output have no 'tpm' column)
+            rpkm_table = \
+                rpkm_table.rename(columns={"rpkm": "rpkm_%s" %(sample.label),
+                                           "counts": "counts_%s" %(sample.label),
+                                           "tpm": "tpm_%s" %(sample.label)})
             # Add gene_symbol and gene_desc columns
             # to RPKM DataFrame
-            gene_table = rna_base.gene_tables[table_name.split(".")[0]]
-            gene_symbols = [gene_table.genes_to_names[gid] \
-                            for gid in rpkm_table["gene_id"]]
-            gene_descs = [gene_table.genes_to_desc[gid] \
-                          for gid in rpkm_table["gene_id"]]
-            rpkm_table["gene_symbol"] = gene_symbols
-            rpkm_table["gene_desc"] = gene_descs
+            annotation = rna_base.get_gene_annotation(table_name.split(".")[0])
+            rpkm_table["gene_symbol"] = \
+                annotation.get_symbols(rpkm_table["gene_id"])
+            rpkm_table["gene_desc"] = \
+                annotation.get_descs(rpkm_table["gene_id"])
         else:
             print "WARNING: Cannot find RPKM filename %s" %(rpkm_filename)
         rpkm_tables[table_name] = rpkm_table
     return rpkm_tables
     
 
+def get_count_store(rpkm_dir, table_name):
+    """
+    Return the store of gene counts of all samples for a table.
+    """
+    return count_store.CountStore(os.path.join(rpkm_dir,
+                                               "%s.counts" %(table_name)))
+
+
+def get_feature_gene_tables(rna_base):
+    """
+    Return the names of the gene tables whose exon and junction
+    counts are output along with RPKMs: the gene tables of the
+    constitutive exons tables that are present.
+    """
+    gene_table_names = set([table_name.split(".")[0] \
+                            for table_name in rna_base.tables_to_const_exons])
+    return sorted([table_name for table_name in gene_table_names \
+                   if rna_base.has_gene_table(table_name)])
+
+
+def get_features_stamp(rna_base, gene_table_name):
+    """
+    Return a stamp of the UCSC table the exons and junctions
+    of a gene table come from.
+    """
+    return array_snapshot.get_files_stamp(
+        [os.path.join(rna_base.ucsc_tables_dir,
+                      "%s.txt" %(gene_table_name))])
+
+
+def get_feature_counter(rna_base, gene_table_name, feature_store,
+                        paired=False,
+                        stranded=None):
+    """
+    Return a FeatureCounter for the exons and junctions of a gene
+    table. Features are written to the store the first time, or
+    when the gene table changes (the only times the gene table
+    is loaded), and the counter is built from the stored features
+    so that counts of all samples refer to the same rows.
+
+    - paired, stranded: as in feature_counts.get_feature_counter
+    """
+    stamp = get_features_stamp(rna_base, gene_table_name)
+    if not all([feature_store.is_current(kind, stamp) \
+                for kind in feature_counts.FEATURE_KINDS]):
+        gene_table = rna_base.get_gene_table(gene_table_name)
+        exons_df, introns_df = gene_table.get_exon_intron_coords()
+        feature_store.write_features("exons", exons_df, stamp=stamp)
+        feature_store.write_features("junctions", introns_df, stamp=stamp)
+    return feature_counts.get_feature_counter(feature_store.load_features("exons"),
+                                              feature_store.load_features("junctions"),
+                                              paired=paired,
+                                              stranded=stranded)
+
+
 def output_rpkm(sample,
                 output_dir,
                 settings_info,
                 rna_base,
-                logger):
+                logger,
+                count_store_dir=None):
     """
     Output RPKM tables for the sample.
 
@@ -69,31 +128,47 @@ def output_rpkm(sample,
     - output_dir: output directory
     - settings_info: settings information
     - rna_base: an RNABase object
+    - count_store_dir: if given, also add the sample's gene counts
+      to the count store of each table in this directory, and its
+      exon and junction counts to the count store of each gene
+      table (see get_feature_gene_tables)
     """
     # Output RPKM information for all constitutive exon tables in the
     # in the RNA Base
     print "Outputting RPKM for: %s" %(sample.label)
     rpkm_tables = {}
+    # Gene tables whose exons and junctions are still to be counted.
+    # They are counted in the same pass as a constitutive exons table.
+    feature_tables = []
+    if count_store_dir is not None:
+        for table_name in get_feature_gene_tables(rna_base):
+            table_feature_store = get_count_store(count_store_dir, table_name)
+            features_stamp = get_features_stamp(rna_base, table_name)
+            if not all([table_feature_store.has_sample_features(sample.label,
+                                                                kind,
+                                                                stamp=features_stamp) \
+                        for kind in feature_counts.FEATURE_KINDS]):
+                feature_tables.append(table_name)
     for table_name, const_exons in rna_base.tables_to_const_exons.iteritems():
         rpkm_output_filename = "%s.rpkm" %(os.path.join(output_dir,
                                                         table_name))
         rpkm_tables[table_name] = rpkm_output_filename
-        if os.path.isfile(rpkm_output_filename):
+        table_count_store = None
+        if count_store_dir is not None:
+            table_count_store = get_count_store(count_store_dir, table_name)
+        gene_table_name = table_name.split(".")[0]
+        feature_store = None
+        if gene_table_name in feature_tables:
+            feature_tables.remove(gene_table_name)
+            feature_store = get_count_store(count_store_dir, gene_table_name)
+        if os.path.isfile(rpkm_output_filename) and \
+           (feature_store is None) and \
+           ((table_count_store is None) or \
+            table_count_store.has_sample(sample.label,
+                                         stamp=const_exons.source_stamp)):
             logger.info("  - Skipping RPKM output, found %s" \
                         %(rpkm_output_filename))
             continue
-        # Directory where BAM containing mapping to constitutive
-        # exons be stored
-        bam2gff_outdir = os.path.join(output_dir,
-                                      "bam2gff_const_exons")
-        utils.make_dir(bam2gff_outdir)
-        # Map reads to GFF of constitutive exons
-        # Use the rRNA subtracted BAM file
-        logger.info("Mapping BAM to GFF %s" %(const_exons.gff_filename))
-        exons_bam_fname = map_bam2gff_subproc(logger,
-                                              sample.ribosub_bam_filename,
-                                              const_exons.gff_filename,
-                                              bam2gff_outdir)
         # Compute RPKMs for sample: use number of ribosub mapped reads
         num_mapped = int(sample.qc.qc_results["num_ribosub_mapped"])
         if num_mapped == 0:
@@ -101,14 +176,51 @@ def output_rpkm(sample,
                             "mapped reads." %(sample.label))
             sys.exit(1)
         logger.info("Sample %s has %s mapped reads" %(sample.label, num_mapped))
-        read_len = settings_info["readlen"]
-        logger.info("Outputting RPKM from GFF aligned BAM (table %s)" \
+        read_len = settings_info["mapping"]["readlen"]
+        if table_count_store is not None:
+            # Gene information is written once for all samples, and
+            # again when the constitutive exons change
+            annotation = rna_base.get_gene_annotation(gene_table_name)
+            table_count_store.write_genes(const_exons.gene_ids,
+                                          annotation.get_symbols(const_exons.gene_ids),
+                                          annotation.get_descs(const_exons.gene_ids),
+                                          const_exons.gene_exons,
+                                          const_exons.gene_lens,
+                                          stamp=const_exons.source_stamp)
+        # Exons and junctions of the gene table are counted in
+        # the same pass
+        feature_counter = None
+        if feature_store is not None:
+            logger.info("Counting exons and junctions of %s" \
+                        %(gene_table_name))
+            feature_counter = \
+                get_feature_counter(rna_base, gene_table_name,
+                                    feature_store,
+                                    paired=settings_info["mapping"]["paired"],
+                                    stranded=settings_info["mapping"]["stranded"])
+        # Count reads in constitutive exons
+        # Use the rRNA subtracted BAM file
+        logger.info("Outputting RPKM from BAM (table %s)" \
                     %(table_name))
-        output_rpkm_from_gff_aligned_bam(exons_bam_fname,
-                                         num_mapped,
-                                         read_len,
-                                         const_exons,
-                                         rpkm_output_filename)
+        output_rpkm_from_bam(sample.ribosub_bam_filename,
+                             num_mapped,
+                             read_len,
+                             const_exons,
+                             rpkm_output_filename,
+                             count_store=table_count_store,
+                             sample_label=sample.label,
+                             num_processes=settings_info["mapping"]["num_processors"],
+                             tile_size=settings_info["settings"]["count_tile_size"],
+                             paired=settings_info["mapping"]["paired"],
+                             stranded=settings_info["mapping"]["stranded"],
+                             other_counters=[feature_counter] \
+                                            if feature_counter is not None else [])
+        if feature_counter is not None:
+            for kind, counts in feature_counter.get_counts().iteritems():
+                feature_store.add_sample_features(sample.label, kind, counts)
+            logger.info("  - %d junction reads of %s were not annotated" \
+                        %(feature_counter.num_novel_junctions,
+                          sample.label))
     logger.info("Finished outputting RPKM for %s to %s" %(sample.label,
                                                           rpkm_output_filename))
     return rpkm_output_filename
@@ -226,7 +338,8 @@ def output_rpkm_from_gff_aligned_bam(bam_filename,
                                      rpkm_header=["gene_id",
                                                   "rpkm",
                                                   "counts",
-                                                  "exons"],
+                                                  "exons",
+                                                  "tpm"],
                                      na_val="NA",
                                      interval_label="gff",
                                      with_exon_cov_stats=True):
@@ -274,38 +387,150 @@ def output_rpkm_from_gff_aligned_bam(bam_filename,
                                       str(region_end))
             # Count reads in region
             region_to_count[region_str] += 1
-    # For each gene, find its exons. Sum their counts
-    # and length to compute RPKM
-    rpkm_table = []
-    for gene_info in const_exons.genes_to_exons:
-        gene_id = gene_info["gene_id"]
-        exons = gene_info["exons"]
-        if exons == na_val:
-            continue
-        parsed_exons = exons.split(",")
-        # Strip the strand of the exons
-        strandless_exons = []
-        for parsed_exon in parsed_exons:
-            curr_exon = parsed_exon[0:-2]
-            if "." in curr_exon:
-                # Strip off dot prefix if any is there
-                curr_exon = curr_exon.split(".")[1]
-            strandless_exons.append(curr_exon)
-        curr_counts = [region_to_count[s_exon] for s_exon in strandless_exons]
-        sum_counts = sum(curr_counts)
-        curr_lens = [const_exons.exon_lens[exon] for exon in parsed_exons]
-        sum_lens = sum(curr_lens)
-        assert(len(curr_counts) == len(curr_lens)), \
-            "Error: sum_counts != sum_lens in RPKM computation."
-        gene_rpkm = compute_rpkm(sum_counts, sum_lens, num_mapped)
-        # RPKM entry for gene
-        rpkm_entry = {"rpkm": gene_rpkm,
-                      "gene_id": gene_id,
-                      "counts": sum_counts,
-                      "exons": exons}
-        rpkm_table.append(rpkm_entry)
-    rpkm_df = pandas.DataFrame(rpkm_table)
+    exon_counts_arr = np.array([region_to_count[exon_name] \
+                                for exon_name in const_exons.exon_ids_to_names],
+                               dtype=np.int64)
+    exon_stats_dict = None
     if with_exon_cov_stats:
+        exon_stats_dict = \
+          coverage_utils.get_exons_coverage_from_tagBam(bam_filename,
+                                                        interval_label=interval_label,
+                                                        gff_coords=True)
+    return output_rpkm_table(exon_counts_arr,
+                             num_mapped,
+                             const_exons,
+                             output_filename,
+                             exon_stats_dict=exon_stats_dict,
+                             rpkm_header=rpkm_header,
+                             na_val=na_val)
+
+
+def output_rpkm_from_bam(bam_filename,
+                         num_mapped,
+                         read_len,
+                         const_exons,
+                         output_filename,
+                         rpkm_header=["gene_id",
+                                      "rpkm",
+                                      "counts",
+                                      "exons",
+                                      "tpm"],
+                         na_val="NA",
+                         with_exon_cov_stats=True,
+                         count_store=None,
+                         sample_label=None,
+                         num_processes=1,
+                         tile_size=None,
+                         paired=False,
+                         stranded=None,
+                         other_counters=[]):
+    """
+    Compute RPKM for each gene from a BAM file, counting the
+    reads in constitutive exons in a single pass over the BAM
+    (with no intermediate BAM).
+
+    Takes the same arguments as output_rpkm_from_gff_aligned_bam,
+    but 'bam_filename' is a BAM of mapped reads.
+
+    - count_store: if given, add the gene counts to this
+      CountStore as the column of 'sample_label'
+    - num_processes: number of processes to count an indexed
+      BAM in, split by chromosome (or tiles of 'tile_size')
+    - paired: count paired-end fragments rather than reads
+    - stranded: strand convention of strand-specific libraries
+      (e.g. 'fr-firststrand'); reads are then only counted in
+      exons on the strand of the transcript they came from
+    - other_counters: counters that count the BAM's reads in the
+      same pass (see exon_counts.count_reads_in_const_exons)
+    """
+    print "Computing RPKM from BAM..."
+    print "  - BAM: %s" %(bam_filename)
+    print "  - Output filename: %s" %(output_filename)
+    exon_counts_arr, exon_stats_dict = \
+      exon_counts.count_reads_in_const_exons(bam_filename,
+                                             const_exons,
+                                             with_coverage=with_exon_cov_stats,
+                                             num_processes=num_processes,
+                                             tile_size=tile_size,
+                                             paired=paired,
+                                             stranded=stranded,
+                                             other_counters=other_counters)
+    if count_store is not None:
+        count_store.add_sample(sample_label,
+                               const_exons.sum_by_gene(exon_counts_arr),
+                               num_mapped)
+    return output_rpkm_table(exon_counts_arr,
+                             num_mapped,
+                             const_exons,
+                             output_filename,
+                             exon_stats_dict=exon_stats_dict,
+                             rpkm_header=rpkm_header,
+                             na_val=na_val)
+
+
+def compute_gene_expression(const_exons, exon_counts_arr, num_mapped):
+    """
+    Compute read counts, RPKM and TPM of all genes that have
+    constitutive exons, from read counts of the exons.
+
+    Args:
+    - const_exons: Constitutive exons object
+    - exon_counts_arr: read counts indexed by exon ID (see
+    ConstExons.compile_gene_index), optionally with one column
+    per sample
+    - num_mapped: number of mapped reads to normalize to (one
+    per sample)
+
+    Returns (counts, rpkm, tpm) arrays with one row per gene
+    in const_exons.gene_ids.
+    """
+    gene_counts = const_exons.sum_by_gene(exon_counts_arr)
+    gene_lens = const_exons.gene_lens.astype(float)
+    if gene_counts.ndim > 1:
+        gene_lens = gene_lens[:, np.newaxis]
+    num_mapped = np.asarray(num_mapped, dtype=float)
+    gene_rpkms = compute_rpkm(gene_counts, gene_lens, num_mapped)
+    gene_tpms = normalization.compute_tpm(gene_counts, gene_lens)
+    return gene_counts, gene_rpkms, gene_tpms
+
+
+def output_rpkm_table(exon_counts_arr,
+                      num_mapped,
+                      const_exons,
+                      output_filename,
+                      exon_stats_dict=None,
+                      rpkm_header=["gene_id",
+                                   "rpkm",
+                                   "counts",
+                                   "exons",
+                                   "tpm"],
+                      na_val="NA"):
+    """
+    Output RPKM table for genes given read counts of their
+    constitutive exons.
+
+    Args:
+    - exon_counts_arr: read counts indexed by exon ID
+    - num_mapped: number of mapped reads to normalize to
+    - const_exons: Constitutive exons object
+    - output_filename: output filename
+
+    Kwargs:
+    - exon_stats_dict: if given, also output a table with exon
+    coverage statistics
+    - rpkm_header: header for output RPKM file
+    - na_val: NA value to use
+    """
+    # Sum the counts and lengths of each gene's exons
+    # to compute RPKM
+    gene_counts, gene_rpkms, gene_tpms = \
+      compute_gene_expression(const_exons, exon_counts_arr, num_mapped)
+    rpkm_df = pandas.DataFrame({"gene_id": const_exons.gene_ids,
+                                "rpkm": gene_rpkms,
+                                "counts": gene_counts,
+                                "exons": const_exons.gene_exons,
+                                "tpm": gene_tpms})
+    if exon_stats_dict is not None:
         # Output version of RPKM table with coverage columns
         # for exons
         # Strip filename extension and add a .coverage
@@ -313,17 +538,15 @@ def output_rpkm_from_gff_aligned_bam(bam_filename,
         output_fname_with_cov += ".coverage.txt" 
         # If asked, output a table with RPKM coverage
         rpkm_df_with_cov, coverage_cols = \
-          add_exons_coverage_from_bam_to_rpkm_df(rpkm_df,
-                                                 bam_filename,
-                                                 interval_label=interval_label)
+          add_exons_coverage_to_rpkm_df(rpkm_df, exon_stats_dict)
         rpkm_header_with_cols = rpkm_header + coverage_cols
         rpkm_df_with_cov.to_csv(output_fname_with_cov,
-                                cols=rpkm_header_with_cols,
+                                columns=rpkm_header_with_cols,
                                 na_rep=na_val,
                                 sep="\t",
                                 index=False)
     rpkm_df.to_csv(output_filename,
-                   cols=rpkm_header,
+                   columns=rpkm_header,
                    na_rep=na_val,
                    sep="\t",
                    # 4-decimal point RPKM format
@@ -395,47 +618,64 @@ def add_exons_coverage_from_bam_to_rpkm_df(rpkm_df,
       coverage_utils.get_exons_coverage_from_tagBam(bam_fname,
                                                     interval_label=interval_label,
                                                     gff_coords=True)
-    gene_entries = []
-    # Add exon coverage statistics to RPKM table
-    for rpkm_row, curr_entry in rpkm_df.iterrows():
-        # Find the stats values for all exons in this gene
-        gene_id = curr_entry["gene_id"]
-        rpkm_exons = curr_entry["exons"].split(",")
-        # Remove "cds." prefix for exons if found
-        rpkm_exons = \
-          map(lambda x: \
-              x.split("cds.")[1] if x.startswith("cds.") else x,
-              rpkm_exons)
-        # Statistics for each exon. Each value in the list
-        # corresponds to the
-        gene_entry = curr_entry.copy()
-        gene_entry["rpkm_exons"] = curr_entry["exons"]
-        gene_entry["gene_id"] = gene_id
-        for cov_col in coverage_cols:
-            gene_entry[cov_col] = []
-        for curr_rpkm_exon in rpkm_exons:
-            if curr_rpkm_exon not in exon_stats_dict:
-                # If exon from RPKM table does not appear in BAM
-                # it likely means that the gene was not expressed
-                # (i.e. its RPKM is zero) or that it did not
-                # meet a read counts criteria applied to
-                # the table. In this case mark the entry as NA.
-                for cov_col in coverage_cols:
-                    gene_entry[cov_col].append("NA")
-            else:
-                curr_exon_stats = exon_stats_dict[curr_rpkm_exon]
-                # If exon is found, record the value
-                # for each of the coverage columns
-                for cov_col in coverage_cols:
-                    # Record the exon stat value in the gene entry
-                    gene_entry[cov_col].append(curr_exon_stats[cov_col])
-        # Convert list values for each coverage statistic column
-        # into strings
-        for cov_col in coverage_cols:
-            gene_entry[cov_col] = ",".join(map(str, gene_entry[cov_col]))
-        gene_entries.append(gene_entry)
-    # Convert to dataframe
-    gene_df = pandas.DataFrame(gene_entries)
+    return add_exons_coverage_to_rpkm_df(rpkm_df,
+                                         exon_stats_dict,
+                                         na_val=na_val,
+                                         coverage_cols=coverage_cols)
+
+
+def add_exons_coverage_to_rpkm_df(rpkm_df,
+                                  exon_stats_dict,
+                                  na_val="NA",
+                                  coverage_cols=["kurtosis",
+                                                 "min",
+                                                 "max",
+                                                 "mean",
+                                                 "std",
+                                                 "cv",
+                                                 "sqrt_jsd"]):
+    """
+    Add exons coverage to RPKM dataframe.
+
+    Args:
+    - rpkm_df: RPKM dataframe
+    - exon_stats_dict: mapping from exons to their coverage
+    statistics
+
+    Kwargs:
+    - na_val: NA value to use
+    """
+    # Table of exons with one row per exon of each gene
+    gene_exons = [exons.split(",") for exons in rpkm_df["exons"]]
+    exons_df = \
+      pandas.DataFrame({"gene_row": np.repeat(np.arange(len(gene_exons)),
+                                              [len(exons) for exons in gene_exons]),
+                        "exon": list(itertools.chain.from_iterable(gene_exons))})
+    # Remove "cds." prefix for exons if found
+    exons_df["exon"] = exons_df["exon"].str.replace("^cds\\.", "")
+    # Join the statistics of each exon
+    stats_df = pandas.DataFrame(exon_stats_dict.values(),
+                                columns=["exon"] + coverage_cols)
+    stats_df = stats_df.set_index("exon")
+    exons_df = exons_df.join(stats_df, on="exon")
+    # If exon from RPKM table does not appear in the exon
+    # statistics it likely means that the gene was not expressed
+    # (i.e. its RPKM is zero) or that it did not meet a read
+    # counts criteria applied to the table. In this case mark
+    # the entry as NA.
+    exon_found = exons_df["exon"].isin(stats_df.index).values
+    for cov_col in coverage_cols:
+        cov_values = exons_df[cov_col].map(str)
+        cov_values[~exon_found] = na_val
+        exons_df[cov_col] = cov_values
+    # Join the values of each gene's exons into comma-separated
+    # strings, in the order of the exons
+    gene_cov_df = \
+      exons_df.groupby("gene_row", sort=True)[coverage_cols].agg(",".join)
+    gene_df = rpkm_df.copy()
+    gene_df["rpkm_exons"] = rpkm_df["exons"]
+    for cov_col in coverage_cols:
+        gene_df[cov_col] = gene_cov_df[cov_col].values
     return gene_df, coverage_cols
 
 
@@ -443,7 +683,7 @@ def compute_rpkm(region_count,
                  region_len,
                  num_total_reads):
     """
-    Compute RPKM for a region.
+    Compute RPKM for a region (or for arrays of regions).
     """
     # Get length of region in KB
     region_kb = region_len / float(1e3)
@@ -458,18 +698,51 @@ def compute_rpkm(region_count,
     return rpkm
 
 
+def add_normalized_rpkms(rpkm_table, sample_labels, lib_sizes,
+                         method="tmm",
+                         prefix="norm"):
+    """
+    Add normalized RPKMs of the given samples to an RPKM table
+    (with 'rpkm_<label>' and 'counts_<label>' columns), as
+    columns '<prefix>_rpkm_<label>'. All samples are normalized
+    at once.
+
+    - lib_sizes: library size of each sample, as used to compute
+      its RPKMs (e.g. the number of mapped reads in the count
+      store, see CountStore.get_num_mapped)
+    - method: 'lowess' (lowess on the MA-plots of the samples'
+      RPKMs against their geometric mean) or a method of
+      normalization.NORM_FACTOR_METHODS (which rescale the
+      samples' library sizes)
+
+    Returns the normalized RPKMs as a genes x samples matrix.
+    """
+    rpkms = rpkm_table[["rpkm_%s" %(label) \
+                        for label in sample_labels]].values.astype(float)
+    if method == "lowess":
+        normed_rpkms = normalization.compute_ma_lowess(rpkms)
+    else:
+        counts = rpkm_table[["counts_%s" %(label) \
+                             for label in sample_labels]].values
+        norm_factors = normalization.compute_norm_factors(counts,
+                                                          method=method,
+                                                          lib_sizes=lib_sizes)
+        normed_rpkms = rpkms / norm_factors
+    for sample_num, label in enumerate(sample_labels):
+        rpkm_table["%s_rpkm_%s" %(prefix, label)] = \
+            normed_rpkms[:, sample_num]
+    return normed_rpkms
+
+
 def loess_normalize_table(rpkm_table, sample_pairs, prefix="norm"):
     """
     Compute loess pairwise comparisons for the given RPKM table
     across the pairs in 'sample_pairs'. Use 'prefix' as the
     name of the new column in the DataFrame.
+
+    Each pair is normalized by lowess on its MA-plot (see
+    normalization.compute_ma_lowess_pair).
     """
-    if not utils.is_rpy2_available():
-        # If rpy2 isn't available, quit
-        return None
-    # Use Rpy2 to do the normalization
-    import rnaseqlib.stats.rpy2_utils as rpy2_utils
-    
     for sample1, sample2 in sample_pairs:
         # Do loess-normalization between the samples
         # Compute the normalized values for this sample comparison
@@ -484,8 +757,8 @@ def loess_normalize_table(rpkm_table, sample_pairs, prefix="norm"):
         sample2_vals = rpkm_table[sample2]
         # Get MA-normalized values 
         sample1_normed, sample2_normed = \
-            rpy2_utils.run_ma_loess(sample1_vals.values,
-                                    sample2_vals.values)
+            normalization.compute_ma_lowess_pair(sample1_vals.values,
+                                                 sample2_vals.values)
         rpkm_table[sample1_col] = sample1_normed
         rpkm_table[sample2_col] = sample2_normed
         # Compute fold change with normalized values
@@ -10,16 +10,26 @@ def load_settings(config_filename,
                   INT_PARAMS=["readlen",
                               "overhanglen",
                               "num_processors",
-                              "paired_end_frag"],
+                              "paired_end_frag",
+                              "read_count_memory",
+                              "count_tile_size",
+                              "local_max_cores",
+                              "local_max_memory"],
                   # Boolean parameters
                   BOOL_PARAMS=["paired",
-                               "prefilter_miso"],
+                               "prefilter_miso",
+                               "stream_mapping",
+                               "debug"],
                   STR_PARAMS=["indir",
                               "outdir",
                               "stranded",
                               "mapper",
                               "adaptors_file",
-                              "python"],
+                              "python",
+                              "read_count_mode",
+                              "rpkm_norm_method",
+                              "sort_memory",
+                              "umi_regex"],
                   # Parameters to be interpreted as Python lists or
                   # data structures,
                   DATA_PARAMS=["sequence_files", 
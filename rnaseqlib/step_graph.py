@@ -0,0 +1,386 @@
+##
+## Graph of pipeline steps with cached, atomic completion records
+##
+import os
+import sys
+import time
+import json
+import shutil
+import hashlib
+import threading
+import Queue
+
+import rnaseqlib
+import rnaseqlib.utils as utils
+
+
+def get_file_fingerprint(fname):
+    """
+    Return a fingerprint of a file or directory: its size and
+    modification time, or None if it does not exist.
+
+    The contents are not read, so that fingerprinting large
+    BAMs is cheap: a file rewritten with the same size and
+    modification time has the same fingerprint, while a file
+    that is only touched gets a new one.
+    """
+    if not os.path.exists(fname):
+        return None
+    file_stat = os.stat(fname)
+    return [file_stat.st_size, repr(file_stat.st_mtime)]
+
+
+def write_atomically(fname, text):
+    """
+    Write text to a file so that readers only ever see the
+    complete file: write to a temporary file in the same
+    directory and rename it into place.
+    """
+    tmp_fname = "%s.tmp.%d.%d" %(fname, os.getpid(),
+                                 threading.current_thread().ident)
+    with open(tmp_fname, "w") as tmp_file:
+        tmp_file.write(text)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.rename(tmp_fname, fname)
+
+
+def get_partial_filename(fname):
+    """
+    Return the temporary path a step can write an output to.
+    It is renamed to the output's path only once the step
+    succeeds.
+    """
+    return "%s.partial" %(fname)
+
+
+def remove_output(fname):
+    """
+    Remove a (possibly partial) output file or directory.
+    """
+    if os.path.isdir(fname):
+        shutil.rmtree(fname)
+    elif os.path.exists(fname):
+        os.remove(fname)
+
+
+class Step:
+    """
+    A unit of pipeline work.
+
+    - name: unique name of the step (used to name its record)
+    - func: function to call (with no arguments) to run the step
+    - inputs: files the step reads
+    - outputs: files the step produces
+    - params: dictionary of parameters that affect the outputs
+      (e.g. settings values)
+    - deps: names of steps that must run before this one
+    - exclusive: if True, the step runs alone, in the thread that
+      runs the graph, with no other step of the graph running
+      (for steps that fork processes or run pools of their own)
+
+    A step without outputs is always run. A step function
+    signals failure by raising (e.g. from subprocess.check_call).
+    It can write each output to get_partial_filename(output) so
+    that the output appears in place only when the step succeeds.
+    """
+    def __init__(self, name, func,
+                 inputs=[],
+                 outputs=[],
+                 params={},
+                 deps=[],
+                 exclusive=False):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = dict(params)
+        self.deps = list(deps)
+        self.exclusive = exclusive
+
+
+    def get_key(self):
+        """
+        Return the key of the step: a hash of its name,
+        parameters, outputs and the fingerprints (sizes and
+        modification times, see get_file_fingerprint) of its
+        inputs. The key does not depend on input contents.
+        """
+        key_fields = [self.name,
+                      sorted([(str(k), repr(v)) \
+                              for k, v in self.params.iteritems()]),
+                      [(os.path.abspath(fname), get_file_fingerprint(fname)) \
+                       for fname in self.inputs],
+                      [os.path.abspath(fname) for fname in self.outputs]]
+        return hashlib.sha1(json.dumps(key_fields)).hexdigest()
+
+
+    def __repr__(self):
+        return "Step(%s)" %(self.name)
+
+
+class StepGraph:
+    """
+    Run steps in dependency order, skipping steps whose
+    completion record matches their current key and outputs.
+
+    A step is marked as running before it starts, and its
+    completion record is written (atomically) only after it
+    succeeds, so outputs left by a failed or interrupted run
+    are never taken as done: they are removed and rebuilt.
+    Changing a step's parameters, or the size or modification
+    time of one of its inputs, changes its key and causes it
+    to rerun.
+
+    Outputs of a step that has no record at all (e.g. made
+    before steps were recorded) are adopted if they are newer
+    than the step's inputs.
+
+    - records_dir: directory where completion records are kept
+    - num_workers: maximum number of independent steps to run
+      at the same time
+    - manifest: optional PerfManifest to record the resources
+      used by each step in
+    """
+    def __init__(self, records_dir, logger,
+                 num_workers=1,
+                 manifest=None):
+        self.records_dir = records_dir
+        self.logger = logger
+        self.num_workers = max(1, int(num_workers))
+        self.manifest = manifest
+        utils.make_dir(self.records_dir)
+        self.steps = []
+        self.steps_by_name = {}
+
+
+    def add_step(self, step):
+        """
+        Add a step to the graph. Returns the step.
+        """
+        if step.name in self.steps_by_name:
+            raise Exception, "Step %s already in graph." %(step.name)
+        self.steps.append(step)
+        self.steps_by_name[step.name] = step
+        return step
+
+
+    def get_record_filename(self, step):
+        return os.path.join(self.records_dir,
+                            "%s.json" %(step.name.replace(os.sep, "_")))
+
+
+    def load_record(self, step):
+        record_fname = self.get_record_filename(step)
+        if not os.path.isfile(record_fname):
+            return None
+        try:
+            with open(record_fname) as record_file:
+                return json.load(record_file)
+        except ValueError:
+            return None
+
+
+    def write_record(self, step, key, status, run_time=None):
+        """
+        Write the record of a step with the given status
+        ("running" or "complete").
+        """
+        record = {"key": key,
+                  "name": step.name,
+                  "status": status,
+                  "params": dict([(str(k), repr(v)) \
+                                  for k, v in step.params.iteritems()])}
+        if status == "complete":
+            record["outputs"] = dict([(os.path.abspath(fname),
+                                       get_file_fingerprint(fname)) \
+                                      for fname in step.outputs])
+            record["run_time"] = run_time
+        write_atomically(self.get_record_filename(step),
+                         json.dumps(record, indent=1))
+
+
+    def is_up_to_date(self, step, key):
+        """
+        Return True if the step's completion record matches its
+        key and its outputs are unchanged since it was written.
+        """
+        if len(step.outputs) == 0:
+            return False
+        record = self.load_record(step)
+        if (record is None) or (record.get("key") != key) or \
+           (record.get("status", "complete") != "complete"):
+            return False
+        recorded_outputs = record.get("outputs", {})
+        for fname in step.outputs:
+            fingerprint = get_file_fingerprint(fname)
+            if (fingerprint is None) or \
+               (recorded_outputs.get(os.path.abspath(fname)) != fingerprint):
+                return False
+        return True
+
+
+    def can_adopt(self, step):
+        """
+        Return True if the step has no record and all of its
+        outputs exist and are newer than its inputs.
+        """
+        if (len(step.outputs) == 0) or \
+           (self.load_record(step) is not None):
+            return False
+        output_mtimes = []
+        for fname in step.outputs:
+            if not os.path.exists(fname):
+                return False
+            output_mtimes.append(os.path.getmtime(fname))
+        input_mtimes = [os.path.getmtime(fname) for fname in step.inputs \
+                        if os.path.exists(fname)]
+        if len(input_mtimes) == 0:
+            return True
+        return min(output_mtimes) >= max(input_mtimes)
+
+
+    def remove_outputs(self, step):
+        """
+        Remove the outputs of a step and their partial files.
+        """
+        for fname in step.outputs:
+            remove_output(get_partial_filename(fname))
+            if os.path.exists(fname):
+                self.logger.info("Removing stale output %s" %(fname))
+                remove_output(fname)
+
+
+    def run_step(self, step):
+        """
+        Run a single step unless it is up to date. Returns True
+        if the step was run.
+        """
+        key = step.get_key()
+        if self.is_up_to_date(step, key):
+            self.logger.info("Step %s is up to date, skipping.." \
+                             %(step.name))
+            if self.manifest is not None:
+                self.manifest.record_skipped(step.name)
+            return False
+        if self.can_adopt(step):
+            self.logger.info("Adopting existing outputs of step %s" \
+                             %(step.name))
+            self.write_record(step, key, "complete")
+            if self.manifest is not None:
+                self.manifest.record_skipped(step.name)
+            return False
+        # Remove stale outputs and mark the step as running
+        self.remove_outputs(step)
+        if len(step.outputs) > 0:
+            self.write_record(step, key, "running")
+        self.logger.info("Running step %s" %(step.name))
+        t1 = time.time()
+        try:
+            if self.manifest is not None:
+                self.manifest.measure(step.name, step.func)
+            else:
+                step.func()
+            # Move outputs written to partial files into place
+            for fname in step.outputs:
+                partial_fname = get_partial_filename(fname)
+                if os.path.exists(partial_fname):
+                    remove_output(fname)
+                    os.rename(partial_fname, fname)
+            missing_outputs = [fname for fname in step.outputs \
+                               if not os.path.exists(fname)]
+            if len(missing_outputs) > 0:
+                raise Exception, "Step %s did not produce: %s" \
+                                 %(step.name, ", ".join(missing_outputs))
+        except:
+            exc_info = sys.exc_info()
+            self.logger.error("Step %s failed, removing its outputs." \
+                              %(step.name))
+            self.remove_outputs(step)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        t2 = time.time()
+        if len(step.outputs) > 0:
+            self.write_record(step, key, "complete", run_time=t2 - t1)
+        self.logger.info("Step %s completed in %.2f mins" \
+                         %(step.name, (t2 - t1)/60.))
+        return True
+
+
+    def get_step_order(self):
+        """
+        Return steps in a topological order (ties broken by the
+        order in which steps were added).
+        """
+        for step in self.steps:
+            for dep in step.deps:
+                if dep not in self.steps_by_name:
+                    raise Exception, "Step %s depends on unknown step %s." \
+                                     %(step.name, dep)
+        ordered_steps = []
+        visited = set()
+        done = set()
+        def visit(step):
+            if step.name in done:
+                return
+            if step.name in visited:
+                raise Exception, "Cycle in steps at %s." %(step.name)
+            visited.add(step.name)
+            for dep in step.deps:
+                visit(self.steps_by_name[dep])
+            done.add(step.name)
+            ordered_steps.append(step)
+        for step in self.steps:
+            visit(step)
+        return ordered_steps
+
+
+    def run(self):
+        """
+        Run all steps in the graph. Independent steps are run in
+        parallel threads, up to 'num_workers' at a time, except
+        exclusive steps, which wait for running steps to finish
+        and run alone. If a step fails, no new steps are started
+        and the error is raised once the running steps finish.
+        """
+        pending_steps = self.get_step_order()
+        done_steps = set()
+        results = Queue.Queue()
+        num_running = 0
+        failure = None
+        def run_in_thread(step):
+            try:
+                self.run_step(step)
+                results.put((step, None))
+            except:
+                results.put((step, sys.exc_info()))
+        while (len(pending_steps) > 0) or (num_running > 0):
+            # Start steps whose dependencies are done
+            if failure is None:
+                ready_steps = [step for step in pending_steps \
+                               if set(step.deps).issubset(done_steps)]
+                for step in ready_steps:
+                    if (num_running >= self.num_workers) or \
+                       (step.exclusive and (num_running > 0)):
+                        break
+                    pending_steps.remove(step)
+                    num_running += 1
+                    if step.exclusive or (self.num_workers == 1):
+                        # Run in this thread, with no other step running
+                        run_in_thread(step)
+                        break
+                    step_thread = threading.Thread(target=run_in_thread,
+                                                   args=(step,))
+                    step_thread.daemon = True
+                    step_thread.start()
+            if num_running == 0:
+                break
+            step, exc_info = results.get()
+            num_running -= 1
+            if exc_info is not None:
+                self.logger.error("Step %s failed." %(step.name))
+                if failure is None:
+                    failure = exc_info
+            else:
+                done_steps.add(step.name)
+        if failure is not None:
+            raise failure[0], failure[1], failure[2]
@@ -18,6 +18,7 @@ import pandas
 
 import rnaseqlib
 import rnaseqlib.utils as utils
+import rnaseqlib.array_snapshot as array_snapshot
 import rnaseqlib.init as init
 import rnaseqlib.genes.exons as exons
 import rnaseqlib.gff
@@ -172,27 +173,118 @@ def load_refGene_table_as_df(table_fname, header, sep="\t"):
     return table
 
 
+def get_table_dirs(table_dir):
+    """
+    Return a mapping from kinds of regions (exons, introns,
+    UTRs and tRNAs) to the directories of their files in a
+    UCSC tables directory.
+    """
+    return {"exons": os.path.join(table_dir, "exons"),
+            "introns": os.path.join(table_dir, "introns"),
+            "utrs": os.path.join(table_dir, "utrs"),
+            "tRNAs": os.path.join(table_dir, "tRNAs")}
+
+
+def get_exon_arrays(exon_starts, exon_ends):
+    """
+    Parse the exonStarts and exonEnds columns of a UCSC table
+    (comma-separated coordinates, one string per transcript).
+
+    Returns flat arrays of exon starts and ends, and the offsets
+    of each transcript's exons in them: the exons of the n-th
+    transcript are at offsets[n]:offsets[n + 1].
+    """
+    exon_starts = [starts.rstrip(",") for starts in exon_starts]
+    exon_ends = [ends.rstrip(",") for ends in exon_ends]
+    offsets = np.zeros(len(exon_starts) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([starts.count(",") + 1 \
+                             for starts in exon_starts])
+    return (np.fromstring(",".join(exon_starts), dtype=np.int64, sep=","),
+            np.fromstring(",".join(exon_ends), dtype=np.int64, sep=","),
+            offsets)
+
+
+def get_gene_arrays(table, gene_symbols=None):
+    """
+    Parse a gene table (ensGene format, with genes given by 'name2')
+    into GeneModel.GeneArrays. Coordinates are made 1-based (GFF
+    convention.)
+
+    Genes are numbered in order of first appearance in the table
+    and each gene's transcripts are kept in table order.
+
+    - gene_symbols: mapping from transcripts to gene symbols. A gene
+      takes the symbol of its last transcript.
+    """
+    gene_codes, gene_ids = pandas.factorize(table["name2"].values)
+    rows = np.argsort(gene_codes, kind="mergesort")
+    gene_offsets = np.zeros(len(gene_ids) + 1, dtype=np.int64)
+    gene_offsets[1:] = np.cumsum(np.bincount(gene_codes,
+                                             minlength=len(gene_ids)))
+    exon_starts, exon_ends, trans_offsets = \
+        get_exon_arrays(table["exonStarts"].values[rows],
+                        table["exonEnds"].values[rows])
+    trans_labels = list(table["name"].values[rows])
+    symbols = None
+    if gene_symbols is not None:
+        symbols = [gene_symbols[trans_labels[last_trans]] \
+                   for last_trans in gene_offsets[1:] - 1]
+    return GeneModel.GeneArrays(exon_starts + 1,
+                                exon_ends,
+                                trans_offsets,
+                                table["cdsStart"].values[rows] + 1,
+                                table["cdsEnd"].values[rows],
+                                gene_offsets,
+                                trans_labels,
+                                list(table["chrom"].values[rows]),
+                                list(table["strand"].values[rows]),
+                                list(gene_ids),
+                                gene_symbols=symbols)
+
+
+def join_groups(values, offsets, sep=","):
+    """
+    Join values into one string per group, where the values of
+    the n-th group are values[offsets[n]:offsets[n + 1]].
+    """
+    values = [str(value) for value in values]
+    return [sep.join(values[start:end]) \
+            for start, end in itertools.izip(offsets[:-1], offsets[1:])]
+
+
 class GeneTable:
     """
     Parse gene table.
+
+    - output_combined: if True, output the gene table combined
+      with UCSC transcript names and kgXref information (see
+      output_combined_tables)
     """
     def __init__(self, table_dir, source,
                  tables_only=False,
                  params={},
-                 headers=None):
+                 headers=None,
+                 output_combined=False):
         self.table_dir = table_dir
         self.headers = headers
-        self.exons_dir = os.path.join(self.table_dir, "exons")
+        table_dirs = get_table_dirs(self.table_dir)
+        self.exons_dir = table_dirs["exons"]
         self.const_exons_dir = os.path.join(self.exons_dir,
                                             "const_exons")
-        self.introns_dir = os.path.join(self.table_dir, "introns")
-        self.utrs_dir = os.path.join(self.table_dir, "utrs")
-        self.tRNAs_dir = os.path.join(self.table_dir, "tRNAs")
+        self.introns_dir = table_dirs["introns"]
+        self.utrs_dir = table_dirs["utrs"]
+        self.tRNAs_dir = table_dirs["tRNAs"]
         self.source = source
         self.delimiter = "\t"
         self.table = None
         self.genes = {}
+        # Gene models as arrays (see get_ensGene_by_genes)
+        self.gene_arrays = None
         self.genes_list = []
+        # Indexes of the table by gene (see index_genes)
+        self.gene_codes = None
+        self.gene_rows = None
+        self.gene_offsets = None
         self.na_val = "NA"
         self.params = params
         self.constitutive_exon_diff = 10
@@ -211,8 +303,6 @@ class GeneTable:
         self.genes_to_names = defaultdict(lambda: self.na_val)
         # Mapping from genes to descriptions
         self.genes_to_desc = defaultdict(lambda: self.na_val)        
-        # Table indexed by gene
-        self.table_by_gene = None
         # UCSC known to Ensembl
         self.known_to_ensembl = defaultdict(lambda: self.na_val)
         # kgXref table
@@ -227,7 +317,8 @@ class GeneTable:
             self.headers["knownGene"] = UCSC_KNOWNGENE_HEADER
             self.headers["refGene"] = UCSC_REFGENE_HEADER
         # Load tables        
-        self.load_tables(tables_only=tables_only)
+        self.load_tables(tables_only=tables_only,
+                         output_combined=output_combined)
         
 
     def init_dirs(self):
@@ -267,14 +358,15 @@ class GeneTable:
         self.kgXref_table = self.kgXref_table[relevant_cols]
             
 
-    def load_tables(self, tables_only=False):
+    def load_tables(self, tables_only=False, output_combined=False):
         """
         Load table.
         """
         # Load kgXref for all tables
         self.load_kgXref_table()
         if self.source == "ensGene":
-            self.load_ensGene_table(tables_only=tables_only)
+            self.load_ensGene_table(tables_only=tables_only,
+                                    output_combined=output_combined)
         elif self.source == "knownGene":
             self.load_knownGene_table(tables_only=tables_only)
         elif self.source == "refSeq":
@@ -297,6 +389,8 @@ class GeneTable:
         # Load the combined table with kgXref
         combined_filename = os.path.join(self.table_dir,
                                          "ensGene.kgXref.combined.txt")
+        if not os.path.isfile(combined_filename):
+            self.output_combined_tables()
         if not os.path.isfile(combined_filename):
             print "Error: cannot get Ensembl to RefSeq ID mapping since " \
                   "%s does not exist." %(combined_filename)
@@ -322,7 +416,7 @@ class GeneTable:
         return ensembl_to_refseq, refseq_to_ensembl
 
             
-    def load_ensGene_table(self, tables_only=False):
+    def load_ensGene_table(self, tables_only=False, output_combined=False):
         """
         Load ensGene table. Expects an 'ensGene.txt'
 
@@ -346,7 +440,8 @@ class GeneTable:
           `exonFrames` longblob NOT NULL,
 
         if tables_only is True, do not parse table into
-        genes but only load tables.
+        genes but only load tables. If output_combined is True,
+        output the combined tables.
         """
         self.ensGene_header = self.headers["ensGene"]
         self.knownToEnsembl_header = ["knownGene_name",
@@ -404,9 +499,8 @@ class GeneTable:
                                   # try left index
                                   how="left")
 #                                  how="outer")
-        # Output combined table
-        combined_fname = self.output_ensGene_combined(self.table,
-                                                      "ensGene.combined")
+        # Table with UCSC transcript names
+        self.known_table = self.table
         ## Note: it is critical to remove NA values from kgXref
         ## to avoid excess memory consumption during merge (thanks to y-p)
         self.kgXref_table = self.kgXref_table.dropna(subset=["kgID"])
@@ -421,34 +515,18 @@ class GeneTable:
                                   left_index=True,
                                   left_on=["knownGene_name"],
                                   right_on=["kgID"])
-        # Output combined table with kgXref
-        self.output_ensGene_combined(self.table,
-                                     "ensGene.kgXref.combined")
+        if output_combined:
+            self.output_combined_tables()
+        # Chromosomes and strands repeat across transcripts
+        self.table["chrom"] = self.table["chrom"].astype("category")
+        self.table["strand"] = self.table["strand"].astype("category")
         self.table_by_trans = self.table.set_index("name")
-        # Get mapping from transcripts to genes
-        self.trans_to_genes = self.table.set_index("name")
-        ##
-        ## Index table by gene and load a list of genes
-        ## Also compute mapping from gene to symbol
-        ## and gene to description
-        ##
-        self.table_by_gene = defaultdict(list)
-        seen_genes = {}
-        for idx, series in self.table.iterrows():
-            gene_id = series["name2"]
-            gene_info = series.to_dict()
-            trans = gene_info["name"]
-            self.table_by_gene[gene_id].append(gene_info)
-            if gene_id in seen_genes:
-                continue
-            else:
-                self.genes_list.append(gene_id)
-                seen_genes[gene_id] = True
-                # Record mapping from gene to name via transcript
-                self.genes_to_names[gene_id] = gene_info[self.gene_symbol_field]
-                # Get Ensembl transcript's UCSC name and from that get
-                # the gene description
-                self.genes_to_desc[gene_id] = gene_info["description"]
+        # Get mapping from transcripts to genes: the table indexed
+        # by transcript (its 'name2' column), shared rather than copied
+        self.trans_to_genes = self.table_by_trans
+        # Index table by gene and load a list of genes, with
+        # the mapping from gene to symbol and gene to description
+        self.index_genes()
         # Parse table into actual gene objects if asked
         if not tables_only:
             self.genes = self.get_genes()
@@ -456,6 +534,51 @@ class GeneTable:
         self.output_lens_table("ensGene")
 
 
+    def index_genes(self):
+        """
+        Index the table by gene. Genes are numbered in order of
+        first appearance in the table (as in genes_list):
+
+        - gene_codes: the number of each row's gene
+        - gene_rows, gene_offsets: the rows of the n-th gene's
+          transcripts are gene_rows[gene_offsets[n]:gene_offsets[n + 1]]
+
+        The symbol and description of a gene are those of its
+        first transcript.
+        """
+        gene_codes, gene_ids = pandas.factorize(self.table["name2"].values)
+        self.gene_codes = gene_codes.astype(np.int32)
+        self.genes_list = list(gene_ids)
+        # Stable sort keeps each gene's transcripts in table order
+        self.gene_rows = np.argsort(self.gene_codes,
+                                    kind="mergesort").astype(np.int32)
+        self.gene_offsets = np.zeros(len(gene_ids) + 1, dtype=np.int64)
+        self.gene_offsets[1:] = np.cumsum(np.bincount(self.gene_codes,
+                                                      minlength=len(gene_ids)))
+        first_rows = self.gene_rows[self.gene_offsets[:-1]]
+        self.genes_to_names.update(
+            itertools.izip(self.genes_list,
+                           self.table[self.gene_symbol_field].values[first_rows]))
+        self.genes_to_desc.update(
+            itertools.izip(self.genes_list,
+                           self.table["description"].values[first_rows]))
+
+
+    def output_combined_tables(self):
+        """
+        Output the ensGene table combined with UCSC transcript
+        names ('ensGene.combined.txt') and with kgXref information
+        ('ensGene.kgXref.combined.txt'), used for mapping between
+        gene IDs and for annotating events.
+        """
+        if self.table is None:
+            return
+        self.output_ensGene_combined(self.known_table,
+                                     "ensGene.combined")
+        self.output_ensGene_combined(self.table,
+                                     "ensGene.kgXref.combined")
+
+
     def output_lens_table(self, table_basename):
         """
         Output the lengths table.
@@ -467,48 +590,35 @@ class GeneTable:
         if os.path.isfile(output_fname):
             print "Found %s. Skipping..." %(output_fname)
             return output_fname
-        lens_entries = []
-        for gene in self.table_by_gene:
-            gene_info = self.table_by_gene[gene]
-            # Get the length of each transcript
-            # which is the sum of the lengths of
-            # its exons
-            exon_lens = []
-            num_exons = []
-            trans_ids = []
-            trans_lens = []
-            for trans_entry in gene_info:
-                # Transcript ID 
-                trans_id = trans_entry["name"]
-                trans_ids.append(trans_id)
-                exon_starts = \
-                    [int(start) + 1 \
-                     for start in trans_entry["exonStarts"].rstrip(",").split(",")]
-                exon_ends = \
-                    [int(end) \
-                     for end in trans_entry["exonEnds"].rstrip(",").split(",")]
-                exon_coords = zip(exon_starts, exon_ends)
-                exon_lens = map(lambda coords: coords[1] - coords[0] + 1,
-                                exon_coords)
-                trans_len = sum(exon_lens)
-                # mRNA lengths
-                trans_lens.append(trans_len)
-                # Number of exons
-                trans_num_exons = len(exon_starts)
-                num_exons.append(trans_num_exons)
-            gene_entry = {"gene_id": gene,
-                          "transcripts": ",".join(trans_ids),
-                          "transcript_lens": ",".join(map(str, trans_lens)),
-                          "num_exons": ",".join(map(str, num_exons)),
-                          "mean_transcript_len": "%.2f" %(np.mean(trans_lens))}
-            lens_entries.append(gene_entry)
-        lens_df = pandas.DataFrame(lens_entries)
+        # The length of each transcript is the sum of the
+        # lengths of its exons
+        exon_starts, exon_ends, exon_offsets = \
+            get_exon_arrays(self.table["exonStarts"].values,
+                            self.table["exonEnds"].values)
+        exon_lens = exon_ends - exon_starts
+        trans_lens = np.add.reduceat(exon_lens, exon_offsets[:-1]) \
+                     if len(exon_lens) > 0 else exon_lens
+        num_exons = np.diff(exon_offsets)
+        # Group transcripts by gene
+        trans_ids = self.table["name"].values[self.gene_rows]
+        trans_lens = trans_lens[self.gene_rows]
+        num_exons = num_exons[self.gene_rows]
+        num_trans = np.diff(self.gene_offsets)
+        mean_lens = np.add.reduceat(trans_lens, self.gene_offsets[:-1]) \
+                    / num_trans.astype(float) \
+                    if len(trans_lens) > 0 else trans_lens
+        lens_df = pandas.DataFrame(
+            {"gene_id": self.genes_list,
+             "transcripts": join_groups(trans_ids, self.gene_offsets),
+             "transcript_lens": join_groups(trans_lens, self.gene_offsets),
+             "num_exons": join_groups(num_exons, self.gene_offsets),
+             "mean_transcript_len": ["%.2f" %(mean_len) \
+                                     for mean_len in mean_lens]})
         cols = ["gene_id", "transcripts", "transcript_lens",
                 "mean_transcript_len", "num_exons"]
-        lens_df.to_csv(output_fname,
-                       sep="\t",
-                       index=False,
-                       cols=cols)
+        lens_df[cols].to_csv(output_fname,
+                             sep="\t",
+                             index=False)
         return output_fname
                 
         
@@ -530,6 +640,83 @@ class GeneTable:
         return combined_filename
             
 
+    def get_gene_annotation_values(self):
+        """
+        Return the IDs of the table's genes and a mapping from
+        each gene annotation field (symbol, description and exons)
+        to its values, in the order of the gene IDs (see
+        genes.gene_annotation).
+
+        Exons are the distinct exons of the gene's transcripts,
+        as comma-separated chrom:start-end:strand (1-based).
+        """
+        symbols = []
+        descs = []
+        for gene_id in self.genes_list:
+            symbol = self.genes_to_names[gene_id]
+            desc = self.genes_to_desc[gene_id]
+            symbols.append(self.na_val if pandas.isnull(symbol) else symbol)
+            descs.append(self.na_val if pandas.isnull(desc) else desc)
+        exon_starts, exon_ends, exon_offsets = \
+            get_exon_arrays(self.table["exonStarts"].values,
+                            self.table["exonEnds"].values)
+        num_exons = np.diff(exon_offsets)
+        exons_df = pandas.DataFrame(
+            {"gene": np.repeat(self.gene_codes, num_exons),
+             "start": exon_starts + 1,
+             "end": exon_ends,
+             "chrom": np.repeat(self.table["chrom"].astype(str).values,
+                                num_exons),
+             "strand": np.repeat(self.table["strand"].astype(str).values,
+                                 num_exons)})
+        exons_df = exons_df.drop_duplicates()
+        exons_df = exons_df.sort_values(["gene", "start", "end",
+                                         "chrom", "strand"])
+        exon_names = exons_df["chrom"] + ":" + \
+                     exons_df["start"].astype(str) + "-" + \
+                     exons_df["end"].astype(str) + ":" + \
+                     exons_df["strand"]
+        gene_exon_offsets = \
+            np.searchsorted(exons_df["gene"].values,
+                            np.arange(len(self.genes_list) + 1))
+        gene_exons = join_groups(exon_names.values, gene_exon_offsets)
+        return self.genes_list, {"symbol": symbols,
+                                 "desc": descs,
+                                 "exons": gene_exons}
+
+
+    def get_exon_intron_coords(self):
+        """
+        Return the distinct exons and introns of the table's
+        transcripts as two DataFrames of 0-based, end-exclusive
+        coordinates, with the IDs of the genes they belong to
+        (comma-separated). Introns are the gaps between consecutive
+        exons of a transcript, i.e. its splice junctions.
+
+        Returns (None, None) if the table is not loaded.
+        """
+        if self.table is None:
+            return None, None
+        exons_to_genes = defaultdict(set)
+        introns_to_genes = defaultdict(set)
+        for chrom, strand, gene_id, exon_starts, exon_ends in \
+            itertools.izip(self.table["chrom"],
+                           self.table["strand"],
+                           self.table["name2"],
+                           self.table["exonStarts"],
+                           self.table["exonEnds"]):
+            exon_starts = map(int, exon_starts.rstrip(",").split(","))
+            exon_ends = map(int, exon_ends.rstrip(",").split(","))
+            for start, end in itertools.izip(exon_starts, exon_ends):
+                exons_to_genes[(chrom, start, end, strand)].add(gene_id)
+            for start, end in itertools.izip(exon_ends[0:-1],
+                                             exon_starts[1:]):
+                if start < end:
+                    introns_to_genes[(chrom, start, end, strand)].add(gene_id)
+        return (get_coords_df(exons_to_genes),
+                get_coords_df(introns_to_genes))
+
+
     def load_introns(self):
         """
         Load introns.
@@ -573,44 +760,20 @@ class GeneTable:
             raise Exception, "Cannot find ensGene table %s" \
                 %(ensGene_filename)
         t1 = time.time()
-        table = dictread_groupby_col(open(ensGene_filename),
-                                     "name2",
-                                     delimiter="\t",
-                                     fieldnames=self.ensGene_header)
-        for gene_id, gene_entries in table.iteritems():
-            gene_symbol = self.na_val
-            all_transcripts = []
-            entries_copy = []
-            for entry in gene_entries:
-                entries_copy.append(entry)
-                chrom = entry["chrom"]
-                strand = entry["strand"]
-                # Convert start coordinates into 1-based coordinates
-                exon_starts = \
-                    (int(start) + 1 \
-                     for start in entry["exonStarts"].rstrip(",").split(","))
-                exon_ends = \
-                    (int(end) \
-                     for end in entry["exonEnds"].rstrip(",").split(","))
-                exon_coords = zip(exon_starts, exon_ends)
-                # Convert cds coordinates into 1-based as well
-                cds_start = int(entry["cdsStart"]) + 1
-                cds_end = int(entry["cdsEnd"])
-                transcript_id = entry["name"]
-                parts = [GeneModel.Part(exon[0], exon[1], chrom, strand,
-                                        parent=transcript_id) \
-                         for exon in exon_coords]
-                transcript = GeneModel.Transcript(parts, chrom, strand,
-                                                  label=transcript_id,
-                                                  cds_start=cds_start,
-                                                  cds_end=cds_end,
-                                                  parent=gene_id)
-                gene_symbol = self.trans_to_names[transcript_id]
-                all_transcripts.append(transcript)
-            gene_model = GeneModel.Gene(all_transcripts, chrom, strand,
-                                        label=gene_id,
-                                        gene_symbol=gene_symbol)
-            self.genes[gene_id] = gene_model
+        table = pandas.read_table(ensGene_filename,
+                                  sep=self.delimiter,
+                                  names=self.ensGene_header,
+                                  dtype={"chrom": str,
+                                         "name": str,
+                                         "name2": str,
+                                         "exonStarts": str,
+                                         "exonEnds": str})
+        # Gene models are kept as arrays; genes are views of them
+        self.gene_arrays = get_gene_arrays(table,
+                                           gene_symbols=self.trans_to_names)
+        for gene_num in xrange(self.gene_arrays.get_num_genes()):
+            gene_model = self.gene_arrays.get_gene(gene_num)
+            self.genes[gene_model.label] = gene_model
         t2 = time.time()
         print "Loading took %.2f secs" %(t2 - t1)
         return self.genes
@@ -705,7 +868,7 @@ class GeneTable:
                                               gene_id=gene_id)
             genes_to_exons = pandas.DataFrame(genes_to_exons)
             genes_to_exons.to_csv(genes_to_exons_fname,
-                                  cols=genes_to_exons_header,
+                                  columns=genes_to_exons_header,
                                   index=False,
                                   sep="\t")
             # Close out file to flush buffers
@@ -999,18 +1162,53 @@ class ConstExons:
 
     Consists of a GFF filename specifying the exons
     and a text file mapping genes to their constitutive exons.
+
+    The mapping is also compiled into a gene to exon index
+    (see compile_gene_index) in which exons are identified by
+    integer IDs, one per distinct exon coordinates.
+
+    - snapshot: if given, an ArraySnapshot in which the gene
+      index is saved, and from which it is loaded (memory-mapped)
+      instead of parsing the tables, as long as the tables have
+      not changed
     """
     def __init__(self, table_name,
-                 from_dir=None):
+                 from_dir=None,
+                 snapshot=None):
         self.table_name = table_name
         self.from_dir = from_dir
+        self.snapshot = snapshot
         self.gff_filename = None
         self.na_val = "NA"
         self.genes_to_exons_filename = None
+        # Stamp of the files the exons are loaded from
+        # (see array_snapshot.get_files_stamp)
+        self.source_stamp = None
         self.found = False
         # A list of genes to exons mapping
         self.genes_to_exons = []
         self.exon_lens = defaultdict(int)
+        # Distinct (strandless) exon coordinates, e.g. 'chr1:100-200',
+        # their 0-based, end-exclusive coordinates and lengths,
+        # indexed by exon ID
+        self.exon_ids_to_names = []
+        self.exon_chroms = None
+        self.exon_starts = None
+        self.exon_ends = None
+        self.exon_id_lens = None
+        # Strand of each exon ID (of the first exon seen with
+        # its coordinates)
+        self.exon_strands = None
+        # Mapping from each exon of the genes to exons table to
+        # its exon ID
+        self.exons_to_ids = {}
+        # Genes that have constitutive exons. The exon IDs of
+        # the i-th gene are gene_exon_ids[gene_offsets[i]:gene_offsets[i+1]]
+        self.gene_ids = []
+        self.gene_exons = []
+        self.gene_offsets = None
+        self.gene_exon_ids = None
+        self.gene_lens = None
         if from_dir is not None:
             self.load_const_exons()
 
@@ -1036,8 +1234,17 @@ class ConstExons:
             print "WARNING: Cannot find mapping from genes to constitutive " \
                 "exons for %s" %(self.table_name)
             return
-        # Load genes to exons mapping
-        self.load_genes_to_exons()
+        # Load genes to exons mapping, or the gene index
+        # compiled from it
+        stamp = array_snapshot.get_files_stamp([self.gff_filename,
+                                                self.genes_to_exons_filename])
+        self.source_stamp = stamp
+        if (self.snapshot is not None) and self.snapshot.is_current(stamp):
+            self.load_snapshot()
+        else:
+            self.load_genes_to_exons()
+            if self.snapshot is not None:
+                self.write_snapshot(stamp)
         self.found = True
 
 
@@ -1061,18 +1268,157 @@ class ConstExons:
                             exon_coords)
             for exon, exon_len in itertools.izip(exons, exon_lens):
                 self.exon_lens[exon] = exon_len
+        self.compile_gene_index()
+
+
+    def compile_gene_index(self):
+        """
+        Compile the genes to exons mapping into integer arrays
+        (in compressed sparse row layout), so that per-gene sums
+        over exons can be computed with a single numpy call.
+        """
+        exon_names_to_ids = {}
+        self.exon_ids_to_names = []
+        self.exons_to_ids = {}
+        exon_chroms = []
+        exon_starts = []
+        exon_ends = []
+        exon_strands = []
+        self.gene_ids = []
+        self.gene_exons = []
+        gene_offsets = [0]
+        gene_exon_ids = []
+        for entry in self.genes_to_exons:
+            if entry["exons"] == self.na_val:
+                continue
+            for exon in entry["exons"].split(","):
+                exon_name = get_strandless_exon(exon)
+                if exon_name not in exon_names_to_ids:
+                    chrom, coords = exon_name.split(":")
+                    start, end = map(int, coords.split("-"))
+                    exon_names_to_ids[exon_name] = len(self.exon_ids_to_names)
+                    self.exon_ids_to_names.append(exon_name)
+                    exon_chroms.append(chrom)
+                    # Convert to 0-based, end-exclusive coordinates
+                    exon_starts.append(start - 1)
+                    exon_ends.append(end)
+                    exon_strands.append(exon[-1])
+                self.exons_to_ids[exon] = exon_names_to_ids[exon_name]
+                gene_exon_ids.append(exon_names_to_ids[exon_name])
+            self.gene_ids.append(entry["gene_id"])
+            self.gene_exons.append(entry["exons"])
+            gene_offsets.append(len(gene_exon_ids))
+        self.exon_chroms = np.array(exon_chroms)
+        self.exon_starts = np.array(exon_starts, dtype=np.int64)
+        self.exon_ends = np.array(exon_ends, dtype=np.int64)
+        self.exon_id_lens = self.exon_ends - self.exon_starts
+        self.exon_strands = np.array(exon_strands)
+        self.gene_offsets = np.array(gene_offsets, dtype=np.int64)
+        self.gene_exon_ids = np.array(gene_exon_ids, dtype=np.int64)
+        self.gene_lens = self.sum_by_gene(self.exon_id_lens)
+
+
+    def write_snapshot(self, stamp):
+        """
+        Save the gene index to the snapshot.
+        """
+        print "Writing constitutive exons snapshot for %s" %(self.table_name)
+        print "  - Output dir: %s" %(self.snapshot.snapshot_dir)
+        arrays = {"gene_ids": np.array(self.gene_ids, dtype=str),
+                  "exon_ids_to_names": np.array(self.exon_ids_to_names,
+                                                dtype=str),
+                  "exon_chroms": np.array(self.exon_chroms, dtype=str),
+                  "exon_strands": np.array(self.exon_strands, dtype=str),
+                  "exon_starts": self.exon_starts,
+                  "exon_ends": self.exon_ends,
+                  "gene_offsets": self.gene_offsets,
+                  "gene_exon_ids": self.gene_exon_ids,
+                  "gene_lens": np.asarray(self.gene_lens, dtype=np.int64)}
+        self.snapshot.write(arrays, stamp,
+                            strings={"gene_exons": self.gene_exons})
+
+
+    def load_snapshot(self):
+        """
+        Load the gene index from the snapshot. The mapping from
+        exons to IDs is built when first asked for (see
+        get_exons_to_ids).
+        """
+        for name in ["gene_ids", "exon_ids_to_names", "exon_chroms",
+                     "exon_strands", "exon_starts", "exon_ends",
+                     "gene_offsets", "gene_exon_ids", "gene_lens"]:
+            setattr(self, name, self.snapshot.load_array(name))
+        self.exon_id_lens = self.exon_ends - self.exon_starts
+        self.gene_exons = self.snapshot.load_strings("gene_exons")
+
+
+    def get_exons_to_ids(self):
+        """
+        Return the mapping from each exon of the genes to exons
+        table to its exon ID.
+        """
+        if (len(self.exons_to_ids) == 0) and (len(self.gene_exon_ids) > 0):
+            exons = [exon for gene_exons in self.gene_exons \
+                     for exon in gene_exons.split(",")]
+            self.exons_to_ids = dict(itertools.izip(exons,
+                                                    self.gene_exon_ids.tolist()))
+        return self.exons_to_ids
+
+
+    def sum_by_gene(self, exon_values):
+        """
+        Sum values given per exon ID over the exons of each gene.
+
+        'exon_values' is an array indexed by exon ID, optionally
+        with one column per sample. Returns an array with one
+        row per gene (in the order of 'gene_ids').
+        """
+        if len(self.gene_ids) == 0:
+            return np.zeros((0,) + np.shape(exon_values)[1:])
+        return np.add.reduceat(np.asarray(exon_values)[self.gene_exon_ids],
+                               self.gene_offsets[0:-1],
+                               axis=0)
                 
 
     def __repr__(self):
-        return "ConstExons(table=%s, gff=%s, genes_to_exons=%d entries)" \
+        return "ConstExons(table=%s, gff=%s, genes=%d)" \
             %(self.table_name,
               self.gff_filename,
-              len(self.genes_to_exons))
+              len(self.gene_ids))
         
 
 ##
 ## Related table utilities
 ##
+def get_coords_df(coords_to_genes):
+    """
+    Return a DataFrame of coordinates, given a mapping from
+    (chrom, start, end, strand) to a set of gene IDs. Coordinates
+    are sorted and named as in constitutive exons tables
+    (e.g. 'chr1:101-200:+', with 1-based start).
+    """
+    coords = sorted(coords_to_genes.keys())
+    coords_df = pandas.DataFrame(coords,
+                                 columns=["chrom", "start", "end", "strand"])
+    coords_df["name"] = ["%s:%d-%d:%s" %(chrom, start + 1, end, strand) \
+                         for chrom, start, end, strand in coords]
+    coords_df["gene_id"] = [",".join(sorted(coords_to_genes[coord])) \
+                            for coord in coords]
+    return coords_df
+
+
+def get_strandless_exon(exon):
+    """
+    Return an exon without its strand and prefix, e.g.
+    'cds.chr1:100-200:+' -> 'chr1:100-200'.
+    """
+    strandless_exon = exon[0:-2]
+    if "." in strandless_exon:
+        # Strip off dot prefix if any is there
+        strandless_exon = strandless_exon.split(".")[1]
+    return strandless_exon
+
+
 def get_ucsc_database(genome):
     return "%s/%s/database" %(UCSC_GOLDENPATH,
                               genome)
@@ -1291,7 +1637,8 @@ def process_ucsc_tables(genome, output_dir,
     for table_name in table_names:
         table = GeneTable(tables_outdir, table_name,
                           params=init_params,
-                          headers=headers)
+                          headers=headers,
+                          output_combined=True)
         # Output the table's exons as GFF
         table.output_exons_as_gff()
         # Output the table's CDS-only exons as GFF
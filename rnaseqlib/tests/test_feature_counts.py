@@ -0,0 +1,122 @@
+##
+## Unit testing for exon and junction counting
+##
+import os
+import sys
+import time
+
+import pandas
+import pysam
+
+import rnaseqlib
+import rnaseqlib.rpkm.feature_counts as feature_counts
+
+
+def make_read(pos, cigar):
+    read = pysam.AlignedRead()
+    read.qname = "read"
+    read.tid = 0
+    read.pos = pos
+    read.cigar = cigar
+    return read
+
+
+def make_mate(qname, pos, cigar, mate_pos,
+              is_read2=False,
+              is_reverse=False):
+    read = make_read(pos, cigar)
+    read.qname = qname
+    read.is_paired = True
+    read.is_read2 = is_read2
+    read.is_reverse = is_reverse
+    read.rnext = 0
+    read.pnext = mate_pos
+    return read
+
+
+def test_count_features():
+    exons_df = pandas.DataFrame({"chrom": ["chr1", "chr1", "chr1"],
+                                 "start": [100, 500, 900],
+                                 "end": [200, 600, 1000]})
+    introns_df = pandas.DataFrame({"chrom": ["chr1", "chr1"],
+                                   "start": [200, 600],
+                                   "end": [500, 900]})
+    counter = feature_counts.get_feature_counter(exons_df, introns_df)
+    # Spliced read across the first junction
+    counter.add_read("chr1", make_read(180, [(0, 20), (3, 300), (0, 20)]))
+    # Read spliced from the first to the last exon (not annotated)
+    counter.add_read("chr1", make_read(190, [(0, 10), (3, 700), (0, 10)]))
+    # Read with a deletion, in the second exon
+    counter.add_read("chr1", make_read(520, [(0, 10), (2, 5), (0, 10)]))
+    # Read on a chromosome with no features
+    counter.add_read("chr2", make_read(100, [(0, 20)]))
+    counter.flush()
+    counts = counter.get_counts()
+    assert list(counts["exons"]) == [2, 2, 1]
+    assert list(counts["junctions"]) == [1, 0]
+    assert counter.num_novel_junctions == 1
+
+
+def test_count_overlapping_exons():
+    # Exons with alternative 3' splice sites
+    exons_df = pandas.DataFrame({"chrom": ["chr1", "chr1"],
+                                 "start": [100, 100],
+                                 "end": [200, 250]})
+    introns_df = pandas.DataFrame({"chrom": ["chr1"],
+                                   "start": [250],
+                                   "end": [500]})
+    counter = feature_counts.get_feature_counter(exons_df, introns_df)
+    # Read in both exons
+    counter.add_read("chr1", make_read(120, [(0, 30)]))
+    # Read in the longer exon only
+    counter.add_read("chr1", make_read(210, [(0, 30)]))
+    counter.flush()
+    assert list(counter.get_counts()["exons"]) == [1, 2]
+
+
+def test_count_paired_features():
+    exons_df = pandas.DataFrame({"chrom": ["chr1", "chr1", "chr1"],
+                                 "start": [100, 500, 900],
+                                 "end": [200, 600, 1000],
+                                 "strand": ["+", "+", "-"]})
+    introns_df = pandas.DataFrame({"chrom": ["chr1", "chr1"],
+                                   "start": [200, 600],
+                                   "end": [500, 900],
+                                   "strand": ["+", "-"]})
+    reads = [# Overlapping mates that both span the first junction
+             make_mate("a", 180, [(0, 20), (3, 300), (0, 20)], 190),
+             make_mate("a", 190, [(0, 10), (3, 300), (0, 30)], 180,
+                       is_read2=True, is_reverse=True),
+             # Mates in the second and third exons
+             make_mate("b", 550, [(0, 20)], 950),
+             make_mate("b", 950, [(0, 20)], 550,
+                       is_read2=True, is_reverse=True)]
+    counter = feature_counts.get_feature_counter(exons_df, introns_df,
+                                                 paired=True)
+    for read in reads:
+        counter.add_read("chr1", read)
+    counter.flush()
+    counts = counter.get_counts()
+    # Each fragment is counted once per feature
+    assert list(counts["exons"]) == [1, 2, 1]
+    assert list(counts["junctions"]) == [1, 0]
+    # Fragments are only counted in features on their strand
+    counter = feature_counts.get_feature_counter(exons_df, introns_df,
+                                                 paired=True,
+                                                 stranded="fr-secondstrand")
+    for read in reads:
+        counter.add_read("chr1", read)
+    counter.flush()
+    counts = counter.get_counts()
+    assert list(counts["exons"]) == [1, 2, 0]
+    assert list(counts["junctions"]) == [1, 0]
+
+
+def main():
+    test_count_features()
+    test_count_overlapping_exons()
+    test_count_paired_features()
+
+
+if __name__ == "__main__":
+    main()
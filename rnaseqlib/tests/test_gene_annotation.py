@@ -0,0 +1,53 @@
+##
+## Unit testing for gene annotation snapshots
+##
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import rnaseqlib
+import rnaseqlib.genes.gene_annotation as gene_annotation
+
+
+def test_gene_annotation():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        snapshot_dir = os.path.join(tmp_dir, "ensGene.annotation")
+        source_stamp = gene_annotation.get_source_stamp(tmp_dir, "ensGene")
+        assert not gene_annotation.is_snapshot_current(snapshot_dir,
+                                                       source_stamp)
+        gene_annotation.write_gene_annotation(snapshot_dir,
+                                              ["ENSG2", "ENSG1", "ENSG3"],
+                                              {"symbol": ["B", "A", "NA"],
+                                               "desc": ["gene b", "", "NA"],
+                                               "exons": ["chr1:1-10:+",
+                                                         "chr2:5-8:-",
+                                                         "NA"]},
+                                              source_stamp)
+        assert gene_annotation.is_snapshot_current(snapshot_dir,
+                                                   source_stamp)
+        annotation = gene_annotation.GeneAnnotation(snapshot_dir)
+        assert annotation.get_symbols(["ENSG1", "ENSG2", "ENSG4"]) == \
+               ["A", "B", "NA"]
+        assert annotation.get_descs(["ENSG2", "ENSG1"]) == ["gene b", ""]
+        assert annotation.genes_to_names["ENSG0"] == "NA"
+        assert annotation.genes_to_exons["ENSG1"] == "chr2:5-8:-"
+        assert "ENSG3" in annotation.genes_to_names
+        # Snapshots are rebuilt when the UCSC tables change
+        with open(os.path.join(tmp_dir, "ensGene.txt"), "w") as table_file:
+            table_file.write("\n")
+        assert not gene_annotation.is_snapshot_current(snapshot_dir,
+                                                       gene_annotation.get_source_stamp(tmp_dir,
+                                                                                        "ensGene"))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def main():
+    test_gene_annotation()
+
+
+if __name__ == "__main__":
+    main()
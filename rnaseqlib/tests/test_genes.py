@@ -51,6 +51,54 @@ class TestGenes:
             print "  - cds_const_exons: ", cds_const_exons
 
 
+def test_gene_arrays():
+    """
+    Test gene models made from Part objects against their arrays.
+    """
+    exon_coords = [[(100, 200), (300, 400), (500, 600)],
+                   [(100, 200), (303, 400), (700, 800)],
+                   [(100, 200), (500, 600)]]
+    transcripts = []
+    for trans_num, coords in enumerate(exon_coords):
+        trans_id = "t%d" %(trans_num)
+        parts = [gene_model.Part(start, end, "chr1", "+", parent=trans_id) \
+                 for start, end in coords]
+        transcripts.append(gene_model.Transcript(parts, "chr1", "+",
+                                                 label=trans_id,
+                                                 cds_start=150,
+                                                 cds_end=550,
+                                                 parent="g1"))
+    gene = gene_model.Gene(transcripts, "chr1", "+", label="g1")
+    assert len(gene.parts) == 8
+    assert [(p.start, p.end) for p in gene.get_parts()] == \
+           [(100, 200), (300, 400), (500, 600), (303, 400), (700, 800)]
+    # UTR containing exons are trimmed to the CDS
+    assert [p.label for p in transcripts[0].get_cds_parts()] == \
+           ["cds.chr1:150-200:+", "cds.chr1:300-400:+", "cds.chr1:500-550:+"]
+    assert [p.label for p in gene.cds_parts[0:3]] == \
+           [p.label for p in transcripts[0].cds_parts]
+    # CDS within a single exon
+    transcript = gene_model.Transcript(transcripts[0].parts, "chr1", "+",
+                                       cds_start=320,
+                                       cds_end=380)
+    assert [(p.start, p.end) for p in transcript.cds_parts] == [(320, 380)]
+    assert transcript.get_cds_parts(min_cds_len=100) == []
+    assert transcripts[1].has_part(gene_model.Part(300, 400), base_diff=3)
+    assert not transcripts[1].has_part(gene_model.Part(300, 400))
+    const_exons, frac_str = gene.compute_const_exons(base_diff=6)
+    assert [(p.start, p.end) for p in const_exons] == [(100, 200)]
+    assert frac_str == "1.00"
+    const_exons, frac_str = gene.compute_const_exons(base_diff=0)
+    assert [(p.start, p.end) for p in const_exons] == [(100, 200)]
+    cds_exons, frac_str = gene.compute_const_exons(cds_only=True,
+                                                   min_exon_space=100)
+    assert [p.label for p in cds_exons] == \
+           ["cds.chr1:150-200:+", "cds.chr1:300-400:+"]
+    assert frac_str == "1.00,0.67"
+    assert gene.get_inclusive_trans_coords() == [100, 800]
+
+
 if __name__ == "__main__":
     test_g = TestGenes()
     test_g.test_const_exons()
+    test_gene_arrays()
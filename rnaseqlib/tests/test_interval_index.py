@@ -0,0 +1,155 @@
+##
+## Unit testing for interval index and region counting
+##
+import os
+import sys
+import time
+import tempfile
+import shutil
+
+import numpy as np
+
+import pysam
+
+import rnaseqlib
+import rnaseqlib.array_snapshot as array_snapshot
+import rnaseqlib.mapping.interval_index as interval_index
+
+
+def make_read(qname, tid, pos, cigar):
+    read = pysam.AlignedRead()
+    read.qname = qname
+    read.tid = tid
+    read.pos = pos
+    read.cigar = cigar
+    read_len = sum([l for op, l in cigar if op in (0, 1, 4)])
+    read.seq = "A" * read_len
+    read.qual = "I" * read_len
+    read.mapq = 50
+    return read
+
+
+def make_test_bam(output_dir, reads):
+    header = {"HD": {"VN": "1.0", "SO": "coordinate"},
+              "SQ": [{"SN": "chr1", "LN": 100000},
+                     {"SN": "chr2", "LN": 100000}]}
+    bam_filename = os.path.join(output_dir, "test.bam")
+    bam_out = pysam.Samfile(bam_filename, "wb", header=header)
+    for read in sorted(reads, key=lambda read: (read.tid, read.pos)):
+        bam_out.write(read)
+    bam_out.close()
+    return bam_filename
+
+
+def test_find_containing():
+    index = interval_index.IntervalIndex()
+    # Interval 1 contains interval 2
+    index.add_intervals(["chr1", "chr1", "chr1", "chr2"],
+                        [500, 100, 150, 100],
+                        [600, 300, 200, 200])
+    hits = index.find_containing("chr1",
+                                 [100, 160, 250, 290, 550, 50],
+                                 [120, 190, 300, 310, 600, 80])
+    assert list(hits) == [1, 1, 1, -1, 0, -1]
+    assert list(index.find_containing("chr2", [150], [160])) == [3]
+    assert list(index.find_containing("chr3", [150], [160])) == [-1]
+    assert list(index.get_lens()) == [100, 200, 50, 100]
+
+
+def test_find_all_containing():
+    index = interval_index.IntervalIndex()
+    # Interval 1 contains interval 2; interval 3 overlaps interval 1
+    index.add_intervals(["chr1", "chr1", "chr1", "chr1"],
+                        [500, 100, 150, 100],
+                        [600, 300, 200, 250])
+    queries, ids = index.find_all_containing("chr1",
+                                             [160, 250, 290, 550, 50],
+                                             [190, 300, 310, 600, 80])
+    assert list(queries) == sorted(queries)
+    assert sorted(zip(queries, ids)) == [(0, 1), (0, 2), (0, 3), (1, 1), (3, 0)]
+    queries, ids = index.find_all_containing("chr3", [150], [160])
+    assert len(queries) == 0 and len(ids) == 0
+
+
+def test_indexes_snapshot():
+    index = interval_index.IntervalIndex(label="exons")
+    index.add_intervals(["chr1", "chr1", "chr2"],
+                        [500, 100, 100],
+                        [600, 300, 200],
+                        names=["a", "b", "c"])
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        snapshot = array_snapshot.ArraySnapshot(os.path.join(tmp_dir,
+                                                             "regions"))
+        assert not snapshot.is_current("stamp")
+        interval_index.write_indexes_snapshot(snapshot, ["exons"], [index],
+                                              "stamp")
+        assert snapshot.is_current("stamp")
+        labels, indexes = interval_index.load_indexes_snapshot(snapshot)
+        assert labels == ["exons"]
+        hits = indexes[0].find_containing("chr1", [150, 520, 350], [200, 580, 400])
+        assert list(hits) == [1, 0, -1]
+        assert list(indexes[0].names) == ["a", "b", "c"]
+        assert list(indexes[0].get_lens()) == [100, 200, 100]
+        # Rewriting the snapshot does not affect a loader that
+        # already started reading it
+        loader = array_snapshot.ArraySnapshot(snapshot.snapshot_dir)
+        assert loader.is_current("stamp")
+        interval_index.write_indexes_snapshot(snapshot, ["exons"], [index],
+                                              "new_stamp")
+        assert snapshot.is_current("new_stamp")
+        assert loader.is_current("stamp")
+        assert list(interval_index.load_indexes_snapshot(loader)[0]) == ["exons"]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_count_reads_in_regions():
+    exons = interval_index.IntervalIndex(label="exons")
+    exons.add_intervals(["chr1", "chr1"], [100, 1000], [200, 1100])
+    introns = interval_index.IntervalIndex(label="introns")
+    introns.add_intervals(["chr1"], [200], [1000])
+    reads = [# Exonic read
+             make_read("r1", 0, 110, [(0, 30)]),
+             # Junction read spanning the two exons
+             make_read("r2", 0, 180, [(0, 20), (3, 800), (0, 20)]),
+             # Intronic read
+             make_read("r3", 0, 500, [(0, 30)]),
+             # Read overlapping exon-intron boundary
+             make_read("r4", 0, 190, [(0, 30)]),
+             # Read on chromosome with no regions
+             make_read("r5", 1, 190, [(0, 30)])]
+    output_dir = tempfile.mkdtemp()
+    try:
+        bam_filename = make_test_bam(output_dir, reads)
+        counter = interval_index.RegionCounter(["exons", "introns"],
+                                               [exons, introns],
+                                               chunk_size=2)
+        region_counts = counter.count_bam(bam_filename)
+        # Count the indexed BAM by region, with tiles small enough
+        # that reads cross their borders
+        pysam.index(bam_filename)
+        counter = interval_index.RegionCounter(["exons", "introns"],
+                                               [exons, introns])
+        parallel_counts = counter.count_bam(bam_filename,
+                                            num_processes=2,
+                                            tile_size=150)
+    finally:
+        shutil.rmtree(output_dir)
+    for counts in [region_counts, parallel_counts]:
+        assert counts.num_reads == 5
+        assert counts.num_junctions == 1
+        assert list(counts.mask_counts) == [2, 2, 1, 0]
+        assert list(counts.interval_counts["exons"]) == [2, 1]
+        assert list(counts.interval_counts["introns"]) == [1]
+
+
+def main():
+    test_find_containing()
+    test_find_all_containing()
+    test_indexes_snapshot()
+    test_count_reads_in_regions()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+##
+## Unit testing for streaming mate pairing
+##
+import os
+import sys
+import time
+
+import rnaseqlib
+import rnaseqlib.bam.mate_pairs as mate_pairs
+
+
+class FakeRead:
+    """
+    Minimal paired-end alignment.
+    """
+    def __init__(self, qname, pos, pnext,
+                 tid=0,
+                 is_read2=False,
+                 is_reverse=False,
+                 mate_is_unmapped=False):
+        self.qname = qname
+        self.tid = tid
+        self.pos = pos
+        self.rnext = tid
+        self.pnext = pnext
+        self.is_paired = True
+        self.is_read2 = is_read2
+        self.is_reverse = is_reverse
+        self.mate_is_unmapped = mate_is_unmapped
+
+
+def run_pairing(reads, **kwargs):
+    mate_buffer = mate_pairs.MateBuffer(**kwargs)
+    fragments = []
+    for read in reads:
+        fragments.extend(mate_buffer.add(read))
+    fragments.extend(mate_buffer.flush())
+    return mate_buffer, [[read.qname for read in fragment] \
+                         for fragment in fragments]
+
+
+def test_mate_pairing():
+    reads = [FakeRead("a", 100, 300),
+             FakeRead("b", 150, 150),
+             FakeRead("b", 150, 150, is_read2=True),
+             # Mate of c was filtered out
+             FakeRead("c", 200, 250),
+             FakeRead("d", 220, 0, mate_is_unmapped=True),
+             FakeRead("a", 300, 100, is_read2=True),
+             FakeRead("e", 10, 10, tid=1)]
+    mate_buffer, fragments = run_pairing(reads)
+    assert fragments == [["b", "b"], ["d"], ["c"], ["a", "a"], ["e"]]
+    assert mate_buffer.num_pairs == 2
+    assert mate_buffer.num_unpaired == 3
+    # With no room to wait, mates form fragments of their own
+    mate_buffer, fragments = \
+        run_pairing([FakeRead("x", 10, 50),
+                     FakeRead("y", 20, 60),
+                     FakeRead("x", 50, 10, is_read2=True),
+                     FakeRead("y", 60, 20, is_read2=True)],
+                    max_pending=1)
+    assert fragments == [["x"], ["x"], ["y", "y"]]
+    assert mate_buffer.num_early_releases == 1
+
+
+def test_fragment_strand():
+    read1 = FakeRead("a", 100, 300, is_reverse=True)
+    read2 = FakeRead("a", 300, 100, is_read2=True)
+    for read in [read1, read2]:
+        assert mate_pairs.get_fragment_strand(read, True) == "+"
+        assert mate_pairs.get_fragment_strand(read, False) == "-"
+    assert mate_pairs.parse_strand_convention("fr-first") == True
+    assert mate_pairs.parse_strand_convention("fr-unstranded") is None
+    assert mate_pairs.parse_strand_convention("\"fr-second\"") == False
+    # Unknown conventions are not strand-specific
+    assert mate_pairs.parse_strand_convention("\"fa\"") is None
+
+
+def main():
+    test_mate_pairing()
+    test_fragment_strand()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+##
+## Unit testing for expression normalization
+##
+import os
+import sys
+import time
+
+import numpy as np
+import pandas
+
+import rnaseqlib
+import rnaseqlib.rpkm.normalization as normalization
+import rnaseqlib.rpkm.rpkm_utils as rpkm_utils
+
+
+def get_biased_counts():
+    """
+    Counts of two samples where a tenth of the genes are 8-fold
+    higher in the second sample, and the rest are unchanged.
+    """
+    rand = np.random.RandomState(1)
+    expression = rand.gamma(0.5, 200, size=20000)
+    fold_changes = np.ones(len(expression))
+    fold_changes[0:2000] = 8
+    return np.column_stack([rand.poisson(expression),
+                            rand.poisson(expression * fold_changes)])
+
+
+def test_norm_factors():
+    counts = get_biased_counts()
+    lib_sizes = counts.sum(axis=0)
+    for method in ["tmm", "median_of_ratios"]:
+        norm_factors = normalization.compute_norm_factors(counts,
+                                                          method=method)
+        assert np.allclose(np.prod(norm_factors), 1)
+        # Effective library sizes match for the unchanged genes
+        effective_sizes = lib_sizes * norm_factors
+        assert abs(np.log2(effective_sizes[1] / effective_sizes[0])) < 0.1
+    # Identical samples are not rescaled
+    assert np.allclose(normalization.compute_tmm_factors(counts[:, [0, 0]]),
+                       [1, 1])
+
+
+def test_tpm():
+    counts = np.array([[10, 0], [20, 5]])
+    lens = np.array([[1000.], [2000.]])
+    tpms = normalization.compute_tpm(counts, lens)
+    assert np.allclose(tpms, [[5e5, 0], [5e5, 1e6]])
+
+
+def test_normalized_rpkms():
+    counts = get_biased_counts()
+    # Mapped reads include reads outside of genes
+    num_mapped = counts.sum(axis=0) * np.array([2, 3])
+    gene_kb = 2.
+    rpkm_table = pandas.DataFrame({"rpkm_a": counts[:, 0] / gene_kb / \
+                                             (num_mapped[0] / 1e6),
+                                   "rpkm_b": counts[:, 1] / gene_kb / \
+                                             (num_mapped[1] / 1e6),
+                                   "counts_a": counts[:, 0],
+                                   "counts_b": counts[:, 1]})
+    rpkm_utils.add_normalized_rpkms(rpkm_table, ["a", "b"], num_mapped)
+    unchanged = rpkm_table[2000:]
+    expressed = (unchanged["counts_a"] > 50) & (unchanged["counts_b"] > 50)
+    log_ratios = np.log2(unchanged["norm_rpkm_b"][expressed] / \
+                         unchanged["norm_rpkm_a"][expressed])
+    assert abs(np.median(log_ratios)) < 0.1
+
+
+def test_ma_lowess():
+    rand = np.random.RandomState(2)
+    values = rand.gamma(1, 50, size=5000) + 1
+    # Intensity-dependent bias in the second sample
+    biased_values = values * 2**(0.5 * np.sin(np.log2(values)))
+    normed = normalization.compute_ma_lowess(np.column_stack([values,
+                                                              biased_values,
+                                                              values]))
+    log_ratios = np.log2(normed[:, 1] / normed[:, 0])
+    assert np.median(np.abs(log_ratios)) < 0.1
+    normed_x, normed_y = \
+        normalization.compute_ma_lowess_pair(values, biased_values)
+    assert np.median(np.abs(np.log2(normed_x / normed_y))) < 0.1
+
+
+def main():
+    test_norm_factors()
+    test_tpm()
+    test_normalized_rpkms()
+    test_ma_lowess()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+##
+## Unit testing for streaming duplicate removal
+##
+import os
+import sys
+import time
+
+import rnaseqlib
+import rnaseqlib.bam.rmdups as rmdups
+
+
+class FakeRead:
+    """
+    Minimal single-end alignment.
+    """
+    def __init__(self, qname, tid, pos, aend,
+                 is_reverse=False,
+                 mapq=255):
+        self.qname = qname
+        self.tid = tid
+        self.pos = pos
+        self.aend = aend
+        self.is_reverse = is_reverse
+        self.is_unmapped = False
+        self.mapq = mapq
+
+
+def run_dedup(reads, **kwargs):
+    dedup = rmdups.StreamingDeduplicator(**kwargs)
+    kept_reads = []
+    for read in reads:
+        kept_reads.extend(dedup.add(read))
+    kept_reads.extend(dedup.flush())
+    return dedup, [read.qname for read in kept_reads]
+
+
+def test_streaming_dedup():
+    reads = [FakeRead("a", 0, 100, 130),
+             # Same 5' end on the other strand: not a duplicate
+             FakeRead("b", 0, 100, 130, is_reverse=True, mapq=1),
+             FakeRead("c", 0, 100, 125),
+             # Reverse reads with the same 5' end as b: the one
+             # with the best mapping quality is kept
+             FakeRead("d", 0, 110, 130, is_reverse=True, mapq=3),
+             FakeRead("e", 0, 115, 130, is_reverse=True, mapq=50),
+             FakeRead("f", 0, 120, 150),
+             FakeRead("g", 1, 100, 130)]
+    dedup, kept = run_dedup(reads)
+    # Kept reads come out in coordinate order
+    assert kept == ["a", "e", "f", "g"]
+    assert dedup.get_counts() == {"num_alignments": 7,
+                                  "num_duplicates": 3}
+
+
+def test_umi_dedup():
+    reads = [FakeRead("r1_ACGT", 0, 100, 130),
+             FakeRead("r2_ACGT", 0, 100, 130),
+             FakeRead("r3_TTTT", 0, 100, 130)]
+    dedup, kept = run_dedup(reads, umi_regex="_([ACGTN]+)$")
+    assert kept == ["r1_ACGT", "r3_TTTT"]
+    # Small window: duplicates released early are kept
+    dedup, kept = run_dedup([FakeRead("x", 0, 10, 100, is_reverse=True),
+                             FakeRead("y", 0, 20, 60, is_reverse=True),
+                             FakeRead("z", 0, 30, 60, is_reverse=True)],
+                            max_window=1)
+    assert kept == ["x", "y", "z"]
+    assert dedup.num_early_releases == 2
+
+
+def main():
+    test_streaming_dedup()
+    test_umi_dedup()
+
+
+if __name__ == "__main__":
+    main()
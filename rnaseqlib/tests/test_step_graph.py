@@ -0,0 +1,144 @@
+##
+## Unit testing for pipeline step graph
+##
+import os
+import sys
+import time
+import json
+import subprocess
+import tempfile
+import shutil
+import logging
+import threading
+
+import rnaseqlib
+import rnaseqlib.step_graph as step_graph
+
+
+def test_step_caching():
+    output_dir = tempfile.mkdtemp()
+    logger = logging.getLogger("test_step_graph")
+    try:
+        input_fname = os.path.join(output_dir, "input.txt")
+        output_fname = os.path.join(output_dir, "output.txt")
+        with open(input_fname, "w") as input_file:
+            input_file.write("a\n")
+        runs = []
+        def make_output():
+            runs.append(1)
+            with open(output_fname, "w") as output_file:
+                output_file.write(open(input_fname).read())
+        def run_graph(params):
+            graph = step_graph.StepGraph(os.path.join(output_dir, "steps"),
+                                         logger)
+            return graph.run_step(step_graph.Step("copy", make_output,
+                                                  inputs=[input_fname],
+                                                  outputs=[output_fname],
+                                                  params=params))
+        assert run_graph({"n": 1})
+        # Up to date: skipped
+        assert not run_graph({"n": 1})
+        # Parameter change triggers a rerun
+        assert run_graph({"n": 2})
+        # Output made before steps were recorded is adopted
+        record_fname = os.path.join(output_dir, "steps", "copy.json")
+        os.remove(record_fname)
+        assert not run_graph({"n": 2})
+        # Output left by an interrupted run is rebuilt
+        with open(record_fname) as record_file:
+            record = json.load(record_file)
+        record["status"] = "running"
+        with open(record_fname, "w") as record_file:
+            json.dump(record, record_file)
+        assert run_graph({"n": 2})
+        assert len(runs) == 3
+    finally:
+        shutil.rmtree(output_dir)
+
+
+def test_step_failure():
+    output_dir = tempfile.mkdtemp()
+    logger = logging.getLogger("test_step_graph")
+    try:
+        output_fname = os.path.join(output_dir, "output.txt")
+        def fail_with_output():
+            with open(output_fname, "w") as output_file:
+                output_file.write("truncated")
+            subprocess.check_call("exit 1", shell=True)
+        graph = step_graph.StepGraph(os.path.join(output_dir, "steps"),
+                                     logger)
+        try:
+            graph.run_step(step_graph.Step("fail", fail_with_output,
+                                           outputs=[output_fname]))
+            assert False, "Failed step should raise."
+        except subprocess.CalledProcessError:
+            pass
+        # Partial output is removed, not recorded as done
+        assert not os.path.exists(output_fname)
+        # Output written to its partial file is moved into place
+        def make_partial_output():
+            partial_fname = step_graph.get_partial_filename(output_fname)
+            with open(partial_fname, "w") as output_file:
+                output_file.write("done")
+        assert graph.run_step(step_graph.Step("partial",
+                                              make_partial_output,
+                                              outputs=[output_fname]))
+        assert open(output_fname).read() == "done"
+        assert not os.path.exists(step_graph.get_partial_filename(output_fname))
+    finally:
+        shutil.rmtree(output_dir)
+
+
+def test_step_order():
+    output_dir = tempfile.mkdtemp()
+    logger = logging.getLogger("test_step_graph")
+    try:
+        graph = step_graph.StepGraph(output_dir, logger, num_workers=3)
+        order = []
+        graph.add_step(step_graph.Step("c", lambda: order.append("c"),
+                                       deps=["a", "b"]))
+        graph.add_step(step_graph.Step("a", lambda: order.append("a")))
+        graph.add_step(step_graph.Step("b", lambda: order.append("b"),
+                                       deps=["a"]))
+        graph.run()
+        assert order == ["a", "b", "c"]
+    finally:
+        shutil.rmtree(output_dir)
+
+
+def test_exclusive_steps():
+    output_dir = tempfile.mkdtemp()
+    logger = logging.getLogger("test_step_graph")
+    try:
+        graph = step_graph.StepGraph(output_dir, logger, num_workers=4)
+        running = []
+        overlaps = []
+        threads = {}
+        def run(name):
+            running.append(name)
+            time.sleep(0.05)
+            overlaps.append((name, len(running)))
+            threads[name] = threading.current_thread()
+            running.remove(name)
+        for name in ["a", "b", "c"]:
+            graph.add_step(step_graph.Step(name,
+                                           lambda name=name: run(name),
+                                           exclusive=(name == "b")))
+        graph.run()
+        # The exclusive step ran alone, in the calling thread
+        assert dict(overlaps)["b"] == 1
+        assert threads["b"] is threading.current_thread()
+        assert threads["a"] is not threading.current_thread()
+    finally:
+        shutil.rmtree(output_dir)
+
+
+def main():
+    test_step_caching()
+    test_step_failure()
+    test_step_order()
+    test_exclusive_steps()
+
+
+if __name__ == "__main__":
+    main()
@@ -69,10 +69,10 @@ setup(name = 'rnaseqlib',
       install_requires = [
 #          "matplotlib >= 1.1.0",
           "matplotlib",
-          "numpy >= 1.5.0",
+          "numpy >= 1.9.0",
           "pysam >= 0.6.0",
           "misopy >= 0.4.6",
-          "pandas >= 0.8.1",
+          "pandas >= 0.17.0",
           # pybedtools
           "pybedtools",
           "cutadapt",